@@ -0,0 +1,136 @@
+import argparse
+import os
+import random
+import tempfile
+import time
+from twisted.internet.testing import StringTransport
+from client_pkg.protocol import SyncClientProtocol
+from server_pkg.protocol import SyncFactory
+from common_pkg.framing import Frame, FLAG_DIRECTORY, MSG_CREATED
+
+
+def make_tree(folder, files, files_per_directory, max_size, rng):
+    """
+    Build a folder of many small files, like an extracted source tarball.
+
+    :param folder: the folder to create the files in (string)
+    :param files: the number of files (int)
+    :param files_per_directory: the number of files in each directory (int)
+    :param max_size: the biggest file size (int)
+    :param rng: the random generator to use (random.Random)
+
+    :return: the events watchdog would emit for the extraction, in order (list of (event type, relative path) tuples)
+    """
+
+    events = []
+    for index in range(files):
+        directory = f"./src/module{index // files_per_directory // 10}/package{index // files_per_directory}"
+        if index % files_per_directory == 0:
+            os.makedirs(os.path.join(folder, directory), exist_ok=True)
+            events.append(("directory", directory))
+
+        path = f"{directory}/file{index}.py"
+        with open(os.path.join(folder, path), "wb") as fh:
+            fh.write(b"# generated\n" * rng.randint(0, max_size // 12))
+        events.append(("created", path))
+        events.append(("modified", path))
+
+    return events
+
+
+def exchange(client, server):
+    """
+    Move the written data between the client and the server until neither of them has anything to send.
+
+    :param client: the client protocol (SyncClientProtocol)
+    :param server: the server protocol (SyncServerProtocol)
+
+    :return: the number of bytes sent in both directions (int)
+    """
+
+    sent = 0
+    while True:
+        # the reactor isn't running, continue transfers which would be resumed in the next reactor iteration and send
+        # the batch whose latency budget would be used up
+        if any(not transfer.waiting for transfer in client.queue.streams.values()):
+            client.queue.pump()
+        if client.queue.batch and not client.queue.items:
+            client.queue.send_batch()
+
+        upstream = client.transport.value()
+        downstream = server.transport.value()
+        if not upstream and not downstream and not client.queue.streams:
+            return sent
+
+        client.transport.clear()
+        server.transport.clear()
+        sent += len(upstream) + len(downstream)
+
+        server.dataReceived(upstream)
+        client.dataReceived(downstream)
+
+
+def run(client_folder, events, batch):
+    """
+    Replay the events of an extraction to a server with an empty folder.
+
+    :param client_folder: the folder the files have been extracted to (string)
+    :param events: the events of the extraction (list of (event type, relative path) tuples)
+    :param batch: True to pack the operations and small files in batch messages (bool)
+
+    :return: a tuple of three values - messages received by the server, bytes on the wire and wall time in seconds
+    """
+
+    with tempfile.TemporaryDirectory() as server_folder:
+        server = SyncFactory(server_folder).buildProtocol(None)
+        server.makeConnection(StringTransport())
+        client = SyncClientProtocol(compression=[])
+        client.makeConnection(StringTransport())
+        exchange(client, server)  # negotiation
+
+        if not batch:
+            client.features.discard("batch")
+        messages = server.session.messages_received
+
+        sent = 0
+        start = time.perf_counter()
+        for event_type, path in events:
+            if event_type == "directory":
+                client.queue.put_frame(Frame(MSG_CREATED, FLAG_DIRECTORY, path.encode("utf-8"), b""))
+            elif event_type == "created":
+                client.queue.put_frame(Frame(MSG_CREATED, 0, path.encode("utf-8"), b""))
+            else:
+                client.queue.put_file(path, os.path.join(client_folder, path))
+
+            # the events arrive while the previous ones are being sent
+            if len(client.transport.value()) >= 64 * 1024:
+                sent += exchange(client, server)
+        sent += exchange(client, server)
+        elapsed = time.perf_counter() - start
+
+        for event_type, path in events:
+            if event_type == "modified":
+                with open(os.path.join(client_folder, path), "rb") as fh, \
+                        open(os.path.join(server_folder, path), "rb") as server_fh:
+                    assert fh.read() == server_fh.read(), f"Server copy of {path} doesn't match the client copy"
+
+        return server.session.messages_received - messages, sent, elapsed
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Compare batch messages with sending every operation on its own when "
+                                                 "replaying the extraction of many small files.")
+    parser.add_argument("--files", type=int, default=20000, help="number of extracted files")
+    parser.add_argument("--per-directory", type=int, default=50, help="number of files in each directory")
+    parser.add_argument("--max-size", type=int, default=8192, help="biggest file size in bytes")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the random generator")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        events = make_tree(folder, args.files, args.per_directory, args.max_size, random.Random(args.seed))
+
+        print(f"{'mode':>8} {'messages':>9} {'bytes on wire':>14} {'wall time (s)':>14} {'files/s':>9}")
+        for mode in ("single", "batch"):
+            messages, sent, elapsed = run(folder, events, mode == "batch")
+            print(f"{mode:>8} {messages:>9} {sent:>14} {elapsed:>14.3f} {args.files / elapsed:>9.0f}")
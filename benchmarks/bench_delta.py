@@ -0,0 +1,118 @@
+import argparse
+import os
+import random
+import tempfile
+import time
+from twisted.internet.testing import StringTransport
+from client_pkg.protocol import SyncClientProtocol
+from server_pkg.protocol import SyncFactory
+
+
+# the size of a single edit when a part of the file is changed
+EDIT_SIZE = 512
+
+
+def make_versions(size, ratio, rng):
+    """
+    Build an old and a new version of a file.
+
+    :param size: the size of the file (int)
+    :param ratio: the part of the file which is changed, between 0 and 1 (float)
+    :param rng: the random generator to use (random.Random)
+
+    :return: a tuple of two values - the old and the new content (bytes)
+    """
+
+    old = rng.getrandbits(size * 8).to_bytes(size, "little")
+    if ratio >= 1:
+        return old, rng.getrandbits(size * 8).to_bytes(size, "little")
+
+    new = bytearray(old)
+    for _ in range(int(size * ratio) // EDIT_SIZE):
+        position = rng.randrange(0, size - EDIT_SIZE)
+        new[position:position + EDIT_SIZE] = rng.getrandbits(EDIT_SIZE * 8).to_bytes(EDIT_SIZE, "little")
+
+    return old, bytes(new)
+
+
+def exchange(client, server):
+    """
+    Move the written data between the client and the server until neither of them has anything to send.
+
+    :param client: the client protocol (SyncClientProtocol)
+    :param server: the server protocol (SyncServerProtocol)
+
+    :return: the number of bytes sent in both directions (int)
+    """
+
+    sent = 0
+    while True:
+        # the reactor isn't running, continue transfers which would be resumed in the next reactor iteration
+        if any(not transfer.waiting for transfer in client.queue.streams.values()):
+            client.queue.pump()
+
+        upstream = client.transport.value()
+        downstream = server.transport.value()
+        if not upstream and not downstream and not client.queue.streams:
+            return sent
+
+        client.transport.clear()
+        server.transport.clear()
+        sent += len(upstream) + len(downstream)
+
+        server.dataReceived(upstream)
+        client.dataReceived(downstream)
+
+
+def run(old, new, delta):
+    """
+    Sync a modified file from a client to a server which has the old version.
+
+    :param old: the content on the server (bytes)
+    :param new: the content on the client (bytes)
+    :param delta: True to use the delta mode, False to stream the full content (bool)
+
+    :return: a tuple of two values - bytes on the wire and wall time in seconds
+    """
+
+    with tempfile.TemporaryDirectory() as client_folder, tempfile.TemporaryDirectory() as server_folder:
+        with open(os.path.join(client_folder, "file.bin"), "wb") as fh:
+            fh.write(new)
+        with open(os.path.join(server_folder, "file.bin"), "wb") as fh:
+            fh.write(old)
+
+        server = SyncFactory(server_folder).buildProtocol(None)
+        server.makeConnection(StringTransport())
+        client = SyncClientProtocol()
+        client.makeConnection(StringTransport())
+        exchange(client, server)  # negotiation
+
+        client.queue.delta_min_size = 0 if delta else None
+
+        start = time.perf_counter()
+        client.queue.put_file("./file.bin", os.path.join(client_folder, "file.bin"))
+        sent = exchange(client, server)
+        elapsed = time.perf_counter() - start
+
+        with open(os.path.join(server_folder, "file.bin"), "rb") as fh:
+            assert fh.read() == new, "Server copy doesn't match the client copy"
+
+        return sent, elapsed
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Compare the delta mode with streaming the full content of a file.")
+    parser.add_argument("--size", type=int, default=32, help="size of the file in MiB")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the random generator")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    size = args.size * 1024 * 1024
+
+    print(f"{'changed':>8} {'mode':>6} {'bytes on wire':>14} {'wall time (s)':>14}")
+    for ratio in (0.01, 0.1, 1.0):
+        old, new = make_versions(size, ratio, rng)
+        for mode in ("full", "delta"):
+            sent, elapsed = run(old, new, mode == "delta")
+            print(f"{ratio:>8.0%} {mode:>6} {sent:>14} {elapsed:>14.3f}")
@@ -0,0 +1,144 @@
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from twisted.internet import reactor
+from client_pkg.journal import Journal
+from client_pkg.protocol import connect
+from server_pkg.durability import GroupCommit
+from server_pkg.protocol import SyncFactory
+
+
+# a run which hasn't finished after this many seconds is aborted
+TIMEOUT = 300
+
+
+class FileSyncs(GroupCommit):
+    """
+    The naive alternative to group commits - every operation syncs the files and folders it changes itself.
+    """
+
+    def record(self, files, directories, size=0):
+        """
+        Sync the changes of an operation right away, called by the executor.
+
+        :param files: the absolute paths of the written files (list of strings)
+        :param directories: the absolute paths of the folders whose entries changed (list of strings)
+        :param size: the bytes written (int)
+        """
+
+        self.sync(files, directories)
+
+
+def worker(mode, files, size):
+    """
+    Send small files from a client with a journal to a server over loopback, until the server has acknowledged them.
+
+    :param mode: 'off', 'per-file' or the commit interval in milliseconds (string)
+    :param files: the number of files (int)
+    :param size: the size of the files in bytes (int)
+
+    :return: the measurements (dict)
+    """
+
+    result = {}
+    with tempfile.TemporaryDirectory() as folder:
+        client_folder, server_folder = os.path.join(folder, "client"), os.path.join(folder, "server")
+        for number in range(files):
+            directory = os.path.join(client_folder, f"dir{number // 100}")
+            os.makedirs(directory, exist_ok=True)
+            with open(os.path.join(directory, f"file{number}"), "wb") as fh:
+                fh.write(os.urandom(size))
+
+        os.makedirs(server_folder)
+        interval = None if mode == "off" else 0 if mode == "per-file" else float(mode) / 1000
+        factory = SyncFactory(server_folder, workers=4, mode="multi", commit_interval=interval)
+        if mode == "per-file":
+            factory.commits = FileSyncs(factory.executor, server_folder, interval)
+
+        port = reactor.listenTCP(0, factory, interface="127.0.0.1")
+        journal = Journal(os.path.join(folder, "journal"))
+        journal.start()
+        client, _ = connect("127.0.0.1", port.getHost().port, client_id="bench", compression=[], journal=journal)
+
+        def start():
+            # the operations are held back until the wire format has been negotiated
+            if client.mode is None:
+                reactor.callLater(0.01, start)
+                return
+
+            result["start"] = time.perf_counter()
+            for number in range(files):
+                client.send_file(f"./dir{number // 100}/file{number}",
+                                 os.path.join(client_folder, f"dir{number // 100}", f"file{number}"))
+            check()
+
+        def check():
+            if journal.acked < journal.last_seq:
+                reactor.callLater(0.001, check)
+                return
+
+            elapsed = time.perf_counter() - result.pop("start")
+            stats = factory.commits.stats() if factory.commits is not None else {}
+            result.update(files_per_second=files / elapsed, commits=stats.get("commits", 0),
+                          synced=stats.get("synced_files", 0) + stats.get("synced_directories", 0))
+            reactor.stop()
+
+        def timeout():
+            result["error"] = f"only {journal.acked} of {journal.last_seq} operations acknowledged in {TIMEOUT} seconds"
+            reactor.stop()
+
+        reactor.callWhenRunning(start)
+        reactor.callLater(TIMEOUT, timeout)
+        reactor.run()
+        journal.close()
+
+    return result
+
+
+def measure(mode, files, size):
+    """
+    Run a worker in its own process, the reactor can't be restarted.
+
+    :param mode: 'off', 'per-file' or the commit interval in milliseconds (string)
+    :param files: the number of files (int)
+    :param size: the size of the files in bytes (int)
+
+    :return: the measurements (dict)
+    """
+
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), "--worker", mode, "--files", str(files),
+                             "--size", str(size)], stdout=subprocess.PIPE, check=True).stdout
+    result = json.loads(output.decode("utf-8").splitlines()[-1])
+    if "error" in result:
+        raise RuntimeError(f"The {mode} mode failed - {result['error']}")
+    return result
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Compare the small files per second acknowledged by the server "
+                                                 "without syncing them, syncing every file and syncing them in group "
+                                                 "commits, against the commit interval.")
+    parser.add_argument("--files", type=int, default=5000, help="number of files")
+    parser.add_argument("--size", type=int, default=4096, help="size of the files in bytes")
+    parser.add_argument("--intervals", type=float, nargs="+", default=[0, 10, 50], help="commit intervals in ms")
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        # the connection is cut when the worker stops
+        logging.basicConfig(level=logging.ERROR)
+        print(json.dumps(worker(args.worker, args.files, args.size)))
+        sys.exit(0)
+
+    print(f"{args.files} files of {args.size} bytes, acknowledged by the server")
+    print(f"{'mode':>14} {'files/s':>9} {'commits':>8} {'fsyncs':>8}")
+    for mode in ["off", "per-file"] + [f"{interval:g}" for interval in args.intervals]:
+        result = measure(mode, args.files, args.size)
+        name = mode if mode in ("off", "per-file") else f"group {mode} ms"
+        print(f"{name:>14} {result['files_per_second']:>9.0f} {result['commits']:>8} {result['synced']:>8}")
@@ -0,0 +1,536 @@
+import argparse
+import datetime
+import json
+import logging
+import math
+import os
+import random
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+
+# the workloads, in the order they are run
+WORKLOADS = ("small-files", "huge-files", "rename-storm", "deep-tree", "checkout-churn", "delete-cleanup")
+
+# the percentiles of the propagation latency which are reported
+PERCENTILES = (50, 90, 99)
+
+# the changes which haven't reached the server this many seconds after the last one was made are reported as missing
+TIMEOUT = 120
+
+# how often the server folder is checked for the changes made to the client folder (seconds)
+POLL_INTERVAL = 0.002
+
+# the expected states of a path on the server - a file of a given size, or no path at all
+FILE = "file"
+GONE = "gone"
+
+
+def write_file(path, size, rng, chunk_size=1024 * 1024):
+    """
+    Write a file of random content, creating its folders.
+
+    :param path: the absolute path of the file (string)
+    :param size: the size of the file (int)
+    :param rng: the random generator of the workload (random.Random)
+    :param chunk_size: the size of the writes (int)
+    """
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as fh:
+        for offset in range(0, size, chunk_size):
+            length = min(chunk_size, size - offset)
+            fh.write(rng.getrandbits(8 * length).to_bytes(length, "big"))
+
+
+def move(root, src_path, dest_path):
+    """
+    Rename a path of the client folder, creating the folder of its destination.
+
+    :param root: the client folder (string)
+    :param src_path: the path relative to the folder (string)
+    :param dest_path: the destination relative to the folder (string)
+    """
+
+    os.makedirs(os.path.dirname(os.path.join(root, dest_path)), exist_ok=True)
+    os.replace(os.path.join(root, src_path), os.path.join(root, dest_path))
+
+
+class Step:
+    """
+    A change made to the client folder and the states of the server folder it results in once it has propagated.
+    """
+
+    def __init__(self, func, args, expected=(), size=0):
+        """
+        :param func: makes the change (callable)
+        :param args: the arguments of the function (tuple)
+        :param expected: (state, relative path, size) of the paths changed on the server, empty if the change is
+                         overwritten by a later one, e.g. a rename in a chain (list of tuples)
+        :param size: the bytes written by the change (int)
+        """
+
+        self.func = func
+        self.args = args
+        self.expected = list(expected)
+        self.size = size
+        self.made = None  # the time the change was made
+        self.propagated = None  # the time all its expected states were found on the server
+
+
+def small_files(root, rng, scale, huge_size):
+    """
+    Many small files created in a few folders.
+
+    :return: the files prepared in both folders, the changes (tuple of dict and list of Step)
+    """
+
+    steps = []
+    for number in range(int(2000 * scale)):
+        path, size = f"small/dir{number % 50}/file{number}.bin", rng.randint(256, 16 * 1024)
+        steps.append(Step(write_file, (os.path.join(root, path), size, rng), [(FILE, path, size)], size))
+    return {}, steps
+
+
+def huge_files(root, rng, scale, huge_size):
+    """
+    A few huge files, written from start to end.
+
+    :return: the files prepared in both folders, the changes (tuple of dict and list of Step)
+    """
+
+    steps = []
+    for number in range(max(1, int(2 * scale))):
+        path, size = f"huge/file{number}.bin", huge_size * 1024 * 1024
+        steps.append(Step(write_file, (os.path.join(root, path), size, rng), [(FILE, path, size)], size))
+    return {}, steps
+
+
+def rename_storm(root, rng, scale, huge_size):
+    """
+    Every file of a folder renamed twice in a row, e.g. by a tool reorganising a folder.
+
+    :return: the files prepared in both folders, the changes (tuple of dict and list of Step)
+    """
+
+    count = int(500 * scale)
+    files = {f"storm/a/file{number}.bin": rng.randint(256, 64 * 1024) for number in range(count)}
+    steps = [Step(move, (root, f"storm/a/file{number}.bin", f"storm/b/file{number}.bin")) for number in range(count)]
+    for number in range(count):
+        src_path, dest_path = f"storm/a/file{number}.bin", f"storm/c/renamed{number}.bin"
+        steps.append(Step(move, (root, f"storm/b/file{number}.bin", dest_path),
+                          [(FILE, dest_path, files[src_path]), (GONE, src_path, 0)]))
+    return files, steps
+
+
+def deep_tree(root, rng, scale, huge_size):
+    """
+    Deeply nested folders created with a couple of files at every level.
+
+    :return: the files prepared in both folders, the changes (tuple of dict and list of Step)
+    """
+
+    steps = []
+    for branch in range(max(1, int(4 * scale))):
+        folder = f"deep/branch{branch}"
+        for depth in range(24):
+            folder = f"{folder}/level{depth}"
+            for number in range(2):
+                path, size = f"{folder}/file{number}.txt", rng.randint(64, 4096)
+                steps.append(Step(write_file, (os.path.join(root, path), size, rng), [(FILE, path, size)], size))
+    return {}, steps
+
+
+def checkout_churn(root, rng, scale, huge_size):
+    """
+    A source tree switched to another branch, like git checkout does - files are rewritten, deleted, renamed and
+    created, in the order of their paths.
+
+    :return: the files prepared in both folders, the changes (tuple of dict and list of Step)
+    """
+
+    count = int(1000 * scale)
+    files = {f"repo/src/pkg{number % 20}/sub{number % 7}/mod{number}.py": rng.randint(200, 8000)
+             for number in range(count)}
+
+    steps = []
+    for path in sorted(files):
+        choice = rng.random()
+        if choice < 0.25:
+            # the size changes, so that the old content can't pass for the new one
+            size = files[path] + rng.randint(1, 1024)
+            steps.append(Step(write_file, (os.path.join(root, path), size, rng), [(FILE, path, size)], size))
+        elif choice < 0.35:
+            steps.append(Step(os.remove, (os.path.join(root, path),), [(GONE, path, 0)]))
+        elif choice < 0.45:
+            dest_path = f"repo/src/pkg{rng.randrange(20)}/moved/{os.path.basename(path)}"
+            steps.append(Step(move, (root, path, dest_path), [(FILE, dest_path, files[path]), (GONE, path, 0)]))
+
+    for number in range(count // 10):
+        path, size = f"repo/src/new{number % 5}/file{number}.py", rng.randint(200, 8000)
+        steps.append(Step(write_file, (os.path.join(root, path), size, rng), [(FILE, path, size)], size))
+    return files, steps
+
+
+def delete_cleanup(root, rng, scale, huge_size):
+    """
+    A build folder with many small files removed package by package, then entirely.
+
+    :return: the files prepared in both folders, the changes (tuple of dict and list of Step)
+    """
+
+    packages = 40
+    files = {f"build/pkg{number % packages}/lib{number % 3}/file{number}.o": rng.randint(256, 8192)
+             for number in range(int(2000 * scale))}
+    steps = [Step(shutil.rmtree, (os.path.join(root, f"build/pkg{number}"),), [(GONE, f"build/pkg{number}", 0)])
+             for number in range(packages)]
+    steps.append(Step(os.rmdir, (os.path.join(root, "build"),), [(GONE, "build", 0)]))
+    return files, steps
+
+
+# the functions building the workloads
+BUILDERS = {
+    "small-files": small_files,
+    "huge-files": huge_files,
+    "rename-storm": rename_storm,
+    "deep-tree": deep_tree,
+    "checkout-churn": checkout_churn,
+    "delete-cleanup": delete_cleanup
+}
+
+
+def reached(server_root, state, path, size):
+    """
+    :param server_root: the server folder (string)
+    :param state: FILE or GONE (string)
+    :param path: the path relative to the folder (string)
+    :param size: the size of the file (int)
+
+    :return: True if the path is in the expected state on the server (bool)
+    """
+
+    try:
+        path_stat = os.stat(os.path.join(server_root, path))
+    except FileNotFoundError:
+        return state == GONE
+
+    return state == FILE and path_stat.st_size == size
+
+
+def watch(server_root, pending, lock, done):
+    """
+    Check the server folder for the changes made to the client folder until the run is over, in a thread.
+
+    :param server_root: the server folder (string)
+    :param pending: the changes which haven't propagated yet (list of Step)
+    :param lock: guards the pending changes (threading.Lock)
+    :param done: set once the run is over (threading.Event)
+    """
+
+    while not done.is_set():
+        with lock:
+            steps = list(pending)
+
+        for step in steps:
+            step.expected = [expected for expected in step.expected if not reached(server_root, *expected)]
+            if not step.expected:
+                step.propagated = time.perf_counter()
+                with lock:
+                    pending.remove(step)
+
+        time.sleep(POLL_INTERVAL)
+
+
+def usage():
+    """
+    :return: the peak memory and the CPU time of the process (dict)
+    """
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return dict(peak_rss_mib=usage.ru_maxrss / 1024, cpu_seconds=usage.ru_utime + usage.ru_stime)
+
+
+def serve(path, port, workers):
+    """
+    Run the server until it's terminated, then report what it has used.
+
+    :param path: the server folder (string)
+    :param port: the port to listen on (int)
+    :param workers: the number of threads applying the filesystem operations (int)
+
+    :return: the usage and the metrics of the server (dict)
+    """
+
+    from common_pkg.metrics import REGISTRY
+    from server_pkg.protocol import create_server
+
+    reactor = create_server(path, port, workers, "multi")
+    reactor.run()  # stopped by SIGTERM
+    return dict(usage(), metrics=REGISTRY.snapshot())
+
+
+def sync(path, port, quiet_window):
+    """
+    Run the client until it's terminated, then report what it has used - 'ready' is printed once the client has
+    connected and the folder is watched.
+
+    :param path: the client folder (string)
+    :param port: the port of the server (int)
+    :param quiet_window: the quiet window of the coalescer, 0 to send every event (float)
+
+    :return: the usage and the metrics of the client (dict)
+    """
+
+    from client_pkg.monitoring import create_observer
+    from client_pkg.protocol import connect
+    from common_pkg.metrics import REGISTRY
+
+    protocol, reactor = connect("127.0.0.1", port, client_id="bench")
+    observer = create_observer(protocol, path, quiet_window)
+    observer.start()
+
+    def ready():
+        # the changes are made once the wire format has been negotiated
+        if protocol.mode is None:
+            reactor.callLater(0.01, ready)
+        else:
+            print(json.dumps({"ready": True}), flush=True)
+
+    reactor.callWhenRunning(ready)
+    reactor.run()  # stopped by SIGTERM
+
+    protocol.queue.flow.close()
+    observer.stop()
+    observer.join()
+    return dict(usage(), metrics=REGISTRY.snapshot())
+
+
+def free_port():
+    """
+    :return: a port nobody listens on (int)
+    """
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start(role, *arguments):
+    """
+    Start the client or the server in its own process, so that its memory and CPU time are its own.
+
+    :param role: 'server' or 'client' (string)
+    :param arguments: the command line arguments of the role (strings)
+
+    :return: the process (subprocess.Popen)
+    """
+
+    return subprocess.Popen([sys.executable, os.path.abspath(__file__), "--role", role] + [str(argument) for argument
+                                                                                             in arguments],
+                            stdout=subprocess.PIPE)
+
+
+def stop(process):
+    """
+    Stop the client or the server.
+
+    :param process: the process (subprocess.Popen)
+
+    :return: the usage and the metrics reported by the process, None if it didn't report them (dict)
+    """
+
+    process.terminate()
+    output = process.communicate(timeout=60)[0].decode("utf-8").splitlines()
+    return json.loads(output[-1]) if output and process.returncode == 0 else None
+
+
+def percentile(values, percent):
+    """
+    :param values: sorted values (list)
+    :param percent: the percentile (int)
+
+    :return: the nearest-rank percentile, None without values
+    """
+
+    return values[max(math.ceil(percent / 100 * len(values)) - 1, 0)] if values else None
+
+
+def run(name, args):
+    """
+    Make the changes of a workload to the folder of a client and measure how they propagate to the server.
+
+    :param name: the name of the workload (string)
+    :param args: the options of the benchmark (argparse.Namespace)
+
+    :return: the measurements (dict)
+    """
+
+    with tempfile.TemporaryDirectory() as folder:
+        client_root, server_root = os.path.join(folder, "client"), os.path.join(folder, "server")
+        os.makedirs(client_root)
+
+        # the workload is the same for every run with the same seed
+        rng = random.Random(f"{args.seed}-{name}")
+        files, steps = BUILDERS[name](client_root, rng, args.scale, args.huge_size)
+
+        # the files the workload starts from are in both folders already
+        for path, size in files.items():
+            write_file(os.path.join(client_root, path), size, rng)
+        shutil.copytree(client_root, server_root)
+
+        port = free_port()
+        server = start("server", "--path", server_root, "--port", port, "--workers", args.workers)
+        client = None
+        try:
+            # the server is up once it accepts connections
+            deadline = time.monotonic() + 30
+            while True:
+                try:
+                    socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                    break
+                except OSError:
+                    if time.monotonic() > deadline:
+                        raise RuntimeError("The server didn't start in 30 seconds")
+                    time.sleep(0.05)
+
+            client = start("client", "--path", client_root, "--port", port, "--quiet-window", args.quiet_window)
+            client.stdout.readline()
+            time.sleep(0.2)  # the watches are added by the observer threads
+
+            pending, lock, done = [], threading.Lock(), threading.Event()
+            watcher = threading.Thread(target=watch, args=(server_root, pending, lock, done), daemon=True)
+            watcher.start()
+
+            for step in steps:
+                step.func(*step.args)
+                step.made = time.perf_counter()
+                if step.expected:
+                    with lock:
+                        pending.append(step)
+
+            deadline = time.perf_counter() + args.timeout
+            while pending and time.perf_counter() < deadline:
+                time.sleep(0.05)
+            done.set()
+            watcher.join()
+        finally:
+            client_usage = stop(client) if client is not None else None
+            server_usage = stop(server)
+
+    checked = [step for step in steps if step.made is not None and (step.propagated or step.expected)]
+    latencies = sorted(step.propagated - step.made for step in checked if step.propagated is not None)
+    finished = max([step.propagated for step in checked if step.propagated is not None] +
+                   [step.made for step in steps])
+    elapsed = finished - steps[0].made
+    written = sum(step.size for step in steps)
+
+    return {
+        "operations": len(steps),
+        "checked": len(checked),
+        "missing": len(checked) - len(latencies),
+        "bytes": written,
+        "seconds": round(elapsed, 4),
+        "operations_per_second": round(len(steps) / elapsed, 1),
+        "bytes_per_second": round(written / elapsed),
+        "latency_ms": dict({f"p{percent}": round(percentile(latencies, percent) * 1000, 3)
+                            for percent in PERCENTILES if latencies},
+                           max=round(latencies[-1] * 1000, 3) if latencies else None),
+        "client": client_usage,
+        "server": server_usage
+    }
+
+
+def revision():
+    """
+    :return: the commit the benchmark runs on, None outside of a git checkout (string)
+    """
+
+    try:
+        output = subprocess.run(["git", "rev-parse", "--short", "HEAD"], stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL, cwd=os.path.dirname(os.path.abspath(__file__)), check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.stdout.decode("utf-8").strip()
+
+
+def change(current, baseline):
+    """
+    :param current: a measurement of this run (float)
+    :param baseline: the same measurement in the baseline (float)
+
+    :return: the relative change, e.g. '+12%' (string)
+    """
+
+    if not current or not baseline:
+        return "-"
+    return f"{(current - baseline) / baseline:+.0%}"
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Run reproducible workloads against a client and a server on loopback "
+                                                 "and measure how the changes propagate - latency percentiles, "
+                                                 "operations and bytes per second and the peak memory of both sides.")
+    parser.add_argument("--workloads", nargs="+", choices=WORKLOADS, default=list(WORKLOADS), help="workloads to run")
+    parser.add_argument("--scale", type=float, default=1.0, help="multiplies the number of files of the workloads")
+    parser.add_argument("--huge-size", type=int, default=64, help="size of the huge files in MiB")
+    parser.add_argument("--seed", type=int, default=1, help="seed of the random workloads")
+    parser.add_argument("--quiet-window", type=float, default=0.0,
+                        help="quiet window of the client in seconds, 0 to send every event straight away")
+    parser.add_argument("--workers", type=int, default=4, help="threads of the server applying the operations")
+    parser.add_argument("--timeout", type=float, default=TIMEOUT,
+                        help="seconds to wait for the changes to propagate after the last one was made")
+    parser.add_argument("--output", help="JSON file the results are written to")
+    parser.add_argument("--baseline", help="JSON file of an earlier run to compare the results with")
+    parser.add_argument("--role", choices=("server", "client"), help=argparse.SUPPRESS)
+    parser.add_argument("--path", help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.role:
+        # the connection is cut when the processes stop
+        logging.basicConfig(level=logging.ERROR)
+        result = serve(args.path, args.port, args.workers) if args.role == "server" else \
+            sync(args.path, args.port, args.quiet_window)
+        print(json.dumps(result))
+        sys.exit(0)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as fh:
+            baseline = json.load(fh)["workloads"]
+
+    results = {
+        "revision": revision(),
+        "date": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "parameters": {key: value for key, value in vars(args).items()
+                       if key not in ("role", "path", "port", "output", "baseline")},
+        "workloads": {}
+    }
+
+    print(f"{'workload':>15} {'ops':>6} {'ops/s':>8} {'MiB/s':>7} {'p50 (ms)':>9} {'p90 (ms)':>9} {'p99 (ms)':>9} "
+          f"{'max (ms)':>9} {'missing':>8} {'client RSS':>11} {'server RSS':>11}" +
+          (f" {'ops/s vs base':>14} {'p99 vs base':>12}" if baseline else ""))
+    for name in args.workloads:
+        result = results["workloads"][name] = run(name, args)
+        latency = result["latency_ms"]
+        rss = [f"{result[side]['peak_rss_mib']:.1f}" if result[side] else "-" for side in ("client", "server")]
+        line = f"{name:>15} {result['operations']:>6} {result['operations_per_second']:>8.0f} " \
+               f"{result['bytes_per_second'] / 2 ** 20:>7.1f} {latency.get('p50', 0):>9.1f} " \
+               f"{latency.get('p90', 0):>9.1f} {latency.get('p99', 0):>9.1f} {latency['max'] or 0:>9.1f} " \
+               f"{result['missing']:>8} {rss[0]:>11} {rss[1]:>11}"
+        if baseline and name in baseline:
+            line += f" {change(result['operations_per_second'], baseline[name]['operations_per_second']):>14} " \
+                    f"{change(latency.get('p99'), baseline[name]['latency_ms'].get('p99')):>12}"
+        print(line)
+
+    if args.output:
+        with open(args.output, "w") as fh:
+            json.dump(results, fh, indent=2)
+        print(f"Results written to {args.output}")
@@ -0,0 +1,178 @@
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from common_pkg.engine import ENGINES, install_engine
+
+# the worker installs the engine it measures, before the modules using the reactor are imported
+if __name__ == "__main__" and "--worker" in sys.argv:
+    install_engine(sys.argv[sys.argv.index("--worker") + 1])
+
+from twisted.internet import reactor
+from client_pkg.protocol import connect
+from server_pkg.protocol import SyncFactory
+from common_pkg.framing import decode_batch, MSG_BATCH, MSG_CREATED
+
+
+# a run which hasn't finished after this many seconds is aborted
+TIMEOUT = 300
+
+
+class TimedFactory(SyncFactory):
+    """
+    A server factory recording when the creations sent by the client reach the server.
+    """
+
+    def __init__(self, sync_folder_path, expected, finished):
+        """
+        :param sync_folder_path: the folder the files are created in (string)
+        :param expected: the number of creations to wait for (int)
+        :param finished: called once all the creations have been received
+        """
+
+        super().__init__(sync_folder_path)
+        self.expected = expected
+        self.finished = finished
+        self.received = {}  # path -> the time the creation was received
+
+    def buildProtocol(self, addr):
+        """
+        :param addr: connection address
+
+        :return: a server protocol timing the creations (SyncServerProtocol)
+        """
+
+        protocol = super().buildProtocol(addr)
+        frame_received = protocol.frameReceived
+
+        def timed(frame):
+            # creations arrive on their own or packed in batches
+            entries = decode_batch(frame.payload) if frame.msg_type == MSG_BATCH else [frame]
+            now = time.perf_counter()
+            for entry in entries:
+                if entry.msg_type == MSG_CREATED:
+                    self.received[entry.path] = now
+
+            frame_received(frame)
+            if len(self.received) == self.expected and self.finished is not None:
+                self.finished()
+                self.finished = None
+
+        protocol.frameReceived = timed
+        return protocol
+
+
+def produce(client, events, rate, sent):
+    """
+    Hand creations over to the client from another thread, like the watchdog observer does.
+
+    :param client: the client protocol (SyncClientProtocol)
+    :param events: the number of creations (int)
+    :param rate: the creations per second, 0 to send them as fast as possible (float)
+    :param sent: filled with path -> the time the creation was handed over (dict)
+    """
+
+    start = time.perf_counter()
+    for number in range(events):
+        if rate:
+            delay = start + number / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+        path = f"./file{number}"
+        sent[path.encode("utf-8")] = time.perf_counter()
+        client.send_event("created", False, path)
+
+
+def worker(engine, events, rate):
+    """
+    Send creations from a client to a server over loopback, both running on the reactor of the engine.
+
+    :param engine: the name of the engine (string)
+    :param events: the number of creations (int)
+    :param rate: the creations per second, 0 to send them as fast as possible (float)
+
+    :return: the measurements (dict)
+    """
+
+    sent = {}
+    result = {}
+
+    with tempfile.TemporaryDirectory() as folder:
+        factory = TimedFactory(folder, events, reactor.stop)
+        port = reactor.listenTCP(0, factory, interface="127.0.0.1")
+        client, _ = connect("127.0.0.1", port.getHost().port, client_id="bench", compression=[])
+
+        def start():
+            # the operations are held back until the wire format has been negotiated
+            if client.mode is None:
+                reactor.callLater(0.01, start)
+            else:
+                threading.Thread(target=produce, args=(client, events, rate, sent), daemon=True).start()
+
+        def timeout():
+            result["error"] = f"only {len(factory.received)} of {events} creations received in {TIMEOUT} seconds"
+            reactor.stop()
+
+        reactor.callWhenRunning(start)
+        reactor.callLater(TIMEOUT, timeout)
+        reactor.run()
+
+        if "error" in result:
+            return result
+
+        latencies = sorted(factory.received[path] - sent[path] for path in sent)
+        elapsed = max(factory.received.values()) - min(sent.values())
+        return dict(engine=engine, events=events, rate=rate, events_per_second=events / elapsed,
+                    p50_ms=latencies[len(latencies) // 2] * 1000,
+                    p99_ms=latencies[min(len(latencies) * 99 // 100, len(latencies) - 1)] * 1000,
+                    max_ms=latencies[-1] * 1000)
+
+
+def measure(engine, events, rate):
+    """
+    Run a worker in its own process, a process can only install one reactor.
+
+    :param engine: the name of the engine (string)
+    :param events: the number of creations (int)
+    :param rate: the creations per second, 0 to send them as fast as possible (float)
+
+    :return: the measurements (dict)
+    """
+
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), "--worker", engine, "--events", str(events),
+                             "--rate", str(rate)], stdout=subprocess.PIPE, check=True).stdout
+    result = json.loads(output.decode("utf-8").splitlines()[-1])
+    if "error" in result:
+        raise RuntimeError(f"The {engine} engine failed - {result['error']}")
+    return result
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Compare the Twisted and the asyncio engines on loopback - the events "
+                                                 "per second of a burst of creations and the end-to-end latency of "
+                                                 "creations sent at a steady rate.")
+    parser.add_argument("--events", type=int, default=20000, help="number of creations sent in a burst")
+    parser.add_argument("--latency-events", type=int, default=2000, help="number of creations sent at a steady rate")
+    parser.add_argument("--rate", type=float, default=1000, help="creations per second sent at a steady rate")
+    parser.add_argument("--engines", nargs="+", choices=ENGINES, default=list(ENGINES), help="engines to compare")
+    parser.add_argument("--worker", choices=ENGINES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        logging.basicConfig(level=logging.WARNING)
+        print(json.dumps(worker(args.worker, args.events, args.rate)))
+        sys.exit(0)
+
+    print(f"{'engine':>8} {'events/s':>9} {'p50 (ms)':>9} {'p99 (ms)':>9} {'max (ms)':>9}")
+    for name in args.engines:
+        burst = measure(name, args.events, 0)
+        steady = measure(name, args.latency_events, args.rate)
+        print(f"{name:>8} {burst['events_per_second']:>9.0f} {steady['p50_ms']:>9.2f} {steady['p99_ms']:>9.2f} "
+              f"{steady['max_ms']:>9.2f}")
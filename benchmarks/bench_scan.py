@@ -0,0 +1,87 @@
+import argparse
+import os
+import random
+import tempfile
+import time
+from common_pkg.manifest import build_manifest
+from common_pkg.scan import ScanPool
+
+
+def make_tree(folder, files, files_per_directory, mean_size, rng):
+    """
+    Build a folder of files of random sizes.
+
+    :param folder: the folder to create the files in (string)
+    :param files: the number of files (int)
+    :param files_per_directory: the number of files in each directory (int)
+    :param mean_size: the mean file size in bytes (int)
+    :param rng: the random generator to use (random.Random)
+
+    :return: the total size of the files in bytes (int)
+    """
+
+    total = 0
+    block = os.urandom(1024 * 1024)
+    for index in range(files):
+        directory = os.path.join(folder, f"dir{index // files_per_directory // 10}", f"sub{index // files_per_directory}")
+        os.makedirs(directory, exist_ok=True)
+
+        # mostly small files and a few big ones, like a source tree with some assets
+        size = int(rng.expovariate(1 / mean_size))
+        with open(os.path.join(directory, f"file{index}.bin"), "wb") as fh:
+            for offset in range(0, size, len(block)):
+                fh.write(block[:min(len(block), size - offset)])
+        total += size
+
+    return total
+
+
+def default_workers():
+    """
+    :return: the worker counts to measure - powers of two up to the number of cores, and the number of cores (list)
+    """
+
+    cores = os.cpu_count() or 1
+    counts = [2 ** power for power in range(cores.bit_length()) if 2 ** power <= cores]
+    return counts + ([cores] if counts[-1] != cores else [])
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Measure the files and bytes per second hashed by a full scan of a "
+                                                 "folder, against the number of workers.")
+    parser.add_argument("--files", type=int, default=20000, help="number of files")
+    parser.add_argument("--per-directory", type=int, default=100, help="number of files in each directory")
+    parser.add_argument("--mean-size", type=int, default=64, help="mean file size in KiB")
+    parser.add_argument("--workers", type=int, nargs="+", default=default_workers(), help="worker counts to measure")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the random generator")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        total = make_tree(folder, args.files, args.per_directory, args.mean_size * 1024, random.Random(args.seed))
+        print(f"{args.files} files, {total / 2 ** 20:.1f} MiB, {os.cpu_count()} cores - every scan hashes all the "
+              f"files, which are in the page cache")
+
+        # the first scan warms the page cache up, it's the single threaded baseline too
+        build_manifest(folder)
+        start = time.perf_counter()
+        expected = build_manifest(folder)
+        elapsed = time.perf_counter() - start
+
+        print(f"{'mode':>9} {'workers':>8} {'wall time (s)':>14} {'files/s':>9} {'MiB/s':>8}")
+        print(f"{'serial':>9} {1:>8} {elapsed:>14.3f} {args.files / elapsed:>9.0f} {total / 2 ** 20 / elapsed:>8.1f}")
+
+        for processes in (False, True):
+            for workers in args.workers:
+                pool = ScanPool(workers, processes)
+                pool.build_manifest(folder)  # starts the workers
+
+                start = time.perf_counter()
+                manifest = pool.build_manifest(folder)
+                elapsed = time.perf_counter() - start
+                pool.close()
+
+                assert manifest.digest == expected.digest, "The parallel scan doesn't match the serial one"
+                mode = "processes" if processes else "threads"
+                print(f"{mode:>9} {workers:>8} {elapsed:>14.3f} {args.files / elapsed:>9.0f} "
+                      f"{total / 2 ** 20 / elapsed:>8.1f}")
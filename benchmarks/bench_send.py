@@ -0,0 +1,163 @@
+import argparse
+import json
+import logging
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from common_pkg.framing import encode_hello_frame
+
+
+# a run which hasn't finished after this many seconds is aborted
+TIMEOUT = 300
+
+# the send paths compared - chunks read into the process, or sent from the page cache with os.sendfile
+MODES = ("read", "sendfile")
+
+
+def sink(server):
+    """
+    Accept clients one after the other, accept the binary wire format and throw away everything they send.
+
+    :param server: the listening socket (socket.socket)
+    """
+
+    while True:
+        try:
+            connection, _ = server.accept()
+        except OSError:
+            return  # closed once every mode has been measured
+
+        with connection:
+            hello = b""
+            while not hello.endswith(b"\n"):
+                hello += connection.recv(1)
+            connection.sendall(encode_hello_frame(features=[]))
+
+            while connection.recv(1024 * 1024):
+                pass
+
+
+def worker(mode, port, path, files):
+    """
+    Send a file a number of times to the sink and measure the cost of it in the client process.
+
+    :param mode: 'read' or 'sendfile' (string)
+    :param port: the port of the sink (int)
+    :param path: the file to send (string)
+    :param files: the number of times the file is sent (int)
+
+    :return: the measurements (dict)
+    """
+
+    from twisted.internet.task import LoopingCall
+    from client_pkg.protocol import connect
+
+    client, reactor = connect("127.0.0.1", port, client_id="bench", compression=[], zero_copy=mode == "sendfile")
+    result = {}
+
+    def start():
+        # the files are held back until the wire format has been negotiated
+        if client.mode is None:
+            reactor.callLater(0.01, start)
+            return
+
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        result.update(start=time.perf_counter(), cpu=usage.ru_utime + usage.ru_stime, base_rss_kib=usage.ru_maxrss)
+        for number in range(files):
+            client.send_file(f"./file{number}", path)
+        LoopingCall(check).start(0.01, now=False)
+
+    def check():
+        stats = client.queue.stats()
+        if stats["queued_items"]:
+            return
+
+        # the transport closes the connection once it has sent everything it has buffered
+        if client.transport.connected:
+            if not client.transport.disconnecting:
+                client.transport.loseConnection()
+            return
+
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        result.update(wall=time.perf_counter() - result.pop("start"),
+                      cpu=usage.ru_utime + usage.ru_stime - result["cpu"], peak_rss_kib=usage.ru_maxrss,
+                      zero_copy_bytes=stats["zero_copy_bytes"])
+        reactor.stop()
+
+    def timeout():
+        result["error"] = f"the files were not sent in {TIMEOUT} seconds"
+        reactor.stop()
+
+    reactor.callWhenRunning(start)
+    reactor.callLater(TIMEOUT, timeout)
+    reactor.run()
+    return result
+
+
+def measure(mode, port, path, files):
+    """
+    Run a worker in its own process, so that its CPU time and peak memory are its own.
+
+    :param mode: 'read' or 'sendfile' (string)
+    :param port: the port of the sink (int)
+    :param path: the file to send (string)
+    :param files: the number of times the file is sent (int)
+
+    :return: the measurements (dict)
+    """
+
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), "--worker", mode, "--port", str(port),
+                             "--path", path, "--files", str(files)], stdout=subprocess.PIPE, check=True).stdout
+    result = json.loads(output.decode("utf-8").splitlines()[-1])
+    if "error" in result:
+        raise RuntimeError(f"The {mode} mode failed - {result['error']}")
+    return result
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Compare the CPU time per GiB and the peak memory of the client "
+                                                 "sending big files over loopback, with the chunks read into the "
+                                                 "process or sent from the page cache.")
+    parser.add_argument("--size", type=int, default=256, help="size of the file in MiB")
+    parser.add_argument("--files", type=int, default=8, help="number of times the file is sent")
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=list(MODES), help="send paths to compare")
+    parser.add_argument("--worker", choices=MODES, help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--path", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        # the connection is cut when the worker stops
+        logging.basicConfig(level=logging.ERROR)
+        print(json.dumps(worker(args.worker, args.port, args.path, args.files)))
+        sys.exit(0)
+
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "big.bin")
+        block = os.urandom(1024 * 1024)
+        with open(path, "wb") as fh:
+            for _ in range(args.size):
+                fh.write(block)
+
+        server = socket.socket()
+        server.bind(("127.0.0.1", 0))
+        server.listen()
+        threading.Thread(target=sink, args=(server,), daemon=True).start()
+
+        total = args.size * args.files / 1024
+        print(f"{args.files} x {args.size} MiB sent over loopback, from the page cache")
+        print(f"{'mode':>9} {'GiB/s':>7} {'CPU s/GiB':>10} {'zero-copy':>10} {'base RSS (MiB)':>15} "
+              f"{'peak RSS (MiB)':>15}")
+        for mode in args.modes:
+            result = measure(mode, server.getsockname()[1], path, args.files)
+            print(f"{mode:>9} {total / result['wall']:>7.2f} {result['cpu'] / total:>10.3f} "
+                  f"{result['zero_copy_bytes'] / 2 ** 30 / total:>10.0%} {result['base_rss_kib'] / 1024:>15.1f} "
+                  f"{result['peak_rss_kib'] / 1024:>15.1f}")
+
+        server.close()
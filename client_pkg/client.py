@@ -1,27 +1,121 @@
-import sys
+import argparse
 import logging
+import sys
+from common_pkg.engine import ENGINES, TWISTED, engine_argument, install_engine
+
+# the engine is installed before the modules using the reactor are imported
+install_engine(engine_argument(sys.argv[1:]))
+
+from client_pkg.coalescing import QUIET_WINDOW, MAX_LATENCY
+from common_pkg.compression import CODECS
+from common_pkg.logs import configure_logging, LOG_SAMPLE
+from common_pkg.metrics import listen_metrics, start_stats_dump, STATS_INTERVAL
+from client_pkg.flow import FlowControl, HIGH_WATERMARK, LOW_WATERMARK
+from client_pkg.ignore import IgnoreRules
+from client_pkg.index import FileIndex, default_state_path
+from client_pkg.journal import Journal
 from client_pkg.monitoring import create_observer
 from client_pkg.protocol import connect
+from common_pkg.scan import ScanPool, WORKERS
 
 
-# configure root logger with basic configuration
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(thread)d - %(threadName)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+if __name__ == "__main__":
 
+    parser = argparse.ArgumentParser(description="Synchronise a folder with a server.")
+    parser.add_argument("path", help="folder to synchronize")
+    parser.add_argument("server_ip", help="server IP")
+    parser.add_argument("--quiet-window", type=float, default=QUIET_WINDOW,
+                        help="seconds without new events before the changes of a file are sent, 0 to send every event")
+    parser.add_argument("--max-latency", type=float, default=MAX_LATENCY,
+                        help="longest time in seconds the changes of a file can be held back")
+    parser.add_argument("--client-id", help="id the client introduces itself with, defaults to the host name")
+    parser.add_argument("--root", help="sync root used on a server giving each client its own root, "
+                                       "defaults to the client id")
+    parser.add_argument("--no-reconcile", action="store_true",
+                        help="don't compare the folder with the server on connect, only propagate new changes")
+    parser.add_argument("--index", help="file used to remember the hashes of the synchronised files between runs, "
+                                        "defaults to a file in ~/.syncapp named after the folder")
+    parser.add_argument("--no-index", action="store_true",
+                        help="don't keep an index of the files, every modified event sends the file")
+    parser.add_argument("--journal", help="file recording the changes until the server acknowledges them, "
+                                          "defaults to a file in ~/.syncapp named after the folder")
+    parser.add_argument("--no-journal", action="store_true",
+                        help="don't record the changes, changes made while disconnected are only found by reconciling")
+    parser.add_argument("--compression", choices=["auto", "none"] + list(CODECS), default="auto",
+                        help="compression codec offered to the server, 'auto' to offer all available codecs")
+    parser.add_argument("--high-watermark", type=int, default=HIGH_WATERMARK // 2 ** 20,
+                        help="MiB queued for the server at which reading changed files is held back")
+    parser.add_argument("--low-watermark", type=int, default=LOW_WATERMARK // 2 ** 20,
+                        help="MiB queued for the server at which reading changed files continues")
+    parser.add_argument("--bidirectional", action="store_true",
+                        help="apply the changes pushed by a server watching its folder too, requires the index")
+    parser.add_argument("--scan-workers", type=int, default=WORKERS,
+                        help="workers stating and hashing files when the folder is reconciled, 0 to use a single thread")
+    parser.add_argument("--scan-processes", action="store_true",
+                        help="hash files in processes reading them through memory maps instead of threads")
+    parser.add_argument("--no-zero-copy", action="store_true",
+                        help="read the files sent to the server instead of sending them from the page cache")
+    parser.add_argument("--metrics-port", type=int,
+                        help="serve the metrics of the client on this port of the loopback interface, in the Prometheus "
+                             "text format on /metrics")
+    parser.add_argument("--stats-interval", type=float, default=STATS_INTERVAL,
+                        help="seconds between two dumps of the metrics to the log, 0 to never dump them")
+    parser.add_argument("--log-sample", type=int, default=LOG_SAMPLE,
+                        help="log one in this many per-event messages, 1 to log all of them")
+    parser.add_argument("--engine", choices=ENGINES, default=TWISTED,
+                        help="event loop the client runs on - twisted's default reactor or an asyncio event loop")
+    args = parser.parse_args()
 
-if __name__ == "__main__":
+    # configure the root logger, the per-event messages are sampled
+    configure_logging(logging.DEBUG, max(args.log_sample, 1))
 
-    assert len(sys.argv) == 3, "Expecting two arguments: python3 client.py <folder to synchronize> <server IP>"
+    # the versions of the files are kept in the index
+    if args.bidirectional and args.no_index:
+        parser.error("--bidirectional can't be used with --no-index")
 
-    # retrieve arguments
-    path = sys.argv[1]
-    server_ip = sys.argv[2]
+    if args.compression == "auto":
+        compression = list(CODECS)
+    else:
+        compression = [] if args.compression == "none" else [args.compression]
+
+    # the index and the journal are kept outside of the synchronised folder
+    index = None if args.no_index else FileIndex(args.index or default_state_path(args.path, "sqlite"), args.path)
+    journal = None if args.no_journal else Journal(args.journal or default_state_path(args.path, "journal"))
 
     # initialise the twisted reactor object and a protocol object used to communicate with the server
-    protocol_instance, reactor = connect(server_ip)
+    protocol_instance, reactor = connect(args.server_ip, client_id=args.client_id, root=args.root,
+                                         compression=compression, journal=journal,
+                                         flow=FlowControl(args.high_watermark * 2 ** 20, args.low_watermark * 2 ** 20),
+                                         zero_copy=not args.no_zero_copy)
+
+    # the folder is scanned in parallel to reconcile it
+    scanner = ScanPool(args.scan_workers, args.scan_processes) if args.scan_workers and not args.no_reconcile else None
 
     # create the watchdog observer object and start monitoring for changes
-    observer = create_observer(protocol_instance, path)
+    observer = create_observer(protocol_instance, args.path, args.quiet_window, args.max_latency,
+                               not args.no_reconcile, index, IgnoreRules.load(args.path), args.bidirectional, scanner)
     observer.start()  # starts the observer in a new thread
 
+    if journal is not None:
+        journal.start()
+
+    # the metrics are served and dumped by the reactor
+    if args.metrics_port is not None:
+        listen_metrics(args.metrics_port)
+    if args.stats_interval > 0:
+        start_stats_dump(args.stats_interval)
+
     # start the reactor's event loop, runs in the main thread
     reactor.run()
+
+    # the watchdog thread may be waiting for the transfer queue to drain, which won't happen anymore
+    protocol_instance.queue.flow.close()
+    observer.stop()
+    observer.join()
+
+    if scanner is not None:
+        scanner.close()
+    if index is not None:
+        index.close()
+    if journal is not None:
+        journal.close()
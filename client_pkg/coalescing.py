@@ -0,0 +1,560 @@
+import logging
+import os
+import threading
+from collections import OrderedDict
+from twisted.internet import reactor, threads
+from twisted.internet.task import LoopingCall
+from common_pkg.logs import event_log
+from common_pkg.manifest import file_digest
+from common_pkg.metrics import REGISTRY
+
+
+# default time without new events for a path before its net operation is sent (seconds)
+QUIET_WINDOW = 0.5
+
+# default upper bound on how long the operations for a path can be held back, so that hot files still sync (seconds)
+MAX_LATENCY = 5.0
+
+# the time the net operations were held back, see common_pkg.metrics
+EVENT_DELAY = REGISTRY.histogram("syncapp_client_event_delay_seconds",
+                                 "Seconds from the first watchdog event of a file to its net operation being sent",
+                                 ("operation",))
+
+
+class PendingFile:
+    """
+    The net state of a file path accumulated from the events received during the quiet window.
+    """
+
+    def __init__(self, path, source, modified, deleted, now):
+        """
+        Initialise the pending state.
+
+        :param path: the relative path of the file (string)
+        :param source: the path of the server copy the file derives from, None for a new file (string)
+        :param modified: True if the content of the file must be sent (bool)
+        :param deleted: True if the file must be deleted on the server (bool)
+        :param now: the time of the first event (float)
+        """
+
+        self.path = path
+        self.source = source
+        self.modified = modified
+        self.deleted = deleted
+        self.first_seen = now
+        self.last_seen = now
+        # the indexed (size, mtime_ns, inode, hash) of a deleted file, used to detect that it was moved by deleting and
+        # creating it
+        self.fingerprint = None
+        # the (size, mtime_ns, inode, hash) of a new file hashed to compare it with a deleted file, and True while it's
+        # being hashed
+        self.digest = None
+        self.hashing = False
+
+
+class EventCoalescer:
+    """
+    A pipeline stage between the watchdog event handler and the protocol - holds the events of each file path until
+    no new events have been received for a quiet window and then sends a single net operation.
+
+    For example, created + modified + deleted is never sent, several modified events result in a single upload
+    and a chain of moves results in a single move. The coalescer has the same interface as the protocol, so the event
+    handler can use either of them. Directory events act as barriers - all pending operations are sent before them.
+
+    Some tools move a file by creating a copy and deleting the original. With an index, the quiet window is also used to
+    correlate such pairs - a new file with the same size and hash as a deleted file is sent as a move of the deleted file,
+    so the server moves its copy and the content isn't sent again. The new file is compared by its size, modification
+    time and inode first and by its indexed hash if it has one. It's only hashed otherwise - in a thread, while it's
+    held back, so that neither the events nor the network wait for it.
+    """
+
+    def __init__(self, protocol_instance, root_path, quiet_window=QUIET_WINDOW, max_latency=MAX_LATENCY, clock=reactor,
+                 index=None):
+        """
+        Initialise the coalescer.
+
+        :param protocol_instance: reference to the protocol object the net operations are sent to
+        :param root_path: the path of the folder that's being monitored (string)
+        :param quiet_window: the time without new events before the operations of a path are sent (float)
+        :param max_latency: the longest time the operations of a path can be held back (float)
+        :param clock: the reactor used for scheduling (IReactorTime)
+        :param index: the persistent index of the files in the folder, used to detect moves (FileIndex)
+        """
+
+        self.protocol = protocol_instance
+        self.root_path = root_path
+        self.quiet_window = quiet_window
+        self.max_latency = max_latency
+        self.clock = clock
+        self.index = index
+
+        # events are received in the watchdog thread and flushed in the reactor thread - the operations are only ever
+        # sent by the reactor thread, in the order they were queued in, and never while the lock is held
+        self.lock = threading.Lock()
+        self.pending = OrderedDict()  # relative path -> PendingFile, in the order of the first event
+        self.sources = {}  # relative path of a server copy -> relative path of the pending file moved from it
+        self.ready = []  # the operations to send, in order - (function, arguments) tuples
+        self.drain_scheduled = False
+
+        self.flush_loop = LoopingCall(self.flush_due)
+        self.flush_loop.clock = clock
+
+        # metrics
+        self.renames_detected = 0  # new files sent as a move of a deleted file
+        self.rename_misses = 0  # new files compared with a deleted file of the same size, but with another content
+
+        REGISTRY.gauge("syncapp_client_coalescer_pending", "Files whose events are held back by the coalescer",
+                       lambda: len(self.pending))
+
+    @property
+    def accepting_events(self):
+        """
+        :return: True if the protocol sends events to the server or records them until it can (bool)
+        """
+
+        return self.protocol.accepting_events
+
+    def start(self):
+        """
+        Start checking periodically for operations which are due.
+        """
+
+        self.flush_loop.start(min(self.quiet_window, self.max_latency) / 2, now=False)
+
+    def stop(self):
+        """
+        Stop checking for due operations and send everything that is pending.
+        """
+
+        if self.flush_loop.running:
+            self.flush_loop.stop()
+        self.flush_all()
+
+        if self.index is not None:
+            logging.info(f"Event coalescer stopped - {self.renames_detected} moves detected from a deletion and a "
+                         f"creation, {self.rename_misses} misses")
+
+    def stats(self):
+        """
+        :return: the counters of the coalescer (dictionary)
+        """
+
+        with self.lock:
+            return dict(pending=len(self.pending), renames_detected=self.renames_detected,
+                        rename_misses=self.rename_misses)
+
+    def send_event(self, event_type, is_directory, event_path):
+        """
+        Record a create/delete event.
+
+        :param event_type: the type of the event (string)
+        :param is_directory: True if the event was emitted for a directory and False if for a file (bool)
+        :param event_path: the path of the directory/file of this event (string)
+        """
+
+        with self.lock:
+            if is_directory:
+                self.directory_barrier(event_path if event_type == "deleted" else None)
+                self.ready.append((self.protocol.send_event, (event_type, is_directory, event_path)))
+            elif event_type == "created":
+                self.file_created(event_path)
+            elif event_type == "deleted":
+                self.file_deleted(event_path)
+
+        self.hand_over()
+
+    def send_file(self, event_path, abs_path):
+        """
+        Record a modified event.
+
+        :param event_path: the path of the file of this event (string)
+        :param abs_path: the absolute path of the file (string)
+        """
+
+        with self.lock:
+            entry = self.pending.get(event_path)
+            if entry is None or entry.deleted:
+                self.claim(event_path)
+                self.put(PendingFile(event_path, event_path, True, False, self.clock.seconds()))
+            else:
+                entry.modified = True
+                entry.last_seen = self.clock.seconds()
+
+        self.hand_over()
+
+    def send_modify_event(self, event_path, content):
+        """
+        Content sent explicitly is never held back, the pending operations of the path are sent first.
+
+        :param event_path: the path of the file of this event (string)
+        :param content: the content of the modified file (bytes)
+        """
+
+        with self.lock:
+            entry = self.remove(event_path)
+            if entry is not None:
+                self.ready.append((self.emit, (entry,)))
+            self.ready.append((self.protocol.send_modify_event, (event_path, content)))
+
+        self.hand_over()
+
+    def send_move_event(self, is_directory, src_path, dst_path):
+        """
+        Record a moved event.
+
+        :param is_directory: True if the event was emitted for a directory and False if for a file (bool)
+        :param src_path: the source path, before the file was moved (string)
+        :param dst_path: the destination path, after the file was moved (string)
+        """
+
+        with self.lock:
+            if is_directory:
+                self.directory_barrier()
+                self.ready.append((self.protocol.send_move_event, (is_directory, src_path, dst_path)))
+            else:
+                self.file_moved(src_path, dst_path)
+
+        self.hand_over()
+
+    def file_created(self, path):
+        """
+        :param path: the relative path of the created file (string)
+        """
+
+        entry = self.pending.get(path)
+        if entry is None:
+            self.claim(path)
+            self.put(PendingFile(path, None, False, False, self.clock.seconds()))
+        else:
+            # the server may still have an older copy, so the (possibly empty) content must be sent
+            entry.deleted = False
+            entry.modified = True
+            entry.last_seen = self.clock.seconds()
+
+    def file_deleted(self, path):
+        """
+        :param path: the relative path of the deleted file (string)
+        """
+
+        now = self.clock.seconds()
+        entry = self.remove(path)
+
+        if entry is None or entry.source == path:
+            deleted = PendingFile(path, path, False, True, now)
+            deleted.fingerprint = self.fingerprint(path)
+            self.put(deleted)
+        elif entry.source is not None:
+            # the file was moved here, the server copy is still at the source path
+            self.delete_server_copy(entry.source, now)
+        # otherwise the file was created during the quiet window and the server never knew about it
+
+    def file_moved(self, src_path, dst_path):
+        """
+        :param src_path: the relative path before the move (string)
+        :param dst_path: the relative path after the move (string)
+        """
+
+        now = self.clock.seconds()
+        entry = self.remove(src_path)
+        if entry is None or entry.deleted:
+            source, modified = src_path, False
+        else:
+            source, modified = entry.source, entry.modified
+
+        # the destination is overwritten - a server copy which was going to be moved there must be deleted instead
+        replaced = self.remove(dst_path)
+        if replaced is not None and not replaced.deleted and replaced.source not in (None, dst_path):
+            self.delete_server_copy(replaced.source, now)
+
+        if source is None:
+            # a new file, the server may have an older copy at the destination
+            modified = True
+        elif source == dst_path and not modified:
+            return  # moved back to where it was
+
+        self.claim(dst_path)
+        self.put(PendingFile(dst_path, source, modified, False, now))
+
+    def fingerprint(self, path):
+        """
+        :param path: the relative path of a deleted file (string)
+
+        :return: the indexed (size, mtime_ns, inode, hash) of the file, None if there's no index or the file isn't
+                 indexed (tuple)
+        """
+
+        if self.index is None:
+            return None
+
+        return self.index.get(path)
+
+    def delete_server_copy(self, path, now):
+        """
+        Make sure the server copy of a path gets deleted.
+
+        :param path: the relative path on the server (string)
+        :param now: the current time (float)
+        """
+
+        entry = self.pending.get(path)
+        if entry is None:
+            self.put(PendingFile(path, path, False, True, now))
+        elif entry.source is None:
+            # a new file is going to replace the server copy, make sure its content is sent
+            entry.modified = True
+
+    def claim(self, path):
+        """
+        Called before a new state is recorded for a path - if a pending move still has to take the server copy away
+        from this path, it is sent first so that the order of the operations is kept.
+
+        :param path: the relative path (string)
+        """
+
+        moved_to = self.sources.get(path)
+        if moved_to is not None:
+            self.ready.append((self.emit, (self.remove(moved_to),)))
+
+    def put(self, entry):
+        """
+        Record the pending state of a path.
+
+        :param entry: the pending state (PendingFile)
+        """
+
+        self.pending[entry.path] = entry
+        if entry.source not in (None, entry.path):
+            self.sources[entry.source] = entry.path
+
+    def remove(self, path):
+        """
+        Remove the pending state of a path.
+
+        :param path: the relative path (string)
+
+        :return: the removed state or None if there wasn't any (PendingFile)
+        """
+
+        entry = self.pending.pop(path, None)
+        if entry is not None and entry.source not in (None, entry.path):
+            self.sources.pop(entry.source, None)
+        return entry
+
+    def directory_barrier(self, deleted_path=None):
+        """
+        Queue all pending operations before a directory event, called with the lock held.
+
+        :param deleted_path: the path of a deleted directory, pending new files inside it are dropped (string)
+        """
+
+        if deleted_path is not None:
+            prefix = deleted_path + "/"
+            for entry in list(self.pending.values()):
+                if entry.path.startswith(prefix) and (entry.source is None or entry.source.startswith(prefix)):
+                    self.remove(entry.path)
+
+        self.flush(list(self.pending))
+
+    def flush_due(self):
+        """
+        Send the operations of all paths which have been quiet for long enough or held back for too long.
+        """
+
+        now = self.clock.seconds()
+        with self.lock:
+            due = [entry for entry in self.pending.values() if not entry.hashing and
+                   (now - entry.last_seen >= self.quiet_window or now - entry.first_seen >= self.max_latency)]
+
+            # new files which have to be hashed to be compared with a deleted file wait for their hash
+            hashing = self.detect_renames([entry.path for entry in due], hash_files=True)
+            due = [entry for entry in due if not entry.hashing]
+
+            # a deletion which may be paired with a new file that's still being written (or hashed) waits for it
+            waiting = set(self.pending) - {entry.path for entry in due}
+            due = [entry for entry in due if entry.fingerprint is None or now - entry.first_seen >= self.max_latency
+                   or not any(self.same_size(self.pending[path], entry.fingerprint) for path in waiting)]
+
+            self.flush([entry.path for entry in due], detect=False)
+
+        self.drain()
+
+        for entry, file_stat in hashing:
+            d = threads.deferToThread(file_digest, f"{self.root_path}{entry.path[1:]}")
+            d.addBoth(self.hashed, entry, file_stat)
+
+    def flush_all(self):
+        """
+        Send all pending operations.
+        """
+
+        with self.lock:
+            self.flush(list(self.pending))
+
+        self.drain()
+
+    def hashed(self, result, entry, file_stat):
+        """
+        Called in the reactor thread once a new file has been hashed - it's sent once it's due, as a move if its content
+        is the content of a deleted file.
+
+        :param result: the hash of the file, or the failure of hashing it (bytes or Failure)
+        :param entry: the pending state of the file (PendingFile)
+        :param file_stat: the stat result of the file taken before it was hashed
+        """
+
+        with self.lock:
+            entry.hashing = False
+            digest = result if isinstance(result, bytes) else None
+            entry.digest = (file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino, digest)
+
+        self.flush_due()
+
+    def flush(self, paths, detect=True):
+        """
+        Queue the operations of the given paths to be sent, in the order of their first event.
+
+        :param paths: the relative paths (list of strings)
+        :param detect: False if the moves among the paths have been detected already (bool)
+        """
+
+        if detect:
+            self.detect_renames(paths)
+
+        for path in paths:
+            entry = self.remove(path)
+            if entry is not None:
+                self.ready.append((self.emit, (entry,)))
+
+    def hand_over(self):
+        """
+        Have the reactor thread send the queued operations, called without holding the lock by the thread which queued
+        them - which then waits while the transfer queue is full, so that the events wait in the watchdog queue while
+        the network is slower than the disk.
+        """
+
+        with self.lock:
+            schedule = bool(self.ready) and not self.drain_scheduled
+            if schedule:
+                self.drain_scheduled = True
+
+        if schedule:
+            self.clock.callFromThread(self.drain)
+        self.protocol.wait_for_room()
+
+    def drain(self):
+        """
+        Send the queued operations to the protocol, in the reactor thread - the only thread sending them, so that the
+        server gets them in the order they were queued in (e.g. the operations of the files in a folder before the move
+        of the folder), whichever thread queued them.
+        """
+
+        with self.lock:
+            ready, self.ready = self.ready, []
+            self.drain_scheduled = False
+
+        for func, args in ready:
+            func(*args)
+
+    def detect_renames(self, paths, hash_files=False):
+        """
+        Turn the new files among the given paths which have the same content as a pending deleted file into a move of
+        the deleted file. A new file is only compared if its size is the same as the size of a deleted file - it's the
+        deleted file if its modification time and inode are the same, otherwise their hashes are compared. The hash of
+        the new file is taken from the index, or from an earlier call, if the file hasn't changed since.
+
+        :param paths: the relative paths which are about to be sent (list of strings)
+        :param hash_files: True to hold back the new files which must be hashed, False to send their content (bool)
+
+        :return: the new files to hash in a thread, with their stat result (list of tuples)
+        """
+
+        deleted = [entry for entry in self.pending.values() if entry.deleted and entry.fingerprint is not None]
+        if not deleted:
+            return []
+
+        hashing = []
+        for path in paths:
+            entry = self.pending.get(path)
+            if entry is None or entry.deleted or entry.source is not None or not entry.modified:
+                continue
+
+            abs_path = f"{self.root_path}{path[1:]}"
+            try:
+                file_stat = os.stat(abs_path)
+            except OSError:
+                continue  # let the transfer deal with it
+
+            key = (file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino)
+            candidates = [deletion for deletion in deleted if deletion.fingerprint[0] == file_stat.st_size]
+            if not candidates:
+                continue
+
+            match = next((deletion for deletion in candidates if deletion.fingerprint[:3] == key), None)
+            digest = None
+            if match is None:
+                hashed = entry.digest is not None and entry.digest[:3] == key
+                digest = entry.digest[3] if hashed else self.index.lookup(abs_path, file_stat)
+                if digest is None and hash_files and not hashed and \
+                        any(deletion.fingerprint[3] is not None for deletion in candidates):
+                    entry.hashing = True
+                    hashing.append((entry, file_stat))
+                    continue
+
+                match = next((deletion for deletion in candidates
+                              if digest is not None and deletion.fingerprint[3] == digest), None)
+
+            if match is None:
+                if digest is not None:
+                    self.rename_misses += 1
+                continue
+
+            logging.info(f"{match.path} was moved to {path}, the server copy is moved instead of sending the content")
+            self.renames_detected += 1
+            deleted.remove(match)
+            self.remove(match.path)
+            entry.source, entry.modified = match.path, False
+            self.index.put(path, file_stat, digest or match.fingerprint[3])
+
+        return hashing
+
+    def same_size(self, entry, fingerprint):
+        """
+        :param entry: the pending state of a path (PendingFile)
+        :param fingerprint: the (size, mtime_ns, inode, hash) of a deleted file (tuple)
+
+        :return: True if the path is a new file with the size of the deleted file (bool)
+        """
+
+        if entry.deleted or entry.source is not None or not entry.modified:
+            return False
+
+        try:
+            return os.stat(f"{self.root_path}{entry.path[1:]}").st_size == fingerprint[0]
+        except OSError:
+            return False
+
+    def emit(self, entry):
+        """
+        Send the net operation of a path to the protocol.
+
+        :param entry: the pending state (PendingFile)
+        """
+
+        delay = self.clock.seconds() - entry.first_seen
+        if entry.deleted:
+            EVENT_DELAY.observe(delay, "deleted")
+            self.protocol.send_event("deleted", False, entry.path)
+            return
+
+        if entry.source is not None and entry.source != entry.path:
+            EVENT_DELAY.observe(delay, "moved")
+            self.protocol.send_move_event(False, entry.source, entry.path)
+        elif entry.source is None and not entry.modified:
+            EVENT_DELAY.observe(delay, "created")
+            self.protocol.send_event("created", False, entry.path)
+
+        if entry.modified:
+            EVENT_DELAY.observe(delay, "modified")
+            self.protocol.send_file(entry.path, f"{self.root_path}{entry.path[1:]}")
+
+        event_log.debug(f"Sent net operation for {entry.path}")
@@ -0,0 +1,147 @@
+import logging
+import os
+import threading
+import time
+
+
+# once this many bytes are queued for the server, the threads handing over events are blocked...
+HIGH_WATERMARK = 16 * 1024 * 1024
+
+# ...until the queued bytes drop to this many, so that they are woken up once for a batch of transfers
+LOW_WATERMARK = 4 * 1024 * 1024
+
+
+def frame_cost(frame):
+    """
+    :param frame: a message to send (Frame)
+
+    :return: the bytes the message takes in the queue (int)
+    """
+
+    return len(frame.path) + len(frame.payload)
+
+
+def file_cost(event_path, abs_path):
+    """
+    :param event_path: the relative path of the file sent to the server (string)
+    :param abs_path: the absolute path of the file (string)
+
+    :return: the bytes the transfer of the file takes in the queue, its size at the time it's queued (int)
+    """
+
+    try:
+        size = os.stat(abs_path).st_size
+    except OSError:
+        size = 0  # the transfer will skip it
+
+    return len(event_path) + size
+
+
+class FlowControl:
+    """
+    Bounds the data queued for the server - the messages and the files waiting to be sent by the transfer queue.
+
+    Room is reserved for every message and file before it's queued and released once it has been handed over to the
+    transport. Once the queued bytes reach the high watermark, reserving room blocks until they drop to the low
+    watermark, so the watchdog thread stops reading and hashing files while the network is slower than the disk and
+    the events wait in the watchdog queue instead. Room can also be reserved without blocking, from the reactor
+    thread, which must never block - the callers are expected to check full and hold back until they're notified.
+    Safe to use from several threads.
+    """
+
+    def __init__(self, high_watermark=HIGH_WATERMARK, low_watermark=LOW_WATERMARK):
+        """
+        Initialise the flow control.
+
+        :param high_watermark: the queued bytes at which the producers are held back (int)
+        :param low_watermark: the queued bytes at which they can continue (int)
+        """
+
+        self.high_watermark = high_watermark
+        self.low_watermark = min(low_watermark, high_watermark)
+
+        self.condition = threading.Condition()
+        self.queued = 0
+        self.full = False  # True from reaching the high watermark until dropping to the low watermark
+        self.closed = False
+
+        # metrics
+        self.peak = 0
+        self.throttled = 0  # the number of times a producer was blocked
+        self.throttled_time = 0.0
+
+    def reserve(self, cost, block=True):
+        """
+        Reserve room for a message or a file, waiting for the queue to drain first if it's full.
+
+        :param cost: the bytes of the message or the file (int)
+        :param block: False to reserve the room even if the queue is full, must be False in the reactor thread (bool)
+        """
+
+        with self.condition:
+            if block:
+                self.wait()
+
+            self.queued += cost
+            self.peak = max(self.peak, self.queued)
+            if self.queued >= self.high_watermark:
+                self.full = True
+
+    def wait(self):
+        """
+        Wait for the queue to drain if it's full, never called in the reactor thread.
+        """
+
+        with self.condition:
+            if not self.full or self.closed:
+                return
+
+            logging.info(f"{self.queued} bytes are queued for the server, waiting until they drop to "
+                         f"{self.low_watermark} bytes")
+            start = time.monotonic()
+            while self.full and not self.closed:
+                self.condition.wait()
+
+            self.throttled += 1
+            self.throttled_time += time.monotonic() - start
+
+    def release(self, cost):
+        """
+        Release the room of a message or a file which has been handed over to the transport or dropped.
+
+        :param cost: the bytes reserved for it (int)
+
+        :return: True if the queue just dropped to the low watermark (bool)
+        """
+
+        with self.condition:
+            self.queued -= cost
+            if self.full and self.queued <= self.low_watermark:
+                self.full = False
+                self.condition.notify_all()
+                return True
+
+        return False
+
+    def close(self):
+        """
+        Stop blocking the producers, e.g. when the client is shutting down.
+        """
+
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def stats(self):
+        """
+        :return: the watermarks, the queued bytes and the counters of the flow control (dict)
+        """
+
+        return {
+            "high_watermark": self.high_watermark,
+            "low_watermark": self.low_watermark,
+            "queued_bytes": self.queued,
+            "peak_queued_bytes": self.peak,
+            "throttled": self.throttled,
+            "throttled_seconds": round(self.throttled_time, 3)
+        }
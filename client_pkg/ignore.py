@@ -0,0 +1,194 @@
+import logging
+import os
+import re
+
+
+# the file in the root of the sync folder listing the paths which are not synchronised, in the gitignore syntax
+IGNORE_FILE = ".syncignore"
+
+# characters which make a pattern a glob rather than a literal name
+GLOB_CHARACTERS = frozenset("*?[\\")
+
+
+def translate(pattern):
+    """
+    Translate a gitignore glob to a regular expression - '*' and '?' never match a '/', '**' matches any number of
+    directories.
+
+    :param pattern: the glob, without the leading '!' and the trailing '/' (string)
+
+    :return: the regular expression (string)
+    """
+
+    parts = []
+    index = 0
+    while index < len(pattern):
+        if pattern.startswith("**/", index) and (index == 0 or pattern[index - 1] == "/"):
+            parts.append("(?:.*/)?")
+            index += 3
+        elif pattern.startswith("**", index) and index + 2 == len(pattern) and (index == 0 or pattern[index - 1] == "/"):
+            parts.append(".*")
+            index += 2
+        elif pattern[index] == "*":
+            parts.append("[^/]*")
+            index += 1
+        elif pattern[index] == "?":
+            parts.append("[^/]")
+            index += 1
+        elif pattern[index] == "[" and "]" in pattern[index + 2:]:
+            end = pattern.index("]", index + 2)
+            characters = pattern[index + 1:end]
+            if characters[0] == "!":
+                characters = "^" + characters[1:]
+            parts.append("[" + characters.replace("\\", "\\\\") + "]")
+            index = end + 1
+        elif pattern[index] == "\\" and index + 1 < len(pattern):
+            parts.append(re.escape(pattern[index + 1]))
+            index += 2
+        else:
+            parts.append(re.escape(pattern[index]))
+            index += 1
+
+    return "".join(parts)
+
+
+class IgnoreRules:
+    """
+    The compiled include/exclude rules of the sync folder, in the gitignore syntax - '#' starts a comment, '!' includes
+    again a path excluded by an earlier rule, a trailing '/' only matches directories and a pattern with a '/' anywhere
+    but at its end is matched against the whole path from the root, otherwise against the name at any depth. The last
+    rule matching a path wins and nothing below an excluded directory can be included again.
+
+    The rules are compiled once - literal names ('node_modules', '.git') and extensions ('*.swp') go to hash tables
+    and the remaining globs are combined in a single regular expression for names and one for paths, so matching a path
+    costs a few lookups and at most two regular expression matches, however many rules there are.
+    """
+
+    def __init__(self, lines=()):
+        """
+        Compile the rules.
+
+        :param lines: the lines of the ignore file (iterable of strings)
+        """
+
+        self.count = 0
+        self.names = {}  # literal name -> [(rule number, excluded, directory only)]
+        self.extensions = {}  # extension including its '.' -> [(rule number, excluded, directory only)]
+        self.paths = {}  # literal path from the root -> [(rule number, excluded, directory only)]
+        self.excluded = {}  # rule number -> True if the rule excludes, for the rules in the regular expressions
+        name_globs, path_globs = [], []
+
+        for line in lines:
+            line = line.rstrip("\n")
+            # trailing spaces are ignored unless escaped
+            if not line.endswith("\\ "):
+                line = line.rstrip(" ")
+            if not line or line.startswith("#"):
+                continue
+
+            excluded = not line.startswith("!")
+            pattern = line if excluded else line[1:]
+            if pattern.startswith("\\") and pattern[1:2] in ("#", "!"):
+                pattern = pattern[1:]
+
+            directory_only = pattern.endswith("/")
+            pattern = pattern.rstrip("/")
+            if not pattern:
+                continue
+
+            anchored = "/" in pattern
+            pattern = pattern.lstrip("/")
+            rule = (self.count, excluded, directory_only)
+            self.count += 1
+
+            if not GLOB_CHARACTERS.intersection(pattern):
+                (self.paths if anchored else self.names).setdefault(pattern, []).append(rule)
+            elif not anchored and pattern.startswith("*.") and not GLOB_CHARACTERS.intersection(pattern[1:]):
+                self.extensions.setdefault(pattern[1:], []).append(rule)
+            else:
+                # the subject of a glob ends with a '/' if it's a directory
+                self.excluded[rule[0]] = excluded
+                alternative = f"(?P<r{rule[0]}>{translate(pattern)}{'/' if directory_only else '/?'})"
+                (path_globs if anchored else name_globs).append(alternative)
+
+        # the alternatives are tried in order, so the last rule comes first
+        self.name_regex = re.compile("|".join(reversed(name_globs))) if name_globs else None
+        self.path_regex = re.compile("|".join(reversed(path_globs))) if path_globs else None
+
+    @classmethod
+    def load(cls, root_path):
+        """
+        :param root_path: the path of the folder that's being synchronised (string)
+
+        :return: the rules of the ignore file in the folder, no rules if there isn't one (IgnoreRules)
+        """
+
+        try:
+            with open(os.path.join(root_path, IGNORE_FILE), encoding="utf-8") as fh:
+                rules = cls(fh)
+        except FileNotFoundError:
+            return cls()
+
+        logging.info(f"Loaded {rules.count} ignore rules from {IGNORE_FILE}")
+        return rules
+
+    def __bool__(self):
+        """
+        :return: True if there is at least one rule (bool)
+        """
+
+        return self.count > 0
+
+    def match(self, path, is_directory):
+        """
+        :param path: a path relative to the sync folder, without the leading './' (string)
+        :param is_directory: True if the path is a directory (bool)
+
+        :return: True if the last rule matching the path excludes it, False if it includes it, None if no rule matches
+        """
+
+        name = path[path.rfind("/") + 1:]
+        best = (-1, None)
+
+        for rules in (self.names.get(name), self.paths.get(path)):
+            for number, excluded, directory_only in reversed(rules or ()):
+                if number > best[0] and (is_directory or not directory_only):
+                    best = (number, excluded)
+                    break
+
+        dot = name.find(".", 1)
+        while dot != -1:
+            for number, excluded, directory_only in reversed(self.extensions.get(name[dot:], ())):
+                if number > best[0] and (is_directory or not directory_only):
+                    best = (number, excluded)
+                    break
+            dot = name.find(".", dot + 1)
+
+        suffix = "/" if is_directory else ""
+        for regex, subject in ((self.name_regex, name), (self.path_regex, path)):
+            match = regex.fullmatch(subject + suffix) if regex is not None else None
+            if match is not None and int(match.lastgroup[1:]) > best[0]:
+                number = int(match.lastgroup[1:])
+                best = (number, self.excluded[number])
+
+        return best[1]
+
+    def ignored(self, relative_path, is_directory):
+        """
+        :param relative_path: a path relative to the sync folder, starting with '.' (string)
+        :param is_directory: True if the path is a directory (bool)
+
+        :return: True if the path or a directory above it is excluded (bool)
+        """
+
+        if not self.count:
+            return False
+
+        path = relative_path[2:]
+        start = path.find("/")
+        while start != -1:
+            if self.match(path[:start], True):
+                return True
+            start = path.find("/", start + 1)
+
+        return bool(path) and self.match(path, is_directory) is True
@@ -0,0 +1,293 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from common_pkg.manifest import file_digest
+from common_pkg.versions import decode_vector, encode_vector, increment, merge
+
+
+# the version of the schema of the index, an index with a different version is rebuilt from scratch
+SCHEMA_VERSION = 2
+
+# updates are committed in batches of this many rows, or once this many seconds have passed since the last commit -
+# losing the last few updates in a crash only means that the affected files are hashed again
+COMMIT_BATCH = 1000
+COMMIT_INTERVAL = 1.0
+
+
+def default_state_path(root_path, extension):
+    """
+    :param root_path: the path of the folder that's being synchronised (string)
+    :param extension: the extension of the file, e.g. 'sqlite' for the index (string)
+
+    :return: the default location of a file holding the state of the client for the folder, outside of the folder so
+             that it's never synchronised (string)
+    """
+
+    name = root_path.strip(os.sep).replace(os.sep, "_") or "root"
+    return os.path.join(os.path.expanduser("~"), ".syncapp", f"{name}.{extension}")
+
+
+class FileIndex:
+    """
+    A persistent index of the files in the sync folder - the size, modification time, inode and content hash of every file
+    as of the last time it was hashed, keyed by its path relative to the folder.
+
+    The index lets the event handler tell apart a real change from a touch, a metadata only change or a tool rewriting the
+    same content, and it survives restarts, so the reconciliation on connect only hashes files which changed since. Rows
+    are looked up on demand (nothing is loaded on startup) and can be used from several threads.
+
+    The index also offers the interface of common_pkg.manifest.HashCache, so it can back the manifests.
+
+    With bidirectional sync, the index also keeps the version vector of every file (see common_pkg.versions). The
+    vector of a deleted file is kept, so that a file created again at its path is newer than the deleted one.
+    """
+
+    def __init__(self, db_path, root_path):
+        """
+        Open the index, creating it if it doesn't exist.
+
+        :param db_path: the path of the database file (string)
+        :param root_path: the path of the folder that's being synchronised (string)
+        """
+
+        self.root_path = root_path
+        self.lock = threading.Lock()
+
+        if db_path != ":memory:":
+            os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+
+        self.db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+
+        if self.db.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+            logging.info(f"Creating the file index {db_path}")
+            self.db.execute("DROP TABLE IF EXISTS files")
+            self.db.execute("DROP TABLE IF EXISTS versions")
+            self.db.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+
+        # paths are stored as bytes, file names don't have to be valid UTF-8
+        self.db.execute("CREATE TABLE IF NOT EXISTS files (path BLOB PRIMARY KEY, size INTEGER, mtime_ns INTEGER, "
+                        "inode INTEGER, digest BLOB) WITHOUT ROWID")
+        self.db.execute("CREATE TABLE IF NOT EXISTS versions (path BLOB PRIMARY KEY, vector BLOB) WITHOUT ROWID")
+
+        self.db.execute("BEGIN")
+        self.uncommitted = 0
+        self.committed_at = time.monotonic()
+
+        # metrics
+        self.hits = 0  # events skipped because the file didn't change
+        self.misses = 0  # events for files which changed
+
+    def key(self, relative_path):
+        """
+        :param relative_path: a path relative to the sync folder, starting with '.' (string)
+
+        :return: the key of the path in the index (bytes)
+        """
+
+        return os.fsencode(relative_path)
+
+    def relative_path(self, abs_path):
+        """
+        :param abs_path: the absolute path of a file in the sync folder (string)
+
+        :return: the path relative to the sync folder, starting with '.' (string)
+        """
+
+        return f".{abs_path[len(self.root_path):]}"
+
+    def get(self, relative_path):
+        """
+        :param relative_path: the path of a file relative to the sync folder (string)
+
+        :return: the indexed (size, mtime_ns, inode, hash) tuple of the file, None if it isn't indexed
+        """
+
+        with self.lock:
+            return self.db.execute("SELECT size, mtime_ns, inode, digest FROM files WHERE path = ?",
+                                   (self.key(relative_path),)).fetchone()
+
+    def put(self, relative_path, file_stat, digest):
+        """
+        :param relative_path: the path of a file relative to the sync folder (string)
+        :param file_stat: the stat result of the file taken before it was hashed
+        :param digest: the hash of its content, None if it hasn't been hashed (bytes)
+        """
+
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+                            (self.key(relative_path), file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino, digest))
+            self.updated()
+
+    def remove(self, relative_path):
+        """
+        Forget a file, or a directory and everything below it.
+
+        :param relative_path: the path relative to the sync folder (string)
+        """
+
+        key = self.key(relative_path)
+        with self.lock:
+            # the children of a directory are the keys between 'path/' and 'path0' - '0' follows '/'
+            self.db.execute("DELETE FROM files WHERE path = ? OR (path >= ? AND path < ?)", (key, key + b"/", key + b"0"))
+            self.updated()
+
+    def move(self, src_path, dest_path):
+        """
+        Move the rows of a file, or a directory and everything below it.
+
+        :param src_path: the old path relative to the sync folder (string)
+        :param dest_path: the new path relative to the sync folder (string)
+        """
+
+        src_key, dest_key = self.key(src_path), self.key(dest_path)
+        with self.lock:
+            for table in ("files", "versions"):
+                # whatever was at the destination has been replaced
+                self.db.execute(f"DELETE FROM {table} WHERE path = ? OR (path >= ? AND path < ?)",
+                                (dest_key, dest_key + b"/", dest_key + b"0"))
+                self.db.execute(f"UPDATE {table} SET path = CAST(? || substr(path, ?) AS BLOB) "
+                                "WHERE path = ? OR (path >= ? AND path < ?)", (dest_key, len(src_key) + 1, src_key, src_key + b"/", src_key + b"0"))
+            self.updated()
+
+    def version(self, relative_path):
+        """
+        :param relative_path: the path of a file relative to the sync folder (string)
+
+        :return: the version vector of the file, empty if it has none (dict)
+        """
+
+        with self.lock:
+            row = self.db.execute("SELECT vector FROM versions WHERE path = ?", (self.key(relative_path),)).fetchone()
+
+        return decode_vector(row[0]) if row is not None else {}
+
+    def set_version(self, relative_path, vector):
+        """
+        :param relative_path: the path of a file relative to the sync folder (string)
+        :param vector: the version vector of its content, merged with the vector the file already has (dict)
+
+        :return: the merged vector (dict)
+        """
+
+        with self.lock:
+            return self.store_version(relative_path, lambda current: merge(vector, current))
+
+    def bump(self, relative_path, replica):
+        """
+        Record a local change of a file.
+
+        :param relative_path: the path of a file relative to the sync folder (string)
+        :param replica: the id of this replica (string)
+
+        :return: the version vector of the change (dict)
+        """
+
+        with self.lock:
+            return self.store_version(relative_path, lambda current: increment(current, replica))
+
+    def store_version(self, relative_path, update):
+        """
+        Update the version vector of a file, the lock must be held.
+
+        :param relative_path: the path of a file relative to the sync folder (string)
+        :param update: called with the current vector, returns the new one
+
+        :return: the new vector (dict)
+        """
+
+        key = self.key(relative_path)
+        row = self.db.execute("SELECT vector FROM versions WHERE path = ?", (key,)).fetchone()
+        vector = update(decode_vector(row[0]) if row is not None else {})
+        self.db.execute("INSERT OR REPLACE INTO versions VALUES (?, ?)", (key, encode_vector(vector)))
+        self.updated()
+        return vector
+
+    def updated(self):
+        """
+        Commit the pending updates if there are enough of them or they are old enough, the lock must be held.
+        """
+
+        self.uncommitted += 1
+        if self.uncommitted >= COMMIT_BATCH or time.monotonic() - self.committed_at >= COMMIT_INTERVAL:
+            self.commit()
+
+    def commit(self):
+        """
+        Commit the pending updates, the lock must be held.
+        """
+
+        self.db.execute("COMMIT")
+        self.db.execute("BEGIN")
+        self.uncommitted = 0
+        self.committed_at = time.monotonic()
+
+    def close(self):
+        """
+        Commit the pending updates and close the database.
+        """
+
+        with self.lock:
+            self.db.execute("COMMIT")
+            self.db.close()
+
+        logging.info(f"File index closed - {self.hits} unchanged files skipped, {self.misses} changed files sent")
+
+    def changed(self, relative_path, abs_path):
+        """
+        Check if a file has changed since it was last indexed and index it again if it has. The file is only read if its
+        size, modification time or inode changed but its size is the same as before - a touch or a rewrite of the same
+        content.
+
+        :param relative_path: the path of the file relative to the sync folder (string)
+        :param abs_path: the absolute path of the file (string)
+
+        :return: False if the content of the file is the same as the indexed content (bool)
+        """
+
+        try:
+            file_stat = os.stat(abs_path)
+            entry = self.get(relative_path)
+
+            if entry is not None and entry[:3] == (file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino):
+                self.hits += 1
+                return False
+
+            # a file whose size changed has changed, it's hashed the next time its size stays the same
+            digest = file_digest(abs_path) if entry is not None and entry[0] == file_stat.st_size else None
+        except OSError:
+            return True  # let the transfer deal with it
+
+        self.put(relative_path, file_stat, digest)
+        if digest is not None and entry[3] == digest:
+            self.hits += 1
+            return False
+
+        self.misses += 1
+        return True
+
+    def lookup(self, abs_path, file_stat):
+        """
+        :param abs_path: the absolute path of a file (string)
+        :param file_stat: the current stat result of the file
+
+        :return: the indexed hash or None if the file has changed since it was hashed (bytes)
+        """
+
+        entry = self.get(self.relative_path(abs_path))
+        if entry is not None and entry[:3] == (file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino):
+            return entry[3]
+
+        return None
+
+    def update(self, abs_path, file_stat, digest):
+        """
+        :param abs_path: the absolute path of a file (string)
+        :param file_stat: the stat result of the file taken before it was hashed
+        :param digest: the hash of its content (bytes)
+        """
+
+        self.put(self.relative_path(abs_path), file_stat, digest)
@@ -0,0 +1,382 @@
+import bisect
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+from twisted.internet import reactor, threads
+from twisted.internet.task import LoopingCall
+from common_pkg.framing import Frame, FLAG_DIRECTORY, MSG_CREATED, MSG_DELETED, MSG_MODIFIED, MSG_MOVED, MSG_VERSION
+
+
+# every record starts with the length and the CRC32 of its body, so that a torn write at the end is detected on load
+RECORD = struct.Struct("!II")
+
+# the body of a record - sequence number, message type, flags and path length, followed by the path and the payload
+ENTRY = struct.Struct("!QBBH")
+
+# the message type of the records marking every operation up to their sequence number as acknowledged
+ACK_RECORD = 0
+
+# appended records are fsynced together in a thread, at most this many seconds after they were written
+SYNC_INTERVAL = 0.1
+
+# the journal file is compacted once it's at least this big and at least twice the size of the pending records
+COMPACT_MIN_SIZE = 1024 * 1024
+
+# upper limit for the size of the pending records - if it's reached the pending operations are dropped and only a
+# reconciliation can bring the server up to date
+MAX_JOURNAL_SIZE = 64 * 1024 * 1024
+
+
+def encode_record(seq, frame):
+    """
+    :param seq: the sequence number of the record (int)
+    :param frame: the operation (Frame)
+
+    :return: the encoded record (bytes)
+    """
+
+    body = ENTRY.pack(seq, frame.msg_type, frame.flags, len(frame.path)) + frame.path + frame.payload
+    return RECORD.pack(len(body), zlib.crc32(body)) + body
+
+
+def decode_records(data):
+    """
+    Decode the records of a journal file, stopping at the first incomplete or corrupted record.
+
+    :param data: the content of the file (bytes)
+
+    :return: a tuple of two values - the list of (sequence number, Frame) tuples and the size of the valid data
+    """
+
+    records = []
+    position = 0
+    while position + RECORD.size <= len(data):
+        length, crc = RECORD.unpack_from(data, position)
+        body = data[position + RECORD.size:position + RECORD.size + length]
+        if len(body) != length or length < ENTRY.size or zlib.crc32(body) != crc:
+            break
+
+        seq, msg_type, flags, path_length = ENTRY.unpack_from(body)
+        path = body[ENTRY.size:ENTRY.size + path_length]
+        records.append((seq, Frame(msg_type, flags, path, body[ENTRY.size + path_length:])))
+        position += RECORD.size + length
+
+    return records, position
+
+
+def fold(records):
+    """
+    Drop the operations made redundant by a later operation on the same file - an upload or a creation of a file
+    followed by another upload or by its deletion, with no operation in between involving the file or a directory. The
+    version of a file recorded ahead of an operation goes with it.
+
+    :param records: the pending records, in order (list of (sequence number, Frame) tuples)
+
+    :return: the records which are left, in order (list of (sequence number, Frame) tuples)
+    """
+
+    kept = []
+    superseded = set()  # paths of files uploaded/deleted later on, with nothing in between involving them
+    dropped = set()  # paths of files whose next operation has been dropped
+    for seq, frame in reversed(records):
+        if frame.msg_type == MSG_VERSION:
+            if frame.path not in dropped:
+                kept.append((seq, frame))
+            continue
+
+        dropped.discard(frame.path)
+        if frame.flags & FLAG_DIRECTORY:
+            superseded.clear()
+            kept.append((seq, frame))
+            continue
+
+        if frame.msg_type in (MSG_CREATED, MSG_MODIFIED) and frame.path in superseded:
+            dropped.add(frame.path)
+            continue
+
+        kept.append((seq, frame))
+        if frame.msg_type == MSG_MOVED:
+            superseded.discard(frame.path)
+            superseded.discard(frame.payload)
+        elif frame.msg_type in (MSG_MODIFIED, MSG_DELETED):
+            superseded.add(frame.path)
+        else:
+            superseded.discard(frame.path)
+
+    kept.reverse()
+    return kept
+
+
+class Journal:
+    """
+    A durable, append-only log of the operations which haven't been acknowledged by the server yet.
+
+    Every event is recorded whatever the state of the connection, so no change is lost while the client is offline or
+    if it crashes - the pending operations are replayed in order once the client is connected again. The records of
+    uploads only hold the path of the file, its current content is sent when the record is replayed. Appended records
+    are fsynced in groups by a thread, at most SYNC_INTERVAL seconds after they were written, so that neither the
+    watchdog thread nor the reactor thread waits for the disk, and the file is compacted in the background once most of
+    it consists of acknowledged or redundant records. Safe to use from several threads.
+    """
+
+    def __init__(self, path, max_size=MAX_JOURNAL_SIZE):
+        """
+        Open the journal, loading the pending records.
+
+        :param path: the path of the journal file (string)
+        :param max_size: upper limit for the size of the pending records (int)
+        """
+
+        self.path = path
+        self.max_size = max_size
+        self.lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        try:
+            with open(path, "rb") as fh:
+                data = fh.read()
+        except FileNotFoundError:
+            data = b""
+
+        records, valid_size = decode_records(data)
+        if valid_size < len(data):
+            logging.warning(f"Discarding {len(data) - valid_size} bytes of incomplete records at the end of {path}")
+            with open(path, "r+b") as fh:
+                fh.truncate(valid_size)
+
+        self.acked = 0  # every operation up to this sequence number has been acknowledged
+        self.last_seq = 0
+        for seq, frame in records:
+            self.last_seq = max(self.last_seq, seq)
+            if frame.msg_type == ACK_RECORD:
+                self.acked = max(self.acked, seq)
+
+        self.records = [(seq, frame) for seq, frame in records if frame.msg_type != ACK_RECORD and seq > self.acked]
+        self.pending_size = sum(RECORD.size + ENTRY.size + len(frame.path) + len(frame.payload)
+                                for _, frame in self.records)
+
+        self.fh = open(path, "ab")
+        self.file_size = valid_size
+        self.dirty = False
+        self.overflowed = False  # True if pending operations have been dropped since the last connection
+        self.busy = False  # True while the journal is being maintained in a thread
+        self.maintenance = None
+
+        # metrics
+        self.appended = 0
+        self.acknowledged = 0
+        self.folded = 0
+        self.compactions = 0
+
+        if self.records:
+            logging.info(f"Loaded {len(self.records)} pending operations from {path}")
+
+    def start(self, clock=reactor):
+        """
+        Start syncing and compacting the journal periodically, in a thread.
+
+        :param clock: the reactor used for scheduling (IReactorTime)
+        """
+
+        self.maintenance = LoopingCall(self.maintain)
+        self.maintenance.clock = clock
+        self.maintenance.start(SYNC_INTERVAL, now=False)
+
+    def maintain(self):
+        """
+        Sync the records written since the last sync and compact the file if it's worth it, in a thread.
+        """
+
+        if self.busy or not (self.dirty or self.worth_compacting()):
+            return
+
+        self.busy = True
+        d = threads.deferToThread(self.sync_and_compact)
+        d.addErrback(lambda failure: logging.warning(f"Journal maintenance failed - {failure.getErrorMessage()}"))
+        d.addBoth(lambda _: setattr(self, "busy", False))
+
+    def sync_and_compact(self):
+        """
+        Sync the journal and compact it if it's worth it.
+        """
+
+        self.sync()
+        with self.lock:
+            if self.worth_compacting():
+                self.compact()
+
+    def append(self, frame):
+        """
+        Record an operation.
+
+        :param frame: the operation, the payload of an upload is the absolute path of the file (Frame)
+
+        :return: the sequence number of the operation (int)
+        """
+
+        with self.lock:
+            self.last_seq += 1
+            seq = self.last_seq
+
+            if self.pending_size >= self.max_size:
+                if not self.overflowed:
+                    logging.warning(f"The journal is full, dropping {len(self.records)} pending operations - "
+                                    f"changes are only recovered by reconciling the folder with the server")
+                self.overflowed = True
+                self.acknowledge_locked(seq)
+                return seq
+
+            self.write(seq, frame)
+            self.records.append((seq, frame))
+            self.pending_size += RECORD.size + ENTRY.size + len(frame.path) + len(frame.payload)
+            self.appended += 1
+
+            return seq
+
+    def acknowledge(self, seq):
+        """
+        Drop the operations acknowledged by the server.
+
+        :param seq: every operation up to this sequence number has been applied (int)
+        """
+
+        with self.lock:
+            self.acknowledge_locked(seq)
+
+    def acknowledge_locked(self, seq):
+        """
+        Drop the acknowledged operations, the lock must be held.
+
+        :param seq: every operation up to this sequence number has been applied (int)
+        """
+
+        if seq <= self.acked:
+            return
+
+        self.acked = seq
+        self.write(seq, Frame(ACK_RECORD, 0, b"", b""))
+
+        # the records are ordered by their unique sequence numbers, (seq + 1,) sorts before the record numbered seq + 1
+        index = bisect.bisect_left(self.records, (seq + 1,))
+        for _, frame in self.records[:index]:
+            self.pending_size -= RECORD.size + ENTRY.size + len(frame.path) + len(frame.payload)
+        self.acknowledged += index
+        del self.records[:index]
+
+    def pending(self, after, limit):
+        """
+        :param after: the sequence number of the last operation already sent (int)
+        :param limit: the maximum number of operations to return (int)
+
+        :return: the pending operations following the given one, in order (list of (sequence number, Frame) tuples)
+        """
+
+        with self.lock:
+            index = bisect.bisect_left(self.records, (after + 1,))
+            return self.records[index:index + limit]
+
+    def write(self, seq, frame):
+        """
+        Append a record to the file - it's synced by the next maintenance, the lock must be held.
+
+        :param seq: the sequence number of the record (int)
+        :param frame: the operation (Frame)
+        """
+
+        record = encode_record(seq, frame)
+        self.fh.write(record)
+        self.file_size += len(record)
+        self.dirty = True
+
+    def sync(self):
+        """
+        Flush the written records to disk - in the maintenance thread, or when the journal is closed. The lock is only
+        held while the records are handed over to the OS, not during the fsync, so that appending and acknowledging
+        operations never wait for the disk.
+        """
+
+        with self.lock:
+            if not self.dirty:
+                return
+
+            self.fh.flush()
+            self.dirty = False
+            # the file may be closed or replaced by a compaction meanwhile, the duplicate refers to the written records
+            fd = os.dup(self.fh.fileno())
+
+        try:
+            os.fsync(fd)
+        except OSError:
+            with self.lock:
+                self.dirty = True
+            raise
+        finally:
+            os.close(fd)
+
+    def worth_compacting(self):
+        """
+        :return: True if most of the file consists of acknowledged or redundant records (bool)
+        """
+
+        return self.file_size >= COMPACT_MIN_SIZE and self.file_size >= 2 * self.pending_size
+
+    def compact(self):
+        """
+        Rewrite the file with the pending records only, dropping the redundant ones, the lock must be held.
+        """
+
+        start = time.monotonic()
+        records = fold(self.records)
+        self.folded += len(self.records) - len(records)
+
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "wb") as fh:
+            # the acknowledged sequence number must survive, so that the numbering continues
+            fh.write(encode_record(self.acked, Frame(ACK_RECORD, 0, b"", b"")))
+            for seq, frame in records:
+                fh.write(encode_record(seq, frame))
+            fh.flush()
+            os.fsync(fh.fileno())
+
+        self.fh.close()
+        os.replace(temp_path, self.path)
+        self.fh = open(self.path, "ab")
+
+        self.records = records
+        self.pending_size = sum(RECORD.size + ENTRY.size + len(frame.path) + len(frame.payload) for _, frame in records)
+        self.file_size = os.path.getsize(self.path)
+        self.compactions += 1
+
+        logging.info(f"Journal compacted in {time.monotonic() - start:.3f} seconds - {self.stats()}")
+
+    def stats(self):
+        """
+        :return: the counters of the journal (dict)
+        """
+
+        return {
+            "pending": len(self.records),
+            "pending_bytes": self.pending_size,
+            "file_bytes": self.file_size,
+            "appended": self.appended,
+            "acknowledged": self.acknowledged,
+            "folded": self.folded,
+            "compactions": self.compactions
+        }
+
+    def close(self):
+        """
+        Sync the journal and close the file.
+        """
+
+        if self.maintenance is not None and self.maintenance.running:
+            self.maintenance.stop()
+
+        self.sync()
+        with self.lock:
+            self.fh.close()
+
+        logging.info(f"Journal closed - {self.stats()}")
@@ -2,6 +2,29 @@ import logging
 import os
 from watchdog.events import FileSystemEventHandler
 from watchdog.observers import Observer
+from client_pkg.coalescing import EventCoalescer, MAX_LATENCY
+from client_pkg.reconcile import Reconciler
+from client_pkg.remote import RemoteChanges
+from common_pkg.echo import EchoFilter
+from common_pkg.logs import event_log
+from common_pkg.metrics import REGISTRY
+
+
+# the events received from watchdog, see common_pkg.metrics
+EVENTS = REGISTRY.counter("syncapp_client_events_total", "Filesystem events received from watchdog", ("type",))
+
+
+def file_size(abs_path):
+    """
+    :param abs_path: the absolute path of a file (string)
+
+    :return: the size of the file, 0 if it doesn't exist anymore (int)
+    """
+
+    try:
+        return os.stat(abs_path).st_size
+    except OSError:
+        return 0
 
 
 class SyncEventHandler(FileSystemEventHandler):
@@ -9,16 +32,83 @@ class SyncEventHandler(FileSystemEventHandler):
     A custom event handler for monitoring folder/file changes.
     """
 
-    def __init__(self, protocol_instance, root_path):
+    def __init__(self, protocol_instance, root_path, index=None, ignore=None):
         """
         Initialise the event handler.
 
         :param protocol_instance: reference to the protocol object used to communicate with server
         :param root_path: the path of the folder that's being monitored
+        :param index: the persistent index of the files in the folder, used to skip files which haven't changed (FileIndex)
+        :param ignore: the rules of the paths which are not synchronised (IgnoreRules)
         """
 
         self.protocol = protocol_instance
         self.root_path = root_path
+        self.index = index
+        self.ignore = ignore
+        # the watches of the observer, set if ignored directories are left out of them (WatchScheduler)
+        self.watches = None
+        # set with bidirectional sync, counts the local changes and recognises the echoes of the pushed ones (RemoteChanges)
+        self.remote = None
+
+    def dispatch(self, event):
+        """
+        Dispatch an event to its handler, unless it was caused by applying a change pushed by the server.
+
+        :param event: reference to the watchdog event object
+        """
+
+        if self.remote is not None and (self.remote.echo.match(event.src_path) is not None or
+                                        getattr(event, "dest_path", None) and
+                                        self.remote.echo.match(event.dest_path) is not None):
+            event_log.debug(f"Dropping the echo of a pushed change - {event.event_type} - {event.src_path}")
+            return
+
+        super().dispatch(event)
+
+    def changed_locally(self, relative_path):
+        """
+        Count a local change of a file in its version, with bidirectional sync.
+
+        :param relative_path: the path of the file relative to the sync folder (string)
+        """
+
+        if self.remote is not None:
+            self.remote.local_change(relative_path)
+
+    def ignored(self, relative_path, is_directory):
+        """
+        :param relative_path: the path of the event file/folder relative to the sync folder (string)
+        :param is_directory: True if the path is a directory (bool)
+
+        :return: True if the path must not be synchronised (bool)
+        """
+
+        return self.ignore is not None and self.ignore.ignored(relative_path, is_directory)
+
+    def send_tree(self, abs_path):
+        """
+        Send the folders and files below a folder which appeared without events for its content, e.g. moved from an
+        ignored path.
+
+        :param abs_path: the absolute path of the folder (string)
+        """
+
+        for dir_path, dir_names, file_names in os.walk(abs_path):
+            # ignored directories are pruned from the walk
+            dir_names[:] = [name for name in sorted(dir_names)
+                            if not self.ignored(os.path.join(dir_path, name).replace(self.root_path, ".", 1), True)]
+
+            for name in dir_names:
+                self.protocol.send_event("created", True, os.path.join(dir_path, name).replace(self.root_path, ".", 1))
+
+            for name in sorted(file_names):
+                file_path = os.path.join(dir_path, name)
+                relative_path = file_path.replace(self.root_path, ".", 1)
+                if not self.ignored(relative_path, False):
+                    self.changed_locally(relative_path)
+                    self.protocol.send_event("created", False, relative_path)
+                    self.protocol.send_file(relative_path, file_path)
 
     def on_any_event(self, event):
         """
@@ -27,7 +117,8 @@ class SyncEventHandler(FileSystemEventHandler):
         :param event: referene to the watchdog event object
         """
 
-        logging.info(f"New event - {event.event_type} - {'directory' if event.is_directory else 'file'} - {event.src_path}")
+        EVENTS.inc(event.event_type)
+        event_log.info(f"New event - {event.event_type} - {'directory' if event.is_directory else 'file'} - {event.src_path}")
 
     def on_created(self, event):
         """
@@ -45,12 +136,32 @@ class SyncEventHandler(FileSystemEventHandler):
         event_type = event.event_type
         is_directory = event.is_directory
 
-        # only propagate changes if there is a connection with the server
-        if self.protocol.connected:
+        if self.ignored(relative_event_path, is_directory):
+            return
+
+        # a new file has never been sent, forget whatever was indexed at the path before
+        if self.index is not None:
+            self.index.remove(relative_event_path)
+
+        # only propagate changes if there is a connection with the server or a journal to record them in
+        if self.protocol.accepting_events:
             self.protocol.send_event(event_type, is_directory, relative_event_path)
+            # a file moved in from an unwatched (e.g. ignored) folder is reported as created, with no modified event -
+            # its content is sent only with the index, which keeps the modified event of a file created here with the
+            # same content from sending it again
+            if not is_directory and self.index is not None and file_size(abs_path) > 0 and \
+                    self.index.changed(relative_event_path, abs_path):
+                self.changed_locally(relative_event_path)
+                self.protocol.send_file(relative_event_path, abs_path)
         else:
             logging.warning("Connection with server has not been established, 'create' changes will not be propagated.")
 
+        # a folder created in a folder watched without its subfolders gets its own watch, its content may have been
+        # created before the watch
+        if is_directory and self.watches is not None and self.watches.directory_created(abs_path) \
+                and self.protocol.accepting_events:
+            self.send_tree(abs_path)
+
     def on_deleted(self, event):
         """
         Called when a 'deleted' event is emitted.
@@ -67,12 +178,25 @@ class SyncEventHandler(FileSystemEventHandler):
         event_type = event.event_type
         is_directory = event.is_directory
 
-        # only propagate changes if there is a connection with the server
-        if self.protocol.connected:
+        if self.ignored(relative_event_path, is_directory):
+            return
+
+        if is_directory and self.watches is not None:
+            self.watches.directory_removed(abs_path)
+
+        if not is_directory:
+            self.changed_locally(relative_event_path)
+
+        # only propagate changes if there is a connection with the server or a journal to record them in
+        if self.protocol.accepting_events:
             self.protocol.send_event(event_type, is_directory, relative_event_path)
         else:
             logging.info("Connection with server has not been established, 'delete' changes will not be propagated.")
 
+        # forgotten only once the event has been recorded, the coalescer looks up the hash of a deleted file
+        if self.index is not None:
+            self.index.remove(relative_event_path)
+
     def on_modified(self, event):
         """
         Called when a 'modified' event is emitted.
@@ -90,19 +214,26 @@ class SyncEventHandler(FileSystemEventHandler):
 
         # modified events are emitted for folders if something inside them has changed, do not propagate these to server
         if is_directory:
-            logging.info(f"Modified events for directories are not propagated to server.")
+            event_log.debug(f"Modified events for directories are not propagated to server - {abs_path}")
+            return
+
+        # checked before the file is touched
+        if self.ignored(relative_event_path, False):
             return
 
         # make sure the file exists
         if os.path.exists(abs_path):
 
-            # read the file content
-            with open(abs_path, "rb") as fh:
-                content = fh.read()
+            # propagate the content of the modified file if server connection is established (or there's a journal),
+            # it is streamed in chunks
+            if self.protocol.accepting_events:
+                # touches, metadata changes and rewrites of the same content don't need to be sent
+                if self.index is not None and not self.index.changed(relative_event_path, abs_path):
+                    event_log.info(f"The content of {abs_path} has not changed, it will not be sent again")
+                    return
 
-            # if server connection is established propagate the content of the modified file
-            if self.protocol.connected:
-                self.protocol.send_modify_event(relative_event_path, content)
+                self.changed_locally(relative_event_path)
+                self.protocol.send_file(relative_event_path, abs_path)
             else:
                 logging.info("Connection with server has not been established, changes will not be propagated.")
         else:
@@ -120,25 +251,196 @@ class SyncEventHandler(FileSystemEventHandler):
         destination_path = event.dest_path.replace(self.root_path, '.')
         is_directory = event.is_directory
 
-        # propagate the moved event if server connection is established
-        if self.protocol.connected:
+        source_ignored = self.ignored(source_path, is_directory)
+        destination_ignored = self.ignored(destination_path, is_directory)
+        if source_ignored and destination_ignored:
+            return
+
+        if is_directory and self.watches is not None:
+            self.watches.directory_removed(event.src_path)
+            self.watches.directory_created(event.dest_path)
+
+        # moved out of sight - deleted as far as the server is concerned
+        if destination_ignored:
+            if not is_directory:
+                self.changed_locally(source_path)
+            if self.protocol.accepting_events:
+                self.protocol.send_event("deleted", is_directory, source_path)
+            if self.index is not None:
+                self.index.remove(source_path)
+            return
+
+        # moved from an ignored path - the server has never seen it
+        if source_ignored:
+            if self.index is not None:
+                self.index.remove(destination_path)
+            if self.protocol.accepting_events:
+                self.protocol.send_event("created", is_directory, destination_path)
+                if is_directory:
+                    self.send_tree(event.dest_path)
+                else:
+                    self.changed_locally(destination_path)
+                    self.protocol.send_file(destination_path, event.dest_path)
+            return
+
+        if self.index is not None:
+            self.index.move(source_path, destination_path)
+
+        # propagate the moved event if server connection is established (or there's a journal)
+        if self.protocol.accepting_events:
             self.protocol.send_move_event(is_directory, source_path, destination_path)
         else:
             logging.info("Connection with server has not been established, changes will not be propagated.")
 
 
-def create_observer(protocol_instance, path):
+class WatchScheduler:
+    """
+    Schedules the watches of the observer so that ignored folders are never watched - a folder without any ignored
+    folder below it gets a single recursive watch, any other folder is watched without its subfolders and its subfolders
+    are scheduled in turn. Folders created later in a folder watched without its subfolders are scheduled as they appear.
+    """
+
+    def __init__(self, observer, handler, root_path, ignore):
+        """
+        Initialise the scheduler.
+
+        :param observer: the watchdog observer
+        :param handler: the event handler of the watches (SyncEventHandler)
+        :param root_path: the path of the folder that's being monitored (string)
+        :param ignore: the rules of the paths which are not synchronised (IgnoreRules)
+        """
+
+        self.observer = observer
+        self.handler = handler
+        self.root_path = root_path
+        self.ignore = ignore
+
+        self.watches = {}  # absolute path of a watched folder -> watch
+        self.shallow = set()  # absolute paths of the folders watched without their subfolders
+
+    def plan(self, abs_path):
+        """
+        :param abs_path: the absolute path of a folder (string)
+
+        :return: the watches covering the folder and everything below it which isn't ignored, the watch of the folder
+                 comes first (list of (absolute path, recursive) tuples)
+        """
+
+        try:
+            with os.scandir(abs_path) as it:
+                entries = list(it)
+        except OSError:
+            entries = []
+
+        clean, children = True, []
+        for entry in entries:
+            if not entry.is_dir(follow_symlinks=False):
+                continue
+
+            if self.ignore.ignored(f".{entry.path[len(self.root_path):]}", True):
+                clean = False
+                continue
+
+            child = self.plan(entry.path)
+            clean = clean and child[0][1]
+            children.extend(child)
+
+        return [(abs_path, True)] if clean else [(abs_path, False)] + children
+
+    def schedule(self, abs_path):
+        """
+        Schedule the watches of a folder and everything below it.
+
+        :param abs_path: the absolute path of the folder (string)
+        """
+
+        for path, recursive in self.plan(abs_path):
+            try:
+                self.watches[path] = self.observer.schedule(self.handler, path, recursive=recursive)
+            except OSError:
+                continue  # removed in the meantime
+
+            if not recursive:
+                self.shallow.add(path)
+
+        logging.info(f"Watching {len(self.watches)} folders of {self.root_path}, {len(self.shallow)} of them without "
+                     f"their subfolders")
+
+    def directory_created(self, abs_path):
+        """
+        :param abs_path: the absolute path of a folder which was created or moved, and isn't ignored (string)
+
+        :return: True if the folder got its own watches - its parent is watched without its subfolders (bool)
+        """
+
+        if os.path.dirname(abs_path) not in self.shallow:
+            return False
+
+        self.schedule(abs_path)
+        return True
+
+    def directory_removed(self, abs_path):
+        """
+        Unschedule the watches of a folder which was deleted or moved and of everything below it.
+
+        :param abs_path: the absolute path of the folder (string)
+        """
+
+        prefix = abs_path + os.sep
+        for path in [path for path in self.watches if path == abs_path or path.startswith(prefix)]:
+            self.shallow.discard(path)
+            try:
+                self.observer.unschedule(self.watches.pop(path))
+            except KeyError:
+                pass  # the watch stopped when its folder was deleted
+
+
+def create_observer(protocol_instance, path, quiet_window=None, max_latency=MAX_LATENCY, reconcile=False, index=None,
+                    ignore=None, bidirectional=False, scanner=None):
     """
     A function used to initialise the event handler and the observer.
 
     :param protocol_instance: reference to protocol object used to communicate with server
     :param path: the path of the folder to monitor
+    :param quiet_window: if given, events are coalesced and the net operation of a path is sent once no new events have
+                         been received for this many seconds (float)
+    :param max_latency: the longest time the events of a path can be held back when coalescing (float)
+    :param reconcile: True if the folder must be reconciled with the server on connect (bool)
+    :param index: the persistent index of the files in the folder (FileIndex)
+    :param ignore: the rules of the paths which are not synchronised (IgnoreRules)
+    :param bidirectional: True if the changes of the server are pushed to the client too, the versions of the files are
+                          kept in the index, which is required (bool)
+    :param scanner: the pool scanning the folder in parallel when it's reconciled (ScanPool)
 
     :return: a reference to the created observer
     """
 
+    # the changes pushed by the server are applied as they arrive, their events are filtered out
+    remote = None
+    if bidirectional:
+        if index is None:
+            raise ValueError("Bidirectional sync requires an index")
+        remote = protocol_instance.remote = RemoteChanges(path, index, EchoFilter(), protocol_instance.client_id, ignore)
+
+    # changes made while the client wasn't running are found by comparing the folder with the server
+    if reconcile:
+        protocol_instance.reconciler = Reconciler(protocol_instance, path, index, ignore, remote, scanner)
+
+    # put the coalescing stage between the event handler and the protocol
+    if quiet_window:
+        protocol_instance = EventCoalescer(protocol_instance, path, quiet_window, max_latency, index=index)
+        protocol_instance.start()
+
     observer = Observer()
-    # schedule a recursive observer, so that everything is monitored
-    observer.schedule(SyncEventHandler(protocol_instance, path), path, recursive=True)
+    handler = SyncEventHandler(protocol_instance, path, index, ignore)
+    handler.remote = remote
+
+    if ignore:
+        # ignored folders are pruned from the watches
+        handler.watches = WatchScheduler(observer, handler, path, ignore)
+        handler.watches.schedule(path)
+    else:
+        # schedule a recursive observer, so that everything is monitored
+        observer.schedule(handler, path, recursive=True)
 
     return observer
@@ -1,20 +1,163 @@
 import logging
+import os
+import random
+import socket
+import time
+from collections import deque
+from twisted.application.internet import ClientService
 from twisted.internet import reactor
-from twisted.internet.protocol import Protocol
-from twisted.internet.endpoints import TCP4ClientEndpoint, connectProtocol
+from twisted.internet.protocol import Factory, Protocol
+from twisted.internet.endpoints import TCP4ClientEndpoint
+from twisted.python.threadable import isInIOThread
+from client_pkg.flow import file_cost, frame_cost
+from client_pkg.remote import REMOTE_MESSAGES
+from client_pkg.transfer import TransferQueue, MESSAGES_SENT, MESSAGE_BYTES
+from common_pkg.compression import CODECS, PayloadCompressor
+from common_pkg.logs import event_log
+from common_pkg.metrics import REGISTRY
+from common_pkg.framing import FrameDecoder, Frame, ProtocolError, decode_hello, encode_header, encode_hello_line, \
+    encode_legacy_frame, EVENT_TYPES, FLAG_DIRECTORY, MSG_HELLO, MSG_MODIFIED, MSG_MOVED, MSG_SIGNATURE, \
+    MSG_CONTENT_REPLY, MSG_TREE, MSG_ACK_REQUEST, MSG_ACK, MSG_OPERATION, MSG_VERSION, PROTOCOL_VERSION, SEQUENCE, \
+    MESSAGE_NAMES
+
+
+# the delay before the first attempt to connect again after the connection has been lost or an attempt failed, it
+# doubles with every failed attempt up to the maximum (seconds)
+INITIAL_RETRY_DELAY = 1.0
+MAX_RETRY_DELAY = 60.0
+
+# the metrics of the connection with the server, see common_pkg.metrics
+ACK_LATENCY = REGISTRY.histogram("syncapp_client_ack_seconds",
+                                 "Seconds from sending operations to the server to their acknowledgement, once applied")
+CONNECTIONS = REGISTRY.counter("syncapp_client_connections_total", "Connections made with the server")
+DISCONNECTIONS = REGISTRY.counter("syncapp_client_connections_lost_total", "Connections with the server lost")
+RECONNECT_ATTEMPTS = REGISTRY.counter("syncapp_client_reconnect_attempts_total",
+                                      "Attempts to connect again after a connection was lost or couldn't be made")
+
+
+def retry_delay(attempt):
+    """
+    The delay before connecting again - exponential backoff with full jitter, so that the clients of a restarted server
+    don't all connect again at the same time.
+
+    :param attempt: the number of failed attempts so far, starting with 1 (int)
+
+    :return: the delay (seconds)
+    """
+
+    delay = random.uniform(0, min(MAX_RETRY_DELAY, INITIAL_RETRY_DELAY * 2 ** attempt))
+    RECONNECT_ATTEMPTS.inc()
+    logging.info(f"Connecting to the server again in {delay:.1f} seconds (attempt {attempt}).")
+    return delay
 
 
 class SyncClientProtocol(Protocol):
     """
     A custom protocol class used to handle the communication with the server.
+
+    Right after connecting, the client offers the binary wire format with a hello message. Messages are held back until
+    the server accepts it, if the server doesn't reply within NEGOTIATION_TIMEOUT seconds it is assumed to only support
+    the legacy line based protocol. The hello message also carries the id of the client and the name of the sync root
+    it wants to use on the server, if the server gives each client its own root, and the compression codecs it
+    supports - the server picks one of them. If a reconciler is attached, the folder is reconciled with the server
+    once the binary wire format has been agreed on.
+
+    All messages go through a transfer queue registered as a streaming producer with the transport, so that messages
+    are sent in order and modified files are streamed in chunks. The send_* methods are called from the watchdog
+    thread, hence they only hand the message over to the reactor thread - once too much is queued for the server, they
+    block until the queue has drained, so the watchdog thread stops reading files while the network is slower than the
+    disk.
+
+    If a journal is attached, the operations are recorded in it first, whatever the state of the connection, and sent
+    from it - at most MAX_IN_FLIGHT operations are sent ahead of the acknowledgements of the server, which are requested
+    every ACK_BATCH operations. Acknowledged operations are dropped from the journal, the others are replayed in order
+    after connecting. The messages of each operation are preceded by its sequence number, so that the server knows which
+    operations have been applied even if the acknowledgement never arrives, and tells the client where to resume in its
+    hello message. Modified files are only sent from the journal while the transfer queue is below its high watermark,
+    so are the other operations unless the server supports streams, since they would wait behind the files anyway.
+
+    With bidirectional sync, the client asks the server to push the changes of its folder, which are applied by a
+    RemoteChanges object, and the version of a file is sent ahead of every upload and deletion of the file.
+
+    The same protocol object is used for every connection with the server, so that the event handlers keep working
+    while the client connects again.
     """
 
+    NEGOTIATION_TIMEOUT = 5
+
+    # an acknowledgement is requested every this many operations sent from the journal
+    ACK_BATCH = 64
+
+    # the number of operations (sequence numbers) sent from the journal ahead of the acknowledgements
+    MAX_IN_FLIGHT = 1024
+
+    def __init__(self, client_id=None, root=None, compression=None, journal=None, flow=None, zero_copy=True):
+        """
+        Initialise the protocol object.
+
+        :param client_id: the id the client introduces itself with, defaults to the host name (string)
+        :param root: the name of the sync root requested on the server, defaults to the client id (string)
+        :param compression: the names of the codecs offered to the server, defaults to all available (list of strings)
+        :param journal: the journal the operations are recorded in until the server acknowledges them (Journal)
+        :param flow: the flow control bounding the data queued for the server (FlowControl)
+        :param zero_copy: True to send file content from the page cache straight to the socket when possible (bool)
+        """
+
+        self.client_id = client_id or socket.gethostname()
+        self.root = root
+        self.compression = list(CODECS) if compression is None else compression
+        self.reconciler = None  # set if the folder must be reconciled with the server on connect (Reconciler)
+        self.remote = None  # set with bidirectional sync, applies the changes pushed by the server (RemoteChanges)
+        self.journal = journal
+        self.replay_started = None
+        self.replayed = 0
+        self.replay_scheduled = False  # True if the reactor thread has been asked to send the new records
+
+        self.queue = TransferQueue(self, flow=flow, zero_copy=zero_copy)  # paused until the negotiation finishes
+        self.negotiation_timeout = None
+        self.reset()
+
+        REGISTRY.gauge("syncapp_client_queued_items", "Messages and files queued for the server",
+                       lambda: len(self.queue.items) + len(self.queue.batch) + len(self.queue.streams))
+        REGISTRY.gauge("syncapp_client_queued_bytes", "Bytes queued for the server", lambda: self.queue.flow.queued)
+        if journal is not None:
+            REGISTRY.gauge("syncapp_client_journal_pending", "Operations in the journal not acknowledged yet",
+                           lambda: len(journal.records))
+
+    def reset(self):
+        """
+        Reset the state of a connection, before connecting (again).
+        """
+
+        self.mode = None  # None while negotiating, 'binary' or 'legacy' afterwards
+        self.features = set()  # optional parts of the binary protocol supported by the server
+        self.compressor = None  # set if the server picks a codec (PayloadCompressor)
+        self.decoder = FrameDecoder()
+
+        # the sequence number of the last operation sent from the journal, None until the negotiation finishes
+        self.sent_seq = None
+        self.ack_requests = deque()  # (sequence number, time) of the acknowledgements requested and not received yet
+
     def connectionMade(self):
         """
         Called when connection with the server is established.
         """
 
         logging.info(f"Connection has been established with {self.transport.getPeer().host}.")
+        CONNECTIONS.inc()
+
+        self.transport.registerProducer(self.queue, True)
+
+        # offer the binary wire format, the hello message is ignored by servers only supporting the legacy protocol
+        capabilities = {"client_id": self.client_id, "compression": self.compression, "resumable": True}
+        if self.root is not None:
+            capabilities["root"] = self.root
+        if self.journal is not None:
+            capabilities["resume"] = True
+        if self.remote is not None:
+            capabilities["push"] = True
+        self.transport.write(encode_hello_line(**capabilities))
+        self.negotiation_timeout = reactor.callLater(self.NEGOTIATION_TIMEOUT, self.negotiation_finished, "legacy")
 
     def connectionLost(self, reason):
         """
@@ -24,9 +167,230 @@ class SyncClientProtocol(Protocol):
         """
 
         logging.warning(f"Connection with {self.transport.getPeer().host} has been lost - {reason}.")
+        DISCONNECTIONS.inc()
+
+        if self.negotiation_timeout is not None and self.negotiation_timeout.active():
+            self.negotiation_timeout.cancel()
+
+        if self.compressor is not None:
+            logging.info(f"Compression stats ({self.compressor.codec.name}) - {self.compressor.stats.as_dict()}")
+
+        if self.journal is not None:
+            logging.info(f"Journal stats - {self.journal.stats()}")
+
+        logging.info(f"Flow control stats - {self.queue.stats()}")
+
+        if self.remote is not None:
+            logging.info(f"Pushed changes stats - {self.remote.stats()}")
+
+        # the client connects again, operations which haven't been applied are replayed from the journal
+        self.connected = 0
+        self.reset()
+
+    def dataReceived(self, data):
+        """
+        Called when data is received from the server.
+
+        :param data: the received bytes
+        """
+
+        try:
+            frames = self.decoder.feed(data)
+        except ProtocolError as e:
+            logging.warning(f"Protocol violation, closing connection - {e}")
+            self.transport.loseConnection()
+            return
+
+        for frame in frames:
+            self.frameReceived(frame)
+
+    def frameReceived(self, frame):
+        """
+        Called for each decoded message sent by the server.
+
+        :param frame: the received message (Frame)
+        """
+
+        if frame.msg_type == MSG_HELLO:
+            try:
+                capabilities = decode_hello(frame.payload)
+            except ProtocolError as e:
+                logging.warning(str(e))
+                return
+
+            if capabilities["version"] == PROTOCOL_VERSION and self.mode is None:
+                self.features = set(capabilities.get("features", []))
+                if capabilities.get("compression") in self.compression:
+                    self.compressor = PayloadCompressor(CODECS[capabilities["compression"]])
+                if self.journal is not None and isinstance(capabilities.get("resume"), int):
+                    # the server has applied these operations, even if it didn't get to acknowledge them
+                    self.journal.acknowledge(capabilities["resume"])
+                self.negotiation_timeout.cancel()
+                self.negotiation_finished("binary")
+
+            elif self.mode == "legacy":
+                # the server has switched to the binary wire format after the client gave up waiting for it, the
+                # legacy messages sent since would be misread - the client connects again
+                logging.warning("Received the server's hello after falling back to the legacy protocol, reconnecting")
+                self.transport.loseConnection()
+
+        elif frame.msg_type == MSG_SIGNATURE:
+            self.queue.signature_received(frame.path, frame.payload)
+
+        elif frame.msg_type == MSG_CONTENT_REPLY:
+            self.queue.content_reply_received(frame.path, frame.payload)
+
+        elif frame.msg_type == MSG_TREE and self.reconciler is not None:
+            self.reconciler.listing_received(frame.path, frame.payload)
+
+        elif frame.msg_type == MSG_ACK and self.journal is not None and len(frame.payload) == SEQUENCE.size:
+            self.acknowledged(SEQUENCE.unpack(frame.payload)[0])
+
+        elif frame.msg_type in REMOTE_MESSAGES and self.remote is not None:
+            self.remote.frame_received(frame)
+
+        else:
+            logging.info(f"Received unrecognized message type - {frame.msg_type}")
+
+    def negotiation_finished(self, mode):
+        """
+        Called when the wire format has been agreed on - sends all messages that were held back.
+
+        :param mode: 'binary' or 'legacy' (string)
+        """
+
+        logging.info(f"Using the {mode} protocol to communicate with the server.")
+
+        self.mode = mode
+        self.queue.start()
+
+        if self.journal is not None:
+            if self.journal.overflowed:
+                logging.warning("Operations have been dropped from the full journal, the folder must be reconciled.")
+                self.journal.overflowed = False
+
+            self.sent_seq = self.journal.acked
+            self.replay_started = time.monotonic()
+            self.replayed = 0
+            self.replay()
+
+        if self.remote is not None and "push" not in self.features:
+            logging.warning("Server doesn't push its changes, only the changes of the client are synchronised.")
+
+        if self.reconciler is not None:
+            if mode == "binary" and "reconcile" in self.features:
+                self.reconciler.start()
+            else:
+                logging.warning("Server doesn't support reconciliation, changes made while offline are not propagated.")
+
+    @property
+    def accepting_events(self):
+        """
+        :return: True if events are sent to the server, or recorded in the journal until they can be (bool)
+        """
+
+        return self.connected or self.journal is not None
+
+    def replay(self):
+        """
+        Send the pending operations from the journal, as long as not too many of them are waiting for an
+        acknowledgement - must be called in the reactor thread.
+        """
+
+        self.replay_scheduled = False
+
+        if self.sent_seq is None or not self.connected:
+            return
+
+        window = self.journal.acked + self.MAX_IN_FLIGHT - self.sent_seq
+        if window <= 0:
+            return  # continued once the server acknowledges the operations in flight
 
-        # stop the reactor since connection with server is lost
-        reactor.stop()
+        sent = 0
+        for seq, frame in self.journal.pending(self.sent_seq, window):
+            # operations overtake the files being streamed, only the files wait for the queue to drain
+            if self.queue.flow.full and (frame.msg_type == MSG_MODIFIED or "streams" not in self.features):
+                break  # continued once the transfer queue has drained
+
+            # versions are only recorded with bidirectional sync, the server may not support them
+            if frame.msg_type == MSG_VERSION and "versions" not in self.features:
+                self.sent_seq = seq
+                continue
+
+            if "resume" in self.features:
+                self.queue.put_frame(Frame(MSG_OPERATION, 0, b"", SEQUENCE.pack(seq)))
+
+            if frame.msg_type == MSG_MODIFIED:
+                # the current content of the file is sent
+                self.queue.put_file(frame.path.decode("utf-8"), os.fsdecode(frame.payload))
+            else:
+                self.queue.put_frame(frame)
+
+            self.sent_seq = seq
+            sent += 1
+            if sent % self.ACK_BATCH == 0:
+                self.request_ack()
+
+        if sent % self.ACK_BATCH:
+            self.request_ack()
+
+        self.replayed += sent
+
+    def queue_drained(self):
+        """
+        Called by the transfer queue when it has drained to its low watermark.
+        """
+
+        if self.journal is not None:
+            self.replay()
+
+    def request_ack(self):
+        """
+        Ask the server to acknowledge the operations sent so far - servers which don't support acknowledgements get
+        none, the operations are dropped from the journal once they have been handed over to the transport.
+        """
+
+        if self.mode == "binary" and "ack" in self.features:
+            self.queue.put_frame(Frame(MSG_ACK_REQUEST, 0, b"", SEQUENCE.pack(self.sent_seq)))
+            self.ack_requests.append((self.sent_seq, time.monotonic()))
+        else:
+            self.journal.acknowledge(self.sent_seq)
+
+    def acknowledged(self, seq):
+        """
+        Called when the server has applied the operations up to a sequence number.
+
+        :param seq: the sequence number of the last applied operation (int)
+        """
+
+        self.journal.acknowledge(seq)
+
+        now = time.monotonic()
+        while self.ack_requests and self.ack_requests[0][0] <= seq:
+            ACK_LATENCY.observe(now - self.ack_requests.popleft()[1])
+
+        if seq == self.sent_seq and not self.journal.pending(seq, 1) and self.replayed:
+            elapsed = time.monotonic() - self.replay_started
+            logging.info(f"Journal drained - {self.replayed} operations sent in {elapsed:.2f} seconds "
+                         f"({self.replayed / max(elapsed, 0.001):.0f} operations per second)")
+            self.replay_started = time.monotonic()
+            self.replayed = 0
+
+        self.replay()
+
+    def record(self, frame):
+        """
+        Record an operation in the journal and send it once the server can take it, safe to call from any thread.
+
+        :param frame: the operation (Frame)
+        """
+
+        self.journal.append(frame)
+
+        # a burst of events wakes the reactor thread up once, the records appended meanwhile are sent by that replay
+        if not self.replay_scheduled:
+            self.replay_scheduled = True
+            reactor.callFromThread(self.replay)
 
     def send_event(self, event_type, is_directory, event_path):
         """
@@ -37,8 +401,11 @@ class SyncClientProtocol(Protocol):
         :param event_path: the path of the directory/file of this event (string)
         """
 
-        msg = f"{event_type}::{int(is_directory)}::{event_path}\r\r\r\n\n\n"
-        self.send_message(msg)
+        if event_type == "deleted" and not is_directory:
+            self.send_version(event_path)
+
+        flags = FLAG_DIRECTORY if is_directory else 0
+        self.send_operation(Frame(EVENT_TYPES[event_type], flags, event_path.encode("utf-8"), b""))
 
     def send_modify_event(self, event_path, content):
         """
@@ -48,10 +415,7 @@ class SyncClientProtocol(Protocol):
         :param content: the content of the modified file (bytes)
         """
 
-        # build the message with concatenation, content is already in bytes
-        msg = f"modified::0::{event_path}::".encode("utf-8") + content + b"\r\r\r\n\n\n"
-        self.transport.write(msg)
-        logging.info(f"Sending a modify message to server for file {event_path}")
+        self.send_frame(Frame(MSG_MODIFIED, 0, event_path.encode("utf-8"), content))
 
     def send_move_event(self, is_directory, src_path, dst_path):
         """
@@ -62,32 +426,152 @@ class SyncClientProtocol(Protocol):
         :param dst_path: the destination path, after the file was moved (string)
         """
 
-        msg = f"moved::{int(is_directory)}::{src_path}::{dst_path}\r\r\r\n\n\n"
-        self.send_message(msg)
+        flags = FLAG_DIRECTORY if is_directory else 0
+        self.send_operation(Frame(MSG_MOVED, flags, src_path.encode("utf-8"), dst_path.encode("utf-8")))
 
-    def send_message(self, msg):
+    def send_file(self, event_path, abs_path):
         """
-        Utility method used to send a message to the server and handle encoding beforehand.
+        Send the content of a modified file to server - the file is read and streamed in chunks by the transfer queue.
 
-        :param msg: the message to send (string)
+        :param event_path: the path of the file of this event (string)
+        :param abs_path: the absolute path of the file to read from (string)
         """
 
-        self.transport.write(msg.encode("utf-8"))
-        logging.info(f"Sending message to server - {msg}")
+        self.send_version(event_path)
+
+        if self.journal is not None:
+            # the record only holds the path of the file, its content is read when the record is sent
+            self.record(Frame(MSG_MODIFIED, 0, event_path.encode("utf-8"), os.fsencode(abs_path)))
+        else:
+            cost = file_cost(event_path, abs_path)
+            self.reserve(cost)
+            reactor.callFromThread(self.queue.put_file, event_path, abs_path, cost)
 
+    def send_version(self, event_path):
+        """
+        Send the version of a file ahead of an upload or a deletion of the file, with bidirectional sync.
+
+        :param event_path: the path of the file (string)
+        """
+
+        if self.remote is None:
+            return
+
+        frame = self.remote.version_frame(event_path)
+        if self.journal is not None:
+            self.record(frame)
+        elif "versions" in self.features:
+            self.send_frame(frame)
+
+    def send_operation(self, frame):
+        """
+        Record an operation in the journal, or send it straight away if there is no journal.
+
+        :param frame: the operation (Frame)
+        """
 
-def connect(connection_ip, connection_port=9876):
+        if self.journal is not None:
+            self.record(frame)
+        else:
+            self.send_frame(frame)
+
+    def send_frame(self, frame):
+        """
+        Utility method used to queue a message to the server, safe to call from any thread.
+
+        :param frame: the message to send (Frame)
+        """
+
+        self.reserve(frame_cost(frame))
+        reactor.callFromThread(self.queue.put_frame, frame, True)
+
+    def reserve(self, cost):
+        """
+        Reserve room in the transfer queue for a message or a file, waiting for the queue to drain if it's full - the
+        reactor thread (e.g. the coalescer sending the due operations) is never blocked.
+
+        :param cost: the bytes of the message or the file (int)
+        """
+
+        self.queue.flow.reserve(cost, block=not isInIOThread())
+
+    def wait_for_room(self):
+        """
+        Wait for the transfer queue to drain if it's full, called by the threads handing over operations which are sent
+        by the reactor thread (e.g. the event coalescer) - the reactor thread never waits.
+        """
+
+        if not isInIOThread():
+            self.queue.flow.wait()
+
+    def write_frame(self, frame):
+        """
+        Write a message to the transport and handle encoding beforehand - must be called in the reactor thread.
+
+        :param frame: the message to send (Frame)
+        """
+
+        if self.mode == "binary":
+            # write the header separately, so that big payloads are not copied
+            self.transport.writeSequence([encode_header(frame.msg_type, frame.flags, len(frame.path), len(frame.payload)),
+                                          frame.path, frame.payload])
+        else:
+            self.transport.write(encode_legacy_frame(frame))
+
+        name = MESSAGE_NAMES.get(frame.msg_type, str(frame.msg_type))
+        MESSAGES_SENT.inc(name)
+        MESSAGE_BYTES.observe(len(frame.path) + len(frame.payload), name)
+        event_log.debug(f"Sending '{name}' message to server for {frame.path}")
+
+
+class SyncClientFactory(Factory):
     """
-    A function used to connect with the server.
+    A factory handing out the same protocol object for every connection with the server.
+    """
+
+    def __init__(self, protocol):
+        """
+        Initialise the factory.
+
+        :param protocol: the protocol used to communicate with the server (SyncClientProtocol)
+        """
+
+        self.protocol = protocol
+
+    def buildProtocol(self, addr):
+        """
+        Called when a connection with the server has been made.
+
+        :param addr: the address of the server
+
+        :return: the protocol object (SyncClientProtocol)
+        """
+
+        return self.protocol
+
+
+def connect(connection_ip, connection_port=9876, client_id=None, root=None, compression=None, journal=None, flow=None,
+            zero_copy=True):
+    """
+    A function used to connect with the server - the client connects again whenever the connection is lost or cannot be
+    made, with exponential backoff.
 
     :param connection_ip: the IP address of the server (string)
     :param connection_port: the port number to connect to (int), defaults to 9876
+    :param client_id: the id the client introduces itself with, defaults to the host name (string)
+    :param root: the name of the sync root requested on the server, defaults to the client id (string)
+    :param compression: the names of the codecs offered to the server, defaults to all available (list of strings)
+    :param journal: the journal the operations are recorded in until the server acknowledges them (Journal)
+    :param flow: the flow control bounding the data queued for the server (FlowControl)
+    :param zero_copy: True to send file content from the page cache straight to the socket when possible (bool)
 
     :return: a tuple of two values - a reference to the created protocol object and twisted's reactor
     """
 
     endpoint = TCP4ClientEndpoint(reactor, connection_ip, connection_port)
-    protocol = SyncClientProtocol()
-    connectProtocol(endpoint, protocol)  # returns a deferred object, use if callbacks are needed
+    protocol = SyncClientProtocol(client_id, root, compression, journal, flow, zero_copy)
+
+    service = ClientService(endpoint, SyncClientFactory(protocol), retryPolicy=retry_delay)
+    service.startService()
 
     return protocol, reactor
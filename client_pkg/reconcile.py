@@ -0,0 +1,310 @@
+import logging
+import os
+import time
+from twisted.internet import threads
+from common_pkg.content import DIGEST_SIZE
+from common_pkg.framing import Frame, MSG_CREATED, MSG_DELETED, MSG_TREE_REQUEST, FLAG_DIRECTORY
+from common_pkg.manifest import Directory, HashCache, ManifestError, build_manifest, decode_listing, FILE, DIRECTORY
+
+
+def empty_directory():
+    """
+    :return: a directory with no entries, standing for a folder which only exists on the server (Directory)
+    """
+
+    directory = Directory()
+    directory.finish()
+    return directory
+
+
+class ChangeTracker:
+    """
+    A hash cache recording the files whose content changed since they were last indexed, e.g. while the client wasn't
+    running - a file whose stat changed but whose new hash is the indexed one hasn't changed.
+    """
+
+    def __init__(self, index):
+        """
+        :param index: the index of the files in the folder (FileIndex)
+        """
+
+        self.index = index
+        self.stale = {}  # absolute path -> the indexed hash of a file whose stat changed, None if it had no hash
+        self.changed = set()  # absolute paths of the changed files
+
+    def lookup(self, abs_path, file_stat):
+        """
+        :param abs_path: the absolute path of a file (string)
+        :param file_stat: the current stat result of the file
+
+        :return: the cached hash or None if the file has changed since it was hashed (bytes)
+        """
+
+        entry = self.index.get(self.index.relative_path(abs_path))
+        if entry is not None and entry[:3] == (file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino):
+            return entry[3]
+
+        self.stale[abs_path] = entry[3] if entry is not None else None
+        return None
+
+    def update(self, abs_path, file_stat, digest):
+        """
+        :param abs_path: the absolute path of a file (string)
+        :param file_stat: the stat result of the file taken before it was hashed
+        :param digest: the hash of its content (bytes)
+        """
+
+        if abs_path in self.stale:
+            indexed = self.stale.pop(abs_path)
+            if indexed is None or indexed != digest:
+                self.changed.add(abs_path)
+
+        self.index.update(abs_path, file_stat, digest)
+
+
+class Reconciler:
+    """
+    Brings the server copy of the sync folder up to date with the client on connect, so that changes made while the
+    client wasn't running are not lost.
+
+    The client builds a manifest of the folder (see common_pkg.manifest) and asks the server for the listings of the
+    directories whose hash differs, starting with the root - a request carries the hash of the client's directory and
+    the server replies with its own hash, followed by its listing only if the hashes differ. Hence only the differing
+    directories are walked and only the differing files are sent. The requests are pipelined, the replies are compared
+    as they come.
+
+    With bidirectional sync, the server copy may be the newer one, so every file sent or deleted is preceded by its
+    version, which is only incremented if the file changed while the client wasn't running - the server drops the
+    changes made on top of an older version and pushes its copy instead. Files and folders which only exist on the server
+    are never deleted as a whole - the client only deletes the files it knows it deleted, the others are pushed to it.
+    """
+
+    def __init__(self, protocol, root_path, cache=None, ignore=None, remote=None, scanner=None):
+        """
+        Initialise the reconciler.
+
+        :param protocol: reference to the protocol used to communicate with the server
+        :param root_path: the path of the folder that's being synchronised (string)
+        :param cache: the cache of file hashes, kept between reconciliations (HashCache)
+        :param ignore: the rules of the paths which are not synchronised, they are neither sent nor deleted (IgnoreRules)
+        :param remote: the applier of the changes pushed by the server, set with bidirectional sync (RemoteChanges)
+        :param scanner: the pool scanning the folder in parallel, the folder is scanned by a single thread without it
+                        (ScanPool)
+        """
+
+        self.protocol = protocol
+        self.root_path = root_path
+        self.cache = cache if cache is not None else HashCache()
+        self.ignore = ignore
+        self.remote = remote
+        self.scanner = scanner
+
+        self.manifest = None
+        self.tracker = None  # the files changed since they were last indexed, with bidirectional sync (ChangeTracker)
+        self.pending = set()  # relative paths of the directories whose listing has been requested
+        self.started = None
+
+        # metrics
+        self.requests = 0
+        self.listing_bytes = 0
+        self.files_sent = 0
+        self.paths_deleted = 0
+
+    def start(self):
+        """
+        Start a reconciliation - the folder is scanned in a thread.
+
+        :return: a deferred fired once the folder has been scanned (Deferred)
+        """
+
+        logging.info(f"Scanning {self.root_path} to reconcile it with the server")
+        self.started = time.monotonic()
+        self.requests = self.listing_bytes = self.files_sent = self.paths_deleted = 0
+        self.pending.clear()  # replies still expected on an earlier connection are never sent
+
+        ignore = self.ignore.ignored if self.ignore else None
+        self.tracker = ChangeTracker(self.cache) if self.bidirectional else None
+        build = self.scanner.build_manifest if self.scanner is not None else build_manifest
+        d = threads.deferToThread(build, self.root_path, self.tracker or self.cache, ignore)
+        d.addCallback(self.manifest_built)
+        d.addErrback(lambda failure: logging.warning(f"Reconciliation failed - {failure.getErrorMessage()}"))
+        return d
+
+    def manifest_built(self, manifest):
+        """
+        Called in the reactor thread once the folder has been scanned - compares the root directories.
+
+        :param manifest: the root of the manifest (Directory)
+        """
+
+        logging.info(f"Scanned {self.root_path} in {time.monotonic() - self.started:.2f} seconds")
+
+        self.manifest = manifest
+        self.request(".", manifest)
+
+    def request(self, relative_path, directory):
+        """
+        Ask the server for the listing of a directory, unless its hash is the same.
+
+        :param relative_path: the path of the directory (string)
+        :param directory: the client's directory (Directory)
+        """
+
+        self.pending.add(relative_path)
+        self.requests += 1
+        self.protocol.queue.put_frame(Frame(MSG_TREE_REQUEST, 0, relative_path.encode("utf-8"), directory.digest))
+
+    def listing_received(self, event_path, payload):
+        """
+        Called when the server replies to a listing request - sends what differs and asks for the listings of the
+        differing subdirectories.
+
+        :param event_path: the path of the directory (bytes)
+        :param payload: the hash of the server's directory followed by its encoded listing, if it differs (bytes)
+        """
+
+        relative_path = event_path.decode("utf-8")
+        if relative_path not in self.pending:
+            logging.info(f"Received an unexpected directory listing for {relative_path}")
+            return
+
+        self.pending.discard(relative_path)
+        self.listing_bytes += len(payload)
+
+        directory = self.manifest.find(relative_path)
+        if directory is None:
+            # a folder which only exists on the server, with bidirectional sync
+            directory = empty_directory()
+
+        if payload[:DIGEST_SIZE] != directory.digest:
+            try:
+                self.compare(relative_path, directory, decode_listing(payload[DIGEST_SIZE:], DIGEST_SIZE))
+            except ManifestError as e:
+                logging.warning(f"Invalid directory listing received for {relative_path} - {e}")
+
+        if not self.pending:
+            logging.info(f"Reconciliation finished in {time.monotonic() - self.started:.2f} seconds - "
+                         f"{self.requests} directories compared, {self.listing_bytes} bytes of listings received, "
+                         f"{self.files_sent} files sent, {self.paths_deleted} paths deleted")
+
+    def compare(self, relative_path, directory, server_entries):
+        """
+        Compare a directory with the server's listing of it.
+
+        :param relative_path: the path of the directory (string)
+        :param directory: the client's directory (Directory)
+        :param server_entries: the server's listing (dict name -> (kind, hash))
+        """
+
+        for name, (kind, digest) in server_entries.items():
+            path = f"{relative_path}/{name}"
+            if kind == FILE and directory.files.get(name) == digest:
+                continue
+
+            # the server copy of an ignored path is left alone
+            if self.ignore and self.ignore.ignored(path, kind == DIRECTORY):
+                continue
+
+            if kind == DIRECTORY and name in directory.dirs:
+                if directory.dirs[name].digest != digest:
+                    self.request(path, directory.dirs[name])
+                continue
+
+            # the files of the folder are compared one by one instead
+            if kind == DIRECTORY and self.bidirectional and name not in directory.files:
+                self.request(path, empty_directory())
+                continue
+
+            if kind == FILE and name in directory.files:
+                self.send_file(path)
+                continue
+
+            # the path has a different kind on the client or is missing
+            if name in directory.files:
+                self.delete(path, kind == DIRECTORY, replaced=True)
+                self.send_file(path)
+            elif name in directory.dirs:
+                self.delete(path, kind == DIRECTORY, replaced=True)
+                self.send_directory(path, directory.dirs[name])
+            else:
+                self.delete(path, kind == DIRECTORY)
+
+        for name in directory.files.keys() - server_entries.keys():
+            self.send_file(f"{relative_path}/{name}")
+
+        for name in directory.dirs.keys() - server_entries.keys():
+            self.send_directory(f"{relative_path}/{name}", directory.dirs[name])
+
+    def abs_path(self, relative_path):
+        """
+        :param relative_path: a path relative to the sync folder, starting with '.' (string)
+
+        :return: the absolute path (string)
+        """
+
+        return f"{self.root_path}{relative_path[1:]}"
+
+    @property
+    def bidirectional(self):
+        """
+        :return: True if the changes of the server are pushed to the client and the versions of the files are sent
+                 (bool)
+        """
+
+        return self.remote is not None and "versions" in self.protocol.features
+
+    def send_version(self, relative_path, changed):
+        """
+        Send the version of a file ahead of an upload or a deletion of the file, with bidirectional sync.
+
+        :param relative_path: the path of the file (string)
+        :param changed: True if the file changed while the client wasn't running (bool)
+        """
+
+        if changed:
+            self.remote.local_change(relative_path)
+        self.protocol.queue.put_frame(self.remote.version_frame(relative_path))
+
+    def send_file(self, relative_path):
+        """
+        :param relative_path: the path of a file missing or different on the server (string)
+        """
+
+        if self.bidirectional:
+            self.send_version(relative_path, self.abs_path(relative_path) in self.tracker.changed)
+
+        self.files_sent += 1
+        self.protocol.queue.put_file(relative_path, self.abs_path(relative_path))
+
+    def send_directory(self, relative_path, directory):
+        """
+        :param relative_path: the path of a directory missing on the server (string)
+        :param directory: the client's directory (Directory)
+        """
+
+        for path, subdirectory in directory.walk(relative_path):
+            self.protocol.queue.put_frame(Frame(MSG_CREATED, FLAG_DIRECTORY, path.encode("utf-8"), b""))
+            for name in sorted(subdirectory.files):
+                self.send_file(f"{path}/{name}")
+
+    def delete(self, relative_path, is_directory, replaced=False):
+        """
+        :param relative_path: the path of a file/directory which only exists on the server (string)
+        :param is_directory: True if the server has a directory at the path (bool)
+        :param replaced: True if the client has something else at the path (bool)
+        """
+
+        if not replaced and os.path.lexists(self.abs_path(relative_path)):
+            return  # created after the scan, the event handler takes care of it
+
+        if self.bidirectional and not is_directory:
+            # the file was deleted while the client wasn't running if it's still indexed, otherwise the client never had
+            # it and the server pushes it
+            deleted = self.cache.get(relative_path) is not None
+            self.send_version(relative_path, deleted)
+            if deleted:
+                self.cache.remove(relative_path)
+
+        self.paths_deleted += 1
+        flags = FLAG_DIRECTORY if is_directory else 0
+        self.protocol.queue.put_frame(Frame(MSG_DELETED, flags, relative_path.encode("utf-8"), b""))
@@ -0,0 +1,342 @@
+import logging
+import os
+import shutil
+from common_pkg.content import content_hasher
+from common_pkg.framing import Frame, ProtocolError, MSG_CREATED, MSG_DELETED, MSG_MOVED, MSG_CHUNK, MSG_VERSION, \
+    FLAG_FIRST, FLAG_LAST
+from common_pkg.versions import compare, conflict_path, decode_vector, encode_vector, increment, merge, AFTER, EQUAL
+
+
+# messages pushed by the server with bidirectional sync
+REMOTE_MESSAGES = (MSG_CREATED, MSG_DELETED, MSG_MOVED, MSG_CHUNK, MSG_VERSION)
+
+# the suffix of the temporary file a pushed file is received in, before it's renamed into place
+PARTIAL_SUFFIX = ".syncpart"
+
+
+class IncomingFile:
+    """
+    A file pushed by the server whose chunks are being received.
+    """
+
+    def __init__(self, abs_path, vector):
+        """
+        Open the temporary file.
+
+        :param abs_path: the absolute path of the file (string)
+        :param vector: the version vector of the new content (dict)
+        """
+
+        self.abs_path = abs_path
+        self.temp_path = f"{abs_path}{PARTIAL_SUFFIX}"
+        self.vector = vector
+        self.hasher = content_hasher()
+
+        os.makedirs(os.path.dirname(abs_path), exist_ok=True)
+        self.fh = open(self.temp_path, "wb")
+
+    def write(self, data):
+        """
+        :param data: a chunk of the content (bytes)
+        """
+
+        self.fh.write(data)
+        self.hasher.update(data)
+
+    def discard(self):
+        """
+        Remove the temporary file.
+        """
+
+        self.fh.close()
+        try:
+            os.remove(self.temp_path)
+        except FileNotFoundError:
+            pass
+
+
+class RemoteChanges:
+    """
+    Applies the changes pushed by the server with bidirectional sync, in the reactor thread.
+
+    Every file carries a version vector (see common_pkg.versions), kept in the index - local changes increment the
+    count of this replica and the vector is sent ahead of every upload and deletion. A pushed change is preceded by the
+    vector of the server's copy and only applied if it has seen every change of the local copy - a change made on top
+    of an older version is dropped, so is a change concurrent with a local one, whose conflict the server resolves when
+    the local change reaches it. A file which changed since it was last indexed counts as changed locally, even if its
+    events haven't been handled yet. The files below a pushed folder deletion are compared one by one, those with local
+    changes are kept, and a file replaced by a pushed move is copied aside first if it has local changes - the events
+    of the kept files and of the copies send them back to the server.
+
+    Pushed files are received in a temporary file, renamed into place once complete. The paths are registered with an
+    echo filter before they are written, so that the event handler drops the events of the writes instead of sending
+    them back to the server.
+    """
+
+    def __init__(self, root_path, index, echo, replica, ignore=None):
+        """
+        Initialise the applier.
+
+        :param root_path: the path of the folder that's being synchronised (string)
+        :param index: the index of the files in the folder, which keeps their versions (FileIndex)
+        :param echo: the filter of the events caused by the pushed changes (EchoFilter)
+        :param replica: the id of this replica in the version vectors, the client id (string)
+        :param ignore: the rules of the paths which are not synchronised, their pushed changes are dropped (IgnoreRules)
+        """
+
+        self.root_path = root_path
+        self.index = index
+        self.echo = echo
+        self.replica = replica
+        self.ignore = ignore
+
+        self.versions = {}  # relative path -> the vector of the next pushed change of the path
+        self.incoming = {}  # relative path -> IncomingFile
+        self.skipped = set()  # relative paths of the pushed files whose chunks are dropped
+
+        # metrics
+        self.applied = 0
+        self.rejected = 0
+
+    def local_change(self, relative_path):
+        """
+        Record a local change of a file, called by the event handler.
+
+        :param relative_path: the path of the file relative to the sync folder (string)
+        """
+
+        self.index.bump(relative_path, self.replica)
+
+    def version_frame(self, relative_path):
+        """
+        :param relative_path: the path of a file relative to the sync folder (string)
+
+        :return: the message carrying the version of the file, sent ahead of an operation on it (Frame)
+        """
+
+        return Frame(MSG_VERSION, 0, relative_path.encode("utf-8"), encode_vector(self.index.version(relative_path)))
+
+    def abs_path(self, relative_path):
+        """
+        :param relative_path: a path relative to the sync folder, starting with '.' (string)
+
+        :return: the absolute path (string)
+        """
+
+        return f"{self.root_path}{relative_path[1:]}"
+
+    def frame_received(self, frame):
+        """
+        Apply a message pushed by the server.
+
+        :param frame: the message (Frame)
+        """
+
+        relative_path = frame.path.decode("utf-8")
+        if self.ignore and self.ignore.ignored(relative_path, frame.is_directory):
+            return
+
+        try:
+            if frame.msg_type == MSG_VERSION:
+                self.versions[relative_path] = decode_vector(frame.payload)
+            elif frame.msg_type == MSG_CHUNK:
+                self.chunk_received(relative_path, frame)
+            elif frame.msg_type == MSG_CREATED:
+                self.write(self.abs_path(relative_path), os.makedirs, self.abs_path(relative_path), exist_ok=True)
+            elif frame.msg_type == MSG_DELETED:
+                self.delete(relative_path, frame.is_directory)
+            else:
+                self.move(relative_path, frame.payload.decode("utf-8"))
+        except (OSError, ProtocolError) as e:
+            logging.warning(f"Failed to apply the change of {relative_path} pushed by the server - {e}")
+
+    def accept(self, relative_path):
+        """
+        Compare the version of a pushed change of a file with the local version.
+
+        :param relative_path: the path of the file relative to the sync folder (string)
+
+        :return: the merged version to record if the change must be applied, None if it must be dropped (dict)
+        """
+
+        incoming = self.versions.pop(relative_path, {})
+        local = self.index.version(relative_path)
+
+        # a change which hasn't been indexed yet hasn't been counted either
+        entry = self.index.get(relative_path)
+        try:
+            file_stat = os.lstat(self.abs_path(relative_path))
+            if entry is None or entry[:3] != (file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino):
+                local = increment(local, self.replica)
+        except FileNotFoundError:
+            pass
+
+        order = compare(incoming, local)
+        if order not in (AFTER, EQUAL):
+            logging.info(f"Dropping the change of {relative_path} pushed by the server - its version {incoming} is "
+                         f"{order} compared to the local version {local}")
+            self.rejected += 1
+            return None
+
+        self.applied += 1
+        return merge(incoming, local)
+
+    def write(self, abs_path, func, *args, **kwargs):
+        """
+        Apply a change to a path, so that its events are recognised as echoes.
+
+        :param abs_path: the absolute path the change writes (string)
+        :param func: the function applying the change
+        :param args: the arguments of the function
+        :param kwargs: the keyword arguments of the function
+        """
+
+        self.echo.expect(abs_path)
+        try:
+            func(*args, **kwargs)
+        finally:
+            self.echo.settle(abs_path)
+
+    def chunk_received(self, relative_path, frame):
+        """
+        :param relative_path: the path of the pushed file relative to the sync folder (string)
+        :param frame: a chunk of the file (Frame)
+        """
+
+        if frame.flags & FLAG_FIRST:
+            previous = self.incoming.pop(relative_path, None)
+            if previous is not None:
+                previous.discard()
+            self.skipped.discard(relative_path)
+
+            vector = self.accept(relative_path)
+            if vector is None:
+                self.skipped.add(relative_path)
+            else:
+                abs_path = self.abs_path(relative_path)
+                self.echo.expect(abs_path)
+                self.echo.expect(f"{abs_path}{PARTIAL_SUFFIX}")
+                self.incoming[relative_path] = IncomingFile(abs_path, vector)
+
+        if relative_path in self.skipped:
+            if frame.flags & FLAG_LAST:
+                self.skipped.discard(relative_path)
+            return
+
+        incoming = self.incoming.get(relative_path)
+        if incoming is None:
+            logging.info(f"Received a chunk for {relative_path} without a pushed file in progress")
+            return
+
+        try:
+            incoming.write(frame.payload)
+            if frame.flags & FLAG_LAST:
+                incoming.fh.close()
+                os.replace(incoming.temp_path, incoming.abs_path)
+                self.index.put(relative_path, os.stat(incoming.abs_path), incoming.hasher.digest())
+                self.index.set_version(relative_path, incoming.vector)
+                logging.info(f"Applied the content of {relative_path} pushed by the server")
+        except OSError:
+            incoming.discard()
+            raise
+        finally:
+            # the file is complete or its transfer failed
+            if incoming.fh.closed:
+                del self.incoming[relative_path]
+                self.echo.settle(incoming.temp_path)
+                self.echo.settle(incoming.abs_path)
+
+    def delete(self, relative_path, is_directory):
+        """
+        :param relative_path: the path of the deleted file/folder relative to the sync folder (string)
+        :param is_directory: True if a folder was deleted (bool)
+        """
+
+        if is_directory:
+            self.delete_folder(relative_path)
+            return
+
+        abs_path = self.abs_path(relative_path)
+        vector = self.accept(relative_path)
+        if vector is None:
+            return
+        if os.path.lexists(abs_path):
+            self.write(abs_path, os.remove, abs_path)
+        self.index.set_version(relative_path, vector)
+
+        self.index.remove(relative_path)
+        logging.info(f"Applied the deletion of {relative_path} pushed by the server")
+
+    def delete_folder(self, relative_path):
+        """
+        Delete a folder, but the files below it with changes the server hasn't seen and the folders leading to them.
+
+        :param relative_path: the path of the deleted folder relative to the sync folder (string)
+        """
+
+        abs_path = self.abs_path(relative_path)
+        kept = 0
+        for folder, folders, names in os.walk(abs_path, topdown=False):
+            # links to folders aren't walked, they are removed like files
+            for name in names + [name for name in folders if os.path.islink(os.path.join(folder, name))]:
+                file_path = os.path.join(folder, name)
+                file_relative_path = self.index.relative_path(file_path)
+                vector = self.accept(file_relative_path)
+                if vector is None:
+                    kept += 1
+                    continue
+
+                self.write(file_path, os.remove, file_path)
+                self.index.set_version(file_relative_path, vector)
+                self.index.remove(file_relative_path)
+
+            try:
+                self.write(folder, os.rmdir, folder)
+            except OSError:
+                pass  # a kept file is below it
+
+        # the versions of the files which weren't there
+        prefix = f"{relative_path}/"
+        for path in [path for path in self.versions if path.startswith(prefix)]:
+            del self.versions[path]
+
+        logging.info(f"Applied the deletion of {relative_path} pushed by the server, {kept} files with local changes "
+                     f"kept")
+
+    def move(self, relative_path, dest_path):
+        """
+        :param relative_path: the source path relative to the sync folder (string)
+        :param dest_path: the destination path relative to the sync folder (string)
+        """
+
+        abs_src_path, abs_dest_path = self.abs_path(relative_path), self.abs_path(dest_path)
+        if not os.path.lexists(abs_src_path):
+            self.versions.pop(dest_path, None)
+            return
+
+        if os.path.lexists(abs_dest_path) and not os.path.isdir(abs_dest_path) and self.accept(dest_path) is None:
+            # the replaced file has changes the server hasn't seen, its copy is a new file sent by its events
+            aside_path = conflict_path(abs_dest_path, self.replica)
+            shutil.copy2(abs_dest_path, aside_path, follow_symlinks=False)
+            logging.warning(f"The move of {relative_path} to {dest_path} pushed by the server replaces local changes, "
+                            f"they are kept in {aside_path}")
+        self.versions.pop(dest_path, None)
+
+        self.echo.expect(abs_src_path)
+        self.echo.expect(abs_dest_path)
+        try:
+            os.makedirs(os.path.dirname(abs_dest_path), exist_ok=True)
+            os.replace(abs_src_path, abs_dest_path)
+        finally:
+            self.echo.settle(abs_src_path)
+            self.echo.settle(abs_dest_path)
+
+        self.index.move(relative_path, dest_path)
+        logging.info(f"Applied the move of {relative_path} to {dest_path} pushed by the server")
+
+    def stats(self):
+        """
+        :return: the counters of the pushed changes (dict)
+        """
+
+        return dict(applied=self.applied, rejected=self.rejected, echoes=self.echo.echoes)
@@ -0,0 +1,802 @@
+import logging
+import os
+from collections import deque, OrderedDict
+from zope.interface import implementer
+from twisted.internet import reactor
+from twisted.internet.interfaces import IPushProducer
+from client_pkg.flow import FlowControl, file_cost, frame_cost
+from client_pkg.zerocopy import transport_socket, write_file_part
+from common_pkg.compression import MIN_COMPRESS_SIZE
+from common_pkg.content import content_hasher, decode_resume, encode_offer, CONTENT_MATERIALISED, CONTENT_RESUME, \
+    DEDUP_MIN_SIZE
+from common_pkg.delta import DeltaEncoder, DeltaError
+from common_pkg.framing import Frame, ProtocolError, encode_batch, encode_header, HEADER, MSG_CREATED, MSG_DELETED, MSG_MOVED, MSG_CHUNK, \
+    MSG_MODIFIED, MSG_SIGNATURE_REQUEST, MSG_SIGNATURE, MSG_DELTA, MSG_CONTENT_OFFER, MSG_CONTENT_REPLY, MSG_ACK_REQUEST, \
+    MSG_OPERATION, MSG_BATCH, MSG_VERSION, FLAG_FIRST, FLAG_LAST, FLAG_COMPRESSED, FLAG_ABORT
+from common_pkg.logs import event_log
+from common_pkg.metrics import REGISTRY, SIZE_BUCKETS
+
+
+# the size of the file chunks sent to the server
+CHUNK_SIZE = 256 * 1024
+
+# the number of chunks written in one reactor iteration, so that other events are not starved by a big file
+CHUNKS_PER_ITERATION = 16
+
+# files at least this big are sent as a delta against the server's copy, if the server supports it
+DELTA_MIN_SIZE = 1024 * 1024
+
+# messages whose payload is compressed, if a codec has been negotiated and the payload compresses well
+COMPRESSIBLE = (MSG_MODIFIED, MSG_CHUNK, MSG_DELTA)
+
+# messages which can be packed in a batch message, if the server supports it - along with the content of small files
+BATCHABLE = (MSG_CREATED, MSG_DELETED, MSG_MOVED, MSG_MODIFIED, MSG_OPERATION, MSG_ACK_REQUEST, MSG_VERSION)
+
+# files smaller than this are sent whole, in a batch message, instead of being streamed in chunks
+SMALL_FILE_SIZE = 64 * 1024
+
+# a batch message carries up to this many bytes of messages...
+BATCH_SIZE = 1024 * 1024
+
+# ...and up to this many messages
+BATCH_ENTRIES = 1024
+
+# the messages written to the server, per message type - see common_pkg.metrics
+MESSAGES_SENT = REGISTRY.counter("syncapp_client_messages_sent_total", "Messages written to the server", ("type",))
+MESSAGE_BYTES = REGISTRY.histogram("syncapp_client_message_bytes", "Bytes of the messages written to the server",
+                                   ("type",), SIZE_BUCKETS)
+
+# a batch which isn't full is sent at the latest this many seconds after its first message was queued (seconds)
+BATCH_LATENCY = 0.01
+
+# the number of files streamed at the same time, taking turns chunk by chunk, if the server supports it
+MAX_STREAMS = 4
+
+
+def overlaps(path, other):
+    """
+    :param path: a relative path (bytes)
+    :param other: another relative path (bytes)
+
+    :return: True if the paths are the same or one of them is below the other (bool)
+    """
+
+    return path == other or path.startswith(other + b"/") or other.startswith(path + b"/")
+
+
+def item_paths(item):
+    """
+    :param item: a queued message or file (Frame or FileTransfer)
+
+    :return: the relative paths the item touches (list of bytes)
+    """
+
+    if isinstance(item, FileTransfer):
+        return [item.event_path]
+    if item.msg_type == MSG_MOVED:
+        return [item.path, item.payload]
+    return [item.path] if item.path else []
+
+
+class FileTransfer:
+    """
+    A queued file whose content is streamed to the server in chunks.
+    """
+
+    def __init__(self, event_path, abs_path, cost):
+        """
+        Initialise the transfer.
+
+        :param event_path: the relative path of the file sent to the server (string)
+        :param abs_path: the absolute path of the file to read from (string)
+        :param cost: the room reserved for the file in the flow control, the part not released yet (int)
+        """
+
+        self.event_path = event_path.encode("utf-8")
+        self.abs_path = abs_path
+        self.cost = cost
+        self.size = None  # the size of the file, once it is known to be too big for a batch
+        self.fh = None
+        self.offset = 0
+        self.first = True  # True until the first chunk/delta message is sent
+
+        self.waiting = None  # the type of the reply the transfer waits for, if any (MSG_CONTENT_REPLY or MSG_SIGNATURE)
+        self.hasher = None  # the hash of the content, while the file is hashed before being offered
+        self.encoder = None  # the delta encoder, if the file is sent as a delta
+        self.compress = None  # True if the content compresses well, None until a sample of it has been seen
+
+
+@implementer(IPushProducer)
+class TransferQueue:
+    """
+    A streaming producer registered with the transport - sends the queued frames and files.
+
+    Files are never read in full - one chunk at a time is read and written to the transport, so the memory used by
+    a transfer is bounded by the chunk size regardless of the size of the file. The transport pauses the producer
+    when its send buffer is full and resumes it when the buffer has been drained. The messages and files waiting in the
+    queue are bounded by a flow control - once they reach its high watermark, the threads queueing more of them are
+    held back until the queue drains to its low watermark, and the protocol is notified when it does.
+
+    If the server supports it, the connection carries several logical channels - the queued messages take priority and
+    are sent while files are being streamed, and up to MAX_STREAMS files are streamed at the same time, taking turns
+    chunk by chunk (the path of a chunk tells the server which file it belongs to). The first message of a file is sent
+    when its transfer starts, before anything queued after it. A message or a file whose path is the same as, above or
+    below the path of a file being streamed waits until the file has been sent, so that e.g. a deletion never overtakes
+    the content it depends on, and the messages behind it keep their order. Otherwise the messages and files are sent in
+    order, one file at a time.
+
+    If the server supports it, consecutive metadata operations and small files are packed in batch messages, which are
+    sent once full or BATCH_LATENCY seconds after their first message, so that e.g. the extraction of an archive isn't
+    sent as hundreds of thousands of tiny messages. Big files are hashed first and offered by their hash - the content is only sent if the
+    server doesn't have it already, if the server supports it, and only the part the server hasn't received yet if an
+    earlier transfer of the same content was interrupted. Payloads are compressed with the negotiated codec if a sample of them (the first
+    chunk of a file) compresses well, incompressible content like media and archives is sent as it is.
+
+    The chunks of a file sent uncompressed are written from the page cache straight to the socket with os.sendfile, if
+    the transport is a plain TCP transport with nothing buffered - otherwise they are read and handed over to the
+    transport as usual. The transport is known to have nothing buffered when it resumes the queue after pausing it, until
+    the queue hands it something again.
+    """
+
+    def __init__(self, protocol, chunk_size=CHUNK_SIZE, delta_min_size=DELTA_MIN_SIZE, dedup_min_size=DEDUP_MIN_SIZE,
+                 flow=None, max_streams=MAX_STREAMS, zero_copy=True):
+        """
+        Initialise the queue.
+
+        :param protocol: reference to the protocol used to write to the server
+        :param chunk_size: the size of the file chunks (int)
+        :param delta_min_size: the smallest file sent as a delta, None to always send the full content (int)
+        :param dedup_min_size: the smallest file offered by its hash, None to never offer files (int)
+        :param flow: the flow control bounding the queued messages and files, defaults to the default watermarks
+                     (FlowControl)
+        :param max_streams: the number of files streamed at the same time (int)
+        :param zero_copy: True to write file chunks straight from the page cache to the socket when possible (bool)
+        """
+
+        self.protocol = protocol
+        self.chunk_size = chunk_size
+        self.delta_min_size = delta_min_size
+        self.dedup_min_size = dedup_min_size
+        self.flow = flow or FlowControl()
+        self.max_streams = max_streams
+        self.zero_copy = zero_copy
+
+        self.items = deque()
+        self.streams = OrderedDict()  # the file transfers in progress, event path -> FileTransfer, in turn order
+        self.paused = True  # nothing is sent until the wire format has been negotiated
+        self.drained = False  # True while the transport is known to have nothing buffered, see use_zero_copy
+        self.scheduled = None
+
+        self.batch = []  # the messages of the batch being filled
+        self.batch_size = 0
+        self.batch_cost = 0  # the room reserved in the flow control for the batched messages and files
+        self.batch_timer = None  # sends the batch once its latency budget has been used up
+
+        # metrics
+        self.pauses = 0  # the number of times the transport paused the queue
+        self.batches = 0
+        self.batched = 0  # the number of messages sent in batches
+        self.zero_copy_bytes = 0  # the bytes of file content written straight to the socket
+
+    def put_frame(self, frame, reserved=False):
+        """
+        Queue a message.
+
+        :param frame: the message to send (Frame)
+        :param reserved: True if room has already been reserved for the message in the flow control (bool)
+        """
+
+        if not reserved:
+            self.flow.reserve(frame_cost(frame), block=False)
+
+        self.items.append(frame)
+        self.pump()
+
+    def put_file(self, event_path, abs_path, cost=None):
+        """
+        Queue a file whose content must be sent.
+
+        :param event_path: the relative path of the file sent to the server (string)
+        :param abs_path: the absolute path of the file (string)
+        :param cost: the room already reserved for the file in the flow control, None to reserve it now (int)
+        """
+
+        if cost is None:
+            cost = file_cost(event_path, abs_path)
+            self.flow.reserve(cost, block=False)
+
+        self.items.append(FileTransfer(event_path, abs_path, cost))
+        self.pump()
+
+    def write_frame(self, frame):
+        """
+        Write a message to the transport.
+
+        :param frame: the message (Frame)
+        """
+
+        self.protocol.write_frame(frame)
+        self.drained = False
+
+    def release(self, cost):
+        """
+        Release the room of a message or a file which has been written to the transport or dropped.
+
+        :param cost: the room reserved for it (int)
+        """
+
+        if self.flow.release(cost):
+            self.protocol.queue_drained()
+
+    def finish_transfer(self, transfer):
+        """
+        Close the file of a transfer which is done or dropped.
+
+        :param transfer: the transfer (FileTransfer)
+        """
+
+        if transfer.fh is not None:
+            transfer.fh.close()
+        if self.streams.get(transfer.event_path) is transfer:
+            del self.streams[transfer.event_path]
+
+        self.release(transfer.cost)
+
+    def pump(self):
+        """
+        Write as much as allowed until the queue is empty or the producer is paused.
+        """
+
+        if self.scheduled is not None and self.scheduled.active():
+            self.scheduled.cancel()
+        self.scheduled = None
+
+        chunks = 0
+        while not self.paused:
+            # the queued messages are sent first, the files being streamed take turns once they are all sent or wait
+            if self.items and self.take_item():
+                continue
+
+            # the latency budget of the batch has been used up
+            if self.batch and self.batch_timer is None:
+                self.send_batch()
+                continue
+
+            stream = self.next_stream()
+            if stream is None:
+                return  # nothing to send until more is queued or the server replies
+
+            if chunks == CHUNKS_PER_ITERATION:
+                # let the reactor process other events before continuing with the files
+                self.scheduled = reactor.callLater(0, self.pump)
+                return
+
+            if stream.hasher is not None:
+                self.hash_chunk(stream)
+            else:
+                self.send_chunk(stream)
+            chunks += 1
+
+    def take_item(self):
+        """
+        Send the next queued message or start the transfer of the next queued file, unless it must wait for the files
+        being streamed.
+
+        :return: False if the item at the head of the queue must wait (bool)
+        """
+
+        item = self.items[0]
+        if self.blocked(item):
+            return False
+
+        self.items.popleft()
+        if self.batch_item(item):
+            return True
+
+        if isinstance(item, FileTransfer) and len(self.streams) >= self.max_streams:
+            self.items.appendleft(item)
+            return False
+
+        # the batch is sent first, so that the order is kept
+        self.send_batch()
+        if isinstance(item, FileTransfer):
+            self.start_transfer(item)
+        else:
+            self.write_frame(self.compress_frame(item))
+            self.release(frame_cost(item))
+
+        return True
+
+    def blocked(self, item):
+        """
+        :param item: the message or file at the head of the queue (Frame or FileTransfer)
+
+        :return: True if the item must wait until the files being streamed have been sent (bool)
+        """
+
+        if not self.streams:
+            return False
+
+        # a server which doesn't support streams expects the messages of a file to follow each other
+        if "streams" not in self.protocol.features:
+            return True
+
+        # the server takes the messages of a file as part of the operation being received when the file's first
+        # message arrives, nothing overtakes a file which is still being hashed before it's offered
+        if any(transfer.hasher is not None for transfer in self.streams.values()):
+            return True
+
+        return any(overlaps(path, event_path) for path in item_paths(item) for event_path in self.streams)
+
+    def next_stream(self):
+        """
+        :return: the file whose turn it is to send a chunk, None if all the files being streamed wait for the server
+                 (FileTransfer)
+        """
+
+        for _ in range(len(self.streams)):
+            event_path, transfer = next(iter(self.streams.items()))
+            self.streams.move_to_end(event_path)
+            if not transfer.waiting:
+                return transfer
+
+        return None
+
+    def batch_item(self, item):
+        """
+        Add a message or a small file to the batch being filled - the batch is sent once it's full.
+
+        :param item: the message or the file taken from the queue (Frame or FileTransfer)
+
+        :return: False if the item can't be batched (bool)
+        """
+
+        if self.protocol.mode != "binary" or "batch" not in self.protocol.features:
+            return False
+
+        if isinstance(item, FileTransfer):
+            if item.size is not None:
+                return False
+
+            try:
+                with open(item.abs_path, "rb") as fh:
+                    size = os.fstat(fh.fileno()).st_size
+                    if size >= SMALL_FILE_SIZE:
+                        item.size = size
+                        return False
+                    content = fh.read()
+            except OSError as e:
+                logging.info(f"File cannot be read and will not be propagated - {item.abs_path} - {e}")
+                self.release(item.cost)
+                return True
+
+            entry, cost = self.compress_frame(Frame(MSG_MODIFIED, 0, item.event_path, content)), item.cost
+        else:
+            if item.msg_type not in BATCHABLE or len(item.payload) >= SMALL_FILE_SIZE:
+                return False
+
+            entry, cost = self.compress_frame(item), frame_cost(item)
+
+        if not self.batch:
+            self.batch_timer = reactor.callLater(BATCH_LATENCY, self.batch_due)
+
+        self.batch.append(entry)
+        self.batch_size += HEADER.size + len(entry.path) + len(entry.payload)
+        self.batch_cost += cost
+        if len(self.batch) >= BATCH_ENTRIES or self.batch_size >= BATCH_SIZE:
+            self.send_batch()
+
+        return True
+
+    def batch_due(self):
+        """
+        Called once the latency budget of the batch has been used up - the batch is sent when the queue is empty.
+        """
+
+        self.batch_timer = None
+        self.pump()
+
+    def send_batch(self):
+        """
+        Send the batch being filled, a single message is sent as it is.
+        """
+
+        if self.batch_timer is not None and self.batch_timer.active():
+            self.batch_timer.cancel()
+        self.batch_timer = None
+
+        if not self.batch:
+            return
+
+        if len(self.batch) == 1:
+            self.write_frame(self.batch[0])
+        else:
+            self.write_frame(Frame(MSG_BATCH, 0, b"", encode_batch(self.batch)))
+            self.batches += 1
+            self.batched += len(self.batch)
+
+        cost = self.batch_cost
+        self.batch = []
+        self.batch_size = 0
+        self.batch_cost = 0
+        self.release(cost)
+
+    def start_transfer(self, transfer):
+        """
+        Open the file of a transfer - files are read in full only if the server uses the legacy protocol.
+
+        :param transfer: the transfer to start (FileTransfer)
+        """
+
+        try:
+            transfer.fh = open(transfer.abs_path, "rb")
+        except OSError as e:
+            logging.info(f"File cannot be read and will not be propagated - {transfer.abs_path} - {e}")
+            self.finish_transfer(transfer)
+            return
+
+        if self.protocol.mode == "legacy":
+            self.write_frame(self.compress_frame(Frame(MSG_MODIFIED, 0, transfer.event_path,
+                                                                transfer.fh.read())))
+            self.finish_transfer(transfer)
+            return
+
+        self.streams[transfer.event_path] = transfer
+
+        if self.use_dedup(transfer):
+            logging.info(f"Hashing file {transfer.abs_path} before offering it to server")
+            transfer.hasher = content_hasher()
+        else:
+            self.send_content(transfer)
+
+    def send_content(self, transfer):
+        """
+        Start sending the content of a file, either as a delta or in full.
+
+        :param transfer: the transfer in progress (FileTransfer)
+        """
+
+        if self.use_delta(transfer):
+            logging.info(f"Requesting signature of {transfer.abs_path} from server")
+            transfer.waiting = MSG_SIGNATURE
+            self.write_frame(Frame(MSG_SIGNATURE_REQUEST, 0, transfer.event_path, b""))
+        else:
+            logging.info(f"Streaming file {transfer.abs_path} to server")
+            self.send_chunk(transfer)  # straight away, the messages queued after the file may overtake the rest of it
+
+    def use_dedup(self, transfer):
+        """
+        :param transfer: the transfer to start (FileTransfer)
+
+        :return: True if the file should be offered by its hash before sending the content (bool)
+        """
+
+        if self.dedup_min_size is None or "dedup" not in self.protocol.features:
+            return False
+
+        return os.fstat(transfer.fh.fileno()).st_size >= self.dedup_min_size
+
+    def use_delta(self, transfer):
+        """
+        :param transfer: the transfer to start (FileTransfer)
+
+        :return: True if the file should be sent as a delta against the server's copy (bool)
+        """
+
+        if self.delta_min_size is None or "delta" not in self.protocol.features:
+            return False
+
+        return os.fstat(transfer.fh.fileno()).st_size >= self.delta_min_size
+
+    def hash_chunk(self, transfer):
+        """
+        Hash the next chunk of a file - once the whole file is hashed it is offered to the server.
+
+        :param transfer: the transfer in progress (FileTransfer)
+        """
+
+        data = transfer.fh.read(self.chunk_size)
+        transfer.hasher.update(data)
+        transfer.offset += len(data)
+
+        if len(data) < self.chunk_size:
+            offer = encode_offer(transfer.hasher.digest(), transfer.offset)
+            transfer.hasher = None
+            transfer.offset = 0
+            transfer.fh.seek(0)
+
+            transfer.waiting = MSG_CONTENT_REPLY
+            self.write_frame(Frame(MSG_CONTENT_OFFER, 0, transfer.event_path, offer))
+
+    def content_reply_received(self, event_path, reply):
+        """
+        Called when the server replies to a content offer - the transfer is done if the server had the content.
+
+        :param event_path: the path of the file (bytes)
+        :param reply: the payload of the reply (bytes)
+        """
+
+        transfer = self.streams.get(event_path)
+        if transfer is None or transfer.waiting != MSG_CONTENT_REPLY:
+            logging.info(f"Received an unexpected content reply for {event_path}")
+            return
+
+        transfer.waiting = None
+        if reply == CONTENT_MATERIALISED:
+            logging.info(f"Server already has the content of {transfer.abs_path}, skipping the transfer")
+            self.finish_transfer(transfer)
+        elif reply[:1] == CONTENT_RESUME:
+            self.resume_content(transfer, reply)
+        else:
+            self.send_content(transfer)
+
+        self.pump()
+
+    def resume_content(self, transfer, reply):
+        """
+        Continue the transfer of a file the server has staged - the content is sent from the requested offset, as
+        part of the transfer the server already has.
+
+        :param transfer: the transfer in progress (FileTransfer)
+        :param reply: the payload of the content reply (bytes)
+        """
+
+        try:
+            offset = decode_resume(reply)
+        except ProtocolError as e:
+            logging.info(f"{e}, sending the full content of {transfer.abs_path}")
+            self.send_content(transfer)
+            return
+
+        logging.info(f"Resuming the transfer of {transfer.abs_path} at byte {offset}")
+        transfer.fh.seek(offset)
+        transfer.offset = offset
+        transfer.first = False
+
+        # the part the server already has is not queued any more
+        skipped = min(offset, transfer.cost)
+        transfer.cost -= skipped
+        self.release(skipped)
+
+    def signature_received(self, event_path, signature):
+        """
+        Called when the server sends the signature of its copy of a file - the transfer continues with the delta.
+
+        :param event_path: the path of the file (bytes)
+        :param signature: the encoded signature (bytes)
+        """
+
+        transfer = self.streams.get(event_path)
+        if transfer is None or transfer.waiting != MSG_SIGNATURE:
+            logging.info(f"Received an unexpected signature for {event_path}")
+            return
+
+        try:
+            transfer.encoder = iter(DeltaEncoder(signature, transfer.fh, self.chunk_size))
+        except DeltaError as e:
+            logging.warning(f"Invalid signature received, sending the full content of {transfer.abs_path} - {e}")
+
+        transfer.waiting = None
+        self.pump()
+
+    def send_chunk(self, transfer):
+        """
+        Read the next chunk of a file (or compute the next part of its delta) and send it - or send it from the page
+        cache, see use_zero_copy.
+
+        :param transfer: the transfer in progress (FileTransfer)
+        """
+
+        if transfer.encoder is not None:
+            payload = next(transfer.encoder, None)
+            if payload == b"":
+                return  # the encoder is still scanning the file
+
+            msg_type = MSG_DELTA
+            flags = FLAG_LAST if payload is None else 0
+            payload = payload or b""
+        elif self.use_zero_copy(transfer):
+            self.send_zero_copy(transfer)
+            return
+        else:
+            payload = transfer.fh.read(self.chunk_size)
+
+            msg_type = MSG_CHUNK
+            flags = FLAG_LAST if len(payload) < self.chunk_size else 0
+
+        if transfer.first:
+            flags |= FLAG_FIRST
+            transfer.first = False
+
+        self.write_frame(self.compress_frame(Frame(msg_type, flags, transfer.event_path, payload), transfer))
+        transfer.offset += len(payload)
+
+        if flags & FLAG_LAST:
+            self.finish_transfer(transfer)
+        else:
+            self.chunk_sent(transfer, len(payload))
+
+    def chunk_sent(self, transfer, size):
+        """
+        Release the room of a chunk which has been sent - the room of a file is released as it is sent, so a big file
+        doesn't hold back the rest of the queue until it's done.
+
+        :param transfer: the transfer in progress (FileTransfer)
+        :param size: the size of the chunk (int)
+        """
+
+        sent = min(size, transfer.cost)
+        transfer.cost -= sent
+        self.release(sent)
+
+    def use_zero_copy(self, transfer):
+        """
+        :param transfer: the transfer in progress (FileTransfer)
+
+        :return: True if the next chunk of the file can be written straight from the page cache to the socket - it's
+                 sent uncompressed, it isn't the last chunk and nothing is buffered in the transport ahead of it (bool)
+        """
+
+        if not self.zero_copy or not self.drained or self.protocol.mode != "binary":
+            return False
+
+        # the first chunk of a file is read when a codec has been negotiated, it's the sample deciding on compression
+        if self.protocol.compressor is not None and transfer.compress is not False:
+            return False
+
+        # the last chunk is read, the server commits the file once it's received and a chunk sent from the page cache
+        # is completed with zeroes if the file is truncated meanwhile
+        if os.fstat(transfer.fh.fileno()).st_size - transfer.offset <= self.chunk_size:
+            return False
+
+        return transport_socket(self.protocol.transport) is not None
+
+    def send_zero_copy(self, transfer):
+        """
+        Write the next chunk of a file straight from the page cache to the socket. Once the socket doesn't take a whole
+        chunk at once, the rest of it is handed over to the transport and the following chunks are read as usual, until
+        the transport has drained its buffer.
+
+        :param transfer: the transfer in progress (FileTransfer)
+        """
+
+        flags = FLAG_FIRST if transfer.first else 0
+        transfer.first = False
+
+        prefix = encode_header(MSG_CHUNK, flags, len(transfer.event_path), self.chunk_size) + transfer.event_path
+        written, complete = write_file_part(self.protocol.transport, prefix, transfer.fh, transfer.offset,
+                                            self.chunk_size)
+        self.zero_copy_bytes += written
+        if written < self.chunk_size:
+            self.drained = False
+
+        MESSAGES_SENT.inc("chunk")
+        MESSAGE_BYTES.observe(len(transfer.event_path) + self.chunk_size, "chunk")
+        event_log.debug(f"Sending 'chunk' message to server for {transfer.event_path} from the page cache")
+
+        if not complete:
+            self.abort_transfer(transfer)
+            return
+
+        # os.sendfile leaves the position of the file alone, the next chunk may be read
+        transfer.offset += self.chunk_size
+        transfer.fh.seek(transfer.offset)
+        if self.protocol.compressor is not None:
+            self.protocol.compressor.skip(self.chunk_size)
+
+        self.chunk_sent(transfer, self.chunk_size)
+
+    def abort_transfer(self, transfer):
+        """
+        Drop the transfer of a file which was truncated while a chunk was sent from the page cache - the chunk was
+        completed with zeroes, so the server is told to discard what it has received of the file. The modified event
+        of the truncation sends the file again.
+
+        :param transfer: the transfer in progress (FileTransfer)
+        """
+
+        logging.info(f"{transfer.abs_path} was truncated while it was sent, aborting its transfer")
+        self.write_frame(Frame(MSG_CHUNK, FLAG_ABORT, transfer.event_path, b""))
+        self.finish_transfer(transfer)
+
+    def compress_frame(self, frame, transfer=None):
+        """
+        Compress the payload of a message, if a codec has been negotiated and the payload is worth compressing.
+
+        :param frame: the message (Frame)
+        :param transfer: the transfer the message belongs to, its first sample decides for the whole file (FileTransfer)
+
+        :return: the message to send (Frame)
+        """
+
+        compressor = self.protocol.compressor
+        if compressor is None or frame.msg_type not in COMPRESSIBLE or not frame.payload:
+            return frame
+
+        worth = transfer.compress if transfer is not None else None
+        if worth is None:
+            worth = compressor.worth_compressing(frame.payload)
+            if transfer is not None and len(frame.payload) >= MIN_COMPRESS_SIZE:
+                transfer.compress = worth
+
+        if not worth:
+            compressor.skip(frame.payload)
+            return frame
+
+        compressed, payload = compressor.compress(frame.payload)
+        if not compressed:
+            if transfer is not None:
+                transfer.compress = False  # the sample was misleading, don't waste more time on this file
+            return frame
+
+        return frame._replace(flags=frame.flags | FLAG_COMPRESSED, payload=payload)
+
+    def stats(self):
+        """
+        :return: the state of the flow control, the number of times the transport paused the queue, the number of
+                 batches sent, the number of files being streamed and the bytes sent from the page cache (dict)
+        """
+
+        stats = self.flow.stats()
+        stats.update(queued_items=len(self.items) + len(self.batch) + len(self.streams), paused=self.paused,
+                     pauses=self.pauses, batches=self.batches, batched_messages=self.batched,
+                     streams=len(self.streams), zero_copy_bytes=self.zero_copy_bytes)
+        return stats
+
+    def pauseProducing(self):
+        """
+        Called by the transport when its buffer is full.
+        """
+
+        if not self.paused:
+            self.pauses += 1
+        self.paused = True
+        self.drained = False
+
+    def resumeProducing(self):
+        """
+        Called by the transport when its buffer has been drained.
+        """
+
+        self.paused = False
+        self.drained = True
+        self.pump()
+
+    def start(self):
+        """
+        Start sending once the wire format has been negotiated - the transport may still have the hello message
+        buffered.
+        """
+
+        self.paused = False
+        self.pump()
+
+    def stopProducing(self):
+        """
+        Called by the transport when the connection is lost - drops everything that is queued.
+        """
+
+        self.paused = True
+        if self.scheduled is not None and self.scheduled.active():
+            self.scheduled.cancel()
+        self.scheduled = None
+
+        # the room of everything dropped is released - without notifying the protocol, the connection is gone
+        if self.batch_timer is not None and self.batch_timer.active():
+            self.batch_timer.cancel()
+        self.batch_timer = None
+        dropped = self.batch_cost
+        self.batch = []
+        self.batch_size = 0
+        self.batch_cost = 0
+
+        for transfer in self.streams.values():
+            transfer.fh.close()
+            dropped += transfer.cost
+        self.streams.clear()
+
+        for item in self.items:
+            dropped += item.cost if isinstance(item, FileTransfer) else frame_cost(item)
+        self.items.clear()
+
+        self.flow.release(dropped)
@@ -0,0 +1,77 @@
+import os
+import socket
+from twisted.internet.interfaces import ISSLTransport, ITCPTransport
+
+
+# file content is written to the socket with os.sendfile, which is missing on some platforms (e.g. Windows)
+SENDFILE = hasattr(os, "sendfile")
+
+
+def transport_socket(transport):
+    """
+    :param transport: the transport of a connection
+
+    :return: the socket of the transport if file content can be written straight to it, None otherwise - only a plain
+             TCP transport qualifies, a TLS or an in-memory transport has to be handed the bytes (socket.socket)
+    """
+
+    if not SENDFILE or not ITCPTransport.providedBy(transport) or ISSLTransport.providedBy(transport):
+        return None
+
+    handle = transport.getHandle()
+    return handle if isinstance(handle, socket.socket) else None
+
+
+def write_file_part(transport, prefix, fh, offset, count):
+    """
+    Write a message whose payload is a part of a file straight to the socket of a drained transport - the prefix (the
+    header and the path of the message) with send and the payload with os.sendfile, from the page cache to the socket
+    without being copied into the process. Whatever the socket doesn't take at once is read from the file and handed
+    over to the transport, which sends it once the socket is writable again.
+
+    The size of the payload is announced in the header already - if the file has been truncated in the meantime, the
+    message is completed with zeroes to keep the framing intact, and the caller must abort the transfer so that the
+    server discards the file.
+
+    :param transport: a TCP transport with nothing buffered (see TransferQueue.use_zero_copy)
+    :param prefix: the header and the path of the message (bytes)
+    :param fh: the file (file object)
+    :param offset: the offset of the payload in the file (int)
+    :param count: the size of the payload (int)
+
+    :return: the bytes of the payload written straight to the socket, the rest has been handed over to the transport,
+             and False if the file was shorter than the payload (tuple)
+    """
+
+    sock = transport.getHandle()
+
+    sent = 0
+    try:
+        sent = sock.send(prefix)
+    except OSError:
+        pass  # the socket is full, or the connection is broken and the transport finds out on its own write
+
+    written = 0
+    while sent == len(prefix) and written < count:
+        try:
+            part = os.sendfile(sock.fileno(), fh.fileno(), offset + written, count - written)
+        except OSError:
+            break
+        if not part:
+            break  # the file has been truncated
+        written += part
+
+    complete = True
+    if sent < len(prefix) or written < count:
+        try:
+            data = os.pread(fh.fileno(), count - written, offset + written)
+        except OSError:
+            data = b""
+
+        complete = len(data) == count - written
+        parts = [prefix[sent:], data]
+        if not complete:
+            parts.append(bytes(count - written - len(data)))
+        transport.writeSequence(parts)
+
+    return written, complete
@@ -0,0 +1,353 @@
+import lzma
+import threading
+import time
+import zlib
+from common_pkg.framing import MAX_PAYLOAD_LENGTH
+
+try:
+    import zstandard
+except ImportError:  # optional dependency, see setup.py
+    zstandard = None
+
+
+# payloads smaller than this are never compressed
+MIN_COMPRESS_SIZE = 512
+
+# the size of the sample used to estimate how well a file compresses
+SAMPLE_SIZE = 16 * 1024
+
+# payloads whose estimated compressed size is bigger than this ratio of the original size are sent uncompressed
+MAX_RATIO = 0.9
+
+# the size of the pieces a payload is decompressed in
+READ_SIZE = 256 * 1024
+
+# upper limit for the decompressed size of a single payload, so that a small payload can't fill up the memory/disk
+MAX_DECOMPRESSED_SIZE = MAX_PAYLOAD_LENGTH
+
+
+class CompressionError(Exception):
+    """
+    Raised when a payload cannot be decompressed.
+    """
+
+
+class ZlibCodec:
+    """
+    Deflate compression from the standard library.
+    """
+
+    name = "zlib"
+
+    def __init__(self, level=3):
+        """
+        :param level: the compression level (int)
+        """
+
+        self.level = level
+
+    def compress(self, data):
+        """
+        :param data: the data to compress (bytes-like)
+
+        :return: the compressed data (bytes)
+        """
+
+        return zlib.compress(data, self.level)
+
+    def decompress(self, payload):
+        """
+        :param payload: the compressed data (bytes-like)
+
+        :return: a generator of decompressed pieces of at most READ_SIZE bytes
+        """
+
+        decompressor = zlib.decompressobj()
+        try:
+            data = payload
+            while data:
+                yield decompressor.decompress(data, READ_SIZE)
+                data = decompressor.unconsumed_tail
+            yield decompressor.flush()
+        except zlib.error as e:
+            raise CompressionError(str(e))
+
+        if not decompressor.eof:
+            raise CompressionError("Truncated zlib payload")
+
+
+class LzmaCodec:
+    """
+    LZMA compression from the standard library - slow, but compresses better.
+    """
+
+    name = "lzma"
+
+    def __init__(self, preset=1):
+        """
+        :param preset: the compression preset (int)
+        """
+
+        self.preset = preset
+
+    def compress(self, data):
+        """
+        :param data: the data to compress (bytes-like)
+
+        :return: the compressed data (bytes)
+        """
+
+        return lzma.compress(data, preset=self.preset)
+
+    def decompress(self, payload):
+        """
+        :param payload: the compressed data (bytes-like)
+
+        :return: a generator of decompressed pieces of at most READ_SIZE bytes
+        """
+
+        decompressor = lzma.LZMADecompressor()
+        try:
+            yield decompressor.decompress(payload, READ_SIZE)
+            while not decompressor.eof and not decompressor.needs_input:
+                yield decompressor.decompress(b"", READ_SIZE)
+        except lzma.LZMAError as e:
+            raise CompressionError(str(e))
+
+        if not decompressor.eof:
+            raise CompressionError("Truncated lzma payload")
+
+
+class ZstdCodec:
+    """
+    Zstandard compression, available if the zstandard package is installed.
+    """
+
+    name = "zstd"
+
+    def __init__(self, level=3):
+        """
+        :param level: the compression level (int)
+        """
+
+        self.compressor = zstandard.ZstdCompressor(level=level)
+        self.decompressor = zstandard.ZstdDecompressor()
+
+    def compress(self, data):
+        """
+        :param data: the data to compress (bytes-like)
+
+        :return: the compressed data (bytes)
+        """
+
+        return self.compressor.compress(data)
+
+    def decompress(self, payload):
+        """
+        :param payload: the compressed data (bytes-like)
+
+        :return: a generator of decompressed pieces of at most READ_SIZE bytes
+        """
+
+        try:
+            with self.decompressor.stream_reader(payload) as reader:
+                for data in iter(lambda: reader.read(READ_SIZE), b""):
+                    yield data
+        except zstandard.ZstdError as e:
+            raise CompressionError(str(e))
+
+
+# the available codecs, in the order of preference
+CODECS = {codec.name: codec for codec in ([ZstdCodec()] if zstandard else []) + [ZlibCodec(), LzmaCodec()]}
+
+
+def choose_codec(offered):
+    """
+    Pick the codec used on a connection.
+
+    :param offered: the names of the codecs the peer supports (list of strings)
+
+    :return: the most preferred codec supported by both peers, None if there isn't one
+    """
+
+    for name, codec in CODECS.items():
+        if name in offered:
+            return codec
+
+    return None
+
+
+class CompressionStats:
+    """
+    Counters of the compression done on a connection - safe to update from several threads.
+    """
+
+    def __init__(self):
+        """
+        Initialise the counters.
+        """
+
+        self.lock = threading.Lock()
+        self.raw_bytes = 0  # the size of the payloads before compression/after decompression
+        self.wire_bytes = 0  # the size of the payloads on the wire
+        self.compressed = 0  # the number of compressed payloads
+        self.skipped = 0  # the number of payloads sent uncompressed because they don't compress well
+        self.cpu_time = 0.0  # the CPU time spent compressing/decompressing (seconds)
+
+    def add(self, raw_bytes, wire_bytes, cpu_time, compressed=True):
+        """
+        Count a payload.
+
+        :param raw_bytes: the size of the uncompressed payload (int)
+        :param wire_bytes: the size of the payload on the wire (int)
+        :param cpu_time: the CPU time spent on the payload (float)
+        :param compressed: False if the payload was sent uncompressed (bool)
+        """
+
+        with self.lock:
+            self.raw_bytes += raw_bytes
+            self.wire_bytes += wire_bytes
+            self.cpu_time += cpu_time
+            if compressed:
+                self.compressed += 1
+            else:
+                self.skipped += 1
+
+    def spend(self, cpu_time):
+        """
+        Count CPU time which isn't spent on a particular payload.
+
+        :param cpu_time: the CPU time (float)
+        """
+
+        with self.lock:
+            self.cpu_time += cpu_time
+
+    def as_dict(self):
+        """
+        :return: the counters, including the number of bytes saved (dict)
+        """
+
+        with self.lock:
+            return {
+                "raw_bytes": self.raw_bytes,
+                "wire_bytes": self.wire_bytes,
+                "bytes_saved": self.raw_bytes - self.wire_bytes,
+                "compressed": self.compressed,
+                "skipped": self.skipped,
+                "cpu_time": self.cpu_time
+            }
+
+
+class PayloadCompressor:
+    """
+    The sending side of a connection - compresses the payloads which are worth it.
+    """
+
+    def __init__(self, codec):
+        """
+        Initialise the compressor.
+
+        :param codec: the negotiated codec
+        """
+
+        self.codec = codec
+        self.stats = CompressionStats()
+
+    def worth_compressing(self, data):
+        """
+        Estimate how well some data compresses by compressing a sample with the fastest zlib level.
+
+        :param data: the data, e.g. the first chunk of a file (bytes-like)
+
+        :return: True if the data should be compressed (bool)
+        """
+
+        if len(data) < MIN_COMPRESS_SIZE:
+            return False
+
+        start = time.thread_time()
+
+        # sample the beginning and the middle, headers of media files are often more compressible than the rest
+        half = SAMPLE_SIZE // 2
+        middle = len(data) // 2
+        sample = bytes(data[:half]) + bytes(data[max(half, middle - half // 2):middle + half // 2])
+        ratio = len(zlib.compress(sample, 1)) / len(sample)
+
+        self.stats.spend(time.thread_time() - start)
+        return ratio <= MAX_RATIO
+
+    def compress(self, data):
+        """
+        Compress a payload, it is sent uncompressed if compression doesn't pay off.
+
+        :param data: the payload (bytes-like)
+
+        :return: a tuple of two values - True if the payload was compressed and the payload to send
+        """
+
+        start = time.thread_time()
+        compressed = self.codec.compress(data)
+        cpu_time = time.thread_time() - start
+
+        if len(compressed) > len(data) * MAX_RATIO:
+            self.stats.add(len(data), len(data), cpu_time, compressed=False)
+            return False, data
+
+        self.stats.add(len(data), len(compressed), cpu_time)
+        return True, compressed
+
+    def skip(self, data):
+        """
+        Count a payload sent uncompressed.
+
+        :param data: the payload, or its size if it's sent without being read (bytes-like or int)
+        """
+
+        size = data if isinstance(data, int) else len(data)
+        self.stats.add(size, size, 0.0, compressed=False)
+
+
+class PayloadDecompressor:
+    """
+    The receiving side of a connection - decompresses payloads in bounded pieces.
+    """
+
+    def __init__(self, codec):
+        """
+        Initialise the decompressor.
+
+        :param codec: the negotiated codec
+        """
+
+        self.codec = codec
+        self.stats = CompressionStats()
+
+    def decompress_into(self, payload, write):
+        """
+        Decompress a payload piece by piece.
+
+        :param payload: the compressed payload (bytes-like)
+        :param write: called with each decompressed piece
+        """
+
+        start = time.thread_time()
+        size = 0
+        for data in self.codec.decompress(payload):
+            size += len(data)
+            if size > MAX_DECOMPRESSED_SIZE:
+                raise CompressionError(f"Payload decompresses to more than {MAX_DECOMPRESSED_SIZE} bytes")
+            write(data)
+
+        self.stats.add(size, len(payload), time.thread_time() - start)
+
+    def decompress(self, payload):
+        """
+        :param payload: the compressed payload (bytes-like)
+
+        :return: the decompressed payload (bytes)
+        """
+
+        pieces = []
+        self.decompress_into(payload, pieces.append)
+        return b"".join(pieces)
@@ -0,0 +1,105 @@
+import hashlib
+import struct
+from common_pkg.framing import ProtocolError
+
+
+# files at least this big are offered by their hash before their content is sent, smaller files are cheaper to send
+DEDUP_MIN_SIZE = 64 * 1024
+
+# the size of the content hash (bytes)
+DIGEST_SIZE = 32
+
+# payload of a content offer - the hash and the size of the content
+OFFER = struct.Struct(f"!{DIGEST_SIZE}sQ")
+
+# payloads of a content reply
+CONTENT_MATERIALISED = b"\x01"  # the server had the content and the file is in place
+CONTENT_NEEDED = b"\x00"  # the content must be sent
+CONTENT_RESUME = b"\x02"  # the content must be sent from the offset which follows, the server keeps what it receives
+
+# payload of a content reply asking for the rest of a partially received file - the reply and the offset
+RESUME_REPLY = struct.Struct("!cQ")
+
+
+def content_hasher():
+    """
+    :return: a new hash object used to identify file contents
+    """
+
+    return hashlib.blake2b(digest_size=DIGEST_SIZE)
+
+
+def encode_offer(digest, size):
+    """
+    :param digest: the hash of the content (bytes)
+    :param size: the size of the content (int)
+
+    :return: the payload of a content offer (bytes)
+    """
+
+    return OFFER.pack(digest, size)
+
+
+def decode_offer(payload):
+    """
+    :param payload: the payload of a content offer (bytes)
+
+    :return: a tuple of two values - the hash and the size of the content
+    """
+
+    if len(payload) != OFFER.size:
+        raise ProtocolError(f"Invalid content offer of {len(payload)} bytes")
+
+    return OFFER.unpack(payload)
+
+
+def encode_resume(offset):
+    """
+    :param offset: the offset the client must continue from (int)
+
+    :return: the payload of a content reply asking for the rest of a file (bytes)
+    """
+
+    return RESUME_REPLY.pack(CONTENT_RESUME, offset)
+
+
+def decode_resume(payload):
+    """
+    :param payload: the payload of a content reply asking for the rest of a file (bytes)
+
+    :return: the offset the client must continue from (int)
+    """
+
+    if len(payload) != RESUME_REPLY.size:
+        raise ProtocolError(f"Invalid content reply of {len(payload)} bytes")
+
+    return RESUME_REPLY.unpack(payload)[1]
+
+
+class HashingWriter:
+    """
+    A file wrapper hashing everything written through it.
+    """
+
+    def __init__(self, fh, hasher):
+        """
+        Initialise the wrapper.
+
+        :param fh: the file opened for writing in binary mode
+        :param hasher: the hash object updated with the written data
+        """
+
+        self.fh = fh
+        self.hasher = hasher
+        self.size = 0
+
+    def write(self, data):
+        """
+        :param data: the data to write (bytes-like)
+
+        :return: the number of written bytes (int)
+        """
+
+        self.hasher.update(data)
+        self.size += len(data)
+        return self.fh.write(data)
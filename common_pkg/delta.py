@@ -0,0 +1,410 @@
+import hashlib
+import math
+import struct
+import zlib
+
+
+# the smallest block size used for signatures, bigger files use bigger blocks (roughly the square root of the size)
+MIN_BLOCK_SIZE = 2048
+
+# the biggest block size used for signatures
+MAX_BLOCK_SIZE = 1024 * 1024
+
+# modulus of the adler-32 checksum used as a rolling (weak) checksum
+ADLER_MODULUS = 65521
+
+# signature header - block size and size of the file the signature was computed for
+SIGNATURE_HEADER = struct.Struct("!IQ")
+
+# signature of a single block - weak checksum and strong hash
+BLOCK_SIGNATURE = struct.Struct("!I16s")
+
+# delta operations - copy a range of the existing file or insert literal data
+COPY_OP = struct.Struct("!cQI")
+DATA_OP = struct.Struct("!cI")
+COPY = b"C"
+DATA = b"D"
+
+# after this many blocks worth of literal data without a match, the encoder stops rolling byte by byte and only checks
+# block aligned positions until it finds a match again - files rewritten in full are then encoded at hashing speed
+ROLLING_LIMIT_BLOCKS = 64
+
+# when a block doesn't match right after a match, the following block aligned positions are checked first - in place
+# modifications (the common case for databases and disk images) are then found without rolling through the block
+LOOKAHEAD_BLOCKS = 8
+
+# the number of steps after which the encoder yields control back to the caller even if no payload is ready
+STEPS_PER_YIELD = 16384
+
+# the size of the reads done by the encoder
+READ_SIZE = 256 * 1024
+
+
+class DeltaError(Exception):
+    """
+    Raised when a signature or a delta cannot be decoded.
+    """
+
+
+def strong_hash(data):
+    """
+    :param data: a block of data (bytes-like)
+
+    :return: the strong hash used to confirm a weak checksum match (bytes)
+    """
+
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def block_size_for(file_size):
+    """
+    Choose the signature block size for a file.
+
+    :param file_size: the size of the file (int)
+
+    :return: the block size (int)
+    """
+
+    block_size = int(math.sqrt(file_size)) // 1024 * 1024
+    return min(max(block_size, MIN_BLOCK_SIZE), MAX_BLOCK_SIZE)
+
+
+def compute_signature(fh, file_size, block_size=None):
+    """
+    Compute the signature of a file - the weak checksum and strong hash of each block.
+
+    :param fh: the file opened for reading in binary mode
+    :param file_size: the size of the file (int)
+    :param block_size: the block size, chosen based on the file size if not given (int)
+
+    :return: the encoded signature (bytes)
+    """
+
+    if block_size is None:
+        block_size = block_size_for(file_size)
+
+    signature = bytearray(SIGNATURE_HEADER.pack(block_size, file_size))
+    while True:
+        block = fh.read(block_size)
+        if not block:
+            break
+        signature += BLOCK_SIGNATURE.pack(zlib.adler32(block), strong_hash(block))
+
+    return bytes(signature)
+
+
+def empty_signature():
+    """
+    :return: the signature used when there is no existing copy of a file (bytes)
+    """
+
+    return SIGNATURE_HEADER.pack(MIN_BLOCK_SIZE, 0)
+
+
+def decode_signature(signature):
+    """
+    Decode a signature into a lookup table.
+
+    :param signature: the encoded signature (bytes)
+
+    :return: a tuple of two values - the block size and a dict mapping weak checksum -> {strong hash: block offset}
+    """
+
+    if len(signature) < SIGNATURE_HEADER.size or (len(signature) - SIGNATURE_HEADER.size) % BLOCK_SIGNATURE.size:
+        raise DeltaError(f"Invalid signature length {len(signature)}")
+
+    block_size, file_size = SIGNATURE_HEADER.unpack_from(signature)
+    if block_size == 0:
+        raise DeltaError("Invalid signature block size")
+
+    table = {}
+    for index, (weak, strong) in enumerate(BLOCK_SIGNATURE.iter_unpack(signature[SIGNATURE_HEADER.size:])):
+        # keep the first occurrence of identical blocks
+        table.setdefault(weak, {}).setdefault(strong, index * block_size)
+
+    return block_size, table
+
+
+class DeltaEncoder:
+    """
+    Compute the delta of a file against the signature of an older copy.
+
+    Iterating over the encoder yields encoded payloads, each containing whole operations and no longer than
+    max_payload_length. An empty payload is yielded from time to time so that the caller can interleave other work.
+    Only a bounded window of the file is kept in memory.
+    """
+
+    def __init__(self, signature, fh, max_payload_length):
+        """
+        Initialise the encoder.
+
+        :param signature: the encoded signature of the older copy (bytes)
+        :param fh: the new file opened for reading in binary mode
+        :param max_payload_length: the biggest payload yielded (int)
+        """
+
+        self.block_size, self.table = decode_signature(signature)
+        self.fh = fh
+        self.max_payload_length = max_payload_length
+        self.max_literal = max_payload_length - DATA_OP.size
+
+        self.ops = bytearray()  # operations of the payload being built
+        self.ready = []  # complete payloads
+        self.copy = None  # a pending copy operation (offset, length), extended while consecutive blocks match
+
+        # statistics
+        self.copied = 0
+        self.literal = 0
+
+    def __iter__(self):
+        return self.encode()
+
+    def add_op(self, op):
+        """
+        Append an encoded operation to the current payload, starting a new payload if it doesn't fit.
+
+        :param op: the encoded operation (bytes)
+        """
+
+        if len(self.ops) + len(op) > self.max_payload_length:
+            self.ready.append(bytes(self.ops))
+            self.ops = bytearray()
+        self.ops += op
+
+    def add_copy(self, offset, length):
+        """
+        Record a matched block, merged with the previous one if they are adjacent in the older copy.
+
+        :param offset: the offset of the block in the older copy (int)
+        :param length: the length of the block (int)
+        """
+
+        self.copied += length
+        if self.copy is not None and self.copy[0] + self.copy[1] == offset and self.copy[1] + length <= 0xffffffff:
+            self.copy = (self.copy[0], self.copy[1] + length)
+            return
+
+        self.flush_copy()
+        self.copy = (offset, length)
+
+    def flush_copy(self):
+        """
+        Encode the pending copy operation, if any.
+        """
+
+        if self.copy is not None:
+            self.add_op(COPY_OP.pack(COPY, *self.copy))
+            self.copy = None
+
+    def add_literal(self, data):
+        """
+        Record data which is not present in the older copy.
+
+        :param data: the literal data (bytes-like)
+        """
+
+        if not data:
+            return
+
+        self.flush_copy()
+        self.literal += len(data)
+        for start in range(0, len(data), self.max_literal):
+            piece = data[start:start + self.max_literal]
+            self.add_op(DATA_OP.pack(DATA, len(piece)) + bytes(piece))
+
+    def match(self, block):
+        """
+        :param block: a block of the new file (bytes-like)
+
+        :return: the offset of an identical block in the older copy or None if there isn't one
+        """
+
+        candidates = self.table.get(zlib.adler32(block))
+        if candidates:
+            return candidates.get(strong_hash(block))
+        return None
+
+    def look_ahead(self, buf, pos):
+        """
+        Check the block aligned positions following a block which didn't match.
+
+        :param buf: the buffered data (bytearray)
+        :param pos: the position of the block which didn't match (int)
+
+        :return: a tuple of the distance and the matched offset in the older copy, None if no block matches
+        """
+
+        block_size = self.block_size
+        for skipped in range(block_size, LOOKAHEAD_BLOCKS * block_size + 1, block_size):
+            if pos + skipped + block_size > len(buf):
+                break
+
+            offset = self.match(memoryview(buf)[pos + skipped:pos + skipped + block_size])
+            if offset is not None:
+                return skipped, offset
+
+        return None
+
+    def encode(self):
+        """
+        Generator doing the actual encoding - see the class docstring.
+        """
+
+        block_size = self.block_size
+        table = self.table
+        rolling_limit = ROLLING_LIMIT_BLOCKS * block_size
+
+        buf = bytearray()
+        pos = 0  # start of the current window
+        literal_start = 0  # start of the data not matched yet
+        eof = False
+        weak = None  # adler-32 components of the current window, recomputed after jumps
+        a = b = 0
+        unmatched = 0  # bytes scanned since the last match
+        steps = 0
+
+        while True:
+            # keep the look ahead blocks and one more byte in the buffer, so that the window can be rolled
+            if len(buf) - pos <= (LOOKAHEAD_BLOCKS + 1) * block_size and not eof:
+                del buf[:literal_start]
+                pos -= literal_start
+                literal_start = 0
+
+                data = self.fh.read(READ_SIZE)
+                if data:
+                    buf += data
+                else:
+                    eof = True
+                continue
+
+            # at the end of the file the last window can't be rolled any more, it is handled as the tail
+            if len(buf) - pos < block_size or (eof and len(buf) - pos == block_size):
+                break
+
+            if weak is None:
+                weak = zlib.adler32(memoryview(buf)[pos:pos + block_size])
+                a, b = weak & 0xffff, weak >> 16
+
+            offset = ahead = None
+            candidates = table.get(weak)
+            if candidates:
+                offset = candidates.get(strong_hash(memoryview(buf)[pos:pos + block_size]))
+            if offset is None and pos == literal_start:
+                ahead = self.look_ahead(buf, pos)
+
+            if offset is not None:
+                self.add_literal(memoryview(buf)[literal_start:pos])
+                self.add_copy(offset, block_size)
+                pos += block_size
+                literal_start = pos
+                weak = None
+                unmatched = 0
+
+            elif ahead is not None:
+                # one of the following aligned blocks matches, the data before it is literal
+                skipped, offset = ahead
+                self.add_literal(memoryview(buf)[pos:pos + skipped])
+                self.add_copy(offset, block_size)
+                pos += skipped + block_size
+                literal_start = pos
+                weak = None
+                unmatched = 0
+
+            elif unmatched >= rolling_limit:
+                # too long without a match, only check block aligned positions
+                pos += block_size
+                weak = None
+                unmatched += block_size
+
+            else:
+                # roll the window by one byte
+                out_byte = buf[pos]
+                in_byte = buf[pos + block_size]
+                a = (a - out_byte + in_byte) % ADLER_MODULUS
+                b = (b - block_size * out_byte + a - 1) % ADLER_MODULUS
+                weak = (b << 16) | a
+                pos += 1
+                unmatched += 1
+
+            if pos - literal_start >= self.max_literal:
+                self.add_literal(memoryview(buf)[literal_start:pos])
+                literal_start = pos
+
+            steps += 1
+            if self.ready or steps == STEPS_PER_YIELD:
+                steps = 0
+                yield from self.take_ready()
+
+        # the tail is shorter than a block, it can only match the (shorter) last block of the older copy
+        tail = memoryview(buf)[pos:]
+        offset = self.match(tail) if len(tail) else None
+        self.add_literal(memoryview(buf)[literal_start:pos])
+        if offset is not None:
+            self.add_copy(offset, len(tail))
+        else:
+            self.add_literal(tail)
+
+        self.flush_copy()
+        if self.ops:
+            self.ready.append(bytes(self.ops))
+            self.ops = bytearray()
+        yield from self.take_ready()
+
+    def take_ready(self):
+        """
+        Yield the complete payloads, or an empty payload if there are none yet.
+        """
+
+        if not self.ready:
+            yield b""
+            return
+
+        ready, self.ready = self.ready, []
+        yield from ready
+
+
+def apply_delta(payload, basis_fh, out_fh, copy_size=READ_SIZE):
+    """
+    Apply a delta payload - copy ranges of the older copy and write literal data to the new file.
+
+    :param payload: an encoded payload as yielded by DeltaEncoder (bytes)
+    :param basis_fh: the older copy opened for reading in binary mode, None if there is no older copy
+    :param out_fh: the new file opened for writing in binary mode
+    :param copy_size: the biggest read done while copying (int)
+    """
+
+    view = memoryview(payload)
+    position = 0
+    while position < len(view):
+        op = bytes(view[position:position + 1])
+
+        if op == COPY:
+            if position + COPY_OP.size > len(view):
+                raise DeltaError("Truncated copy operation")
+            _, offset, length = COPY_OP.unpack_from(view, position)
+            position += COPY_OP.size
+
+            if basis_fh is None:
+                raise DeltaError("Copy operation received without an existing file")
+
+            basis_fh.seek(offset)
+            while length:
+                data = basis_fh.read(min(length, copy_size))
+                if not data:
+                    raise DeltaError(f"Copy operation beyond the end of the existing file at {offset}")
+                out_fh.write(data)
+                length -= len(data)
+
+        elif op == DATA:
+            if position + DATA_OP.size > len(view):
+                raise DeltaError("Truncated data operation")
+            _, length = DATA_OP.unpack_from(view, position)
+            position += DATA_OP.size
+
+            if position + length > len(view):
+                raise DeltaError("Truncated data operation")
+            out_fh.write(view[position:position + length])
+            position += length
+
+        else:
+            raise DeltaError(f"Unknown delta operation {op}")
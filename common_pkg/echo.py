@@ -0,0 +1,143 @@
+import os
+import threading
+import time
+
+
+# events for a path written on behalf of the other side are expected for this long after the write (seconds)
+ECHO_WINDOW = 2.0
+
+# the state of a path while it's being written
+PENDING = object()
+
+
+class Expectation:
+    """
+    A write made on behalf of the other side whose events are expected.
+    """
+
+    __slots__ = ("origin", "shared", "state", "writes", "deadline")
+
+    def __init__(self, origin, deadline):
+        """
+        :param origin: who the write was made for, e.g. the session of a client (any object)
+        :param deadline: the time the events stop being expected (float)
+        """
+
+        self.origin = origin
+        self.shared = False  # True if the write must be sent back to its origin too, e.g. to resolve a conflict
+        self.state = PENDING
+        self.writes = 0  # the writes which haven't been settled yet
+        self.deadline = deadline
+
+
+def file_state(path):
+    """
+    :param path: an absolute path (string)
+
+    :return: the state of the path compared to tell apart an echo from a later change - None if it doesn't exist
+    """
+
+    try:
+        path_stat = os.lstat(path)
+    except OSError:
+        return None
+
+    return path_stat.st_size, path_stat.st_mtime_ns, path_stat.st_ino
+
+
+class EchoFilter:
+    """
+    Tells apart the filesystem events caused by applying the changes of the other side from local changes, so that
+    applied changes are not sent back - which would loop forever between two replicas.
+
+    A path is expected before it's written and settled once the write is done, the state of the path (size,
+    modification time and inode) is recorded then. An event for the path is an echo if the path is still being written,
+    or if it arrives within ECHO_WINDOW seconds of the last write and the path hasn't changed since - a local change made
+    right after the write changes the state, so it's never mistaken for an echo. Events below a folder which is being
+    written or has been deleted (e.g. the files of a deleted folder) are echoes too. Safe to use from several threads.
+    """
+
+    def __init__(self, window=ECHO_WINDOW, clock=time.monotonic):
+        """
+        Initialise the filter.
+
+        :param window: how long the events of a write are expected (float)
+        :param clock: returns the current time (callable)
+        """
+
+        self.window = window
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.expected = {}  # absolute path -> Expectation
+
+        # metrics
+        self.echoes = 0
+
+    def expect(self, path, origin=None, shared=False):
+        """
+        Called before a path is written on behalf of the other side.
+
+        :param path: the absolute path (string)
+        :param origin: who the write is made for (any object)
+        :param shared: True if the events of the write must go back to its origin too, e.g. to resolve a conflict - an
+                       expectation stays shared until it expires (bool)
+        """
+
+        with self.lock:
+            entry = self.expected.get(path)
+            if entry is None or entry.deadline < self.clock() and not entry.writes:
+                entry = self.expected[path] = Expectation(origin, self.clock() + self.window)
+
+            entry.origin = origin
+            entry.shared = entry.shared or shared
+            entry.state = PENDING
+            entry.writes += 1
+            entry.deadline = self.clock() + self.window
+
+    def settle(self, path):
+        """
+        Called once a path has been written - its state is recorded.
+
+        :param path: the absolute path (string)
+        """
+
+        state = file_state(path)
+        with self.lock:
+            entry = self.expected.get(path)
+            if entry is not None:
+                entry.writes = max(entry.writes - 1, 0)
+                if not entry.writes:
+                    entry.state = state
+                entry.deadline = self.clock() + self.window
+
+    def match(self, path):
+        """
+        :param path: the absolute path of a filesystem event (string)
+
+        :return: the expectation the event is an echo of, None if the event is a local change (Expectation)
+        """
+
+        now = self.clock()
+        with self.lock:
+            # expired expectations are dropped lazily
+            if len(self.expected) > 1024:
+                self.expected = {key: entry for key, entry in self.expected.items()
+                                 if entry.deadline >= now or entry.writes}
+
+            entry = self.expected.get(path)
+            if entry is not None and (entry.deadline < now and not entry.writes or
+                                      entry.state is not PENDING and entry.state != file_state(path)):
+                entry = None
+
+            # the content of a folder which is being written or has been deleted
+            parent = os.path.dirname(path)
+            while entry is None and parent != path:
+                ancestor = self.expected.get(parent)
+                if ancestor is not None and (ancestor.deadline >= now or ancestor.writes) and \
+                        ancestor.state in (PENDING, None):
+                    entry = ancestor
+                path, parent = parent, os.path.dirname(parent)
+
+            if entry is not None:
+                self.echoes += 1
+            return entry
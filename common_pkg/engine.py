@@ -0,0 +1,75 @@
+import argparse
+import asyncio
+import sys
+
+
+# the event loops the client and the server can run on
+TWISTED = "twisted"
+ASYNCIO = "asyncio"
+ENGINES = (TWISTED, ASYNCIO)
+
+
+def engine_argument(argv):
+    """
+    Read the engine option of an entry point ahead of the other options, since the engine must be installed before the
+    modules using the reactor are imported.
+
+    :param argv: the command line arguments (list of strings)
+
+    :return: the name of the engine (string)
+    """
+
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("--engine", choices=ENGINES, default=TWISTED)
+    return parser.parse_known_args(argv)[0].engine
+
+
+def engine_of(reactor):
+    """
+    :param reactor: an installed reactor
+
+    :return: the name of the engine the reactor belongs to (string)
+    """
+
+    from twisted.internet.asyncioreactor import AsyncioSelectorReactor
+
+    return ASYNCIO if isinstance(reactor, AsyncioSelectorReactor) else TWISTED
+
+
+def install_engine(name, loop=None):
+    """
+    Install the event loop the protocols run on - must be called before the modules using the reactor are imported,
+    importing the reactor installs Twisted's default one.
+
+    The asyncio engine runs the same protocols on an asyncio event loop, the handovers from the watchdog and executor
+    threads (reactor.callFromThread) go through loop.call_soon_threadsafe. To embed the client or the server in an
+    asyncio program, pass its loop, call reactor.startRunning(), run the loop as usual and call reactor.stop() once done,
+    which stops the threads of the reactor.
+
+    :param name: 'twisted' or 'asyncio' (string)
+    :param loop: the asyncio event loop to run on, a new one by default (asyncio.AbstractEventLoop)
+
+    :return: the installed reactor
+    """
+
+    if name not in ENGINES:
+        raise ValueError(f"Unknown engine {name} - the engines are {', '.join(ENGINES)}")
+
+    if "twisted.internet.reactor" in sys.modules:
+        from twisted.internet import reactor
+
+        if engine_of(reactor) != name:
+            raise RuntimeError(f"Can't use the {name} engine, the {engine_of(reactor)} reactor is already installed")
+        return reactor
+
+    if name == ASYNCIO:
+        from twisted.internet import asyncioreactor
+
+        if loop is None:
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+        asyncioreactor.install(loop)
+
+    from twisted.internet import reactor
+
+    return reactor
@@ -0,0 +1,314 @@
+import json
+import struct
+from collections import namedtuple
+
+
+# version of the binary wire format, sent in every frame header and agreed on during negotiation
+PROTOCOL_VERSION = 1
+
+# the delimiter used by the legacy line based protocol
+LEGACY_DELIMITER = b"\r\r\r\n\n\n"
+
+# fixed frame header - version, message type, flags, path length and payload length (network byte order)
+HEADER = struct.Struct("!BBBHQ")
+
+# upper limit for the payload of a single frame, anything bigger is considered a protocol violation
+MAX_PAYLOAD_LENGTH = 64 * 1024 * 1024
+
+# the payload of acknowledgement requests and acknowledgements - the sequence number of an operation of the client
+SEQUENCE = struct.Struct("!Q")
+
+# message types
+MSG_HELLO = 1
+MSG_CREATED = 2
+MSG_DELETED = 3
+MSG_MODIFIED = 4
+MSG_MOVED = 5
+MSG_CHUNK = 6
+MSG_SIGNATURE_REQUEST = 7
+MSG_SIGNATURE = 8
+MSG_DELTA = 9
+MSG_CONTENT_OFFER = 10
+MSG_CONTENT_REPLY = 11
+MSG_TREE_REQUEST = 12
+MSG_TREE = 13
+MSG_ACK_REQUEST = 14
+MSG_ACK = 15
+MSG_OPERATION = 16
+MSG_BATCH = 17
+MSG_VERSION = 18
+
+# flags
+FLAG_DIRECTORY = 0x01
+FLAG_FIRST = 0x02  # first chunk/delta message of a streamed file
+FLAG_LAST = 0x04  # last chunk/delta message of a streamed file
+FLAG_COMPRESSED = 0x08  # the payload is compressed with the codec negotiated in the hello messages
+FLAG_ABORT = 0x10  # the streamed file is dropped, e.g. it was truncated while it was sent, and must be discarded
+
+# mapping between the event types used by watchdog (and by the legacy protocol) and the binary message types
+EVENT_TYPES = {
+    "created": MSG_CREATED,
+    "deleted": MSG_DELETED,
+    "modified": MSG_MODIFIED,
+    "moved": MSG_MOVED
+}
+
+EVENT_NAMES = {msg_type: event_type for event_type, msg_type in EVENT_TYPES.items()}
+
+# the names of all message types, e.g. in the metrics
+MESSAGE_NAMES = {
+    MSG_HELLO: "hello", MSG_CREATED: "created", MSG_DELETED: "deleted", MSG_MODIFIED: "modified", MSG_MOVED: "moved",
+    MSG_CHUNK: "chunk", MSG_SIGNATURE_REQUEST: "signature_request", MSG_SIGNATURE: "signature", MSG_DELTA: "delta",
+    MSG_CONTENT_OFFER: "content_offer", MSG_CONTENT_REPLY: "content_reply", MSG_TREE_REQUEST: "tree_request",
+    MSG_TREE: "tree", MSG_ACK_REQUEST: "ack_request", MSG_ACK: "ack", MSG_OPERATION: "operation", MSG_BATCH: "batch",
+    MSG_VERSION: "version"
+}
+
+
+class ProtocolError(Exception):
+    """
+    Raised when the received data doesn't follow the wire format.
+    """
+
+
+class Frame(namedtuple("Frame", ["msg_type", "flags", "path", "payload"])):
+    """
+    A single decoded message - the path and the payload are kept as bytes.
+    """
+
+    __slots__ = ()
+
+    @property
+    def is_directory(self):
+        """
+        :return: True if the frame was sent for a directory, False otherwise (bool)
+        """
+
+        return bool(self.flags & FLAG_DIRECTORY)
+
+
+def encode_header(msg_type, flags, path_length, payload_length):
+    """
+    Build the fixed size header of a frame.
+
+    :param msg_type: the type of the message (int)
+    :param flags: bit flags of the message (int)
+    :param path_length: the length of the encoded path (int)
+    :param payload_length: the length of the payload (int)
+
+    :return: the encoded header (bytes)
+    """
+
+    return HEADER.pack(PROTOCOL_VERSION, msg_type, flags, path_length, payload_length)
+
+
+def encode_frame(msg_type, flags, path=b"", payload=b""):
+    """
+    Build a full frame - header, path and payload.
+
+    :param msg_type: the type of the message (int)
+    :param flags: bit flags of the message (int)
+    :param path: the path the message refers to (bytes)
+    :param payload: the body of the message (bytes)
+
+    :return: the encoded frame (bytes)
+    """
+
+    return encode_header(msg_type, flags, len(path), len(payload)) + path + payload
+
+
+def encode_batch(frames):
+    """
+    Build the payload of a batch message - the frames it carries, one after the other.
+
+    :param frames: the messages to send in a single frame (list of Frame)
+
+    :return: the encoded payload (bytes)
+    """
+
+    return b"".join(encode_frame(*frame) for frame in frames)
+
+
+def decode_batch(payload):
+    """
+    Parse the payload of a batch message.
+
+    :param payload: the encoded frames (bytes)
+
+    :return: the messages carried by the batch (list of Frame)
+    """
+
+    decoder = FrameDecoder()
+    frames = decoder.feed(payload)
+    if decoder.buffered:
+        raise ProtocolError(f"Batch message with {decoder.buffered} bytes of an incomplete frame")
+
+    return frames
+
+
+def encode_hello_line(**capabilities):
+    """
+    Build the negotiation line sent by a client right after connecting.
+
+    The line follows the legacy format, hence a server which only understands the old protocol will simply
+    log it as an unrecognized message type and ignore it.
+
+    :param capabilities: any additional values advertised to the peer
+
+    :return: the encoded line (bytes)
+    """
+
+    capabilities["version"] = PROTOCOL_VERSION
+    return b"hello::0::" + json.dumps(capabilities).encode("utf-8") + LEGACY_DELIMITER
+
+
+def encode_hello_frame(**capabilities):
+    """
+    Build the binary hello frame a server replies with once it accepts the binary wire format.
+
+    :param capabilities: any additional values advertised to the peer
+
+    :return: the encoded frame (bytes)
+    """
+
+    capabilities["version"] = PROTOCOL_VERSION
+    return encode_frame(MSG_HELLO, 0, payload=json.dumps(capabilities).encode("utf-8"))
+
+
+def decode_hello(body):
+    """
+    Parse the body of a hello line/frame.
+
+    :param body: the JSON encoded capabilities (bytes)
+
+    :return: the capabilities (dict)
+    """
+
+    try:
+        capabilities = json.loads(body.decode("utf-8"))
+    except ValueError as e:
+        raise ProtocolError(f"Invalid hello message - {e}")
+
+    if not isinstance(capabilities, dict) or not isinstance(capabilities.get("version"), int):
+        raise ProtocolError(f"Invalid hello message - {body}")
+
+    return capabilities
+
+
+def encode_legacy_frame(frame):
+    """
+    Encode a frame using the legacy line based protocol - used when the peer doesn't support the binary format.
+
+    :param frame: the frame to encode (Frame)
+
+    :return: the encoded line (bytes)
+    """
+
+    event_type = EVENT_NAMES.get(frame.msg_type)
+    if event_type is None:
+        raise ProtocolError(f"Message type {frame.msg_type} is not supported by the legacy protocol")
+
+    msg = f"{event_type}::{int(frame.is_directory)}::".encode("utf-8") + frame.path
+    if frame.msg_type in (MSG_MODIFIED, MSG_MOVED):
+        msg += b"::" + frame.payload
+
+    return msg + LEGACY_DELIMITER
+
+
+def decode_legacy_line(line):
+    """
+    Parse a message of the legacy line based protocol.
+
+    Messages follow the format <event_type>::<flag for directory event>::<msg body dependent on event>
+
+    :param line: the received line without the delimiter (bytes)
+
+    :return: the decoded frame (Frame)
+    """
+
+    msg_parts = line.split(b"::", 2)
+    if len(msg_parts) != 3:
+        raise ProtocolError(f"Protocol violation - {msg_parts}")
+
+    event_type = msg_parts[0].decode("utf-8")
+    msg_type = EVENT_TYPES.get(event_type)
+    if msg_type is None:
+        raise ProtocolError(f"Received unrecognized message type - {event_type}")
+
+    try:
+        flags = FLAG_DIRECTORY if int(msg_parts[1]) else 0
+    except ValueError:
+        raise ProtocolError(f"Protocol violation - {msg_parts}")
+
+    # modified events carry the content and moved events the destination path after the event path
+    if msg_type in (MSG_MODIFIED, MSG_MOVED):
+        body_parts = msg_parts[2].split(b"::", 1)
+        if len(body_parts) != 2:
+            raise ProtocolError(f"Protocol violation - {msg_parts}")
+        path, payload = body_parts
+    else:
+        path, payload = msg_parts[2], b""
+
+    return Frame(msg_type, flags, path, payload)
+
+
+class FrameDecoder:
+    """
+    Incremental decoder - received data is buffered and frames are extracted as soon as they are complete.
+    """
+
+    def __init__(self, max_payload_length=MAX_PAYLOAD_LENGTH):
+        """
+        Initialise the decoder.
+
+        :param max_payload_length: the biggest payload accepted in a single frame (int)
+        """
+
+        self.max_payload_length = max_payload_length
+        self._buffer = bytearray()
+
+    def feed(self, data):
+        """
+        Add received data to the buffer and extract all complete frames.
+
+        :param data: the received data (bytes)
+
+        :return: a list of the decoded frames (list of Frame)
+        """
+
+        self._buffer += data
+        frames = []
+
+        offset = 0
+        buffered = len(self._buffer)
+        while buffered - offset >= HEADER.size:
+            version, msg_type, flags, path_length, payload_length = HEADER.unpack_from(self._buffer, offset)
+
+            if version != PROTOCOL_VERSION:
+                raise ProtocolError(f"Unsupported protocol version {version}")
+            if payload_length > self.max_payload_length:
+                raise ProtocolError(f"Payload length {payload_length} exceeds the limit of {self.max_payload_length}")
+
+            path_start = offset + HEADER.size
+            payload_start = path_start + path_length
+            frame_end = payload_start + payload_length
+            if frame_end > buffered:
+                break  # wait for the rest of the frame
+
+            frames.append(Frame(msg_type, flags, bytes(self._buffer[path_start:payload_start]),
+                                bytes(self._buffer[payload_start:frame_end])))
+            offset = frame_end
+
+        # drop all consumed data at once
+        if offset:
+            del self._buffer[:offset]
+
+        return frames
+
+    @property
+    def buffered(self):
+        """
+        :return: the number of bytes waiting for the rest of their frame (int)
+        """
+
+        return len(self._buffer)
@@ -0,0 +1,82 @@
+import atexit
+import itertools
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+from common_pkg.metrics import REGISTRY
+
+
+# the format of the log records of the client and the server
+LOG_FORMAT = "%(asctime)s - %(levelname)s - %(thread)d - %(threadName)s - %(message)s"
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# default sampling of the per-event log records - one in this many is logged
+LOG_SAMPLE = 100
+
+# the logger of the records written for every event, message or filesystem operation - sampled once logging is
+# configured, since they cost real CPU under load
+event_log = logging.getLogger("syncapp.events")
+
+# watchdog logs every inotify event it reads at the debug level, its records below this level are dropped
+WATCHDOG_LOG_LEVEL = logging.INFO
+
+SAMPLED_OUT = REGISTRY.counter("syncapp_log_records_sampled_out_total", "Per-event log records dropped by sampling")
+
+
+class SampleFilter(logging.Filter):
+    """
+    Keeps one in every N records, starting with the first one. Safe to use from any thread.
+    """
+
+    def __init__(self, rate):
+        """
+        :param rate: one in this many records is kept (int)
+        """
+
+        super().__init__()
+        self.rate = rate
+        self.counter = itertools.count()
+
+    def filter(self, record):
+        """
+        :param record: the log record (LogRecord)
+
+        :return: True if the record is kept (bool)
+        """
+
+        if next(self.counter) % self.rate == 0:
+            return True
+
+        SAMPLED_OUT.inc()
+        return False
+
+
+def configure_logging(level=logging.DEBUG, sample=LOG_SAMPLE):
+    """
+    Configure the root logger - records are handed over to a queue and written to stderr by a listener thread, so that
+    logging never blocks the reactor (or the watchdog and executor threads) on I/O. Only one in every sample records of
+    the per-event logger is kept, and watchdog's own per-event records are dropped unless every record is logged.
+
+    :param level: the lowest level logged (int)
+    :param sample: one in this many per-event records is logged, 1 to log all of them (int)
+
+    :return: the listener writing the records, stopped when the process exits (QueueListener)
+    """
+
+    records = queue.Queue()
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(LOG_FORMAT, DATE_FORMAT))
+    listener = QueueListener(records, handler)
+    listener.start()
+    atexit.register(listener.stop)
+
+    # the message is formatted by the thread logging it, when the record is queued - the listener adds the time, the
+    # level and the thread
+    queue_handler = QueueHandler(records)
+    queue_handler.setFormatter(logging.Formatter("%(message)s"))
+    logging.basicConfig(level=level, handlers=[queue_handler])
+    if sample > 1:
+        event_log.addFilter(SampleFilter(sample))
+        logging.getLogger("watchdog").setLevel(max(level, WATCHDOG_LOG_LEVEL))
+
+    return listener
@@ -0,0 +1,231 @@
+import os
+import stat
+import struct
+import threading
+from common_pkg.content import content_hasher
+
+
+# an entry of an encoded directory listing - the kind of the entry and the length of its name, followed by the name
+# and the hash of the entry
+ENTRY = struct.Struct("!BH")
+
+# kinds of entries
+FILE = 0
+DIRECTORY = 1
+
+# the size of the reads done while hashing a file
+READ_SIZE = 1024 * 1024
+
+
+class ManifestError(Exception):
+    """
+    Raised when a directory listing cannot be decoded.
+    """
+
+
+class HashCache:
+    """
+    Content hashes of files, reused as long as the size, modification time and inode of a file don't change, so that
+    only new and modified files are read when a manifest is built again.
+    """
+
+    def __init__(self):
+        """
+        Initialise the cache.
+        """
+
+        self.lock = threading.Lock()
+        self.entries = {}  # absolute path -> (size, mtime_ns, inode, hash)
+
+    def lookup(self, abs_path, file_stat):
+        """
+        :param abs_path: the absolute path of a file (string)
+        :param file_stat: the current stat result of the file
+
+        :return: the cached hash or None if the file has changed since it was hashed (bytes)
+        """
+
+        with self.lock:
+            entry = self.entries.get(abs_path)
+
+        if entry is not None and entry[:3] == (file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino):
+            return entry[3]
+
+        return None
+
+    def update(self, abs_path, file_stat, digest):
+        """
+        :param abs_path: the absolute path of a file (string)
+        :param file_stat: the stat result of the file taken before it was hashed
+        :param digest: the hash of its content (bytes)
+        """
+
+        with self.lock:
+            self.entries[abs_path] = (file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino, digest)
+
+
+def file_digest(abs_path):
+    """
+    :param abs_path: the absolute path of a file (string)
+
+    :return: the hash of the content of the file (bytes)
+    """
+
+    hasher = content_hasher()
+    with open(abs_path, "rb") as fh:
+        for data in iter(lambda: fh.read(READ_SIZE), b""):
+            hasher.update(data)
+
+    return hasher.digest()
+
+
+class Directory:
+    """
+    A node of a manifest - the hashes of the files in a directory and its subdirectories.
+
+    The hash of a directory is the hash of its encoded listing, so two directories have the same hash only if all files
+    and subdirectories below them are the same (a Merkle tree).
+    """
+
+    __slots__ = ("files", "dirs", "digest")
+
+    def __init__(self):
+        """
+        Initialise an empty directory.
+        """
+
+        self.files = {}  # name -> hash of the content
+        self.dirs = {}  # name -> Directory
+        self.digest = None
+
+    def entries(self):
+        """
+        :return: the entries of the directory sorted by name (list of (name, kind, hash) tuples)
+        """
+
+        entries = [(name, FILE, digest) for name, digest in self.files.items()]
+        entries.extend((name, DIRECTORY, directory.digest) for name, directory in self.dirs.items())
+        return sorted(entries)
+
+    def finish(self):
+        """
+        Compute the hash of the directory, once the hashes of all its entries are known.
+        """
+
+        hasher = content_hasher()
+        hasher.update(encode_listing(self.entries()))
+        self.digest = hasher.digest()
+
+    def find(self, relative_path):
+        """
+        :param relative_path: the path of a directory relative to this one, starting with '.' (string)
+
+        :return: the directory or None if there is no such directory (Directory)
+        """
+
+        directory = self
+        for name in relative_path.split("/")[1:]:
+            directory = directory.dirs.get(name)
+            if directory is None:
+                return None
+
+        return directory
+
+    def walk(self, relative_path="."):
+        """
+        :param relative_path: the path of this directory (string)
+
+        :return: a generator of (relative path, Directory) tuples for this directory and everything below it, parents
+                 before their children
+        """
+
+        yield relative_path, self
+        for name, directory in sorted(self.dirs.items()):
+            yield from directory.walk(f"{relative_path}/{name}")
+
+
+def build_manifest(root_path, cache=None, ignore=None, relative_path="."):
+    """
+    Scan a folder and compute the hashes of all files and directories below it - symbolic links and special files are
+    skipped, files which disappear during the scan are left out.
+
+    :param root_path: the absolute path of the folder (string)
+    :param cache: the cache of file hashes to use and update (HashCache)
+    :param ignore: called with the relative path of each entry and True if it's a directory, returns True if the entry
+                   must be left out - ignored directories are not scanned
+    :param relative_path: the path of the folder relative to the root of the scan, starting with '.' (string)
+
+    :return: the root of the manifest (Directory)
+    """
+
+    directory = Directory()
+
+    try:
+        with os.scandir(root_path) as it:
+            children = list(it)
+    except (FileNotFoundError, NotADirectoryError):
+        children = []
+
+    for entry in children:
+        entry_path = f"{relative_path}/{entry.name}"
+        try:
+            if ignore is not None and ignore(entry_path, entry.is_dir(follow_symlinks=False)):
+                continue
+
+            entry_stat = entry.stat(follow_symlinks=False)
+            if stat.S_ISDIR(entry_stat.st_mode):
+                directory.dirs[entry.name] = build_manifest(entry.path, cache, ignore, entry_path)
+            elif stat.S_ISREG(entry_stat.st_mode):
+                digest = cache.lookup(entry.path, entry_stat) if cache is not None else None
+                if digest is None:
+                    digest = file_digest(entry.path)
+                    if cache is not None:
+                        cache.update(entry.path, entry_stat, digest)
+                directory.files[entry.name] = digest
+        except FileNotFoundError:
+            continue
+
+    directory.finish()
+    return directory
+
+
+def encode_listing(entries):
+    """
+    :param entries: the entries of a directory sorted by name (list of (name, kind, hash) tuples)
+
+    :return: the encoded listing (bytes)
+    """
+
+    parts = []
+    for name, kind, digest in entries:
+        name = name.encode("utf-8", "surrogateescape")
+        parts.append(ENTRY.pack(kind, len(name)) + name + digest)
+
+    return b"".join(parts)
+
+
+def decode_listing(payload, digest_size):
+    """
+    :param payload: an encoded listing (bytes)
+    :param digest_size: the size of the hashes (int)
+
+    :return: the entries of the directory (dict name -> (kind, hash))
+    """
+
+    entries = {}
+    position = 0
+    while position < len(payload):
+        if position + ENTRY.size > len(payload):
+            raise ManifestError("Truncated directory listing")
+        kind, name_length = ENTRY.unpack_from(payload, position)
+        position += ENTRY.size
+
+        end = position + name_length + digest_size
+        if end > len(payload) or kind not in (FILE, DIRECTORY):
+            raise ManifestError("Invalid directory listing entry")
+
+        name = payload[position:position + name_length].decode("utf-8", "surrogateescape")
+        entries[name] = (kind, payload[position + name_length:end])
+        position = end
+
+    return entries
@@ -0,0 +1,381 @@
+import bisect
+import logging
+import threading
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+from twisted.web.resource import Resource
+from twisted.web.server import Site
+
+
+# the upper bounds of the buckets of the latency histograms (seconds)
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0)
+
+# the upper bounds of the buckets of the size histograms (bytes)
+SIZE_BUCKETS = (256, 4096, 65536, 1024 ** 2, 16 * 1024 ** 2, 256 * 1024 ** 2)
+
+# default interval of the periodic dump of the metrics to the log (seconds)
+STATS_INTERVAL = 60.0
+
+# the content type of the Prometheus text exposition format
+CONTENT_TYPE = b"text/plain; version=0.0.4; charset=utf-8"
+
+
+def format_labels(names, values, extra=()):
+    """
+    :param names: the label names of a metric (tuple of strings)
+    :param values: the label values of a series (tuple)
+    :param extra: additional (name, value) pairs, e.g. the upper bound of a histogram bucket (tuple of tuples)
+
+    :return: the labels of a series in the text format, e.g. '{type="created"}', empty without labels (string)
+    """
+
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+
+    escaped = (str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f"{name}=\"{value}\"" for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def format_value(value):
+    """
+    :param value: a sample value (int or float)
+
+    :return: the value in the text format (string)
+    """
+
+    if value == float("inf"):
+        return "+Inf"
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """
+    A counter per combination of label values, e.g. the messages sent per message type. Safe to use from any thread.
+    """
+
+    kind = "counter"
+
+    def __init__(self, name, description, labels=()):
+        """
+        Initialise the counter.
+
+        :param name: the name of the metric (string)
+        :param description: what the metric counts (string)
+        :param labels: the names of the labels (tuple of strings)
+        """
+
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.lock = threading.Lock()
+        self.values = {}  # label values -> count
+
+    def inc(self, *labels, amount=1):
+        """
+        Increment the counter.
+
+        :param labels: the values of the labels, in the order of their names
+        :param amount: the increment (int or float)
+        """
+
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        """
+        :return: the samples of the metric in the text format (list of strings)
+        """
+
+        with self.lock:
+            values = sorted(self.values.items())
+        return [f"{self.name}{format_labels(self.labels, labels)} {format_value(value)}" for labels, value in values]
+
+    def snapshot(self):
+        """
+        :return: the total, or the count per label value of a metric with a single label (int or dict)
+        """
+
+        with self.lock:
+            if len(self.labels) == 1:
+                return {labels[0]: value for labels, value in sorted(self.values.items())}
+            return sum(self.values.values())
+
+
+class Histogram:
+    """
+    The distribution of observed values (latencies, sizes) per combination of label values, in buckets with fixed
+    upper bounds. Safe to use from any thread.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        """
+        Initialise the histogram.
+
+        :param name: the name of the metric (string)
+        :param description: what the metric observes (string)
+        :param labels: the names of the labels (tuple of strings)
+        :param buckets: the upper bounds of the buckets, in increasing order (tuple)
+        """
+
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.values = {}  # label values -> [the count per bucket (the last one without an upper bound), sum, count]
+
+    def observe(self, value, *labels):
+        """
+        Record an observation.
+
+        :param value: the observed value (int or float)
+        :param labels: the values of the labels, in the order of their names
+        """
+
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.values.get(labels)
+            if series is None:
+                series = self.values[labels] = [[0] * (len(self.buckets) + 1), 0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def samples(self):
+        """
+        :return: the samples of the metric in the text format - the cumulative buckets, the sum and the count of each
+                 series (list of strings)
+        """
+
+        with self.lock:
+            values = sorted((labels, (list(counts), total, count)) for labels, (counts, total, count)
+                            in self.values.items())
+
+        samples = []
+        for labels, (counts, total, count) in values:
+            cumulative = 0
+            for bound, bucket in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket
+                samples.append(f"{self.name}_bucket{format_labels(self.labels, labels, [('le', format_value(bound))])} "
+                               f"{cumulative}")
+            samples.append(f"{self.name}_sum{format_labels(self.labels, labels)} {format_value(total)}")
+            samples.append(f"{self.name}_count{format_labels(self.labels, labels)} {count}")
+        return samples
+
+    def snapshot(self):
+        """
+        :return: the count and the mean of the observations, per label value of a metric with a single label, empty
+                 without observations (dict)
+        """
+
+        with self.lock:
+            values = {labels: (total, count) for labels, (_, total, count) in self.values.items()}
+
+        if len(self.labels) == 1:
+            return {labels[0]: dict(count=count, mean=round(total / count, 6)) for labels, (total, count)
+                    in sorted(values.items())}
+
+        total, count = sum(value[0] for value in values.values()), sum(value[1] for value in values.values())
+        return dict(count=count, mean=round(total / count, 6)) if count else {}
+
+
+class Gauge:
+    """
+    A value read when the metrics are collected, e.g. the depth of a queue.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name, description, func):
+        """
+        Initialise the gauge.
+
+        :param name: the name of the metric (string)
+        :param description: what the metric measures (string)
+        :param func: returns the current value (callable)
+        """
+
+        self.name = name
+        self.description = description
+        self.func = func
+
+    def value(self):
+        """
+        :return: the current value, None if it can't be read (e.g. the object it's read from is closed)
+        """
+
+        try:
+            return self.func()
+        except Exception as e:
+            logging.debug(f"Failed to read the {self.name} gauge - {e}")
+            return None
+
+    def samples(self):
+        """
+        :return: the sample of the metric in the text format (list of strings)
+        """
+
+        value = self.value()
+        return [] if value is None else [f"{self.name} {format_value(value)}"]
+
+    def snapshot(self):
+        """
+        :return: the current value
+        """
+
+        return self.value()
+
+
+class Registry:
+    """
+    The metrics of a process - counters and histograms recorded by the pipeline as it goes, and gauges read from the
+    objects they measure when the metrics are collected. The metrics are exposed in the Prometheus text format (see
+    MetricsPage) and dumped to the log periodically (see start_stats_dump).
+    """
+
+    def __init__(self):
+        """
+        Initialise the registry.
+        """
+
+        self.lock = threading.Lock()
+        self.metrics = {}  # name -> metric, in the order of registration
+
+    def register(self, metric):
+        """
+        Register a metric - a counter or a histogram registered again is shared, a gauge registered again replaces the
+        previous one (e.g. the queue of a new protocol object).
+
+        :param metric: the metric (Counter, Histogram or Gauge)
+
+        :return: the registered metric
+        """
+
+        with self.lock:
+            existing = self.metrics.get(metric.name)
+            if existing is not None and existing.kind != metric.kind:
+                raise ValueError(f"Metric {metric.name} is already registered as a {existing.kind}")
+            if existing is not None and metric.kind != "gauge":
+                return existing
+            self.metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, description, labels=()):
+        """
+        :return: the counter registered under the name (Counter)
+        """
+
+        return self.register(Counter(name, description, labels))
+
+    def histogram(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        """
+        :return: the histogram registered under the name (Histogram)
+        """
+
+        return self.register(Histogram(name, description, labels, buckets))
+
+    def gauge(self, name, description, func):
+        """
+        :return: the gauge registered under the name (Gauge)
+        """
+
+        return self.register(Gauge(name, description, func))
+
+    def render(self):
+        """
+        :return: all metrics in the Prometheus text exposition format (string)
+        """
+
+        with self.lock:
+            metrics = list(self.metrics.values())
+
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.description}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        """
+        :return: a summary of the metrics which have been recorded, for the log (dict)
+        """
+
+        with self.lock:
+            metrics = list(self.metrics.values())
+
+        snapshot = {}
+        for metric in metrics:
+            value = metric.snapshot()
+            if value or value == 0 and metric.kind == "gauge":
+                snapshot[metric.name] = value
+        return snapshot
+
+
+# the metrics of the process, shared by the client and the server modules
+REGISTRY = Registry()
+
+
+class MetricsPage(Resource):
+    """
+    Serves the metrics of a registry in the Prometheus text format.
+    """
+
+    isLeaf = True
+
+    def __init__(self, registry=REGISTRY):
+        """
+        :param registry: the metrics served (Registry)
+        """
+
+        super().__init__()
+        self.registry = registry
+
+    def render_GET(self, request):
+        """
+        :param request: the HTTP request
+
+        :return: the metrics (bytes)
+        """
+
+        request.setHeader(b"content-type", CONTENT_TYPE)
+        return self.registry.render().encode("utf-8")
+
+
+def listen_metrics(port, registry=REGISTRY, interface="127.0.0.1", clock=reactor):
+    """
+    Serve the metrics on /metrics over HTTP, in the reactor thread - only on the loopback interface by default.
+
+    :param port: the port to listen on (int)
+    :param registry: the metrics served (Registry)
+    :param interface: the address to listen on (string)
+    :param clock: the reactor serving the requests
+
+    :return: the listening port (IListeningPort)
+    """
+
+    root = Resource()
+    root.putChild(b"metrics", MetricsPage(registry))
+    listening = clock.listenTCP(port, Site(root), interface=interface)
+    logging.info(f"Serving metrics on http://{interface}:{listening.getHost().port}/metrics")
+    return listening
+
+
+def start_stats_dump(interval=STATS_INTERVAL, registry=REGISTRY, clock=reactor):
+    """
+    Log a summary of the metrics periodically.
+
+    :param interval: the seconds between two dumps (float)
+    :param registry: the metrics dumped (Registry)
+    :param clock: the reactor used for scheduling
+
+    :return: the looping call dumping the metrics (LoopingCall)
+    """
+
+    dump = LoopingCall(lambda: logging.info(f"Metrics - {registry.snapshot()}"))
+    dump.clock = clock
+    dump.start(interval, now=False)
+    return dump
@@ -0,0 +1,401 @@
+import logging
+import mmap
+import multiprocessing
+import os
+import stat
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from common_pkg.content import content_hasher
+from common_pkg.manifest import Directory, READ_SIZE
+
+
+# the number of workers stating and hashing files, one per core by default
+WORKERS = os.cpu_count() or 1
+
+# the most files and bytes handled by one task of the pool
+BATCH_FILES = 64
+BATCH_BYTES = 64 * 1024 * 1024
+
+# files at least this big are hashed through a memory map when they are hashed by processes
+MMAP_THRESHOLD = 1024 * 1024
+
+# the tasks in progress per worker, bounding the memory used while scanning millions of files
+TASKS_PER_WORKER = 4
+
+# the progress of a long scan is logged this often (seconds)
+PROGRESS_INTERVAL = 10.0
+
+
+def stat_batch(paths):
+    """
+    :param paths: the absolute paths of files (list of strings)
+
+    :return: the lstat results of the files, None for the files which have disappeared (list)
+    """
+
+    results = []
+    for path in paths:
+        try:
+            results.append(os.lstat(path))
+        except FileNotFoundError:
+            results.append(None)
+
+    return results
+
+
+def hash_file(abs_path, use_mmap):
+    """
+    :param abs_path: the absolute path of a file (string)
+    :param use_mmap: True to hash a big file through a memory map instead of reading it (bool)
+
+    :return: the hash of the content of the file (bytes)
+    """
+
+    hasher = content_hasher()
+    with open(abs_path, "rb") as fh:
+        if use_mmap and os.fstat(fh.fileno()).st_size >= MMAP_THRESHOLD:
+            # hashed in place with a single update, which releases the GIL for the whole file
+            with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                if hasattr(mapped, "madvise"):
+                    mapped.madvise(mmap.MADV_SEQUENTIAL)
+                hasher.update(mapped)
+        else:
+            buffer = bytearray(READ_SIZE)
+            view = memoryview(buffer)
+            for size in iter(lambda: fh.readinto(buffer), 0):
+                hasher.update(view[:size])
+
+    return hasher.digest()
+
+
+def hash_batch(paths, use_mmap):
+    """
+    :param paths: the absolute paths of files (list of strings)
+    :param use_mmap: True to hash the big files through memory maps (bool)
+
+    :return: the hashes of the files, None for the files which have disappeared (list)
+    """
+
+    digests = []
+    for path in paths:
+        try:
+            digests.append(hash_file(path, use_mmap))
+        except FileNotFoundError:
+            digests.append(None)
+
+    return digests
+
+
+class ScanPool:
+    """
+    Builds the manifests of big folders (see common_pkg.manifest.build_manifest) in parallel - the calling thread walks
+    the folder with os.scandir, a pool of threads stats the files in batches and the files missing from the hash cache
+    are hashed in batches by a pool of threads or processes.
+
+    The hashes are handed over as they are computed rather than after the whole walk - stored in the hash cache (e.g.
+    the file index, so an interrupted scan doesn't hash them again) and passed to an optional callback.
+
+    Processes hash the files of at least MMAP_THRESHOLD bytes through memory maps. A file truncated while it's mapped
+    raises SIGBUS, which only takes the worker process down - the batch is then hashed again with plain reads, which
+    is also why threads never use memory maps. Safe to use from several threads.
+    """
+
+    def __init__(self, workers=WORKERS, processes=False):
+        """
+        Initialise the pool, the workers are started on demand.
+
+        :param workers: the number of workers (int)
+        :param processes: True to hash the files in processes instead of threads (bool)
+        """
+
+        self.workers = max(workers, 1)
+        self.processes = processes
+        self.lock = threading.Lock()
+
+        self.threads = ThreadPoolExecutor(self.workers, thread_name_prefix="scan")
+        self.hashers = self.start_processes() if processes else self.threads
+
+        # metrics
+        self.scans = 0
+        self.files = 0
+        self.hashed_files = 0
+        self.hashed_bytes = 0
+        self.seconds = 0.0
+
+    def start_processes(self):
+        """
+        :return: a new pool of hashing processes, spawned so that they don't inherit the threads of the application
+                 (ProcessPoolExecutor)
+        """
+
+        # the start method of the pool can only be chosen from Python 3.7, the processes are forked before that
+        if sys.version_info < (3, 7):
+            return ProcessPoolExecutor(self.workers)
+
+        return ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+
+    def replace_broken(self, executor):
+        """
+        Replace the pool of hashing processes once one of them has died.
+
+        :param executor: the broken pool (ProcessPoolExecutor)
+        """
+
+        with self.lock:
+            if self.hashers is executor:
+                executor.shutdown(wait=False)
+                self.hashers = self.start_processes()
+
+    def build_manifest(self, root_path, cache=None, ignore=None, on_file=None):
+        """
+        Scan a folder and compute the hashes of all files and directories below it, like
+        common_pkg.manifest.build_manifest.
+
+        :param root_path: the absolute path of the folder (string)
+        :param cache: the cache of file hashes to use and update (HashCache)
+        :param ignore: called with the relative path of each entry and True if it's a directory, returns True if the
+                       entry must be left out - ignored directories are not scanned
+        :param on_file: called in the calling thread with the relative path and the hash of each file, as they are found
+
+        :return: the root of the manifest (Directory)
+        """
+
+        started = time.monotonic()
+        scan = Scan(self, cache, on_file)
+        root = Directory()
+
+        # directories in walk order, parents before their children
+        directories = []
+        stack = [(root_path, ".", root)]
+        while stack:
+            path, relative_path, directory = stack.pop()
+            directories.append(directory)
+
+            try:
+                with os.scandir(path) as it:
+                    children = list(it)
+            except (FileNotFoundError, NotADirectoryError):
+                children = []
+
+            for entry in children:
+                entry_path = f"{relative_path}/{entry.name}"
+                try:
+                    is_directory = entry.is_dir(follow_symlinks=False)
+                    if ignore is not None and ignore(entry_path, is_directory):
+                        continue
+
+                    # symbolic links and special files are skipped
+                    if is_directory:
+                        directory.dirs[entry.name] = Directory()
+                        stack.append((entry.path, entry_path, directory.dirs[entry.name]))
+                    elif entry.is_file(follow_symlinks=False):
+                        scan.add(directory, entry.name, entry.path, entry_path)
+                except FileNotFoundError:
+                    continue
+
+        scan.finish()
+
+        # the hash of a directory covers its subdirectories, which come after it in walk order
+        for directory in reversed(directories):
+            directory.finish()
+
+        elapsed = time.monotonic() - started
+        with self.lock:
+            self.scans += 1
+            self.files += scan.files
+            self.hashed_files += scan.hashed_files
+            self.hashed_bytes += scan.hashed_bytes
+            self.seconds += elapsed
+
+        logging.info(f"Scanned {root_path} in {elapsed:.2f} seconds - {scan.files} files, {scan.hashed_files} hashed "
+                     f"({scan.hashed_bytes / 2 ** 20:.1f} MiB, {scan.hashed_bytes / 2 ** 20 / max(elapsed, 0.001):.1f} "
+                     f"MiB/s) by {self.workers} {'processes' if self.processes else 'threads'}")
+        return root
+
+    def stats(self):
+        """
+        :return: the counters of the pool (dict)
+        """
+
+        with self.lock:
+            return dict(workers=self.workers, processes=self.processes, scans=self.scans, files=self.files,
+                        hashed_files=self.hashed_files, hashed_bytes=self.hashed_bytes, seconds=self.seconds)
+
+    def close(self):
+        """
+        Stop the workers.
+        """
+
+        self.threads.shutdown()
+        if self.hashers is not self.threads:
+            self.hashers.shutdown()
+
+
+class Scan:
+    """
+    The files of a scan waiting for their stat results or their hashes - only used by the scanning thread, the results
+    of the pool are handled in it too.
+    """
+
+    def __init__(self, pool, cache, on_file):
+        """
+        :param pool: the pool doing the work (ScanPool)
+        :param cache: the cache of file hashes to use and update (HashCache)
+        :param on_file: called with the relative path and the hash of each file
+        """
+
+        self.pool = pool
+        self.cache = cache
+        self.on_file = on_file
+
+        self.to_stat = []  # (directory, name, absolute path, relative path) tuples
+        self.to_hash = deque()  # (directory, name, absolute path, relative path, stat result) tuples
+        self.to_hash_bytes = 0
+        self.tasks = {}  # future -> (executor, callback, items)
+        self.logged_at = time.monotonic()
+
+        # metrics
+        self.files = 0
+        self.hashed_files = 0
+        self.hashed_bytes = 0
+
+    def add(self, directory, name, abs_path, relative_path):
+        """
+        :param directory: the directory the file is in (Directory)
+        :param name: the name of the file (string)
+        :param abs_path: the absolute path of the file (string)
+        :param relative_path: the path of the file relative to the root of the scan (string)
+        """
+
+        self.to_stat.append((directory, name, abs_path, relative_path))
+        if len(self.to_stat) >= BATCH_FILES:
+            self.submit_stats()
+        self.submit_hashes()
+
+    def submit(self, executor, function, callback, items, *args):
+        """
+        Hand a batch over to the pool, once there is room for it.
+
+        :param executor: the pool of workers (Executor)
+        :param function: the task (callable)
+        :param callback: called with the items and the result of the task
+        :param items: the items of the batch (list of tuples)
+        :param args: the arguments of the task
+        """
+
+        while len(self.tasks) >= self.pool.workers * TASKS_PER_WORKER:
+            self.collect()
+
+        self.tasks[executor.submit(function, *args)] = (executor, callback, items)
+
+    def submit_stats(self):
+        """
+        Stat the files waiting for it.
+        """
+
+        items, self.to_stat = self.to_stat, []
+        self.submit(self.pool.threads, stat_batch, self.stated, items, [item[2] for item in items])
+
+    def submit_hashes(self, flush=False):
+        """
+        Hash the files waiting for it, in full batches unless the walk is over.
+
+        :param flush: True to submit a partial batch too (bool)
+        """
+
+        while self.to_hash and (flush or len(self.to_hash) >= BATCH_FILES or self.to_hash_bytes >= BATCH_BYTES):
+            items, size = [], 0
+            while self.to_hash and len(items) < BATCH_FILES and size < BATCH_BYTES:
+                items.append(self.to_hash.popleft())
+                size += items[-1][4].st_size
+            self.to_hash_bytes -= size
+
+            # only processes use memory maps
+            executor = self.pool.hashers
+            use_mmap = executor is not self.pool.threads
+            self.submit(executor, hash_batch, self.hashed, items, [item[2] for item in items], use_mmap)
+
+    def collect(self):
+        """
+        Wait for at least one task to finish and handle the results of the finished tasks.
+        """
+
+        done, _ = wait(self.tasks, return_when=FIRST_COMPLETED)
+        for future in done:
+            executor, callback, items = self.tasks.pop(future)
+            try:
+                results = future.result()
+            except BrokenProcessPool:
+                logging.warning("A hashing process has died, e.g. a mapped file was truncated - hashing its batch "
+                                "again")
+                self.pool.replace_broken(executor)
+                results = hash_batch([item[2] for item in items], False)
+            callback(items, results)
+
+        if time.monotonic() - self.logged_at >= PROGRESS_INTERVAL:
+            self.logged_at = time.monotonic()
+            logging.info(f"Scanning - {self.files} files found, {self.hashed_files} hashed "
+                         f"({self.hashed_bytes / 2 ** 20:.1f} MiB)")
+
+    def stated(self, items, results):
+        """
+        :param items: the files of a stat batch (list of tuples)
+        :param results: their stat results (list)
+        """
+
+        for (directory, name, abs_path, relative_path), file_stat in zip(items, results):
+            if file_stat is None or not stat.S_ISREG(file_stat.st_mode):
+                continue
+
+            self.files += 1
+            digest = self.cache.lookup(abs_path, file_stat) if self.cache is not None else None
+            if digest is None:
+                self.to_hash.append((directory, name, abs_path, relative_path, file_stat))
+                self.to_hash_bytes += file_stat.st_size
+            else:
+                self.found(directory, name, relative_path, digest)
+
+    def hashed(self, items, digests):
+        """
+        :param items: the files of a hash batch (list of tuples)
+        :param digests: their hashes (list of bytes)
+        """
+
+        for (directory, name, abs_path, relative_path, file_stat), digest in zip(items, digests):
+            if digest is None:
+                continue
+
+            self.hashed_files += 1
+            self.hashed_bytes += file_stat.st_size
+            if self.cache is not None:
+                self.cache.update(abs_path, file_stat, digest)
+            self.found(directory, name, relative_path, digest)
+
+    def found(self, directory, name, relative_path, digest):
+        """
+        :param directory: the directory the file is in (Directory)
+        :param name: the name of the file (string)
+        :param relative_path: the path of the file relative to the root of the scan (string)
+        :param digest: the hash of the file (bytes)
+        """
+
+        directory.files[name] = digest
+        if self.on_file is not None:
+            self.on_file(relative_path, digest)
+
+    def finish(self):
+        """
+        Wait for all the files of the scan.
+        """
+
+        if self.to_stat:
+            self.submit_stats()
+
+        while self.tasks or self.to_hash:
+            self.submit_hashes(flush=True)
+            if self.tasks:
+                self.collect()
@@ -0,0 +1,102 @@
+import json
+import os
+from common_pkg.framing import ProtocolError
+
+
+# the outcomes of comparing two version vectors
+EQUAL = "equal"
+BEFORE = "before"  # the first vector is older than the second one
+AFTER = "after"  # the first vector is newer than the second one
+CONCURRENT = "concurrent"  # the vectors have diverged, the changes they stand for were made independently
+
+
+def encode_vector(vector):
+    """
+    :param vector: replica id -> the number of changes of the replica (dict)
+
+    :return: the payload of a version message (bytes)
+    """
+
+    return json.dumps(vector, sort_keys=True, separators=(",", ":")).encode("utf-8")
+
+
+def decode_vector(payload):
+    """
+    :param payload: the payload of a version message (bytes)
+
+    :return: replica id -> the number of changes of the replica (dict)
+    """
+
+    try:
+        vector = json.loads(payload.decode("utf-8"))
+    except (UnicodeDecodeError, ValueError) as e:
+        raise ProtocolError(f"Invalid version vector - {e}")
+
+    if not isinstance(vector, dict) or not all(isinstance(count, int) and count >= 0 for count in vector.values()):
+        raise ProtocolError(f"Invalid version vector - {vector!r}")
+
+    return vector
+
+
+def compare(vector, other):
+    """
+    :param vector: a version vector (dict)
+    :param other: another version vector (dict)
+
+    :return: EQUAL, BEFORE or AFTER if one vector has seen all the changes of the other one, CONCURRENT otherwise
+    """
+
+    newer = any(count > other.get(replica, 0) for replica, count in vector.items())
+    older = any(count > vector.get(replica, 0) for replica, count in other.items())
+
+    if newer and older:
+        return CONCURRENT
+    if newer:
+        return AFTER
+    return BEFORE if older else EQUAL
+
+
+def merge(vector, other):
+    """
+    :param vector: a version vector (dict)
+    :param other: another version vector (dict)
+
+    :return: the vector which has seen the changes of both (dict)
+    """
+
+    merged = dict(other)
+    for replica, count in vector.items():
+        merged[replica] = max(count, merged.get(replica, 0))
+    return merged
+
+
+def increment(vector, replica):
+    """
+    :param vector: a version vector (dict)
+    :param replica: the id of the replica which made a change (string)
+
+    :return: the vector of the change (dict)
+    """
+
+    changed = dict(vector)
+    changed[replica] = changed.get(replica, 0) + 1
+    return changed
+
+
+def conflict_path(abs_path, replica, exists=os.path.lexists):
+    """
+    :param abs_path: the absolute path of a file with conflicting changes (string)
+    :param replica: the id of the replica whose change is moved aside (string)
+    :param exists: checks if a path exists
+
+    :return: the first free path next to the file for the conflicting copy, e.g. 'notes (conflict server).txt' (string)
+    """
+
+    stem, extension = os.path.splitext(abs_path)
+    candidate = f"{stem} (conflict {replica}){extension}"
+    number = 1
+    while exists(candidate):
+        number += 1
+        candidate = f"{stem} (conflict {replica} {number}){extension}"
+
+    return candidate
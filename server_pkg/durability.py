@@ -0,0 +1,281 @@
+import logging
+import os
+import threading
+import time
+from twisted.internet import defer, reactor
+from common_pkg.metrics import REGISTRY
+
+
+# the changes applied to the sync folder are made durable together, at most this many seconds after they were applied
+COMMIT_INTERVAL = 0.01
+
+# ... or as soon as this many bytes have been written since the last group commit
+COMMIT_BYTES = 16 * 1024 * 1024
+
+# the time the group commits took, see common_pkg.metrics
+COMMIT_TIME = REGISTRY.histogram("syncapp_server_commit_seconds", "Seconds taken to sync a group commit")
+
+
+class GroupCommit:
+    """
+    Makes the changes applied to the sync folder durable in group commits, so that a crash of the server never loses an
+    operation it has acknowledged, without paying an fsync per file.
+
+    The filesystem operations record the files they write and the directories whose entries they change, in the
+    executor threads. The recorded files and directories are fsynced together by the executor, COMMIT_INTERVAL seconds
+    after the first change since the last commit, or as soon as COMMIT_BYTES have been written - the interval trades the
+    latency of the acknowledgements for fewer fsyncs. An acknowledgement waits for the commit covering the operations
+    it acknowledges. Files are renamed into place before they are fsynced, an operation interrupted by a crash isn't
+    acknowledged and the client sends it again.
+    """
+
+    def __init__(self, executor, root, interval=COMMIT_INTERVAL, max_bytes=COMMIT_BYTES, clock=reactor):
+        """
+        Initialise the group commit.
+
+        :param executor: the executor the commits are run by (PathExecutor)
+        :param root: the sync folder, the directories above it are not synced (string)
+        :param interval: the seconds a change waits for others to be committed with, at most (float)
+        :param max_bytes: the bytes written which start a commit right away (int)
+        :param clock: the reactor used to schedule the commits
+        """
+
+        self.executor = executor
+        self.root = root
+        self.interval = interval
+        self.max_bytes = max_bytes
+        self.clock = clock
+
+        # the changes recorded since the last commit started, recorded by the executor threads
+        self.lock = threading.Lock()
+        self.files = set()
+        self.directories = set()
+        self.size = 0
+        self.batch = None  # the files and directories of the commit in progress (tuple of sets)
+
+        self.waiting = []  # deferreds fired once the next commit is done
+        self.committing = None  # deferreds fired once the commit in progress is done, None without a commit
+        self.timer = None
+
+        # metrics
+        self.commits = 0
+        self.synced_files = 0
+        self.synced_directories = 0
+        self.commit_time_max = 0.0
+
+    def written(self, abs_path, size=0, parents=False):
+        """
+        Record a file written (or created) by a filesystem operation, called by the executor.
+
+        :param abs_path: the absolute path of the file (string)
+        :param size: the bytes written (int)
+        :param parents: True if the folders above the file may have been created too (bool)
+        """
+
+        self.record([abs_path], self.entries(abs_path, parents), size)
+
+    def changed(self, abs_path, parents=False):
+        """
+        Record a path created, deleted or renamed by a filesystem operation - the entries of its folder have changed,
+        called by the executor.
+
+        :param abs_path: the absolute path (string)
+        :param parents: True if the folders above the path may have been created too (bool)
+        """
+
+        self.record([], self.entries(abs_path, parents))
+
+    def entries(self, abs_path, parents):
+        """
+        :param abs_path: an absolute path inside the sync folder (string)
+        :param parents: True to include the folders above its folder, up to the sync folder (bool)
+
+        :return: the folders whose entries are changed by creating, deleting or renaming the path (list of strings)
+        """
+
+        directories = []
+        directory = os.path.dirname(abs_path)
+        while directory == self.root or directory.startswith(self.root + os.sep):
+            directories.append(directory)
+            if not parents or directory == self.root:
+                break
+            directory = os.path.dirname(directory)
+
+        return directories
+
+    def record(self, files, directories, size=0):
+        """
+        Record changes to sync, a commit is scheduled by the first change since the last commit.
+
+        :param files: the absolute paths of the written files (list of strings)
+        :param directories: the absolute paths of the folders whose entries changed (list of strings)
+        :param size: the bytes written (int)
+        """
+
+        with self.lock:
+            first = not self.files and not self.directories
+            self.files.update(files)
+            self.directories.update(directories)
+            self.size += size
+            full = self.size >= self.max_bytes
+
+        if first or full:
+            self.call(self.schedule, 0 if full else self.interval)
+
+    def moved(self, abs_src_path, abs_dest_path):
+        """
+        Record a file or a folder renamed by a filesystem operation, called by the executor - the files and folders
+        below its old path are synced at their new path, by the next commit or by the one waiting for the rename.
+
+        :param abs_src_path: the absolute source path (string)
+        :param abs_dest_path: the absolute destination path (string)
+        """
+
+        with self.lock:
+            batch = self.batch or ()
+            for paths in (self.files, self.directories) + batch:
+                for abs_path in [path for path in paths if path == abs_src_path or
+                                 path.startswith(abs_src_path + os.sep)]:
+                    paths.discard(abs_path)
+                    paths.add(abs_dest_path + abs_path[len(abs_src_path):])
+
+        self.record([], self.entries(abs_src_path, False) + self.entries(abs_dest_path, True))
+
+    def call(self, func, *args):
+        """
+        Call a function in the reactor thread - an executor without workers applies the operations in it already.
+
+        :param func: the function
+        :param args: its arguments
+        """
+
+        if self.executor.pool is None:
+            func(*args)
+        else:
+            self.clock.callFromThread(func, *args)
+
+    def wait(self):
+        """
+        Called in the reactor thread once operations have been applied.
+
+        :return: a deferred fired once the changes of the operations are durable, failed if they couldn't be synced
+                 (Deferred)
+        """
+
+        with self.lock:
+            dirty = bool(self.files or self.directories)
+
+        if dirty:
+            d = defer.Deferred()
+            self.waiting.append(d)
+            self.schedule(self.interval)
+            return d
+
+        # the changes recorded so far are part of the commit in progress
+        if self.committing is not None:
+            d = defer.Deferred()
+            self.committing.append(d)
+            return d
+
+        return defer.succeed(None)
+
+    def schedule(self, delay):
+        """
+        Start a commit after a delay, unless one is already scheduled sooner or in progress - a commit in progress
+        schedules the next one once it's done.
+
+        :param delay: the delay in seconds (float)
+        """
+
+        if self.committing is not None:
+            return
+
+        if self.timer is None:
+            self.timer = self.clock.callLater(delay, self.commit)
+        elif self.timer.getTime() > self.clock.seconds() + delay:
+            self.timer.reset(delay)
+
+    def commit(self):
+        """
+        Sync the recorded changes in the executor - after the operations submitted earlier on their paths (e.g. a
+        rename of a written file, still queued for another client) and before the later ones.
+        """
+
+        self.timer = None
+        with self.lock:
+            files, directories = self.files, self.directories
+            self.files, self.directories, self.size = set(), set(), 0
+            self.batch = (files, directories)
+
+        self.committing, self.waiting = self.waiting, []
+        # the sync folder itself is never renamed or deleted, ordering the commit after everything below it isn't needed
+        paths = sorted((files | directories) - {self.root})
+        d = self.executor.submit(paths, self.sync, files, directories)
+        d.addBoth(self.committed)
+
+    def sync(self, files, directories):
+        """
+        Sync files and directories, called by the executor - the paths deleted in the meantime are skipped, the
+        deletions are synced with their folders.
+
+        :param files: the absolute paths of the files (set of strings)
+        :param directories: the absolute paths of the directories (set of strings)
+        """
+
+        start = time.monotonic()
+        synced = 0
+        # the content and the inodes first, then the entries naming them
+        with self.lock:
+            abs_paths = sorted(files) + sorted(directories, key=len, reverse=True)
+        for abs_path in abs_paths:
+            try:
+                fd = os.open(abs_path, os.O_RDONLY)
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            synced += 1
+
+        elapsed = time.monotonic() - start
+        self.commits += 1
+        self.synced_files += len(files)
+        self.synced_directories += len(directories)
+        self.commit_time_max = max(self.commit_time_max, elapsed)
+        COMMIT_TIME.observe(elapsed)
+        logging.debug(f"Synced {synced} files and directories in {elapsed:.3f} seconds")
+
+    def committed(self, result):
+        """
+        Called in the reactor thread once a commit is done - the operations waiting for it are acknowledged.
+
+        :param result: None, or the failure of the commit
+        """
+
+        committing, self.committing = self.committing, None
+        with self.lock:
+            self.batch = None
+        if result is not None:
+            logging.warning(f"Group commit failed, the operations waiting for it are not acknowledged - "
+                            f"{result.getErrorMessage()}")
+
+        for d in committing:
+            if result is None:
+                d.callback(None)
+            else:
+                d.errback(result)
+
+        with self.lock:
+            dirty = bool(self.files or self.directories)
+        if self.waiting or dirty:
+            self.schedule(0 if self.size >= self.max_bytes else self.interval)
+
+    def stats(self):
+        """
+        :return: the counters of the group commits (dict)
+        """
+
+        return dict(commits=self.commits, synced_files=self.synced_files, synced_directories=self.synced_directories,
+                    commit_time_max=self.commit_time_max, waiting=len(self.waiting))
@@ -0,0 +1,264 @@
+import logging
+import time
+from collections import OrderedDict, deque
+from twisted.internet import defer, reactor, threads
+from twisted.python.failure import Failure
+from twisted.python.threadpool import ThreadPool
+from common_pkg.metrics import REGISTRY
+
+
+# default number of worker threads applying filesystem operations
+WORKERS = 4
+
+# the seconds from submitting a filesystem operation to it being applied, per operation - see common_pkg.metrics
+APPLY_LATENCY = REGISTRY.histogram("syncapp_server_apply_seconds",
+                                   "Seconds from submitting a filesystem operation to it being applied", ("operation",))
+
+
+def ancestors(path):
+    """
+    :param path: a path separated by '/' (string)
+
+    :return: the path itself followed by all of its ancestors (list of strings)
+    """
+
+    paths = [path]
+    while True:
+        path = path.rpartition("/")[0]
+        if not path:
+            return paths
+        paths.append(path)
+
+
+class Operation:
+    """
+    A filesystem operation waiting for or being applied by the executor.
+    """
+
+    def __init__(self, paths, owner, func, args):
+        """
+        Initialise the operation.
+
+        :param paths: the paths the operation touches (list of strings)
+        :param owner: the client which submitted the operation
+        :param func: the function applying the operation
+        :param args: the arguments of the function (tuple)
+        """
+
+        self.paths = list(dict.fromkeys(paths))
+        self.owner = owner
+        self.func = func
+        self.args = args
+
+        self.waiting_for = 0  # the number of earlier operations which must finish first
+        self.dependents = []  # later operations waiting for this one
+        self.deferred = defer.Deferred()
+        self.submitted = time.monotonic()
+
+
+class PathExecutor:
+    """
+    Applies filesystem operations in a bounded pool of worker threads, so that the reactor thread never blocks on disk.
+
+    Operations touching the same path, or a path and one of its ancestors, are applied in the order they were submitted,
+    while operations on unrelated paths are applied in parallel. Operations which are ready to be applied are taken
+    from the clients in a round robin fashion, so that a client with a big backlog doesn't starve the others. The
+    scheduling state is only ever touched in the reactor thread. With zero workers the operations are applied
+    synchronously in the calling thread.
+    """
+
+    def __init__(self, workers=WORKERS, clock=reactor):
+        """
+        Initialise the executor.
+
+        :param workers: the number of worker threads, 0 to apply operations synchronously (int)
+        :param clock: the reactor used to start the pool and deliver results
+        """
+
+        self.workers = workers
+        self.clock = clock
+
+        self.pool = None
+        if workers:
+            self.pool = ThreadPool(minthreads=0, maxthreads=workers, name="sync-io")
+            self.pool.start()
+            clock.addSystemEventTrigger("during", "shutdown", self.pool.stop)
+
+        self.latest = {}  # path -> the latest unfinished operation touching it
+        self.active_below = {}  # path -> paths below it touched by unfinished operations
+        self.ready = OrderedDict()  # owner -> operations ready to be applied, in round robin order
+        self.owner_depth = {}  # owner -> the number of its unfinished operations
+
+        # metrics
+        self.queued = 0  # operations waiting for earlier operations
+        self.waiting = 0  # operations waiting for a free worker
+        self.running = 0  # operations handed over to the worker threads
+        self.applied = 0
+        self.failed = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def submit(self, paths, func, *args, owner=None):
+        """
+        Submit an operation.
+
+        :param paths: the paths the operation touches (list of strings)
+        :param func: the function applying the operation
+        :param args: the arguments of the function
+        :param owner: the client submitting the operation, used for fair scheduling
+
+        :return: a deferred fired with the result of the function once applied (Deferred)
+        """
+
+        operation = Operation(paths, owner, func, args)
+        self.owner_depth[owner] = self.owner_depth.get(owner, 0) + 1
+
+        # find the unfinished operations this one conflicts with
+        dependencies = set()
+        for path in operation.paths:
+            for ancestor in ancestors(path):
+                if ancestor in self.latest:
+                    dependencies.add(self.latest[ancestor])
+            for below in self.active_below.get(path, ()):
+                dependencies.add(self.latest[below])
+
+        # register the operation as the latest one for its paths
+        for path in operation.paths:
+            if path not in self.latest:
+                for ancestor in ancestors(path)[1:]:
+                    self.active_below.setdefault(ancestor, set()).add(path)
+            self.latest[path] = operation
+
+        dependencies.discard(operation)
+        for dependency in dependencies:
+            dependency.dependents.append(operation)
+        operation.waiting_for = len(dependencies)
+
+        if operation.waiting_for:
+            self.queued += 1
+        else:
+            self.start(operation)
+
+        return operation.deferred
+
+    def start(self, operation):
+        """
+        Called when an operation no longer waits for earlier operations - queues it for a free worker.
+
+        :param operation: the operation to apply (Operation)
+        """
+
+        self.ready.setdefault(operation.owner, deque()).append(operation)
+        self.waiting += 1
+        self.dispatch()
+
+    def dispatch(self):
+        """
+        Hand ready operations over to the worker threads, one owner at a time.
+        """
+
+        while self.ready and (self.pool is None or self.running < self.workers):
+            owner, operations = next(iter(self.ready.items()))
+            operation = operations.popleft()
+            if operations:
+                self.ready.move_to_end(owner)
+            else:
+                del self.ready[owner]
+
+            self.waiting -= 1
+            self.run(operation)
+
+    def run(self, operation):
+        """
+        Apply an operation in a worker thread (or synchronously without workers).
+
+        :param operation: the operation to apply (Operation)
+        """
+
+        self.running += 1
+        if self.pool is None:
+            d = defer.maybeDeferred(operation.func, *operation.args)
+        else:
+            d = threads.deferToThreadPool(self.clock, self.pool, operation.func, *operation.args)
+        d.addBoth(self.finished, operation)
+
+    def finished(self, result, operation):
+        """
+        Called in the reactor thread when an operation has been applied - starts the operations waiting for it.
+
+        :param result: the result of the operation or a failure
+        :param operation: the applied operation (Operation)
+        """
+
+        self.running -= 1
+        self.owner_depth[operation.owner] -= 1
+        if not self.owner_depth[operation.owner]:
+            del self.owner_depth[operation.owner]
+
+        latency = time.monotonic() - operation.submitted
+        self.applied += 1
+        self.latency_total += latency
+        self.latency_max = max(self.latency_max, latency)
+        APPLY_LATENCY.observe(latency, getattr(operation.func, "__name__", "operation"))
+        if isinstance(result, Failure):
+            self.failed += 1
+
+        for path in operation.paths:
+            if self.latest.get(path) is operation:
+                del self.latest[path]
+                for ancestor in ancestors(path)[1:]:
+                    below = self.active_below[ancestor]
+                    below.discard(path)
+                    if not below:
+                        del self.active_below[ancestor]
+
+        for dependent in operation.dependents:
+            dependent.waiting_for -= 1
+            if not dependent.waiting_for:
+                self.queued -= 1
+                self.start(dependent)
+        self.dispatch()
+
+        if isinstance(result, Failure):
+            operation.deferred.errback(result)
+        else:
+            operation.deferred.callback(result)
+
+    @property
+    def depth(self):
+        """
+        :return: the number of operations submitted but not applied yet (int)
+        """
+
+        return self.queued + self.waiting + self.running
+
+    def pending(self, owner):
+        """
+        :param owner: the client which submitted the operations
+
+        :return: the number of operations of the client submitted but not applied yet (int)
+        """
+
+        return self.owner_depth.get(owner, 0)
+
+    def metrics(self):
+        """
+        :return: the queue depth and apply latency metrics (dict)
+        """
+
+        return {
+            "queued": self.queued,
+            "waiting": self.waiting,
+            "running": self.running,
+            "applied": self.applied,
+            "failed": self.failed,
+            "apply_latency_avg": self.latency_total / self.applied if self.applied else 0.0,
+            "apply_latency_max": self.latency_max
+        }
+
+    def log_metrics(self):
+        """
+        Log the current metrics.
+        """
+
+        logging.info(f"Executor metrics - {self.metrics()}")
@@ -1,21 +1,115 @@
+import json
 import logging
 import os
 import shutil
+import time
+from collections import deque
 from twisted.internet.endpoints import TCP4ServerEndpoint
 from twisted.internet.protocol import Factory
 from twisted.protocols.basic import LineReceiver
 from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+from watchdog.observers import Observer
+from server_pkg.durability import GroupCommit
+from server_pkg.executor import PathExecutor, WORKERS
+from server_pkg.push import PushQueue, ServerEventHandler
+from server_pkg.session import ClientSession, InvalidPathError, InvalidRootError, root_folder
+from server_pkg.store import ContentStore, STORE_FOLDER
+from server_pkg.transfer import IncomingTransfer, ResumableTransfer, StagingArea, RESUMABLE_MIN_SIZE, TEMP_SUFFIX
+from server_pkg.versions import VersionStore
+from common_pkg.compression import PayloadDecompressor, choose_codec
+from common_pkg.content import decode_offer, encode_resume, CONTENT_MATERIALISED, CONTENT_NEEDED
+from common_pkg.delta import compute_signature, empty_signature
+from common_pkg.echo import EchoFilter
+from common_pkg.logs import event_log
+from common_pkg.metrics import REGISTRY, SIZE_BUCKETS
+from common_pkg.manifest import Directory, HashCache, build_manifest, encode_listing
+from common_pkg.scan import ScanPool, WORKERS as SCAN_WORKERS
+from common_pkg.framing import FrameDecoder, ProtocolError, decode_batch, decode_hello, decode_legacy_line, \
+    encode_frame, encode_hello_frame, MSG_CREATED, MSG_DELETED, MSG_MODIFIED, MSG_MOVED, MSG_CHUNK, \
+    MSG_SIGNATURE_REQUEST, MSG_SIGNATURE, MSG_DELTA, MSG_CONTENT_OFFER, MSG_CONTENT_REPLY, MSG_TREE_REQUEST, MSG_TREE, \
+    MSG_ACK_REQUEST, MSG_ACK, MSG_OPERATION, MSG_BATCH, MSG_VERSION, FLAG_FIRST, FLAG_LAST, FLAG_COMPRESSED, \
+    FLAG_ABORT, PROTOCOL_VERSION, SEQUENCE, EVENT_NAMES, MESSAGE_NAMES
+from common_pkg.versions import compare, conflict_path, decode_vector, increment, merge, AFTER, BEFORE, EQUAL
+
+
+# optional parts of the binary protocol supported by the server, advertised in the hello message
+FEATURES = ["delta", "dedup", "reconcile", "ack", "resume", "batch", "streams", "resumable"]
+
+# optional parts of the binary protocol supported by the server if it watches its sync folder
+PUSH_FEATURES = ["versions", "push"]
+
+# the operations of a batch message which are applied together, in a single pass
+BATCH_OPERATIONS = (MSG_CREATED, MSG_DELETED, MSG_MODIFIED, MSG_MOVED)
+
+# the messages whose file is checked against the version of the server's copy before they are applied
+VERSIONED = (MSG_DELETED, MSG_MODIFIED, MSG_MOVED, MSG_CHUNK, MSG_DELTA, MSG_SIGNATURE_REQUEST, MSG_CONTENT_OFFER)
+
+# the messages which start the transfer of a streamed file
+STREAM_STARTS = (MSG_CHUNK, MSG_DELTA, MSG_SIGNATURE_REQUEST, MSG_CONTENT_OFFER)
+
+# the id of the server in the version vectors
+SERVER_REPLICA = "server"
+
+# the policies resolving the conflicts between concurrent changes of a file - keep both copies, the server's one being
+# renamed with a suffix, or let the last change received by the server win
+KEEP_BOTH = "keep-both"
+OVERWRITE = "overwrite"
+CONFLICT_POLICIES = (KEEP_BOTH, OVERWRITE)
+
+# default number of clients served at the same time in the multi-client mode
+MAX_CONNECTIONS = 256
+
+# the messages received from the clients, per message type - see common_pkg.metrics
+MESSAGES_RECEIVED = REGISTRY.counter("syncapp_server_messages_received_total", "Messages received from the clients",
+                                     ("type",))
+MESSAGE_BYTES = REGISTRY.histogram("syncapp_server_message_bytes", "Bytes of the messages received from the clients",
+                                   ("type",), SIZE_BUCKETS)
+CONNECTIONS = REGISTRY.counter("syncapp_server_connections_total", "Connections accepted from the clients")
+
+# the per-client sync root of clients which don't introduce themselves (legacy clients)
+DEFAULT_ROOT = "default"
+
+# interval between the removals of unused blobs from the content store (seconds)
+STORE_GC_INTERVAL = 3600
+
+# the file in the sync folder the resume points of the clients are saved to, so that they survive a restart
+RESUME_FILE = ".syncresume.json"
+
+# interval between the saves of the resume points (seconds)
+RESUME_SAVE_INTERVAL = 1
 
 
 class SyncServerProtocol(LineReceiver):
     """
-    A custom protocol built on top of the LineReceiver protocol - messages are buffered until a delimiter (\r\r\r\n\n\n) is received.
+    A custom protocol built on top of the LineReceiver protocol.
+
+    Clients which negotiate the binary wire format (see common_pkg.framing) are switched to raw mode and their messages
+    are dispatched on the frame header. Legacy clients keep using the line based protocol - messages are buffered until
+    a delimiter (\r\r\r\n\n\n) is received.
+
+    The hello message also identifies the client, which is mapped by the factory to a sync root. Paths received from
+    the client are relative to that root. The server picks one of the compression codecs offered by the client and
+    decompresses the payloads flagged as compressed in the executor.
+
+    Big files offered by clients which can resume their transfers are received in the staging area of the factory -
+    if the connection is lost, what has been received is kept and the client is asked for the rest when it offers the
+    same content again.
+
+    If the factory watches the sync folder, the changes made to it by anyone else - other clients or local programs -
+    are pushed to the clients asking for them. Every file has a version vector then (see common_pkg.versions) and the
+    uploads and deletions of a client are checked against the version of the server's copy before they are applied:
+    a change made on top of an older version is dropped and the server's copy is pushed to the client instead, a
+    change concurrent with the server's copy is a conflict, resolved by the policy of the factory.
     """
 
     delimiter = b"\r\r\r\n\n\n"
 
     MAX_LENGTH = 999999999
 
+    # reading from the client is paused while this many of its filesystem operations are waiting to be applied
+    MAX_PENDING_OPERATIONS = 256
+
     def __init__(self, factory, abort=False):
         """
         Initialise the protocol object.
@@ -29,16 +123,49 @@ class SyncServerProtocol(LineReceiver):
         self.factory = factory
         self.abort = abort
 
+        self.session = None  # set once the client has been identified
+        self.decoder = None  # set once the client negotiates the binary wire format
+        self.decompressor = None  # set if a compression codec has been negotiated (PayloadDecompressor)
+        self.resumable = False  # True if the client can resume the transfer of a big file after reconnecting
+        self.manifest = None  # the manifest of the sync root, built when the client starts a reconciliation
+        self.handlers = {
+            MSG_CREATED: self.handle_created,
+            MSG_DELETED: self.handle_deleted,
+            MSG_MODIFIED: self.handle_modified,
+            MSG_MOVED: self.handle_moved,
+            MSG_CHUNK: self.handle_chunk,
+            MSG_SIGNATURE_REQUEST: self.handle_signature_request,
+            MSG_DELTA: self.handle_delta,
+            MSG_CONTENT_OFFER: self.handle_content_offer,
+            MSG_TREE_REQUEST: self.handle_tree_request,
+            MSG_ACK_REQUEST: self.handle_ack_request,
+            MSG_OPERATION: self.handle_operation,
+            MSG_BATCH: self.handle_batch,
+            MSG_VERSION: self.handle_version
+        }
+        self.transfers = {}  # streamed transfers in progress, event path -> IncomingTransfer
+        self.streams = {}  # event path -> the operation of the client a file being streamed belongs to
+        self.pending_acks = deque()  # acknowledgements waiting for the operations of streamed files
+        self.reading_paused = False
+
+        self.push = None  # set if the changes of the sync folder are pushed to the client (PushQueue)
+        self.pending_versions = {}  # event path -> the version of the next operation of the client on the file
+        self.checked = set()  # event paths of the streamed files whose version has been checked
+        self.resolved = {}  # event path -> (the client's version, the merged version) of its last conflict
+        self.shared = set()  # absolute paths whose next write must be pushed back to the client too
+
     def connectionMade(self):
         """
-        Called when the connection is established - abort if another client has already connected.
+        Called when the connection is established - abort if the factory can't serve another client.
         """
 
-        # check if a connection with another client has already been made
+        # check if a connection with another client has already been made or the connection cap has been reached
         if self.abort:
             self.transport.abortConnection()
             logging.warning(f"Connection with {self.transport.getPeer().host} has been aborted.")
         else:
+            self.factory.connections += 1
+            CONNECTIONS.inc()
             logging.info(f"Connection with {self.transport.getPeer().host} has been established.")
 
     def connectionLost(self, reason):
@@ -48,54 +175,502 @@ class SyncServerProtocol(LineReceiver):
         :param reason: the reason as reported by twisted.
         """
 
-        # if this was the first connection, update the factory flag
+        # if this was an accepted connection, update the factory state
         if not self.abort:
             self.factory.connection_made = False
+            self.factory.connections -= 1
+
+        # incomplete transfers are discarded or kept to be resumed, the destination files are left untouched
+        for transfer in self.transfers.values():
+            self.submit([transfer.abs_path], transfer.suspend, tracked=False)
+        self.transfers.clear()
+
+        if self.session is not None:
+            self.factory.unregister(self)
+            logging.info(f"Client session finished - {self.session.stats()}")
+
+        if self.push is not None:
+            logging.info(f"Push stats - {self.push.stats()}")
+            self.push.stopProducing()
+
         logging.warning(f"Connection with {self.transport.getPeer().host} has been lost - {reason}.")
 
     def lineReceived(self, line):
         """
-        Called when the full message was received.
+        Called when a full message of the line based protocol was received.
 
         :param line: the sent message
         """
 
+        # a client supporting the binary wire format introduces itself with a hello message
+        if line.startswith(b"hello::"):
+            self.negotiate(line.split(b"::", 2)[-1])
+            return
+
+        # a client sending messages without a hello only speaks the legacy protocol
+        if self.session is None and not self.start_session(None, None, legacy=True):
+            return
+
         if not line.startswith(b"modified"):  # do not log the full line if this is a modified event
-            logging.info(f"Received {line}")
+            event_log.info(f"Received {line}")
         else:
-            logging.info("Received 'modified' event")
+            event_log.info("Received 'modified' event")
+
+        try:
+            frame = decode_legacy_line(line)
+        except ProtocolError as e:
+            logging.info(str(e))
+            return
+
+        self.frameReceived(frame)
+
+    def negotiate(self, body):
+        """
+        Called when a client asks to switch to the binary wire format.
 
-        # messages follow the format <event_type>::<flag for directory event>::<msg body dependent on event>
-        msg_parts = line.split(b"::", 2)
+        :param body: the capabilities advertised by the client (JSON encoded bytes)
+        """
 
-        if len(msg_parts) != 3:
-            logging.info(f"Protocol violation - {msg_parts}")
+        try:
+            capabilities = decode_hello(body)
+        except ProtocolError as e:
+            logging.info(str(e))
             return
 
-        msg_type = msg_parts[0].decode("utf-8")
-        is_directory = bool(int(msg_parts[1].decode("utf-8")))
-        msg_body = msg_parts[2]
+        if capabilities["version"] != PROTOCOL_VERSION:
+            logging.warning(f"Client requested unsupported protocol version {capabilities['version']}, "
+                            f"staying on the legacy protocol.")
+            return
+
+        if not self.start_session(capabilities.get("client_id"), capabilities.get("root")):
+            return
+
+        logging.info(f"Negotiated binary protocol version {PROTOCOL_VERSION} with {self.session.client_id}.")
+
+        self.resumable = bool(capabilities.get("resumable"))
+
+        reply = {"features": FEATURES + (PUSH_FEATURES if self.factory.versions is not None else [])}
+        codec = choose_codec(capabilities.get("compression", []))
+        if codec is not None:
+            logging.info(f"Using {codec.name} compression with {self.session.client_id}.")
+            self.decompressor = PayloadDecompressor(codec)
+            self.session.compression = self.decompressor.stats
+            reply["compression"] = codec.name
+
+        if capabilities.get("push") and self.factory.versions is not None:
+            logging.info(f"Pushing the changes of {self.session.sync_folder} to {self.session.client_id}.")
+            self.push = PushQueue(self, self.factory.versions)
+            self.transport.registerProducer(self.push, True)
+
+        # any data buffered after the hello line is passed to rawDataReceived by LineReceiver
+        self.decoder = FrameDecoder()
+        self.setRawMode()
+
+        if capabilities.get("resume"):
+            # operations sent on an earlier connection may still be applied, the client resumes after all of them
+            d = self.submit([self.session.sync_folder], self.barrier)
+            d.addCallback(lambda _: self.resume(reply))
+        else:
+            self.transport.write(encode_hello_frame(**reply))
+
+    def resume(self, reply):
+        """
+        Accept the binary wire format, telling the client which of its operations have been applied.
+
+        :param reply: the capabilities advertised to the client (dict)
+        """
+
+        self.session.applied = self.factory.resume_points.get(self.session.client_id, 0)
+        logging.info(f"Client {self.session.client_id} resumes after operation {self.session.applied}.")
+
+        if self.connected:
+            self.transport.write(encode_hello_frame(resume=self.session.applied, **reply))
+
+    def start_session(self, client_id, root, legacy=False):
+        """
+        Identify the client and map it to its sync root - the connection is closed if the root isn't valid.
+
+        :param client_id: the identifier sent by the client, None if it didn't send one (string)
+        :param root: the name of the sync root requested by the client, None for the default (string)
+        :param legacy: True if the client uses the legacy line based protocol (bool)
+
+        :return: True if the session has been started (bool)
+        """
+
+        if client_id is None:
+            peer = self.transport.getPeer()
+            client_id = f"{peer.host}:{peer.port}"
+            root = root or DEFAULT_ROOT
 
-        handle_method = f"handle_{msg_type}"
         try:
-            getattr(self, handle_method)(is_directory, msg_body)
-        except AttributeError as e:
-            logging.info(f"Received unrecognized message type - {msg_type} - {e}")
+            self.session = self.factory.register(self, str(client_id), root, legacy)
+        except InvalidRootError as e:
+            logging.warning(f"{e}, closing connection with {self.transport.getPeer().host}")
+            self.transport.loseConnection()
+            return False
+
+        logging.info(f"Client {self.session.client_id} is synchronised with {self.session.sync_folder}")
+
+        # a per-client sync root is created the first time its client connects
+        if self.session.sync_folder != self.factory.sync_folder:
+            self.submit([self.session.sync_folder], self.create_path, True, self.session.sync_folder)
+
+        return True
+
+    def rawDataReceived(self, data):
+        """
+        Called with data received after the binary wire format was negotiated.
+
+        :param data: the received bytes
+        """
+
+        try:
+            frames = self.decoder.feed(data)
+        except ProtocolError as e:
+            logging.warning(f"Protocol violation, closing connection - {e}")
+            self.transport.loseConnection()
+            return
+
+        for frame in frames:
+            self.frameReceived(frame)
+
+    def frameReceived(self, frame):
+        """
+        Dispatch a decoded message to its handler based on the message type.
+
+        :param frame: the received message (Frame)
+        """
+
+        name = MESSAGE_NAMES.get(frame.msg_type, str(frame.msg_type))
+        MESSAGES_RECEIVED.inc(name)
+        MESSAGE_BYTES.observe(len(frame.path) + len(frame.payload), name)
+        event_log.debug(f"Received '{name}' event for {frame.path}")
+        self.session.message_received(frame)
+
+        if frame.flags & FLAG_COMPRESSED and self.decompressor is None:
+            logging.warning("Received a compressed payload without a negotiated codec, closing connection")
+            self.transport.loseConnection()
+            return
+
+        handler = self.handlers.get(frame.msg_type)
+        if handler is None:
+            logging.info(f"Received unrecognized message type - {frame.msg_type}")
+            return
+
+        if not self.check_paths(frame):
+            return
+
+        if frame.msg_type in VERSIONED and self.factory.versions is not None and not self.check_version(frame):
+            return
+
+        handler(frame)
+
+    def check_paths(self, frame):
+        """
+        Check that the paths of a message are inside the sync root of the client, before anything is submitted for it.
+
+        :param frame: the received message (Frame)
+
+        :return: False if the message must be dropped (bool)
+        """
+
+        try:
+            self.abs_path(frame.path)
+            if frame.msg_type == MSG_MOVED:
+                self.abs_path(frame.payload)
+        except InvalidPathError as e:
+            logging.warning(f"{e}, dropping the {MESSAGE_NAMES.get(frame.msg_type, frame.msg_type)} message")
+            return False
+
+        return True
+
+    def abs_path(self, event_path):
+        """
+        Build the absolute path of an event path relative to the sync root of the client.
+
+        :param event_path: the relative path, starting with '.' (bytes)
+
+        :return: the absolute path (string)
+        """
+
+        return self.session.abs_path(event_path)
+
+    def event_path(self, abs_path):
+        """
+        Build the event path of an absolute path inside the sync root of the client.
+
+        :param abs_path: the absolute path (string)
+
+        :return: the relative path, starting with '.' (bytes)
+        """
+
+        return f".{abs_path[len(self.session.sync_folder):]}".encode("utf-8")
+
+    def submit(self, abs_paths, func, *args, tracked=True):
+        """
+        Hand a filesystem operation over to the executor - reading from the client is paused while too many of its
+        operations are waiting to be applied, other clients are not affected.
+
+        :param abs_paths: the absolute paths the operation touches (list of strings)
+        :param func: the function applying the operation
+        :param args: the arguments of the function
+        :param tracked: False if the operation belongs to a streamed file, which is tracked on its own (bool)
+
+        :return: a deferred fired with the result of the function (Deferred)
+        """
+
+        # the events of the operation are recognised as echoes of the client's change
+        if self.factory.observer is not None:
+            for abs_path in abs_paths:
+                self.factory.echo.expect(abs_path, self.session, abs_path in self.shared)
+                self.shared.discard(abs_path)
+
+        executor = self.factory.executor
+        d = executor.submit(abs_paths, func, *args, owner=self.session.client_id)
+        if self.factory.observer is not None:
+            d.addBoth(self.settle, abs_paths)
+        d.addErrback(self.operation_failed, func)
+        d.addBoth(self.operation_finished)
+
+        # the operation of the client the message belongs to is applied once all its filesystem operations are
+        seq = self.session.operation_submitted() if tracked else None
+        if seq is not None:
+            d.addBoth(self.operation_applied, seq)
+
+        if executor.pending(self.session.client_id) >= self.MAX_PENDING_OPERATIONS and not self.reading_paused:
+            logging.info(f"Too many pending filesystem operations, pausing {self.transport.getPeer().host}")
+            self.reading_paused = True
+            self.transport.pauseProducing()
+
+        return d
+
+    def settle(self, result, abs_paths):
+        """
+        Called when a filesystem operation has been applied, while the sync folder is watched.
+
+        :param result: the result of the operation
+        :param abs_paths: the absolute paths the operation touches (list of strings)
+        """
+
+        for abs_path in abs_paths:
+            self.factory.echo.settle(abs_path)
+        return result
 
-    def handle_created(self, is_directory, event_path):
+    def frame_decompressor(self, frame):
+        """
+        :param frame: a received message (Frame)
+
+        :return: the decompressor for the payload of the message, None if the payload isn't compressed
+        """
+
+        return self.decompressor if frame.flags & FLAG_COMPRESSED else None
+
+    def operation_failed(self, failure, func):
+        """
+        Called when a filesystem operation fails.
+
+        :param failure: the failure raised by the operation
+        :param func: the function applying the operation
+        """
+
+        logging.warning(f"Failed to apply {func.__name__} - {failure.getErrorMessage()}")
+
+    def operation_finished(self, result):
+        """
+        Called when a filesystem operation has been applied - resumes reading once the executor has caught up.
+
+        :param result: the result of the operation
+        """
+
+        pending = self.factory.executor.pending(self.session.client_id)
+        if self.reading_paused and pending <= self.MAX_PENDING_OPERATIONS // 2:
+            self.reading_paused = False
+            if self.connected:
+                self.transport.resumeProducing()
+
+        return result
+
+    def operation_applied(self, result, seq):
+        """
+        Called when a filesystem operation belonging to an operation of the client has been applied.
+
+        :param result: the result of the filesystem operation
+        :param seq: the sequence number of the operation of the client (int)
+        """
+
+        self.session.operation_applied(seq)
+        self.send_pending_acks()
+        return result
+
+    def stream_started(self, event_path):
+        """
+        Called when the first message of a streamed file is received - the messages of the file are interleaved with
+        the messages of later operations, so the file belongs to the operation being received now until it's done.
+
+        :param event_path: the relative path of the file (bytes)
+        """
+
+        if event_path not in self.streams:
+            seq = self.session.operation_submitted()
+            if seq is not None:
+                self.streams[event_path] = seq
+
+    def stream_finished(self, result, event_path):
+        """
+        Called when a streamed file has been put in place (or its transfer has failed) - its operation can be applied.
+
+        :param result: the result of the last filesystem operation of the file
+        :param event_path: the relative path of the file (bytes)
+        """
+
+        seq = self.streams.pop(event_path, None)
+        if seq is not None:
+            self.operation_applied(None, seq)
+        self.checked.discard(event_path)
+        return result
+
+    def handle_version(self, frame):
+        """
+        Called when a client sends the version of a file ahead of an operation on it.
+
+        :param frame: the message, its path is the path of the file and its payload the version vector (Frame)
+        """
+
+        try:
+            self.pending_versions[frame.path] = decode_vector(frame.payload)
+        except ProtocolError as e:
+            logging.info(str(e))
+            return
+
+        # a new operation on the file starts
+        self.checked.discard(frame.path)
+
+    def check_version(self, frame):
+        """
+        Check the version of the file of an operation against the version of the server's copy, before the operation is
+        applied.
+
+        A change made on top of every change of the server's copy is applied. A change made on top of an older version,
+        which has nothing the server's copy doesn't have, is dropped and the server's copy is pushed to the client
+        instead - unless it's part of a stream which can't be dropped. The other changes are conflicts - with the
+        keep-both policy, the server's copy is kept next to the file with a suffix and the deletion of a file is dropped,
+        otherwise the change is applied. The merged version, along with the content of the file, is pushed back to the
+        client. Changes of clients which don't send versions are counted as changes made on top of the server's copy.
+
+        :param frame: the message of the operation (Frame)
+
+        :return: False if the operation must be dropped (bool)
+        """
+
+        versions = self.factory.versions
+        abs_path = self.abs_path(frame.path)
+
+        if frame.msg_type == MSG_MOVED:
+            versions.move(abs_path, self.abs_path(frame.payload))
+            return True
+
+        if frame.is_directory or frame.msg_type in (MSG_CHUNK, MSG_DELTA) and not frame.flags & FLAG_FIRST:
+            return True
+
+        # a streamed file is checked once, by the first message of its transfer
+        if frame.msg_type in STREAM_STARTS:
+            if frame.path in self.checked:
+                return True
+            self.checked.add(frame.path)
+
+        stored = versions.get(abs_path)
+        incoming = self.pending_versions.pop(frame.path, None)
+        if incoming is None:
+            versions.put(abs_path, increment(stored, self.session.client_id))
+            return True
+
+        order = compare(incoming, stored)
+
+        # the client made the change on top of its own change whose conflict has been resolved since
+        previous, resolved = self.resolved.get(frame.path, (None, None))
+        if order not in (AFTER, EQUAL) and resolved == stored and compare(incoming, previous) in (AFTER, EQUAL):
+            order = AFTER
+
+        merged = merge(incoming, stored)
+        if order in (AFTER, EQUAL):
+            versions.put(abs_path, merged)
+            if merged != incoming:
+                self.shared.add(abs_path)
+            return True
+
+        deletion = frame.msg_type == MSG_DELETED
+        if order == BEFORE and frame.msg_type in (MSG_DELETED, MSG_MODIFIED, MSG_CONTENT_OFFER) or \
+                deletion and self.factory.conflict_policy == KEEP_BOTH:
+            logging.info(f"Dropping {EVENT_NAMES[frame.msg_type]} {abs_path} from {self.session.client_id} - its "
+                         f"version {incoming} is {order} compared to the server's version {stored}")
+            self.factory.push_to(self, "modified", abs_path)
+            if frame.msg_type == MSG_CONTENT_OFFER:
+                # the client doesn't send the content
+                self.stream_started(frame.path)
+                self.send_content_reply((CONTENT_MATERIALISED, None), frame.path)
+            return False
+
+        self.factory.conflicts += 1
+        logging.warning(f"Conflicting changes of {abs_path} - {self.session.client_id} made {incoming}, the server's copy "
+                        f"is {stored}, resolved with the {self.factory.conflict_policy} policy")
+
+        if self.factory.conflict_policy == KEEP_BOTH:
+            # named after the replica whose change is kept aside
+            replica = min(replica for replica, count in stored.items() if count > incoming.get(replica, 0))
+            aside_path = conflict_path(abs_path, replica)
+            versions.put(aside_path, increment(versions.get(aside_path), SERVER_REPLICA))
+            self.shared.add(aside_path)
+            self.submit([abs_path, aside_path], self.keep_aside, abs_path, aside_path, tracked=False)
+
+        versions.put(abs_path, merged)
+        self.resolved[frame.path] = (incoming, merged)
+        self.shared.add(abs_path)
+        return True
+
+    def keep_aside(self, abs_path, aside_path):
+        """
+        Keep the server's copy of a file with conflicting changes next to it, called by the executor.
+
+        :param abs_path: the absolute path of the file (string)
+        :param aside_path: the absolute path of the copy (string)
+        """
+
+        if not os.path.isfile(abs_path):
+            return
+
+        logging.info(f"Keeping the server's copy of {abs_path} as {aside_path}")
+
+        # received files are replaced by renames, so the copy can share the content
+        try:
+            os.link(abs_path, aside_path)
+        except OSError:
+            shutil.copy2(abs_path, aside_path)
+        self.written(aside_path)
+
+    def handle_created(self, frame):
         """
         Called when a 'created' event is received.
 
-        :param is_directory: True if event is for a directory and False otherwise (bool)
-        :param event_path: the message body is simply the path of the created folder/file (bytes)
+        :param frame: the message, its path is the path of the created folder/file (Frame)
         """
 
-        abs_path = f"{self.factory.sync_folder}{event_path[1:].decode('utf-8')}"
-        logging.info(f"Creating {'directory' if is_directory else 'file'} {abs_path}")
+        abs_path = self.abs_path(frame.path)
+        self.submit([abs_path], self.create_path, frame.is_directory, abs_path)
+
+    def create_path(self, is_directory, abs_path):
+        """
+        Create a folder/file, called by the executor.
+
+        :param is_directory: True if a folder must be created, False otherwise (bool)
+        :param abs_path: the absolute path to create (string)
+        """
+
+        event_log.info(f"Creating {'directory' if is_directory else 'file'} {abs_path}")
 
         if is_directory:
             # recursively create all the folders in the path
             os.makedirs(abs_path, exist_ok=True)
+            self.changed(abs_path, parents=True)
         else:
             # check if the file exists already
             if not os.path.exists(abs_path):
@@ -107,19 +682,27 @@ class SyncServerProtocol(LineReceiver):
 
                 # create the new file
                 os.mknod(abs_path)
+                self.written(abs_path, parents=True)
 
-    def handle_deleted(self, is_directory, event_path):
+    def handle_deleted(self, frame):
         """
         Called when a 'deleted' event is received.
 
-        :param is_directory: True if event is for a directory and False otherwise (bool)
-        :param event_path: the message body is simply the path of the deleted folder/file (bytes)
-        :return:
+        :param frame: the message, its path is the path of the deleted folder/file (Frame)
+        """
+
+        abs_path = self.abs_path(frame.path)
+        self.submit([abs_path], self.delete_path, frame.is_directory, abs_path)
+
+    def delete_path(self, is_directory, abs_path):
         """
+        Delete a folder/file, called by the executor.
 
-        # build up the absolute path to delete
-        abs_path = f"{self.factory.sync_folder}{event_path[1:].decode('utf-8')}"
-        logging.info(f"Deleting {'directory' if is_directory else 'file'} {abs_path}")
+        :param is_directory: True if a folder must be deleted, False otherwise (bool)
+        :param abs_path: the absolute path to delete (string)
+        """
+
+        event_log.info(f"Deleting {'directory' if is_directory else 'file'} {abs_path}")
 
         # if deleting a directory, do a recursive delete
         if is_directory:
@@ -128,62 +711,756 @@ class SyncServerProtocol(LineReceiver):
             # if deleting a file check that it exists first
             if os.path.exists(abs_path):
                 os.remove(abs_path)
+        self.changed(abs_path)
 
-    def handle_modified(self, is_directory, msg_body):
+    def handle_modified(self, frame):
         """
         Called when a 'modified' event is received.
 
-        :param is_directory: True if event is for a directory and False otherwise (bool)
-        :param msg_body: the body of the message, follows format '<event path>::<modified content>' (bytes)
-        :return:
+        :param frame: the message, its path is the path of the modified file and its payload the new content (Frame)
         """
 
-        if is_directory:
+        if frame.is_directory:
             return  # this shouldn't be received in the first place
 
-        # retrieve path and content
-        path, content = msg_body.split(b"::", 1)
+        abs_path = self.abs_path(frame.path)
+        self.submit([abs_path], self.write_file, abs_path, frame.payload, self.frame_decompressor(frame))
+
+    def write_file(self, abs_path, content, decompressor=None):
+        """
+        Write the full content of a file, called by the executor.
+
+        The content is written (decompressed piece by piece) to a temporary file renamed into place, so that neither a
+        corrupted payload nor a crash of the server leaves the file with partial content.
 
-        # build the absolute path to modify
-        abs_path = f"{self.factory.sync_folder}{path[1:].decode('utf-8')}"
-        logging.info(f"Modifying file {abs_path}")
+        :param abs_path: the absolute path of the file (string)
+        :param content: the new content (bytes)
+        :param decompressor: the decompressor of the content, None if it isn't compressed (PayloadDecompressor)
+        """
 
-        with open(abs_path, 'wb') as fh:
-            fh.write(content)
+        transfer = IncomingTransfer(abs_path, store=self.factory.store, commits=self.factory.commits)
+        transfer.write(content, decompressor)
+        transfer.commit()
 
-    def handle_moved(self, is_directory, msg_body):
+    def written(self, abs_path, size=0, parents=False):
+        """
+        Record a file written by a filesystem operation, if the changes are made durable - called by the executor.
+
+        :param abs_path: the absolute path of the file (string)
+        :param size: the bytes written (int)
+        :param parents: True if the folders above the file may have been created too (bool)
+        """
+
+        if self.factory.commits is not None:
+            self.factory.commits.written(abs_path, size, parents)
+
+    def changed(self, abs_path, parents=False):
+        """
+        Record a path created, deleted or renamed by a filesystem operation, if the changes are made durable - called
+        by the executor.
+
+        :param abs_path: the absolute path (string)
+        :param parents: True if the folders above the path may have been created too (bool)
+        """
+
+        if self.factory.commits is not None:
+            self.factory.commits.changed(abs_path, parents)
+
+    def handle_moved(self, frame):
         """
         Called when a 'moved' event is received.
 
-        :param is_directory: True if event is for a directory and False otherwise (bool)
-        :param msg_body: the body of the message, follows format '<source path>::<destination path>'
+        :param frame: the message, its path is the source path and its payload the destination path (Frame)
+        """
+
+        abs_src_path, abs_dest_path = self.abs_path(frame.path), self.abs_path(frame.payload)
+        self.submit([abs_src_path, abs_dest_path], self.move_path, frame.is_directory, abs_src_path, abs_dest_path)
+
+    def move_path(self, is_directory, abs_src_path, abs_dest_path):
         """
+        Move a folder/file, called by the executor.
 
-        src_path, dest_path = msg_body.decode("utf-8").split("::", 1)
-        # build up the absolute paths for the event
-        abs_src_path = f"{self.factory.sync_folder}{src_path[1:]}"
-        abs_dest_path = f"{self.factory.sync_folder}{dest_path[1:]}"
+        :param is_directory: True if a folder is moved, False otherwise (bool)
+        :param abs_src_path: the absolute source path (string)
+        :param abs_dest_path: the absolute destination path (string)
+        """
 
         # make sure the source path exists before trying to move it
         if os.path.exists(abs_src_path):
-            logging.info(f"Moving {'directory' if is_directory else 'file'} {abs_src_path} to {abs_dest_path}")
+            event_log.info(f"Moving {'directory' if is_directory else 'file'} {abs_src_path} to {abs_dest_path}")
             shutil.move(abs_src_path, abs_dest_path)
+            if self.factory.commits is not None:
+                self.factory.commits.moved(abs_src_path, abs_dest_path)
+
+    def handle_chunk(self, frame):
+        """
+        Called when a chunk of a streamed file is received.
+
+        The first chunk opens a temporary file next to the destination, the following chunks are appended to it and
+        the last chunk atomically renames it into place. A chunk flagged as aborting the transfer removes the temporary
+        file instead.
+
+        :param frame: the message, its path is the path of the modified file and its payload the chunk (Frame)
+        """
+
+        transfer = self.get_transfer(frame)
+        if transfer is None:
+            return
+
+        if frame.flags & FLAG_ABORT:
+            # the client dropped the file, e.g. it was truncated while it was sent - a new transfer follows
+            logging.info(f"Transfer of {frame.path} aborted by the client, discarding it")
+            del self.transfers[frame.path]
+            d = self.submit([transfer.abs_path], transfer.discard, tracked=False)
+            d.addBoth(self.stream_finished, frame.path)
+            return
+
+        self.submit([transfer.abs_path], transfer.write, frame.payload, self.frame_decompressor(frame), tracked=False)
+        self.finish_transfer(frame)
+
+    def handle_signature_request(self, frame):
+        """
+        Called when a client asks for the block signatures of a file before sending a delta.
+
+        :param frame: the message, its path is the path of the file (Frame)
+        """
+
+        self.stream_started(frame.path)
+        abs_path = self.abs_path(frame.path)
+        d = self.submit([abs_path], self.file_signature, abs_path, tracked=False)
+        d.addCallback(self.send_signature, frame.path)
+
+    def file_signature(self, abs_path):
+        """
+        Compute the signature of a file, called by the executor.
+
+        :param abs_path: the absolute path of the file (string)
+
+        :return: the encoded signature (bytes)
+        """
+
+        try:
+            with open(abs_path, "rb") as fh:
+                return compute_signature(fh, os.fstat(fh.fileno()).st_size)
+        except OSError:
+            return empty_signature()  # the client will send the full content as literal data
+
+    def send_signature(self, signature, event_path):
+        """
+        Send the computed signature of a file to the client.
+
+        :param signature: the encoded signature (bytes)
+        :param event_path: the relative path of the file (bytes)
+        """
+
+        if signature is not None and self.connected:
+            self.transport.write(encode_frame(MSG_SIGNATURE, 0, event_path, signature))
+
+    def handle_delta(self, frame):
+        """
+        Called when a part of a delta is received - the new content is rebuilt from the existing file and the delta
+        operations, the same way as streamed chunks.
+
+        :param frame: the message, its path is the path of the modified file and its payload the operations (Frame)
+        """
+
+        transfer = self.get_transfer(frame, delta=True)
+        if transfer is not None:
+            self.submit([transfer.abs_path], transfer.apply, frame.payload, self.frame_decompressor(frame),
+                        tracked=False)
+            self.finish_transfer(frame)
+
+    def handle_content_offer(self, frame):
+        """
+        Called when a client offers the hash of a file before sending its content - if the server already has the
+        content, the file is put in place from the content store and the client doesn't send it.
+
+        :param frame: the message, its path is the path of the file and its payload the hash and size (Frame)
+        """
+
+        try:
+            digest, size = decode_offer(frame.payload)
+        except ProtocolError as e:
+            logging.info(str(e))
+            self.send_content_reply(None, frame.path)
+            return
+
+        self.stream_started(frame.path)
+        abs_path = self.abs_path(frame.path)
+        d = self.submit([abs_path], self.offer_content, digest, size, abs_path, frame.path, tracked=False)
+        d.addCallback(self.send_content_reply, frame.path)
+
+    def offer_content(self, digest, size, abs_path, event_path):
+        """
+        Put an offered file in place from the content store, or prepare its transfer, called by the executor.
+
+        A big file is staged if its transfer can be resumed - unless there is nothing staged for it yet and the server
+        has a copy of the file, which the client sends a delta against instead.
+
+        :param digest: the hash of the content (bytes)
+        :param size: the size of the content (int)
+        :param abs_path: the absolute path of the file (string)
+        :param event_path: the relative path of the file (bytes)
+
+        :return: a tuple of two values - the payload of the reply and the staged transfer, if any (ResumableTransfer)
+        """
+
+        if self.factory.store.materialise(digest, size, abs_path):
+            self.written(abs_path, size, parents=True)
+            return CONTENT_MATERIALISED, None
+
+        if not self.resumable or size < RESUMABLE_MIN_SIZE:
+            return CONTENT_NEEDED, None
+
+        staging_path = self.factory.staging.staging_path(self.session.client_id, event_path, digest, size)
+        transfer = ResumableTransfer(abs_path, staging_path, digest, size, self.factory.store, self.factory.commits)
+        offset = transfer.prepare()
+        if offset == 0 and os.path.isfile(abs_path):
+            return CONTENT_NEEDED, None
+
+        return encode_resume(offset), transfer
+
+    def send_content_reply(self, reply, event_path):
+        """
+        Tell the client whether the content of a file must be sent, and from which offset.
+
+        :param reply: the payload of the reply and the staged transfer, None if the content must be sent (tuple)
+        :param event_path: the relative path of the file (bytes)
+        """
+
+        payload, transfer = reply or (CONTENT_NEEDED, None)
+
+        # the content follows as a streamed file otherwise
+        if payload == CONTENT_MATERIALISED:
+            self.stream_finished(None, event_path)
+
+        if transfer is not None:
+            if not self.connected:
+                self.submit([transfer.abs_path], transfer.suspend, tracked=False)
+                return
+
+            # the client continues the staged transfer, without starting a new one
+            previous = self.transfers.pop(event_path, None)
+            if previous is not None:
+                self.submit([previous.abs_path], previous.discard, tracked=False)
+            self.transfers[event_path] = transfer
+
+        if self.connected:
+            self.transport.write(encode_frame(MSG_CONTENT_REPLY, 0, event_path, payload))
+
+    def handle_tree_request(self, frame):
+        """
+        Called when a client asks for the listing of a directory while reconciling its folder with the server.
+
+        :param frame: the message, its path is the path of the directory and its payload the client's hash of it (Frame)
+        """
+
+        abs_path = self.abs_path(frame.path)
+        d = self.submit([abs_path], self.tree_listing, frame.path, frame.payload)
+        d.addCallback(self.send_listing, frame.path)
+
+    def tree_listing(self, event_path, client_digest):
+        """
+        Build the reply to a listing request, called by the executor - the manifest of the sync root is built again
+        when the client asks for the root directory, which starts a reconciliation.
+
+        :param event_path: the relative path of the directory (bytes)
+        :param client_digest: the client's hash of the directory (bytes)
+
+        :return: the hash of the directory, followed by its listing if the client's hash is different (bytes)
+        """
+
+        if event_path == b"." or self.manifest is None:
+            build = self.factory.scanner.build_manifest if self.factory.scanner is not None else build_manifest
+            self.manifest = build(self.session.sync_folder, self.factory.hash_cache, server_file)
+
+        directory = self.manifest.find(event_path.decode("utf-8"))
+        if directory is None:
+            directory = Directory()
+            directory.finish()
+
+        if directory.digest == client_digest:
+            return directory.digest
+
+        return directory.digest + encode_listing(directory.entries())
+
+    def send_listing(self, listing, event_path):
+        """
+        Send the reply to a listing request to the client.
+
+        :param listing: the reply, None if it couldn't be built (bytes)
+        :param event_path: the relative path of the directory (bytes)
+        """
+
+        if self.connected:
+            self.transport.write(encode_frame(MSG_TREE, 0, event_path, listing or b""))
+
+    def handle_ack_request(self, frame):
+        """
+        Called when a client asks for an acknowledgement of the operations it has sent so far - the acknowledgement is
+        sent once all of them have been applied.
+
+        :param frame: the message, its payload is the sequence number of the last operation sent (Frame)
+        """
+
+        # the messages of the last operation have been received
+        self.session.begin_operation(None)
+
+        # an operation on the sync root waits for all earlier operations below it
+        d = self.submit([self.session.sync_folder], self.barrier)
+        d.addCallback(lambda _: self.send_ack(frame.payload))
+
+    def handle_operation(self, frame):
+        """
+        Called when a client with a journal starts sending the messages of an operation.
+
+        :param frame: the message, its payload is the sequence number of the operation (Frame)
+        """
+
+        if len(frame.payload) != SEQUENCE.size:
+            logging.warning("Received an invalid operation message, closing connection")
+            self.transport.loseConnection()
+            return
+
+        self.session.begin_operation(SEQUENCE.unpack(frame.payload)[0])
+
+    def handle_batch(self, frame):
+        """
+        Called when a batch of messages is received - consecutive filesystem operations are applied together by a
+        single executor operation, the other messages are handled as if they had been received on their own.
+
+        :param frame: the message, its payload is the encoded messages (Frame)
+        """
+
+        try:
+            entries = decode_batch(frame.payload)
+        except ProtocolError as e:
+            logging.warning(f"Protocol violation, closing connection - {e}")
+            self.transport.loseConnection()
+            return
+
+        operations = []
+        seqs = []  # the operations of the client the filesystem operations belong to, one per filesystem operation
+        paths = set()  # the paths of the operations
+        for entry in entries:
+            if entry.flags & FLAG_COMPRESSED and self.decompressor is None:
+                logging.warning("Received a compressed payload without a negotiated codec, closing connection")
+                self.transport.loseConnection()
+                return
+
+            if not self.check_paths(entry):
+                continue
+
+            if entry.msg_type in BATCH_OPERATIONS:
+                if entry.msg_type in VERSIONED and self.factory.versions is not None:
+                    # a conflict keeps the file aside before the operation is applied, after the earlier ones
+                    if entry.path in paths:
+                        self.submit_batch(operations, seqs)
+                        operations, seqs, paths = [], [], set()
+                    if not self.check_version(entry):
+                        continue
+
+                operations.append(entry)
+                paths.add(entry.path)
+                seq = self.session.operation_submitted()
+                if seq is not None:
+                    seqs.append(seq)
+
+            elif entry.msg_type in (MSG_OPERATION, MSG_ACK_REQUEST, MSG_VERSION):
+                # an acknowledgement is sent once the operations before it have been applied
+                if entry.msg_type == MSG_ACK_REQUEST:
+                    self.submit_batch(operations, seqs)
+                    operations, seqs, paths = [], [], set()
+
+                self.handlers[entry.msg_type](entry)
+
+            else:
+                logging.warning(f"Received message type {entry.msg_type} in a batch, closing connection")
+                self.transport.loseConnection()
+                return
+
+        self.submit_batch(operations, seqs)
+
+    def submit_batch(self, operations, seqs):
+        """
+        Hand the filesystem operations of a batch over to the executor, as a single operation.
+
+        :param operations: the messages of the operations (list of Frame)
+        :param seqs: the operations of the client they belong to (list of int)
+        """
+
+        if not operations:
+            return
+
+        abs_paths = []
+        for operation in operations:
+            abs_paths.append(self.abs_path(operation.path))
+            if operation.msg_type == MSG_MOVED:
+                abs_paths.append(self.abs_path(operation.payload))
+
+        d = self.submit(abs_paths, self.apply_batch, operations)
+        for seq in seqs:
+            d.addBoth(self.operation_applied, seq)
+
+    def apply_batch(self, operations):
+        """
+        Apply the filesystem operations of a batch in a single pass, called by the executor.
+
+        Consecutive creations and uploads are grouped - the directories are created first, parents before children,
+        then the files are written in the order of their paths, so that the files of a directory are written together,
+        and files whose content follows are not created empty first.
+        Deletions and moves are applied in between, in the order they were received. A failed operation doesn't stop
+        the rest of the batch.
+
+        :param operations: the messages of the operations (list of Frame)
+        """
+
+        start = time.monotonic()
+        created = set()  # directories known to exist
+        group = []
+        for operation in operations + [None]:
+            if operation is not None and operation.msg_type in (MSG_CREATED, MSG_MODIFIED):
+                group.append(operation)
+                continue
+
+            self.apply_group(group, created)
+            group = []
+            if operation is None:
+                break
+
+            abs_path = self.abs_path(operation.path)
+            try:
+                if operation.msg_type == MSG_DELETED:
+                    self.delete_path(operation.is_directory, abs_path)
+                else:
+                    self.move_path(operation.is_directory, abs_path, self.abs_path(operation.payload))
+            except OSError as e:
+                logging.warning(f"Failed to apply {EVENT_NAMES[operation.msg_type]} {abs_path} - {e}")
+
+            # the directories which were known to exist may have been deleted or moved
+            created.clear()
+
+        logging.info(f"Applied a batch of {len(operations)} operations in {time.monotonic() - start:.3f} seconds")
+
+    def apply_group(self, group, created):
+        """
+        Apply a group of creations and uploads of a batch, called by the executor.
+
+        :param group: the messages of the operations, in the order they were received (list of Frame)
+        :param created: the directories known to exist, updated with the created directories (set of strings)
+        """
+
+        directories = sorted(self.abs_path(operation.path) for operation in group if operation.is_directory)
+        files = sorted((operation for operation in group if not operation.is_directory),
+                       key=lambda operation: operation.path)  # a stable sort keeps the order of writes to a file
+
+        # a new file whose content is in the group doesn't have to be created empty first
+        uploaded = {operation.path for operation in files if operation.msg_type == MSG_MODIFIED}
+
+        for abs_path in directories:
+            if abs_path not in created:
+                try:
+                    os.makedirs(abs_path, exist_ok=True)
+                    self.changed(abs_path, parents=True)
+                    created.add(abs_path)
+                except OSError as e:
+                    logging.warning(f"Failed to create directory {abs_path} - {e}")
+
+        for operation in files:
+            abs_path = self.abs_path(operation.path)
+            base_folder = os.path.dirname(abs_path)
+            try:
+                if base_folder not in created:
+                    os.makedirs(base_folder, exist_ok=True)
+                    created.add(base_folder)
+
+                if operation.msg_type == MSG_MODIFIED:
+                    self.write_file(abs_path, operation.payload, self.frame_decompressor(operation))
+                elif operation.path not in uploaded and not os.path.exists(abs_path):
+                    os.mknod(abs_path)
+                    self.written(abs_path, parents=True)
+            except OSError as e:
+                logging.warning(f"Failed to apply {EVENT_NAMES[operation.msg_type]} {abs_path} - {e}")
+
+    def barrier(self):
+        """
+        Nothing to apply, called by the executor once all earlier operations of the client have been applied.
+        """
+
+    def send_ack(self, seq):
+        """
+        Acknowledge the operations of the client.
+
+        :param seq: the encoded sequence number of the last applied operation (bytes)
+        """
+
+        self.pending_acks.append(seq)
+        self.send_pending_acks()
+
+    def send_pending_acks(self):
+        """
+        Send the acknowledgements whose operations have all been applied - an operation whose file is still being
+        streamed holds back the acknowledgements of the later operations, which were sent in the meantime.
+        """
+
+        while self.pending_acks:
+            seq = self.pending_acks[0]
+            if len(seq) == SEQUENCE.size and not self.session.operations_applied(SEQUENCE.unpack(seq)[0]):
+                return
+
+            self.pending_acks.popleft()
+            if self.factory.commits is None:
+                self.write_ack(seq)
+            else:
+                # the operations are acknowledged once their changes are durable
+                d = self.factory.commits.wait()
+                d.addCallbacks(lambda _, seq=seq: self.write_ack(seq), self.commit_failed)
+
+    def write_ack(self, seq):
+        """
+        :param seq: the encoded sequence number of the last applied operation (bytes)
+        """
+
+        if self.connected:
+            self.transport.write(encode_frame(MSG_ACK, 0, b"", seq))
+
+    def commit_failed(self, failure):
+        """
+        Called when the changes of operations waiting for an acknowledgement couldn't be made durable - the connection is
+        closed, so that the client sends the operations again.
+
+        :param failure: the failure of the group commit
+        """
+
+        if self.connected:
+            logging.warning(f"Closing connection with {self.transport.getPeer().host}, its operations are not durable")
+            self.transport.loseConnection()
+
+    def get_transfer(self, frame, delta=False):
+        """
+        Get the transfer a chunk/delta message belongs to, a new transfer is started by the first message.
+
+        :param frame: the received message (Frame)
+        :param delta: True if the transfer is a delta against the existing file (bool)
+
+        :return: the transfer or None if there is no transfer in progress (IncomingTransfer)
+        """
+
+        if frame.flags & FLAG_FIRST:
+            if frame.path in self.transfers:
+                logging.info(f"Restarting transfer of {frame.path}")
+                transfer = self.transfers.pop(frame.path)
+                self.submit([transfer.abs_path], transfer.discard, tracked=False)
+
+            self.stream_started(frame.path)
+            self.transfers[frame.path] = IncomingTransfer(self.abs_path(frame.path), delta, self.factory.store,
+                                                          self.factory.commits)
+
+        transfer = self.transfers.get(frame.path)
+        if transfer is None:
+            logging.info(f"Received a chunk for {frame.path} without a transfer in progress")
+
+        return transfer
+
+    def finish_transfer(self, frame):
+        """
+        Rename the received file into place if this was the last message of the transfer.
+
+        :param frame: the received message (Frame)
+        """
+
+        if frame.flags & FLAG_LAST:
+            self.checked.discard(frame.path)
+            transfer = self.transfers.pop(frame.path)
+            d = self.submit([transfer.abs_path], transfer.commit, tracked=False)
+            d.addBoth(self.stream_finished, frame.path)
+
+
+def server_file(relative_path, is_directory):
+    """
+    :param relative_path: the path of a file/folder relative to the sync folder (string)
+    :param is_directory: True if the path is a folder (bool)
+
+    :return: True if the file/folder is used by the server itself and must not be reconciled (bool)
+    """
+
+    name = os.path.basename(relative_path)
+    return name in (STORE_FOLDER, RESUME_FILE) or name.endswith(TEMP_SUFFIX)
 
 
 class SyncFactory(Factory):
     """
     Protocol factory used to build protocol objects when a new connection is made.
+
+    In the 'single' mode only one client is served at a time and any other connection is aborted. In the 'multi' mode
+    up to max_connections clients are served at the same time - all of them share the sync folder, or each of them gets
+    its own sync root inside it (named after the client id or the root requested in the hello message). The filesystem
+    operations of all clients go through the same executor, which takes turns between the clients. Received files are
+    added to a content store shared by all clients, see server_pkg.store.
+
+    If the factory watches the sync folder, the version vectors of its files are kept in a version store and its
+    changes are pushed to the clients asking for them - except to the client a change was made for, which is told apart
+    from the events of the change by an echo filter, unless the change resolves a conflict. Changes made by anyone else
+    (e.g. a program on the server) increment the server's count in the version of the file.
+
+    With a commit interval, the changes applied for the clients are made durable in group commits and an operation is
+    only acknowledged (and its client's resume point only moves past it) once its changes are, see GroupCommit.
     """
 
-    def __init__(self, sync_folder_path):
+    def __init__(self, sync_folder_path, workers=0, mode="single", max_connections=MAX_CONNECTIONS,
+                 client_roots=False, watch=False, conflict_policy=KEEP_BOTH, scan_workers=0, commit_interval=None):
         """
         Initialise the factory.
 
         :param sync_folder_path: the path of the folder to synchronise
+        :param workers: the number of threads applying filesystem operations, 0 to apply them in the reactor thread
+        :param mode: 'single' to serve one client at a time or 'multi' to serve many clients (string)
+        :param max_connections: the number of clients served at the same time in the multi-client mode (int)
+        :param client_roots: True if each client gets its own sync root inside the sync folder (bool)
+        :param watch: True if the sync folder is watched and its changes are pushed to the clients (bool)
+        :param conflict_policy: 'keep-both' or 'overwrite', how concurrent changes of a file are resolved (string)
+        :param scan_workers: the number of threads stating and hashing files when a client reconciles its folder, 0 to
+                             scan the folder in a single thread (int)
+        :param commit_interval: the seconds the applied changes wait for others to be synced to disk with, None to never
+                                sync them (float)
         """
 
+        if mode not in ("single", "multi"):
+            raise ValueError(f"Unknown server mode - {mode}")
+        if conflict_policy not in CONFLICT_POLICIES:
+            raise ValueError(f"Unknown conflict policy - {conflict_policy}")
+
         self.sync_folder = sync_folder_path
+        self.mode = mode
+        self.max_connections = max_connections
+        self.client_roots = client_roots
+
         self.connection_made = False  # a flag if a connection with a client has been made
+        self.connections = 0  # the number of accepted connections
+        self.clients = {}  # client id -> protocol of the connected client
+        self.executor = PathExecutor(workers)
+        self.commits = GroupCommit(self.executor, sync_folder_path, commit_interval) \
+            if commit_interval is not None else None
+        self.store = ContentStore(sync_folder_path)
+        self.staging = StagingArea(self.store.root)  # partially received files, see ResumableTransfer
+        self.hash_cache = HashCache()  # content hashes of the synchronised files, kept between reconciliations
+        self.scanner = ScanPool(scan_workers) if scan_workers else None
+        self.store_gc = LoopingCall(self.collect_garbage)
+
+        # the sync folder is watched once the server starts listening
+        self.watch = watch
+        self.conflict_policy = conflict_policy
+        self.versions = VersionStore(sync_folder_path, self.store.root) if watch else None
+        self.echo = EchoFilter()
+        self.observer = None
+        self.conflicts = 0
+
+        # client id -> the sequence number of the last applied operation of the client, see ClientSession
+        self.resume_path = os.path.join(sync_folder_path, RESUME_FILE)
+        self.resume_points = {}
+        self.saved_resume_points = {}
+        self.resume_save = LoopingCall(self.save_resume_points)
+
+        REGISTRY.gauge("syncapp_server_connected_clients", "Clients connected", lambda: self.connections)
+        REGISTRY.gauge("syncapp_server_executor_depth", "Filesystem operations submitted but not applied yet",
+                       lambda: self.executor.depth)
+        if self.commits is not None:
+            REGISTRY.gauge("syncapp_server_commit_waiting", "Acknowledgements waiting for the next group commit",
+                           lambda: len(self.commits.waiting))
+
+    def startFactory(self):
+        """
+        Called when the server starts listening - loads the resume points of the clients and schedules the garbage
+        collection of the content store.
+        """
+
+        self.resume_points = self.load_resume_points()
+        self.saved_resume_points = dict(self.resume_points)
+
+        self.store_gc.start(STORE_GC_INTERVAL, now=False)
+        self.resume_save.start(RESUME_SAVE_INTERVAL, now=False)
+
+        if self.watch:
+            logging.info(f"Watching {self.sync_folder}, its changes are pushed to the clients")
+            self.observer = Observer()
+            self.observer.schedule(ServerEventHandler(self, server_file), self.sync_folder, recursive=True)
+            self.observer.start()
+
+    def stopFactory(self):
+        """
+        Called when the server stops listening.
+        """
+
+        if self.store_gc.running:
+            self.store_gc.stop()
+
+        if self.resume_save.running:
+            self.resume_save.stop()
+            self.write_resume_points(dict(self.resume_points))
+
+        if self.observer is not None:
+            self.observer.stop()
+            self.observer.join()
+            self.observer = None
+            logging.info(f"Stopped watching {self.sync_folder} - {self.conflicts} conflicts, "
+                         f"{self.echo.echoes} echoes of the changes of the clients")
+
+        if self.versions is not None:
+            self.versions.commit()
+
+        if self.commits is not None:
+            logging.info(f"Group commit stats - {self.commits.stats()}")
+
+    def load_resume_points(self):
+        """
+        :return: the resume points saved by an earlier run of the server (dict client id -> sequence number)
+        """
+
+        try:
+            with open(self.resume_path) as fh:
+                return {str(client_id): int(seq) for client_id, seq in json.load(fh).items()}
+        except FileNotFoundError:
+            return {}
+        except (ValueError, AttributeError, OSError) as e:
+            logging.warning(f"Ignoring invalid resume points in {self.resume_path} - {e}")
+            return {}
+
+    def save_resume_points(self):
+        """
+        Save the resume points if they have changed, the file is written by the executor.
+        """
+
+        if self.resume_points == self.saved_resume_points:
+            return
+
+        self.saved_resume_points = dict(self.resume_points)
+        d = self.executor.submit([self.resume_path], self.write_resume_points, self.saved_resume_points)
+        d.addErrback(lambda failure: logging.warning(f"Saving resume points failed - {failure.getErrorMessage()}"))
+
+    def write_resume_points(self, resume_points):
+        """
+        Write the resume points to disk, atomically.
+
+        :param resume_points: client id -> sequence number (dict)
+        """
+
+        temp_path = f"{self.resume_path}{TEMP_SUFFIX}"
+        with open(temp_path, "w") as fh:
+            json.dump(resume_points, fh)
+        os.replace(temp_path, self.resume_path)
+
+        if self.commits is not None:
+            self.commits.written(self.resume_path)
+
+    def collect_garbage(self):
+        """
+        Remove the unused blobs of the content store and the expired staged files, the store is scanned by the
+        executor.
+        """
+
+        for collect in (self.store.collect, self.staging.collect):
+            d = self.executor.submit([self.store.root], collect)
+            d.addErrback(lambda failure: logging.warning(f"Garbage collection failed - {failure.getErrorMessage()}"))
 
     def buildProtocol(self, addr):
         """
@@ -194,25 +1471,148 @@ class SyncFactory(Factory):
         :return: new protocol object
         """
 
-        proto = SyncServerProtocol(self, abort=self.connection_made)
-        
-        if not self.connection_made:
+        if self.mode == "single":
+            proto = SyncServerProtocol(self, abort=self.connection_made)
             self.connection_made = True
+        else:
+            proto = SyncServerProtocol(self, abort=self.connections >= self.max_connections)
 
         return proto
 
+    def register(self, protocol, client_id, root=None, legacy=False):
+        """
+        Called when a client has introduced itself - maps it to its sync root.
+
+        A client connecting again with the same id replaces its previous connection, which is most likely dead.
+
+        :param protocol: the protocol of the client (SyncServerProtocol)
+        :param client_id: the identifier of the client (string)
+        :param root: the name of the requested sync root, None to use the client id (string)
+        :param legacy: True if the client uses the legacy line based protocol (bool)
+
+        :return: the state of the client (ClientSession)
+        """
+
+        if self.client_roots:
+            sync_folder = root_folder(self.sync_folder, root or client_id)
+        else:
+            sync_folder = self.sync_folder
+
+        previous = self.clients.get(client_id)
+        if previous is not None and previous is not protocol:
+            logging.warning(f"Client {client_id} connected again, dropping its previous connection")
+            previous.transport.abortConnection()
+
+        self.clients[client_id] = protocol
+
+        applied = self.resume_points.get(client_id, 0)
+        return ClientSession(client_id, sync_folder, legacy, applied, lambda seq: self.operations_applied(client_id, seq))
+
+    def operations_applied(self, client_id, seq):
+        """
+        Called when the operations of a client have been applied - its resume point moves past them once they are
+        durable.
+
+        :param client_id: the identifier of the client (string)
+        :param seq: the sequence number of the last applied operation (int)
+        """
+
+        if self.commits is None:
+            self.resume_points[client_id] = seq
+            return
+
+        d = self.commits.wait()
+        d.addCallbacks(lambda _: self.resume_points.__setitem__(client_id, seq), lambda failure: None)
+
+    def local_change(self, kind, is_directory, abs_path, dest_path=None):
+        """
+        Called in the reactor thread when the sync folder changes - the change is pushed to the clients whose sync root
+        it's in, but the client it was made for.
+
+        :param kind: 'created', 'modified', 'deleted' or 'moved' (string)
+        :param is_directory: True if the change is made to a folder (bool)
+        :param abs_path: the absolute path of the changed file/folder (string)
+        :param dest_path: the absolute destination path of a move (string)
+        """
+
+        echo = self.echo.match(abs_path)
+        if echo is None and dest_path is not None:
+            echo = self.echo.match(dest_path)
+
+        # the versions of the changes of the clients are recorded when they are received
+        if echo is None:
+            event_log.info(f"Local change - {kind} - {abs_path}")
+            if kind == "moved":
+                self.versions.move(abs_path, dest_path)
+            elif not is_directory:
+                self.versions.put(abs_path, increment(self.versions.get(abs_path), SERVER_REPLICA))
+
+        for protocol in list(self.clients.values()):
+            if echo is None or protocol.session is not echo.origin or echo.shared:
+                self.push_to(protocol, kind, abs_path, dest_path, is_directory)
+
+    def push_to(self, protocol, kind, abs_path, dest_path=None, is_directory=False):
+        """
+        Push a change of the sync folder to a client, if it asked for the changes and the change is in its sync root.
+
+        :param protocol: the protocol of the client (SyncServerProtocol)
+        :param kind: 'created', 'modified', 'deleted' or 'moved' - a modified file which doesn't exist anymore is pushed
+                     as deleted (string)
+        :param abs_path: the absolute path of the changed file/folder (string)
+        :param dest_path: the absolute destination path of a move (string)
+        :param is_directory: True if the change is made to a folder (bool)
+        """
+
+        if protocol.push is None or not protocol.connected:
+            return
+
+        prefix = protocol.session.sync_folder + os.sep
+        if kind == "moved" and not dest_path.startswith(prefix):
+            kind = "deleted"  # moved out of the sync root
+        elif kind == "moved" and not abs_path.startswith(prefix):
+            kind, abs_path = "created" if is_directory else "modified", dest_path  # moved into the sync root
+
+        if not abs_path.startswith(prefix):
+            return
+
+        if kind == "modified" and not os.path.lexists(abs_path):
+            kind = "deleted"
+        protocol.push.put(kind, is_directory, abs_path, dest_path)
+
+    def unregister(self, protocol):
+        """
+        Called when the connection with an identified client is lost.
+
+        :param protocol: the protocol of the client (SyncServerProtocol)
+        """
+
+        if self.clients.get(protocol.session.client_id) is protocol:
+            del self.clients[protocol.session.client_id]
+
 
-def create_server(sync_folder_path, port=9876):
+def create_server(sync_folder_path, port=9876, workers=WORKERS, mode="multi", max_connections=MAX_CONNECTIONS,
+                  client_roots=False, watch=False, conflict_policy=KEEP_BOTH, scan_workers=SCAN_WORKERS,
+                  commit_interval=None):
     """
     A function used to initialise the server TCP endpoint.
 
     :param sync_folder_path: folder to synchronise (string)
     :param port: port number (int) defaults to 9876
+    :param workers: the number of threads applying filesystem operations (int)
+    :param mode: 'single' to serve one client at a time or 'multi' to serve many clients (string)
+    :param max_connections: the number of clients served at the same time in the multi-client mode (int)
+    :param client_roots: True if each client gets its own sync root inside the sync folder (bool)
+    :param watch: True if the sync folder is watched and its changes are pushed to the clients (bool)
+    :param conflict_policy: 'keep-both' or 'overwrite', how concurrent changes of a file are resolved (string)
+    :param scan_workers: the number of threads stating and hashing files when a client reconciles its folder (int)
+    :param commit_interval: the seconds the applied changes wait for others to be synced to disk with, None to never
+                            sync them (float)
 
     :return: a reference to twisted's reactor
     """
 
     endpoint = TCP4ServerEndpoint(reactor, port)
-    endpoint.listen(SyncFactory(sync_folder_path))
+    endpoint.listen(SyncFactory(sync_folder_path, workers, mode, max_connections, client_roots, watch, conflict_policy,
+                                scan_workers, commit_interval))
 
     return reactor
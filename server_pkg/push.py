@@ -0,0 +1,307 @@
+import logging
+import os
+import stat
+from collections import deque
+from zope.interface import implementer
+from twisted.internet import reactor
+from twisted.internet.interfaces import IPushProducer
+from watchdog.events import FileSystemEventHandler
+from common_pkg.framing import encode_header, MSG_CREATED, MSG_DELETED, MSG_MOVED, MSG_CHUNK, MSG_VERSION, \
+    FLAG_DIRECTORY, FLAG_FIRST, FLAG_LAST
+from common_pkg.versions import encode_vector
+
+
+# the size of the file chunks pushed to the clients
+CHUNK_SIZE = 256 * 1024
+
+# the number of chunks written in one reactor iteration, so that other events are not starved by a big file
+CHUNKS_PER_ITERATION = 16
+
+
+class ServerEventHandler(FileSystemEventHandler):
+    """
+    Watches the sync folder of the server and hands its changes over to the factory, in the reactor thread - the files
+    used by the server itself (see server_pkg.protocol.server_file) are left out at any depth.
+
+    A file replaced by renaming a temporary file over it (e.g. a file received from a client) is reported as modified.
+    """
+
+    def __init__(self, factory, server_file):
+        """
+        Initialise the event handler.
+
+        :param factory: the factory the changes are handed over to (SyncFactory)
+        :param server_file: called with a relative path and True if it's a folder, returns True if the path is used by the
+                            server itself
+        """
+
+        self.factory = factory
+        self.server_file = server_file
+
+    def internal(self, abs_path):
+        """
+        :param abs_path: the absolute path of an event (string)
+
+        :return: True if the path is, or is below, a file/folder used by the server itself (bool)
+        """
+
+        relative_path = abs_path[len(self.factory.sync_folder):]
+        return any(self.server_file(name, False) for name in relative_path.split(os.sep) if name)
+
+    def change(self, kind, is_directory, abs_path, dest_path=None):
+        """
+        Hand a change over to the factory.
+
+        :param kind: 'created', 'modified', 'deleted' or 'moved' (string)
+        :param is_directory: True if the change is made to a folder (bool)
+        :param abs_path: the absolute path of the changed file/folder (string)
+        :param dest_path: the absolute destination path of a move (string)
+        """
+
+        reactor.callFromThread(self.factory.local_change, kind, is_directory, abs_path, dest_path)
+
+    def on_created(self, event):
+        """
+        :param event: reference to the watchdog event object
+        """
+
+        if not self.internal(event.src_path):
+            self.change("created" if event.is_directory else "modified", event.is_directory, event.src_path)
+
+    def on_deleted(self, event):
+        """
+        :param event: reference to the watchdog event object
+        """
+
+        if not self.internal(event.src_path):
+            self.change("deleted", event.is_directory, event.src_path)
+
+    def on_modified(self, event):
+        """
+        :param event: reference to the watchdog event object
+        """
+
+        # modified events of folders only mean that something inside them has changed
+        if not event.is_directory and not self.internal(event.src_path):
+            self.change("modified", False, event.src_path)
+
+    def on_moved(self, event):
+        """
+        :param event: reference to the watchdog event object
+        """
+
+        source_internal, destination_internal = self.internal(event.src_path), self.internal(event.dest_path)
+        if source_internal and not destination_internal:
+            self.change("created" if event.is_directory else "modified", event.is_directory, event.dest_path)
+        elif destination_internal and not source_internal:
+            self.change("deleted", event.is_directory, event.src_path)
+        elif not source_internal:
+            self.change("moved", event.is_directory, event.src_path, event.dest_path)
+
+
+@implementer(IPushProducer)
+class PushQueue:
+    """
+    A streaming producer registered with the transport of a client - pushes the changes of the sync folder to the
+    client, in order.
+
+    Files are streamed in chunks, read when their turn comes, so a file changed several times while it was waiting is
+    only sent once, with its latest content. Every upload, deletion and move of a file is preceded by the version of the
+    server's copy, and the deletion of a folder by the versions of the files below it, read when they're sent too.
+    """
+
+    def __init__(self, protocol, versions, chunk_size=CHUNK_SIZE, clock=reactor):
+        """
+        Initialise the queue.
+
+        :param protocol: the protocol of the client (SyncServerProtocol)
+        :param versions: the versions of the files (VersionStore)
+        :param chunk_size: the size of the file chunks (int)
+        :param clock: the reactor used to schedule the sending of the queued changes
+        """
+
+        self.protocol = protocol
+        self.versions = versions
+        self.chunk_size = chunk_size
+        self.clock = clock
+
+        self.items = deque()  # (kind, True if a folder, absolute path, absolute destination path) tuples
+        self.queued = set()  # absolute paths of the files whose content is waiting to be sent
+        self.current = None  # the file being sent - (event path, file object, remaining bytes, first chunk) list
+        self.paused = False
+        self.scheduled = None
+
+        # metrics
+        self.pushed = 0
+        self.pushed_bytes = 0
+
+    def put(self, kind, is_directory, abs_path, dest_path=None):
+        """
+        Queue a change of the sync folder.
+
+        :param kind: 'created', 'modified', 'deleted' or 'moved' (string)
+        :param is_directory: True if the change is made to a folder (bool)
+        :param abs_path: the absolute path of the changed file/folder (string)
+        :param dest_path: the absolute destination path of a move (string)
+        """
+
+        if kind == "modified":
+            if abs_path in self.queued:
+                return
+            self.queued.add(abs_path)
+
+        self.items.append((kind, is_directory, abs_path, dest_path))
+        self.schedule()
+
+    def schedule(self):
+        """
+        Send the queued changes in a later reactor iteration.
+        """
+
+        if self.scheduled is None and not self.paused and (self.items or self.current is not None):
+            self.scheduled = self.clock.callLater(0, self.pump)
+
+    def pump(self):
+        """
+        Send the queued changes, a bounded number of chunks at a time.
+        """
+
+        self.scheduled = None
+        written = 0
+        while not self.paused and written < CHUNKS_PER_ITERATION and (self.items or self.current is not None):
+            if self.current is None:
+                self.start(*self.items.popleft())
+            else:
+                self.send_chunk()
+            written += 1
+
+        self.schedule()
+
+    def write(self, msg_type, flags, event_path, payload=b""):
+        """
+        Write a message to the client.
+
+        :param msg_type: the type of the message (int)
+        :param flags: the flags of the message (int)
+        :param event_path: the relative path of the message (bytes)
+        :param payload: the payload of the message (bytes)
+        """
+
+        self.protocol.transport.writeSequence([encode_header(msg_type, flags, len(event_path), len(payload)),
+                                               event_path, payload])
+        self.pushed_bytes += len(payload)
+
+    def write_version(self, abs_path, event_path):
+        """
+        :param abs_path: the absolute path of a file (string)
+        :param event_path: the relative path of the file (bytes)
+        """
+
+        self.write(MSG_VERSION, 0, event_path, encode_vector(self.versions.get(abs_path)))
+
+    def start(self, kind, is_directory, abs_path, dest_path):
+        """
+        Start sending a queued change.
+
+        :param kind: 'created', 'modified', 'deleted' or 'moved' (string)
+        :param is_directory: True if the change is made to a folder (bool)
+        :param abs_path: the absolute path of the changed file/folder (string)
+        :param dest_path: the absolute destination path of a move (string)
+        """
+
+        event_path = self.protocol.event_path(abs_path)
+        flags = FLAG_DIRECTORY if is_directory else 0
+        self.pushed += 1
+
+        if kind == "created":
+            self.write(MSG_CREATED, flags, event_path)
+
+        elif kind == "deleted":
+            # the client keeps the files below a deleted folder which have changes the server hasn't seen
+            for file_path in self.versions.below(abs_path) if is_directory else [abs_path]:
+                self.write_version(file_path, self.protocol.event_path(file_path))
+            self.write(MSG_DELETED, flags, event_path)
+
+        elif kind == "moved":
+            # ... and a copy of a file replaced by a move, if it has changes the server hasn't seen
+            dest_event_path = self.protocol.event_path(dest_path)
+            if not is_directory:
+                self.write_version(dest_path, dest_event_path)
+            self.write(MSG_MOVED, flags, event_path, dest_event_path)
+
+        else:
+            self.queued.discard(abs_path)
+            try:
+                fh = open(abs_path, "rb")
+            except OSError:
+                return  # deleted in the meantime, the deletion follows
+
+            file_stat = os.fstat(fh.fileno())
+            if not stat.S_ISREG(file_stat.st_mode):
+                fh.close()
+                return
+
+            self.write_version(abs_path, event_path)
+            self.current = [event_path, fh, file_stat.st_size, True]
+
+    def send_chunk(self):
+        """
+        Send the next chunk of the file being sent - a file changing while it's sent is cut at its size when it was
+        opened, its modified event sends it again.
+        """
+
+        event_path, fh, remaining, first = self.current
+        try:
+            data = fh.read(min(self.chunk_size, remaining))
+        except OSError as e:
+            logging.warning(f"Failed to read {fh.name} while pushing it - {e}")
+            data = b""
+
+        remaining = remaining - len(data) if data else 0
+        flags = (FLAG_FIRST if first else 0) | (FLAG_LAST if not remaining else 0)
+        self.write(MSG_CHUNK, flags, event_path, data)
+
+        if remaining:
+            self.current[2:] = [remaining, False]
+        else:
+            fh.close()
+            self.current = None
+
+    def pauseProducing(self):
+        """
+        Called by the transport when its send buffer is full.
+        """
+
+        self.paused = True
+
+    def resumeProducing(self):
+        """
+        Called by the transport when its send buffer has been drained.
+        """
+
+        self.paused = False
+        self.schedule()
+
+    def stopProducing(self):
+        """
+        Called by the transport when the connection is lost.
+        """
+
+        self.paused = True
+        if self.scheduled is not None and self.scheduled.active():
+            self.scheduled.cancel()
+        self.scheduled = None
+
+        if self.current is not None:
+            self.current[1].close()
+            self.current = None
+
+        self.items.clear()
+        self.queued.clear()
+
+    def stats(self):
+        """
+        :return: the counters of the queue (dict)
+        """
+
+        return dict(pushed=self.pushed, pushed_bytes=self.pushed_bytes, queued=len(self.items))
@@ -1,20 +1,69 @@
-import sys
+import argparse
 import logging
-from server_pkg.protocol import create_server
+import sys
+from common_pkg.engine import ENGINES, TWISTED, engine_argument, install_engine
 
+# the engine is installed before the modules using the reactor are imported
+install_engine(engine_argument(sys.argv[1:]))
+
+from common_pkg.logs import configure_logging, LOG_SAMPLE
+from common_pkg.metrics import listen_metrics, start_stats_dump, STATS_INTERVAL
+from server_pkg.durability import COMMIT_INTERVAL
+from server_pkg.executor import WORKERS
+from server_pkg.protocol import create_server, MAX_CONNECTIONS, CONFLICT_POLICIES, KEEP_BOTH, SCAN_WORKERS
 
-# configure root logger with basic configuration
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(thread)d - %(threadName)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
 
 if __name__ == "__main__":
 
-    assert len(sys.argv) == 2, "Expecting two arguments: python3 server.py <folder to synchronize>"
+    parser = argparse.ArgumentParser(description="Synchronise a folder with clients.")
+    parser.add_argument("path", help="folder to synchronize")
+    parser.add_argument("--port", type=int, default=9876, help="port to listen on")
+    parser.add_argument("--workers", type=int, default=WORKERS,
+                        help="threads applying filesystem operations, 0 to apply them in the reactor thread")
+    parser.add_argument("--single", action="store_true", help="serve only one client at a time")
+    parser.add_argument("--max-connections", type=int, default=MAX_CONNECTIONS,
+                        help="number of clients served at the same time")
+    parser.add_argument("--client-roots", action="store_true",
+                        help="give each client its own sync root inside the folder instead of sharing it")
+    parser.add_argument("--watch", action="store_true",
+                        help="watch the folder and push its changes to the clients asking for them (bidirectional sync)")
+    parser.add_argument("--conflicts", choices=CONFLICT_POLICIES, default=KEEP_BOTH,
+                        help="how concurrent changes of a file are resolved - keep the server's copy under a suffixed "
+                             "name or let the last change received win")
+    parser.add_argument("--scan-workers", type=int, default=SCAN_WORKERS,
+                        help="threads stating and hashing files when a client reconciles its folder, 0 to use a single "
+                             "thread")
+    parser.add_argument("--durable", action="store_true",
+                        help="sync the changes to disk in group commits and only acknowledge the operations of the "
+                             "clients once they are durable")
+    parser.add_argument("--commit-interval", type=float, default=COMMIT_INTERVAL * 1000,
+                        help="with --durable, milliseconds a change waits for others to be synced with - longer "
+                             "intervals mean fewer syncs and slower acknowledgements")
+    parser.add_argument("--metrics-port", type=int,
+                        help="serve the metrics of the server on this port of the loopback interface, in the Prometheus "
+                             "text format on /metrics")
+    parser.add_argument("--stats-interval", type=float, default=STATS_INTERVAL,
+                        help="seconds between two dumps of the metrics to the log, 0 to never dump them")
+    parser.add_argument("--log-sample", type=int, default=LOG_SAMPLE,
+                        help="log one in this many per-event messages, 1 to log all of them")
+    parser.add_argument("--engine", choices=ENGINES, default=TWISTED,
+                        help="event loop the server runs on - twisted's default reactor or an asyncio event loop")
+    args = parser.parse_args()
+
+    # configure the root logger, the per-event messages are sampled
+    configure_logging(logging.DEBUG, max(args.log_sample, 1))
 
-    # retrieve arguments
-    path = sys.argv[1]
+    # create the server
+    reactor = create_server(args.path, args.port, args.workers, "single" if args.single else "multi",
+                            args.max_connections, args.client_roots, args.watch, args.conflicts,
+                            args.scan_workers, args.commit_interval / 1000 if args.durable else None)
 
-    reactor = create_server(path)  # create the server
+    # the metrics are served and dumped by the reactor
+    if args.metrics_port is not None:
+        listen_metrics(args.metrics_port)
+    if args.stats_interval > 0:
+        start_stats_dump(args.stats_interval)
 
     # start the reactor's event loop, runs in the main thread
-    logging.info("Starting server")
+    logging.info(f"Starting server on the {args.engine} engine")
     reactor.run()
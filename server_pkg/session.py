@@ -0,0 +1,171 @@
+import os
+import re
+import time
+from collections import OrderedDict
+
+
+# names of per-client sync roots - a single path component, so that a client can't escape the sync folder
+ROOT_NAME = re.compile(r"[A-Za-z0-9][A-Za-z0-9._-]{0,127}")
+
+
+class InvalidRootError(ValueError):
+    """
+    Raised when a client asks for a sync root which isn't a valid folder name.
+    """
+
+
+class InvalidPathError(ValueError):
+    """
+    Raised when the path of an event of a client resolves outside of its sync root, e.g. './../other/file'.
+    """
+
+
+def root_folder(sync_folder, name):
+    """
+    :param sync_folder: the folder synchronised by the server (string)
+    :param name: the name of the per-client sync root (string)
+
+    :return: the path of the per-client sync root inside the sync folder (string)
+    """
+
+    if not isinstance(name, str) or not ROOT_NAME.fullmatch(name):
+        raise InvalidRootError(f"Invalid sync root name - {name!r}")
+
+    return os.path.join(sync_folder, name)
+
+
+class ClientSession:
+    """
+    The state of a connected client - its identity, the sync root its paths are relative to and a few counters.
+    """
+
+    def __init__(self, client_id, sync_folder, legacy=False, applied=0, on_applied=None):
+        """
+        Initialise the session.
+
+        :param client_id: the identifier the client introduced itself with (string)
+        :param sync_folder: the sync root of the client (string)
+        :param legacy: True if the client uses the legacy line based protocol (bool)
+        :param applied: the sequence number of the last operation of the client applied in an earlier session (int)
+        :param on_applied: called with the applied sequence number whenever it moves forward
+        """
+
+        self.client_id = client_id
+        self.sync_folder = sync_folder
+        self.legacy = legacy
+
+        # the operations of a client with a journal are numbered, the messages following an operation message belong to
+        # that operation - all operations up to the applied one have been applied, so the client can resume after it
+        self.applied = applied
+        self.operation = None  # the operation whose messages are being received
+        self.outstanding = OrderedDict()  # sequence number -> the number of filesystem operations not applied yet
+        self.on_applied = on_applied
+
+        self.connected_at = time.time()
+        self.messages_received = 0
+        self.bytes_received = 0
+        self.compression = None  # the decompression counters, if the client compresses payloads (CompressionStats)
+
+    def abs_path(self, event_path):
+        """
+        Build the absolute path of an event path relative to the sync root of the client - the '..' components of the
+        path must not take it out of the sync root, which would let a client write to the root of another client or
+        outside of the sync folder.
+
+        :param event_path: the relative path, starting with '.', encoded in UTF-8 (bytes)
+
+        :return: the absolute path (string)
+        """
+
+        try:
+            abs_path = f"{self.sync_folder}{event_path[1:].decode('utf-8')}"
+        except UnicodeDecodeError:
+            raise InvalidPathError(f"Path {event_path!r} of {self.client_id} isn't valid UTF-8") from None
+
+        root = os.path.normpath(self.sync_folder)
+        if os.path.commonpath([root, os.path.normpath(abs_path)]) != root:
+            raise InvalidPathError(f"Path {event_path!r} of {self.client_id} is outside of its sync root")
+
+        return abs_path
+
+    def message_received(self, frame):
+        """
+        Update the counters of the session.
+
+        :param frame: the received message (Frame)
+        """
+
+        self.messages_received += 1
+        self.bytes_received += len(frame.path) + len(frame.payload)
+
+    def begin_operation(self, seq):
+        """
+        Called when the messages of a new operation of the client start - the previous operation is complete.
+
+        :param seq: the sequence number of the operation (int), None if the messages don't belong to an operation
+        """
+
+        self.operation = None
+        if seq is not None and seq > self.applied:
+            self.outstanding.setdefault(seq, 0)
+            self.operation = seq
+        self.advance()
+
+    def operation_submitted(self):
+        """
+        Called when a filesystem operation is submitted for a message of the client.
+
+        :return: the sequence number of the operation the message belongs to, None if there isn't one (int)
+        """
+
+        if self.operation is not None:
+            self.outstanding[self.operation] += 1
+        return self.operation
+
+    def operation_applied(self, seq):
+        """
+        Called when a filesystem operation submitted for a message of the client has been applied (or has failed).
+
+        :param seq: the sequence number of the operation the message belongs to (int)
+        """
+
+        self.outstanding[seq] -= 1
+        self.advance()
+
+    def operations_applied(self, seq):
+        """
+        :param seq: the sequence number of an operation of the client (int)
+
+        :return: True if all the operations up to it which have been received have also been applied (bool)
+        """
+
+        return not self.outstanding or next(iter(self.outstanding)) > seq
+
+    def advance(self):
+        """
+        Move the applied sequence number over the complete operations which have been applied, in order.
+        """
+
+        while self.outstanding:
+            seq, count = next(iter(self.outstanding.items()))
+            if count or seq == self.operation:
+                return
+            del self.outstanding[seq]
+            self.applied = seq
+            if self.on_applied is not None:
+                self.on_applied(seq)
+
+    def stats(self):
+        """
+        :return: the counters of the session (dict)
+        """
+
+        return {
+            "client_id": self.client_id,
+            "sync_folder": self.sync_folder,
+            "connected_for": time.time() - self.connected_at,
+            "messages_received": self.messages_received,
+            "bytes_received": self.bytes_received,
+            "applied": self.applied,
+            "compression": self.compression.as_dict() if self.compression is not None else None
+        }
@@ -0,0 +1,202 @@
+import errno
+import fcntl
+import logging
+import os
+import shutil
+from common_pkg.content import content_hasher, DEDUP_MIN_SIZE
+from server_pkg.transfer import temp_path_for, STAGING_FOLDER
+
+
+# the folder of the content store, inside the sync folder so that blobs can be hard linked to synchronised files
+STORE_FOLDER = ".syncstore"
+
+# the ioctl cloning a file on filesystems supporting copy-on-write (Linux FICLONE)
+FICLONE = 0x40049409
+
+# the size of the reads done while verifying a blob
+READ_SIZE = 1024 * 1024
+
+
+def reflink(src_path, dest_path):
+    """
+    Make a copy-on-write clone of a file.
+
+    :param src_path: the file to clone (string)
+    :param dest_path: the path of the new file, must not exist (string)
+
+    :return: True if the file was cloned, False if the filesystem doesn't support it (bool)
+    """
+
+    with open(src_path, "rb") as src, open(dest_path, "xb") as dest:
+        try:
+            fcntl.ioctl(dest.fileno(), FICLONE, src.fileno())
+            return True
+        except OSError as e:
+            if e.errno not in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.ENOSYS):
+                raise
+
+    os.remove(dest_path)
+    return False
+
+
+class ContentStore:
+    """
+    A content addressed store of the files received by the server, so that content the server already has never has to
+    be sent again.
+
+    Blobs are hard links to the received files, named after the hash of their content and spread over 256 folders, so
+    a lookup is a single path check no matter how big the tree grows and the store takes no extra space. Synchronised
+    files are only ever replaced by renames, never written in place, hence a blob keeps its content after its file is
+    modified. A blob no longer linked to any file is removed by the garbage collection.
+    """
+
+    def __init__(self, sync_folder, min_size=DEDUP_MIN_SIZE):
+        """
+        Initialise the store.
+
+        :param sync_folder: the folder synchronised by the server (string)
+        :param min_size: the smallest file added to the store (int)
+        """
+
+        self.root = os.path.join(sync_folder, STORE_FOLDER)
+        self.min_size = min_size
+
+    def blob_path(self, digest):
+        """
+        :param digest: the hash of the content (bytes)
+
+        :return: the path of the blob with the given content (string)
+        """
+
+        name = digest.hex()
+        return os.path.join(self.root, name[:2], name)
+
+    def add(self, abs_path, digest, size):
+        """
+        Add a received file to the store, called by the executor.
+
+        :param abs_path: the absolute path of the file (string)
+        :param digest: the hash of its content (bytes)
+        :param size: the size of its content (int)
+        """
+
+        if size < self.min_size:
+            return
+
+        blob_path = self.blob_path(digest)
+        if os.path.exists(blob_path):
+            return
+
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        try:
+            os.link(abs_path, blob_path)
+        except FileExistsError:
+            pass  # added by another operation in the meantime
+
+    def materialise(self, digest, size, abs_path):
+        """
+        Put a file in place from the blob with the given content, called by the executor.
+
+        The blob is cloned if the filesystem supports it, otherwise it is copied - never hard linked, files with the
+        same content would share an inode and a file written in place would change all of them. The blob is verified
+        before being used, in case its linked file was modified in place by someone else.
+
+        :param digest: the hash of the content (bytes)
+        :param size: the size of the content (int)
+        :param abs_path: the absolute path of the file (string)
+
+        :return: True if the file is in place, False if the content must be sent (bool)
+        """
+
+        blob_path = self.blob_path(digest)
+        try:
+            blob_stat = os.stat(blob_path)
+        except FileNotFoundError:
+            return False
+
+        if blob_stat.st_size != size or not self.verify(blob_path, digest):
+            logging.warning(f"Blob {blob_path} doesn't match its hash, removing it")
+            os.remove(blob_path)
+            return False
+
+        try:
+            if os.path.samestat(os.stat(abs_path), blob_stat):
+                return True  # the file is already linked to the blob
+        except FileNotFoundError:
+            pass
+
+        os.makedirs(os.path.dirname(abs_path), exist_ok=True)
+        temp_path = temp_path_for(abs_path)
+
+        try:
+            if not reflink(blob_path, temp_path):
+                shutil.copyfile(blob_path, temp_path)
+            if os.path.exists(abs_path):
+                shutil.copymode(abs_path, temp_path)
+        except FileNotFoundError:
+            return False  # removed by the garbage collection in the meantime
+
+        logging.info(f"Materialising file {abs_path} from the content store")
+        os.replace(temp_path, abs_path)
+        return True
+
+    def verify(self, blob_path, digest):
+        """
+        :param blob_path: the path of a blob (string)
+        :param digest: the expected hash of its content (bytes)
+
+        :return: True if the content of the blob matches the hash (bool)
+        """
+
+        hasher = content_hasher()
+        with open(blob_path, "rb") as fh:
+            for data in iter(lambda: fh.read(READ_SIZE), b""):
+                hasher.update(data)
+
+        return hasher.digest() == digest
+
+    def collect(self):
+        """
+        Remove the blobs which are no longer linked to any file, called by the executor.
+
+        :return: the number of removed blobs (int)
+        """
+
+        removed = 0
+        for folder, folders, names in os.walk(self.root):
+            # staged files aren't blobs, they are collected by the staging area, and the files in the root of the
+            # store hold the state of the server (e.g. the version store)
+            if folder == self.root:
+                if STAGING_FOLDER in folders:
+                    folders.remove(STAGING_FOLDER)
+                continue
+
+            for name in names:
+                path = os.path.join(folder, name)
+                try:
+                    if os.stat(path).st_nlink == 1:
+                        os.remove(path)
+                        removed += 1
+                except FileNotFoundError:
+                    pass
+
+        logging.info(f"Removed {removed} unused blobs from the content store")
+        return removed
+
+    def detach(self, abs_path):
+        """
+        Make sure a file about to be written in place doesn't share its content with a blob, called by the executor.
+
+        :param abs_path: the absolute path of the file (string)
+        """
+
+        try:
+            if os.stat(abs_path).st_nlink > 1:
+                # the file is rewritten from scratch, so it is enough to replace the link with an empty copy
+                temp_path = temp_path_for(abs_path)
+                with open(temp_path, "xb"):
+                    pass
+                shutil.copymode(abs_path, temp_path)
+                os.replace(temp_path, abs_path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,417 @@
+import logging
+import os
+import shutil
+import time
+import uuid
+from common_pkg.content import HashingWriter, content_hasher
+from common_pkg.delta import apply_delta
+from common_pkg.logs import event_log
+
+
+# suffix of the temporary files streamed transfers are written to before being renamed into place
+TEMP_SUFFIX = ".synctmp"
+
+# the folder inside the content store folder partially received files are kept in, so that their transfer can be resumed
+STAGING_FOLDER = "staging"
+
+# suffix of the files recording the offset up to which a staged file has been flushed to disk
+CHECKPOINT_SUFFIX = ".checkpoint"
+
+# files at least this big are staged, if the client can resume their transfer
+RESUMABLE_MIN_SIZE = 4 * 1024 * 1024
+
+# a staged file is flushed to disk and its offset recorded every this many bytes
+CHECKPOINT_SIZE = 8 * 1024 * 1024
+
+# staged files whose transfer hasn't been resumed for this long are removed (seconds)
+STAGING_TTL = 24 * 3600
+
+# the size of the reads done while hashing the staged part of a file
+READ_SIZE = 1024 * 1024
+
+
+def temp_path_for(abs_path):
+    """
+    :param abs_path: the absolute path of a file (string)
+
+    :return: a unique path for a hidden temporary file next to it (string)
+    """
+
+    base_folder, file_name = os.path.split(abs_path)
+    return os.path.join(base_folder, f".{file_name}.{uuid.uuid4().hex[:8]}{TEMP_SUFFIX}")
+
+
+class IncomingTransfer:
+    """
+    A file being received from a client - the content is written to a temporary file next to the destination, which
+    is atomically renamed into place once complete, so the destination never contains partial content.
+
+    The transfer is created in the reactor thread, while all filesystem work is done by the executor. Once a write
+    fails, the temporary file is removed and the rest of the transfer is ignored. The content is hashed while being
+    written, so that the complete file can be added to the content store.
+    """
+
+    def __init__(self, abs_path, delta=False, store=None, commits=None):
+        """
+        Initialise the transfer.
+
+        :param abs_path: the absolute path of the destination (string)
+        :param delta: True if the content is received as a delta against the existing destination (bool)
+        :param store: the content store the complete file is added to, None to not add it (ContentStore)
+        :param commits: the group commit the complete file is made durable by, None to not sync it (GroupCommit)
+        """
+
+        self.abs_path = abs_path
+        self.delta = delta
+        self.store = store
+        self.commits = commits
+        self.temp_path = temp_path_for(abs_path)
+
+        self.fh = None  # the temporary file, wrapped to hash its content (HashingWriter)
+        self.basis = None  # the existing copy a delta refers to
+        self.failed = False
+
+    def open(self):
+        """
+        Open the temporary file and the existing copy, if needed.
+        """
+
+        if self.fh is not None:
+            return
+
+        os.makedirs(os.path.dirname(self.abs_path), exist_ok=True)
+        self.fh = HashingWriter(open(self.temp_path, "xb"), content_hasher())
+
+        if self.delta and os.path.isfile(self.abs_path):
+            self.basis = open(self.abs_path, "rb")
+
+    def write(self, payload, decompressor=None):
+        """
+        Append a chunk of content.
+
+        :param payload: the chunk (bytes)
+        :param decompressor: the decompressor of the chunk, None if it isn't compressed (PayloadDecompressor)
+        """
+
+        if decompressor is not None:
+            self.guarded(lambda: decompressor.decompress_into(payload, self.fh.write))
+        else:
+            self.guarded(lambda: self.fh.write(payload))
+
+    def apply(self, payload, decompressor=None):
+        """
+        Apply a delta payload against the existing copy of the file.
+
+        :param payload: the encoded delta operations (bytes)
+        :param decompressor: the decompressor of the payload, None if it isn't compressed (PayloadDecompressor)
+        """
+
+        if decompressor is not None:
+            self.guarded(lambda: apply_delta(decompressor.decompress(payload), self.basis, self.fh))
+        else:
+            self.guarded(lambda: apply_delta(payload, self.basis, self.fh))
+
+    def guarded(self, func):
+        """
+        Run a write unless the transfer has already failed - a failure discards the transfer.
+
+        :param func: the function doing the write
+        """
+
+        if self.failed:
+            return
+
+        try:
+            self.open()
+            func()
+        except Exception:
+            self.discard()
+            raise
+
+    def suspend(self):
+        """
+        Called when the connection is lost before the transfer is complete - the temporary file is removed.
+        """
+
+        self.discard()
+
+    def close(self):
+        """
+        Close the open file handles.
+        """
+
+        if self.fh is not None:
+            self.fh.fh.close()
+        if self.basis is not None:
+            self.basis.close()
+
+    def commit(self):
+        """
+        Rename the temporary file into place, keeping the permissions of the file being replaced.
+        """
+
+        if self.failed:
+            return
+
+        self.open()  # a transfer of an empty file has no writes
+        self.close()
+
+        event_log.info(f"Modifying file {self.abs_path}")
+        if os.path.exists(self.abs_path):
+            shutil.copymode(self.abs_path, self.temp_path)
+        os.replace(self.temp_path, self.abs_path)
+
+        if self.commits is not None:
+            self.commits.written(self.abs_path, self.fh.size, parents=True)
+        if self.store is not None:
+            self.store.add(self.abs_path, self.fh.hasher.digest(), self.fh.size)
+
+    def discard(self):
+        """
+        Remove the temporary file of an incomplete transfer.
+        """
+
+        if self.failed:
+            return
+
+        self.failed = True
+        self.close()
+
+        if self.fh is None:
+            return
+
+        try:
+            os.remove(self.temp_path)
+        except OSError as e:
+            logging.warning(f"Failed to remove temporary file {self.temp_path} - {e}")
+
+
+class ResumableTransfer(IncomingTransfer):
+    """
+    A big file being received from a client which can resume the transfer after losing the connection.
+
+    The content is written to a staging file named after the transfer, see StagingArea, instead of a temporary file
+    next to the destination. The staging file is flushed to disk every CHECKPOINT_SIZE bytes and when the connection is
+    lost, and the flushed offset is recorded next to it. When the client offers the same content again, the staged
+    part up to the recorded offset is hashed again and the client sends the rest. The complete file must match the
+    offered hash - a resumed transfer which doesn't is discarded.
+    """
+
+    def __init__(self, abs_path, staging_path, digest, size, store=None, commits=None):
+        """
+        Initialise the transfer.
+
+        :param abs_path: the absolute path of the destination (string)
+        :param staging_path: the path of the staging file (string)
+        :param digest: the offered hash of the content (bytes)
+        :param size: the offered size of the content (int)
+        :param store: the content store the complete file is added to, None to not add it (ContentStore)
+        :param commits: the group commit the complete file is made durable by, None to not sync it (GroupCommit)
+        """
+
+        super().__init__(abs_path, store=store, commits=commits)
+        self.temp_path = staging_path
+        self.checkpoint_path = f"{staging_path}{CHECKPOINT_SUFFIX}"
+        self.digest = digest
+        self.size = size
+        self.resumed = False
+        self.checkpointed = 0  # the offset flushed to disk
+
+    def prepare(self):
+        """
+        Check what has been staged for the transfer so far, called by the executor.
+
+        :return: the offset the client must continue from (int)
+        """
+
+        try:
+            with open(self.checkpoint_path) as fh:
+                offset = min(int(fh.read()), os.stat(self.temp_path).st_size)
+        except (OSError, ValueError):
+            offset = 0
+
+        if not 0 < offset <= self.size:
+            self.remove()
+            return 0
+
+        # the part written after the last checkpoint may not have made it to disk
+        fh = open(self.temp_path, "r+b")
+        fh.truncate(offset)
+
+        hasher = content_hasher()
+        for data in iter(lambda: fh.read(READ_SIZE), b""):
+            hasher.update(data)
+
+        self.fh = HashingWriter(fh, hasher)
+        self.fh.size = self.checkpointed = offset
+        self.resumed = True
+
+        logging.info(f"Resuming the transfer of {self.abs_path} at byte {offset}")
+        return offset
+
+    def open(self):
+        """
+        Open the staging file, unless the transfer has been resumed.
+        """
+
+        if self.fh is not None:
+            return
+
+        os.makedirs(os.path.dirname(self.temp_path), exist_ok=True)
+        self.fh = HashingWriter(open(self.temp_path, "wb"), content_hasher())
+
+    def write(self, payload, decompressor=None):
+        """
+        Append a chunk of content, recording a checkpoint every CHECKPOINT_SIZE bytes.
+
+        :param payload: the chunk (bytes)
+        :param decompressor: the decompressor of the chunk, None if it isn't compressed (PayloadDecompressor)
+        """
+
+        super().write(payload, decompressor)
+        if not self.failed and self.fh.size - self.checkpointed >= CHECKPOINT_SIZE:
+            self.guarded(self.checkpoint)
+
+    def checkpoint(self):
+        """
+        Flush the staging file to disk and record the flushed offset.
+        """
+
+        self.fh.fh.flush()
+        os.fsync(self.fh.fh.fileno())
+
+        temp_path = f"{self.checkpoint_path}{TEMP_SUFFIX}"
+        with open(temp_path, "w") as fh:
+            fh.write(str(self.fh.size))
+        os.replace(temp_path, self.checkpoint_path)
+        self.checkpointed = self.fh.size
+
+    def suspend(self):
+        """
+        Called when the connection is lost before the transfer is complete - the staging file is kept, so that the
+        client can resume the transfer.
+        """
+
+        if self.failed or self.fh is None:
+            return
+
+        self.guarded(self.checkpoint)
+        self.close()
+        logging.info(f"Keeping {self.checkpointed} bytes of {self.abs_path} until its transfer is resumed")
+
+    def commit(self):
+        """
+        Verify the received content against the offered hash and rename the staging file into place.
+        """
+
+        if self.failed:
+            return
+
+        self.open()  # a transfer of an empty file has no writes
+        if (self.fh.hasher.digest(), self.fh.size) != (self.digest, self.size):
+            if self.resumed:
+                logging.warning(f"Resumed transfer of {self.abs_path} doesn't match the offered content, discarding it")
+                self.discard()
+                return
+
+            # the file was modified while it was sent, its new content follows
+            logging.info(f"Received content of {self.abs_path} doesn't match the offered content")
+
+        super().commit()
+        self.remove_checkpoint()
+
+    def discard(self):
+        """
+        Remove the staging file of a transfer which won't be resumed.
+        """
+
+        super().discard()
+        self.remove_checkpoint()
+
+    def remove(self):
+        """
+        Remove a stale staging file and its checkpoint.
+        """
+
+        for path in (self.temp_path, self.checkpoint_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def remove_checkpoint(self):
+        """
+        Remove the checkpoint of the staging file.
+        """
+
+        try:
+            os.remove(self.checkpoint_path)
+        except FileNotFoundError:
+            pass
+
+
+class StagingArea:
+    """
+    The folder partially received files are staged in, inside the content store folder.
+
+    A staged file is named after its transfer - the client, the path and the size of the file, so that clients sending
+    the same content to different paths don't share a staging file - and the hash of its content, so that a transfer is
+    only resumed for the same content. Staged files whose transfer isn't resumed within the TTL are removed by the
+    garbage collection.
+    """
+
+    def __init__(self, store_root, ttl=STAGING_TTL):
+        """
+        Initialise the staging area.
+
+        :param store_root: the folder of the content store (string)
+        :param ttl: the time a staged file is kept after its last write (seconds)
+        """
+
+        self.root = os.path.join(store_root, STAGING_FOLDER)
+        self.ttl = ttl
+
+    def staging_path(self, client_id, event_path, digest, size):
+        """
+        :param client_id: the identifier of the client sending the file (string)
+        :param event_path: the relative path of the file (bytes)
+        :param digest: the hash of the content (bytes)
+        :param size: the size of the content (int)
+
+        :return: the path of the staging file of the transfer (string)
+        """
+
+        hasher = content_hasher()
+        hasher.update(f"{client_id}\0{size}\0".encode("utf-8") + event_path)
+        transfer_id = hasher.hexdigest()[:16]
+
+        return os.path.join(self.root, f"{transfer_id}-{digest.hex()}")
+
+    def collect(self, now=None):
+        """
+        Remove the staged files which haven't been written to within the TTL, called by the executor.
+
+        :param now: the current time, defaults to the time of the call (seconds since the epoch)
+
+        :return: the number of removed files (int)
+        """
+
+        now = time.time() if now is None else now
+        removed = 0
+
+        try:
+            names = os.listdir(self.root)
+        except FileNotFoundError:
+            return 0
+
+        for name in names:
+            path = os.path.join(self.root, name)
+            try:
+                if now - os.stat(path).st_mtime >= self.ttl:
+                    os.remove(path)
+                    removed += not name.endswith(CHECKPOINT_SUFFIX)
+            except FileNotFoundError:
+                pass
+
+        logging.info(f"Removed {removed} expired staged files")
+        return removed
@@ -0,0 +1,128 @@
+import logging
+import os
+import sqlite3
+import time
+from common_pkg.versions import decode_vector, encode_vector
+
+
+# the file of the version store, in the content store folder so that it's never synchronised
+VERSIONS_FILE = "versions.sqlite"
+
+# updates are committed in batches of this many rows, or once this many seconds have passed since the last commit
+COMMIT_BATCH = 1000
+COMMIT_INTERVAL = 1.0
+
+
+class VersionStore:
+    """
+    The version vectors of the files of the sync folder (see common_pkg.versions), keyed by their path relative to the
+    folder, so that the clients sharing a folder share the versions of its files. The vector of a deleted file is kept,
+    so that a file created again at its path is newer than the deleted one.
+
+    Only used in the reactor thread.
+    """
+
+    def __init__(self, root_path, store_root):
+        """
+        Open the store, creating it if it doesn't exist.
+
+        :param root_path: the folder synchronised by the server (string)
+        :param store_root: the folder of the content store (string)
+        """
+
+        self.root_path = root_path
+        os.makedirs(store_root, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(store_root, VERSIONS_FILE))
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS versions (path BLOB PRIMARY KEY, vector BLOB) WITHOUT ROWID")
+
+        self.uncommitted = 0
+        self.committed_at = time.monotonic()
+
+    def key(self, abs_path):
+        """
+        :param abs_path: the absolute path of a file in the sync folder (string)
+
+        :return: the key of the path in the store (bytes)
+        """
+
+        return os.fsencode(f".{abs_path[len(self.root_path):]}")
+
+    def get(self, abs_path):
+        """
+        :param abs_path: the absolute path of a file (string)
+
+        :return: the version vector of the file, empty if it has none (dict)
+        """
+
+        row = self.db.execute("SELECT vector FROM versions WHERE path = ?", (self.key(abs_path),)).fetchone()
+        return decode_vector(row[0]) if row is not None else {}
+
+    def put(self, abs_path, vector):
+        """
+        :param abs_path: the absolute path of a file (string)
+        :param vector: the version vector of its content (dict)
+        """
+
+        self.db.execute("INSERT OR REPLACE INTO versions VALUES (?, ?)", (self.key(abs_path), encode_vector(vector)))
+        self.updated()
+
+    def below(self, abs_path):
+        """
+        :param abs_path: the absolute path of a folder (string)
+
+        :return: the absolute paths of the files below the folder which have a version, deleted ones included (list of
+                 strings)
+        """
+
+        key = self.key(abs_path)
+        rows = self.db.execute("SELECT path FROM versions WHERE path >= ? AND path < ? ORDER BY path",
+                               (key + b"/", key + b"0"))
+        return [f"{self.root_path}{os.fsdecode(path)[1:]}" for path, in rows]
+
+    def move(self, abs_src_path, abs_dest_path):
+        """
+        Move the versions of a file, or a directory and everything below it.
+
+        :param abs_src_path: the absolute source path (string)
+        :param abs_dest_path: the absolute destination path (string)
+        """
+
+        src_key, dest_key = self.key(abs_src_path), self.key(abs_dest_path)
+
+        # whatever was at the destination has been replaced, the children of a directory are the keys between
+        # 'path/' and 'path0' - '0' follows '/'
+        self.db.execute("DELETE FROM versions WHERE path = ? OR (path >= ? AND path < ?)",
+                        (dest_key, dest_key + b"/", dest_key + b"0"))
+        self.db.execute("UPDATE versions SET path = CAST(? || substr(path, ?) AS BLOB) "
+                        "WHERE path = ? OR (path >= ? AND path < ?)",
+                        (dest_key, len(src_key) + 1, src_key, src_key + b"/", src_key + b"0"))
+        self.updated()
+
+    def updated(self):
+        """
+        Commit the updates once enough of them have been made, or enough time has passed since the last commit.
+        """
+
+        self.uncommitted += 1
+        if self.uncommitted >= COMMIT_BATCH or time.monotonic() - self.committed_at >= COMMIT_INTERVAL:
+            self.commit()
+
+    def commit(self):
+        """
+        Commit the pending updates.
+        """
+
+        self.db.commit()
+        self.uncommitted = 0
+        self.committed_at = time.monotonic()
+
+    def close(self):
+        """
+        Commit the pending updates and close the store.
+        """
+
+        self.commit()
+        self.db.close()
+        logging.info("Version store closed")
@@ -8,4 +8,7 @@ setup(name='foldersync',
       install_requires=[
         "twisted==18.9.0",
         "watchdog==0.9.0"
-      ])
+      ],
+      extras_require={
+        "zstd": ["zstandard"]
+      })
@@ -1,34 +1,123 @@
+import os
+import zlib
 from unittest.mock import patch
 from twisted.test.proto_helpers import StringTransport
-from client_pkg.protocol import connect, SyncClientProtocol
+from client_pkg.protocol import connect, retry_delay, SyncClientProtocol, INITIAL_RETRY_DELAY, MAX_RETRY_DELAY
+from common_pkg.framing import encode_frame, encode_hello_frame, FrameDecoder, Frame, MSG_CREATED, MSG_DELETED, \
+    MSG_MODIFIED, MSG_MOVED, MSG_CHUNK, FLAG_DIRECTORY, FLAG_FIRST, FLAG_LAST, FLAG_COMPRESSED
 
 
 @patch("client_pkg.protocol.reactor")
-@patch("client_pkg.protocol.connectProtocol")
+@patch("client_pkg.protocol.ClientService")
 @patch("client_pkg.protocol.SyncClientProtocol")
 @patch("client_pkg.protocol.TCP4ClientEndpoint")
-def test_connect(endpoint_mock, protocol_mock, connect_protocol_mock, reactor_mock):
+def test_connect(endpoint_mock, protocol_mock, service_mock, reactor_mock):
 
     protocol, reactor = connect("127.0.0.1", 9999)
 
     endpoint_mock.assert_called_once_with(reactor_mock, "127.0.0.1", 9999)
     protocol_mock.assert_called_once()
-    connect_protocol_mock.assert_called_once_with(endpoint_mock.return_value, protocol_mock.return_value)
+
+    # the client connects again with backoff, always with the same protocol object
+    endpoint, factory = service_mock.call_args[0]
+    assert endpoint == endpoint_mock.return_value
+    assert factory.buildProtocol(None) is factory.buildProtocol(None) is protocol_mock.return_value
+    assert service_mock.call_args[1] == {"retryPolicy": retry_delay}
+    service_mock.return_value.startService.assert_called_once()
 
     assert protocol == protocol_mock.return_value, "Incorrect protocol reference returned"
     assert reactor == reactor_mock, "Incorrect reactor reference returned"
 
 
+def test_retry_delay():
+
+    delays = [retry_delay(attempt) for attempt in range(1, 20)]
+    assert all(0 <= delay <= MAX_RETRY_DELAY for delay in delays)
+    assert max(retry_delay(1) for _ in range(100)) <= 2 * INITIAL_RETRY_DELAY
+    assert len(set(delays)) == len(delays), "Delays must be jittered"
+
+
 @patch("client_pkg.protocol.reactor")
-def test_protocol(reactor_mock):
+def test_protocol(reactor_mock, tmp_path):
+
+    reactor_mock.callFromThread.side_effect = lambda f, *args: f(*args)
+
+    protocol = SyncClientProtocol(client_id="test", compression=[])
+    transport = StringTransport()
+    protocol.makeConnection(transport)
+
+    # the binary wire format is offered straight away
+    assert transport.value() == \
+        b'hello::0::{"client_id": "test", "compression": [], "resumable": true, "version": 1}\r\r\r\n\n\n'
+    reactor_mock.callLater.assert_called_once_with(SyncClientProtocol.NEGOTIATION_TIMEOUT, protocol.negotiation_finished, "legacy")
+    transport.clear()
+
+    # messages are held back until the server replies
+    protocol.send_event("created", True, "./test")
+    assert transport.value() == b""
+
+    protocol.dataReceived(encode_hello_frame())
+    reactor_mock.callLater.return_value.cancel.assert_called_once()
+    assert protocol.mode == "binary"
+    assert transport.value() == encode_frame(MSG_CREATED, FLAG_DIRECTORY, b"./test")
+    transport.clear()
+
+    # test for file
+    protocol.send_event("deleted", False, "./test1.log")
+    assert transport.value() == encode_frame(MSG_DELETED, 0, b"./test1.log")
+    transport.clear()
+
+    # test moved event
+    protocol.send_move_event(True, "./test1", "./test2")
+    protocol.send_move_event(False, "./test1.log", "./test2.log")
+    assert FrameDecoder().feed(transport.value()) == [
+        Frame(MSG_MOVED, FLAG_DIRECTORY, b"./test1", b"./test2"),
+        Frame(MSG_MOVED, 0, b"./test1.log", b"./test2.log")
+    ]
+    transport.clear()
+
+    # test modify event, content containing the legacy delimiter must go through untouched
+    protocol.send_modify_event("./test.log", b"Logging data::\r\r\r\n\n\n for testing.")
+    assert FrameDecoder().feed(transport.value()) == [
+        Frame(MSG_MODIFIED, 0, b"./test.log", b"Logging data::\r\r\r\n\n\n for testing.")
+    ]
+    transport.clear()
+
+    # test streamed file
+    protocol.queue.chunk_size = 4
+    (tmp_path / "test.log").write_bytes(b"0123456789")
+    protocol.send_file("./test.log", str(tmp_path / "test.log"))
+    assert FrameDecoder().feed(transport.value()) == [
+        Frame(MSG_CHUNK, FLAG_FIRST, b"./test.log", b"0123"),
+        Frame(MSG_CHUNK, 0, b"./test.log", b"4567"),
+        Frame(MSG_CHUNK, FLAG_LAST, b"./test.log", b"89")
+    ]
+    transport.clear()
+
+    # missing files are skipped
+    protocol.send_file("./missing.log", str(tmp_path / "missing.log"))
+    assert transport.value() == b""
+
+    # test connection lost, the state of the connection is reset for the next one
+    protocol.connectionLost("test reason")
+    reactor_mock.stop.assert_not_called()
+    assert not protocol.connected and protocol.mode is None
+
+
+@patch("client_pkg.protocol.reactor")
+def test_protocol_legacy_fallback(reactor_mock, tmp_path):
+
+    reactor_mock.callFromThread.side_effect = lambda f, *args: f(*args)
 
     protocol = SyncClientProtocol()
     transport = StringTransport()
     protocol.makeConnection(transport)
+    transport.clear()
 
-    # test send event - created or deleted
-    # test for folder
     protocol.send_event("created", True, "./test")
+
+    # the server never replied to the hello message
+    protocol.negotiation_finished("legacy")
     assert transport.value() == b"created::1::./test\r\r\r\n\n\n"
     transport.clear()
 
@@ -38,21 +127,52 @@ def test_protocol(reactor_mock):
     transport.clear()
 
     # test moved event
-    # test for folder
     protocol.send_move_event(True, "./test1", "./test2")
     assert transport.value() == b"moved::1::./test1::./test2\r\r\r\n\n\n"
     transport.clear()
 
-    # test for file
-    protocol.send_move_event(False, "./test1.log", "./test2.log")
-    assert transport.value() == b"moved::0::./test1.log::./test2.log\r\r\r\n\n\n"
-    transport.clear()
-
     # test modify event
     protocol.send_modify_event("./test.log", b"Logging data for testing.")
     assert transport.value() == b"modified::0::./test.log::Logging data for testing.\r\r\r\n\n\n"
     transport.clear()
 
-    # test connection lost
-    protocol.connectionLost("test reason")
-    reactor_mock.stop.assert_called_once()
+    # files are sent in full with the legacy protocol
+    (tmp_path / "test.log").write_bytes(b"0123456789")
+    protocol.send_file("./test.log", str(tmp_path / "test.log"))
+    assert transport.value() == b"modified::0::./test.log::0123456789\r\r\r\n\n\n"
+
+    # the server's hello arriving after the fallback - the server reads binary messages now, the client reconnects
+    protocol.dataReceived(encode_hello_frame())
+    assert protocol.mode == "legacy" and transport.disconnecting
+
+
+@patch("client_pkg.protocol.reactor")
+def test_protocol_compression(reactor_mock, tmp_path):
+
+    reactor_mock.callFromThread.side_effect = lambda f, *args: f(*args)
+
+    protocol = SyncClientProtocol(client_id="test", compression=["zlib"])
+    transport = StringTransport()
+    protocol.makeConnection(transport)
+    protocol.dataReceived(encode_hello_frame(compression="zlib"))
+    transport.clear()
+
+    # the first chunk of a file decides if the file is compressed
+    protocol.queue.chunk_size = 4096
+    text = b"compressible line of text\n" * 500
+    noise = os.urandom(len(text))
+    (tmp_path / "text.log").write_bytes(text)
+    (tmp_path / "noise.bin").write_bytes(noise)
+    protocol.send_file("./text.log", str(tmp_path / "text.log"))
+    protocol.send_file("./noise.bin", str(tmp_path / "noise.bin"))
+
+    frames = FrameDecoder().feed(transport.value())
+    text_frames = [frame for frame in frames if frame.path == b"./text.log"]
+    noise_frames = [frame for frame in frames if frame.path == b"./noise.bin"]
+    assert all(frame.flags & FLAG_COMPRESSED for frame in text_frames)
+    assert b"".join(zlib.decompress(frame.payload) for frame in text_frames) == text
+    assert not any(frame.flags & FLAG_COMPRESSED for frame in noise_frames)
+    assert b"".join(frame.payload for frame in noise_frames) == noise
+
+    stats = protocol.compressor.stats.as_dict()
+    assert stats["bytes_saved"] > len(text) // 2 and stats["skipped"] == len(noise_frames)
@@ -0,0 +1,256 @@
+import os
+import threading
+from unittest.mock import Mock, call, patch
+from twisted.internet import defer
+from twisted.internet.task import Clock
+from client_pkg.coalescing import EventCoalescer
+from client_pkg.index import FileIndex
+from common_pkg.manifest import file_digest
+
+
+def setup_coalescer():
+
+    clock = Clock()
+    clock.callFromThread = lambda f, *args: f(*args)
+    protocol = Mock()
+    protocol.wait_for_room = lambda: None
+    coalescer = EventCoalescer(protocol, "/var/log", quiet_window=1, max_latency=10, clock=clock)
+    coalescer.start()
+
+    return clock, protocol, coalescer
+
+
+def test_quiet_window():
+
+    clock, protocol, coalescer = setup_coalescer()
+
+    # a burst of modified events results in a single upload once the file is quiet
+    for _ in range(5):
+        coalescer.send_file("./test.log", "/var/log/test.log")
+        clock.advance(0.5)
+    protocol.send_file.assert_not_called()
+
+    clock.advance(1)
+    protocol.send_file.assert_called_once_with("./test.log", "/var/log/test.log")
+
+    # a file which is modified all the time is still sent after the maximum latency
+    protocol.reset_mock()
+    for _ in range(25):
+        coalescer.send_file("./hot.log", "/var/log/hot.log")
+        clock.advance(0.5)
+    protocol.send_file.assert_called_once_with("./hot.log", "/var/log/hot.log")
+
+    coalescer.stop()
+    assert protocol.send_file.call_count == 2, "Pending operations must be sent when stopping"
+    assert not coalescer.pending and not coalescer.sources
+
+
+def test_net_operations():
+
+    clock, protocol, coalescer = setup_coalescer()
+
+    # created + modified + deleted is never sent
+    coalescer.send_event("created", False, "./tmp.log")
+    coalescer.send_file("./tmp.log", "/var/log/tmp.log")
+    coalescer.send_event("deleted", False, "./tmp.log")
+
+    # a chain of moves results in a single move
+    coalescer.send_move_event(False, "./a.log", "./b.log")
+    coalescer.send_move_event(False, "./b.log", "./c.log")
+    coalescer.send_move_event(False, "./c.log", "./d.log")
+
+    # moved back to where it was
+    coalescer.send_move_event(False, "./e.log", "./f.log")
+    coalescer.send_move_event(False, "./f.log", "./e.log")
+
+    # editor save - write a temporary file and rename it over the original
+    coalescer.send_event("created", False, "./.doc.swp")
+    coalescer.send_file("./.doc.swp", "/var/log/.doc.swp")
+    coalescer.send_move_event(False, "./.doc.swp", "./doc.txt")
+
+    # a new empty file
+    coalescer.send_event("created", False, "./empty.log")
+
+    # deleted and created again
+    coalescer.send_event("deleted", False, "./again.log")
+    coalescer.send_event("created", False, "./again.log")
+
+    # moved and then deleted - the server copy is deleted at the source path
+    coalescer.send_move_event(False, "./old.log", "./new.log")
+    coalescer.send_event("deleted", False, "./new.log")
+
+    clock.advance(1)
+    assert protocol.mock_calls == [
+        call.send_move_event(False, "./a.log", "./d.log"),
+        call.send_file("./doc.txt", "/var/log/doc.txt"),
+        call.send_event("created", False, "./empty.log"),
+        call.send_file("./again.log", "/var/log/again.log"),
+        call.send_event("deleted", False, "./old.log")
+    ]
+
+
+def test_ordering():
+
+    clock, protocol, coalescer = setup_coalescer()
+
+    # a new file at a path whose server copy is moved away - the move must be sent first
+    coalescer.send_move_event(False, "./a.log", "./b.log")
+    coalescer.send_event("created", False, "./a.log")
+    protocol.send_move_event.assert_called_once_with(False, "./a.log", "./b.log")
+
+    # moving over a file whose server copy was going to be moved there
+    coalescer.send_move_event(False, "./x.log", "./y.log")
+    coalescer.send_event("created", False, "./z.log")
+    coalescer.send_file("./z.log", "/var/log/z.log")
+    coalescer.send_move_event(False, "./z.log", "./y.log")
+
+    # directory events act as barriers, changes inside a deleted directory are dropped unless they come from outside
+    coalescer.send_file("./dir/test.log", "/var/log/dir/test.log")
+    coalescer.send_event("created", False, "./dir/new.log")
+    coalescer.send_move_event(False, "./outside.log", "./dir/inside.log")
+    coalescer.send_event("deleted", True, "./dir")
+
+    assert protocol.mock_calls[1:] == [
+        call.send_event("created", False, "./a.log"),
+        call.send_event("deleted", False, "./x.log"),
+        call.send_file("./y.log", "/var/log/y.log"),
+        call.send_move_event(False, "./outside.log", "./dir/inside.log"),
+        call.send_event("deleted", True, "./dir")
+    ]
+
+    # explicit content is never held back
+    protocol.reset_mock()
+    coalescer.send_move_event(False, "./m.log", "./n.log")
+    coalescer.send_modify_event("./n.log", b"content")
+    assert protocol.mock_calls == [
+        call.send_move_event(False, "./m.log", "./n.log"),
+        call.send_modify_event("./n.log", b"content")
+    ]
+    assert not coalescer.pending and not coalescer.sources
+
+
+def test_rename_detection(tmp_path):
+
+    clock = Clock()
+    clock.callFromThread = lambda f, *args: f(*args)
+    protocol = Mock()
+    protocol.wait_for_room = lambda: None
+    index = FileIndex(":memory:", str(tmp_path))
+    coalescer = EventCoalescer(protocol, str(tmp_path), quiet_window=1, max_latency=10, clock=clock, index=index)
+    coalescer.start()
+
+    # the indexed files which are going to be deleted
+    for name, content in (("old.bin", b"moved content"), ("other.bin", b"other content")):
+        (tmp_path / name).write_bytes(content)
+        index.update(str(tmp_path / name), os.stat(tmp_path / name), file_digest(str(tmp_path / name)))
+
+    # moved by copying and deleting the original - the new file is sent as a move
+    (tmp_path / "new.bin").write_bytes(b"moved content")
+    coalescer.send_event("created", False, "./new.bin")
+    coalescer.send_event("deleted", False, "./old.bin")
+    clock.advance(0.8)
+    coalescer.send_file("./new.bin", str(tmp_path / "new.bin"))
+
+    # a new file with the same size but another content is sent
+    (tmp_path / "same.bin").write_bytes(b"other CONTENT")
+    coalescer.send_event("created", False, "./same.bin")
+    coalescer.send_file("./same.bin", str(tmp_path / "same.bin"))
+    coalescer.send_event("deleted", False, "./other.bin")
+
+    # the deletion waits for the new file of the same size which is still being written
+    clock.advance(0.5)
+    protocol.send_move_event.assert_not_called()
+
+    # the new files are hashed in a thread, they are held back along with the deletions until they have been hashed
+    hashing = []
+
+    def defer_to_thread(func, abs_path):
+        hashing.append((defer.Deferred(), abs_path))
+        return hashing[-1][0]
+
+    with patch("client_pkg.coalescing.threads.deferToThread", side_effect=defer_to_thread):
+        clock.advance(1)
+    assert [abs_path for _, abs_path in hashing] == [str(tmp_path / "new.bin"), str(tmp_path / "same.bin")]
+    assert not protocol.mock_calls and coalescer.lock.acquire(blocking=False)
+    coalescer.lock.release()
+
+    for d, abs_path in hashing:
+        d.callback(file_digest(abs_path))
+    assert protocol.mock_calls == [
+        call.send_move_event(False, "./old.bin", "./new.bin"),
+        call.send_file("./same.bin", str(tmp_path / "same.bin")),
+        call.send_event("deleted", False, "./other.bin")
+    ]
+    assert index.get("./new.bin")[3] == file_digest(str(tmp_path / "new.bin"))
+    assert coalescer.stats() == dict(pending=0, renames_detected=1, rename_misses=1)
+
+    # a file moved by linking it and removing the original has the same inode, it isn't hashed
+    protocol.reset_mock()
+    os.link(tmp_path / "new.bin", tmp_path / "linked.bin")
+    os.remove(tmp_path / "new.bin")
+    coalescer.send_event("created", False, "./linked.bin")
+    coalescer.send_file("./linked.bin", str(tmp_path / "linked.bin"))
+    coalescer.send_event("deleted", False, "./new.bin")
+    with patch("client_pkg.coalescing.threads.deferToThread") as defer_to_thread:
+        clock.advance(2)
+    defer_to_thread.assert_not_called()
+    assert protocol.mock_calls == [call.send_move_event(False, "./new.bin", "./linked.bin")]
+    index.close()
+
+
+def test_blocked_protocol():
+
+    clock, protocol, coalescer = setup_coalescer()
+    waiting, unblock = threading.Event(), threading.Event()
+    calls = []
+
+    def wait_for_room():
+        waiting.set()
+        unblock.wait(5)
+
+    # the watchdog thread waits for the transfer queue to drain after handing over a directory event
+    coalescer.send_file("./a.log", "/var/log/a.log")
+    clock.callFromThread = lambda f, *args: calls.append((f, args))
+    protocol.wait_for_room = wait_for_room
+    watchdog = threading.Thread(target=coalescer.send_event, args=("created", True, "./dir"))
+    watchdog.start()
+    assert waiting.wait(5)
+
+    # the reactor thread can still send the operations and check for due ones
+    for f, args in calls:
+        f(*args)
+    flush = threading.Thread(target=clock.advance, args=(1,))
+    flush.start()
+    flush.join(1)
+    assert not flush.is_alive()
+
+    unblock.set()
+    watchdog.join(5)
+    assert protocol.mock_calls == [call.send_file("./a.log", "/var/log/a.log"),
+                                   call.send_event("created", True, "./dir")]
+
+
+def test_directory_move_ordering():
+
+    clock, protocol, coalescer = setup_coalescer()
+    calls = []
+    clock.callFromThread = lambda f, *args: calls.append((f, args))
+    coalescer.send_move_event(False, "./d/a.log", "./d/b.log")
+    assert not calls and not protocol.mock_calls
+
+    # the watchdog thread moves the folder while the reactor thread is sending the due move of a file inside it
+    def move_folder(delay, operation):
+        watchdog = threading.Thread(target=coalescer.send_move_event, args=(True, "./d", "./e"))
+        watchdog.start()
+        watchdog.join(5)
+
+    with patch("client_pkg.coalescing.EVENT_DELAY.observe", side_effect=move_folder):
+        clock.advance(1)
+
+    # the folder is moved once the reactor thread gets to it
+    assert protocol.mock_calls == [call.send_move_event(False, "./d/a.log", "./d/b.log")]
+    for f, args in calls:
+        f(*args)
+    assert protocol.mock_calls == [call.send_move_event(False, "./d/a.log", "./d/b.log"),
+                                   call.send_move_event(True, "./d", "./e")]
+    assert not coalescer.ready and not coalescer.pending
@@ -0,0 +1,111 @@
+import threading
+from unittest.mock import patch, Mock
+from twisted.test.proto_helpers import StringTransport
+from client_pkg.flow import FlowControl
+from client_pkg.journal import Journal
+from client_pkg.protocol import SyncClientProtocol
+from client_pkg.transfer import TransferQueue
+from common_pkg.framing import encode_hello_frame, FrameDecoder, Frame, MSG_CREATED, MSG_CHUNK, FLAG_FIRST, \
+    FLAG_LAST
+
+
+def test_flow_control():
+
+    flow = FlowControl(high_watermark=10, low_watermark=4)
+    flow.reserve(6)
+    assert not flow.full
+    flow.reserve(6, block=False)
+    assert flow.full
+
+    # a producer is held back until the queue drops to the low watermark
+    producer = threading.Thread(target=flow.reserve, args=(1,))
+    producer.start()
+    producer.join(0.1)
+    assert producer.is_alive()
+
+    assert not flow.release(6)
+    producer.join(0.1)
+    assert producer.is_alive()
+
+    assert flow.release(2)
+    producer.join(5)
+    assert not producer.is_alive()
+    assert flow.stats()["queued_bytes"] == 5
+    assert flow.stats()["peak_queued_bytes"] == 12
+    assert flow.stats()["throttled"] == 1
+
+    # nothing is held back once the flow control is closed
+    flow.reserve(10)
+    flow.close()
+    flow.reserve(1)
+    assert flow.queued == 16
+
+
+def test_transfer_queue_flow(tmp_path):
+
+    protocol = Mock()
+    protocol.mode = "binary"
+    protocol.features = set()
+    protocol.compressor = None
+    protocol.transport = StringTransport()
+    queue = TransferQueue(protocol, flow=FlowControl(high_watermark=64, low_watermark=0))
+
+    (tmp_path / "test.log").write_bytes(b"x" * 100)
+    queue.put_frame(Frame(MSG_CREATED, 0, b"./test.log", b""))
+    queue.put_file("./test.log", str(tmp_path / "test.log"))
+    assert queue.flow.queued == 120
+    assert queue.flow.full
+
+    # the room is released once the messages have been written, the protocol is notified when the queue drains
+    queue.resumeProducing()
+    assert queue.flow.queued == 0
+    protocol.queue_drained.assert_called_once_with()
+
+    stats = queue.stats()
+    assert stats["high_watermark"] == 64 and stats["low_watermark"] == 0
+    assert stats["queued_items"] == 0
+
+
+@patch("client_pkg.protocol.reactor")
+def test_protocol_flow(reactor_mock, tmp_path):
+
+    reactor_mock.callFromThread.side_effect = lambda f, *args: f(*args)
+    (tmp_path / "test.log").write_bytes(b"x" * 20)
+
+    journal = Journal(str(tmp_path / "journal"))
+    protocol = SyncClientProtocol(client_id="test", compression=[], journal=journal,
+                                  flow=FlowControl(high_watermark=16, low_watermark=0))
+
+    transport = StringTransport()
+    protocol.makeConnection(transport)
+    protocol.dataReceived(encode_hello_frame())
+    transport.clear()
+
+    # the transport is full - operations are only sent from the journal until the queue reaches its high watermark
+    protocol.queue.pauseProducing()
+    protocol.send_file("./test.log", str(tmp_path / "test.log"))
+    protocol.send_event("created", False, "./new.log")
+    assert protocol.sent_seq == 1
+    assert [seq for seq, _ in journal.pending(0, 10)] == [2]
+
+    # and continued once it has drained
+    protocol.queue.resumeProducing()
+    assert protocol.sent_seq == 2
+    assert FrameDecoder().feed(transport.value()) == [
+        Frame(MSG_CHUNK, FLAG_FIRST | FLAG_LAST, b"./test.log", b"x" * 20),
+        Frame(MSG_CREATED, 0, b"./new.log", b"")
+    ]
+    assert protocol.queue.stats()["pauses"] == 1
+
+    # operations overtake the files of a server supporting streams, they don't wait for the queue to drain
+    protocol.connectionLost(None)
+    transport = StringTransport()
+    protocol.makeConnection(transport)
+    protocol.dataReceived(encode_hello_frame(features=["streams"]))
+    protocol.queue.pauseProducing()
+    protocol.send_file("./test.log", str(tmp_path / "test.log"))
+    protocol.send_event("deleted", False, "./new.log")
+    protocol.send_file("./test.log", str(tmp_path / "test.log"))
+    assert protocol.sent_seq == 4
+    assert [seq for seq, _ in journal.pending(2, 10)] == [5]
+    journal.close()
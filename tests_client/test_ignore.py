@@ -0,0 +1,44 @@
+from client_pkg.ignore import IgnoreRules, IGNORE_FILE
+
+
+def test_ignore_rules():
+
+    rules = IgnoreRules([
+        "# editor and build files\n",
+        "*.swp\n",
+        "!keep.swp\n",
+        "node_modules/\n",
+        "__pycache__\n",
+        "/build\n",
+        "docs/**/*.tmp\n",
+        "cache-?/\n",
+        "*.log\n",
+        "!important.log\n",
+        "logs/\n",
+        "\n"
+    ])
+    assert rules.count == 10 and rules
+
+    assert rules.ignored("./.doc.swp", False) and not rules.ignored("./keep.swp", False)
+    assert rules.ignored("./node_modules", True) and not rules.ignored("./node_modules", False)
+    assert rules.ignored("./app/node_modules/lib/index.js", False), "Everything below an ignored directory is ignored"
+    assert rules.ignored("./src/__pycache__", True) and rules.ignored("./src/__pycache__", False)
+    assert rules.ignored("./build/app.bin", False) and not rules.ignored("./src/build", True), "Rules with a / are anchored"
+    assert rules.ignored("./docs/a/b/c.tmp", False) and rules.ignored("./docs/c.tmp", False)
+    assert not rules.ignored("./src/c.tmp", False)
+    assert rules.ignored("./cache-1", True) and not rules.ignored("./cache-12", True)
+
+    # the last matching rule wins, but nothing below an ignored directory can be included again
+    assert rules.ignored("./debug.log", False) and not rules.ignored("./important.log", False)
+    assert rules.ignored("./logs/important.log", False)
+    assert not rules.ignored("./src/main.py", False) and not rules.ignored(".", True)
+
+
+def test_load_rules(tmp_path):
+
+    assert not IgnoreRules.load(str(tmp_path)), "No rules without an ignore file"
+
+    (tmp_path / IGNORE_FILE).write_text(".git/\n*.o\n")
+    rules = IgnoreRules.load(str(tmp_path))
+    assert rules.ignored("./.git/objects/ab", False) and rules.ignored("./lib/main.o", False)
+    assert not rules.ignored(f"./{IGNORE_FILE}", False)
@@ -0,0 +1,66 @@
+import os
+from unittest.mock import Mock
+from client_pkg.index import FileIndex
+from client_pkg.monitoring import SyncEventHandler
+from common_pkg.manifest import build_manifest
+
+
+def test_file_index(tmp_path):
+
+    root = tmp_path / "root"
+    root.mkdir()
+    (root / "dir").mkdir()
+    (root / "dir" / "a.txt").write_bytes(b"a" * 100)
+    (root / "b.txt").write_bytes(b"b" * 100)
+
+    index = FileIndex(str(tmp_path / "index.sqlite"), str(root))
+
+    # new files have changed, a touch with the same content hasn't
+    assert index.changed("./b.txt", str(root / "b.txt"))
+    assert not index.changed("./b.txt", str(root / "b.txt")), "Unchanged files must be skipped"
+    # the content is hashed the first time the size stays the same
+    os.utime(root / "b.txt", ns=(1, 1))
+    assert index.changed("./b.txt", str(root / "b.txt"))
+    os.utime(root / "b.txt", ns=(2, 2))
+    assert not index.changed("./b.txt", str(root / "b.txt")), "Touched files must be skipped"
+    (root / "b.txt").write_bytes(b"c" * 100)
+    assert index.changed("./b.txt", str(root / "b.txt")), "A rewrite with the same size must be detected"
+    (root / "b.txt").write_bytes(b"c" * 101)
+    assert index.changed("./b.txt", str(root / "b.txt"))
+    assert (index.hits, index.misses) == (2, 4)
+
+    # the index backs the manifests and survives restarts
+    manifest = build_manifest(str(root), index)
+    assert index.changed("./dir/a.txt", str(root / "dir" / "a.txt")) is False
+    index.close()
+
+    index = FileIndex(str(tmp_path / "index.sqlite"), str(root))
+    assert index.get("./dir/a.txt")[3] == manifest.dirs["dir"].files["a.txt"]
+    assert index.lookup(str(root / "b.txt"), os.stat(root / "b.txt")) == manifest.files["b.txt"]
+
+    # moves and deletions of directories apply to everything below them
+    index.move("./dir", "./moved")
+    assert index.get("./dir/a.txt") is None and index.get("./moved/a.txt") is not None
+    index.put("./moved0", os.stat(root / "b.txt"), b"")
+    index.remove("./moved")
+    assert index.get("./moved/a.txt") is None
+    assert index.get("./moved0") is not None, "Only the children of the directory must be removed"
+    index.close()
+
+
+def test_event_handler_with_index(tmp_path):
+
+    (tmp_path / "test.log").write_bytes(b"log")
+    protocol = Mock()
+    index = FileIndex(":memory:", str(tmp_path))
+    handler = SyncEventHandler(protocol, str(tmp_path), index)
+
+    event = Mock(src_path=str(tmp_path / "test.log"), is_directory=False, event_type="modified")
+    handler.on_modified(event)
+    handler.on_modified(event)
+    protocol.send_file.assert_called_once_with("./test.log", str(tmp_path / "test.log"))
+
+    # a re-created file is always sent
+    handler.on_created(Mock(src_path=str(tmp_path / "test.log"), is_directory=False, event_type="created"))
+    handler.on_modified(event)
+    assert protocol.send_file.call_count == 2
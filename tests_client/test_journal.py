@@ -0,0 +1,187 @@
+from unittest.mock import patch
+from twisted.test.proto_helpers import StringTransport
+from client_pkg import journal as journal_module
+from client_pkg.journal import Journal, fold
+from client_pkg.protocol import SyncClientProtocol
+from common_pkg.framing import encode_frame, encode_hello_frame, FrameDecoder, Frame, MSG_CREATED, MSG_DELETED, \
+    MSG_MODIFIED, MSG_MOVED, MSG_CHUNK, MSG_ACK_REQUEST, MSG_ACK, MSG_OPERATION, SEQUENCE, FLAG_DIRECTORY, FLAG_FIRST, \
+    FLAG_LAST
+
+
+def test_journal(tmp_path):
+
+    path = str(tmp_path / "journal")
+    journal = Journal(path)
+    for name in (b"./a", b"./b", b"./c"):
+        journal.append(Frame(MSG_CREATED, 0, name, b""))
+    journal.acknowledge(1)
+    assert [seq for seq, _ in journal.pending(0, 10)] == [2, 3]
+    assert journal.pending(2, 10) == [(3, Frame(MSG_CREATED, 0, b"./c", b""))]
+    journal.close()
+
+    # the pending records survive a restart, a torn record at the end is discarded
+    with open(path, "ab") as fh:
+        fh.write(b"\x00\x00\x00\x40torn")
+    journal = Journal(path)
+    assert [seq for seq, _ in journal.pending(0, 10)] == [2, 3]
+    assert journal.acked == 1
+    assert journal.append(Frame(MSG_DELETED, 0, b"./a", b"")) == 4, "Sequence numbers must continue after a restart"
+
+    # compaction keeps the pending records only, without the redundant ones
+    journal.append(Frame(MSG_MODIFIED, 0, b"./b", b"/abs/b"))
+    journal.acknowledge(2)
+    journal.compact()
+    assert [seq for seq, _ in journal.pending(0, 10)] == [3, 4, 5]
+    journal.close()
+
+    journal = Journal(path)
+    assert (journal.acked, journal.last_seq) == (2, 5)
+    assert journal.stats()["pending"] == 3
+    journal.close()
+
+
+def test_journal_overflow(tmp_path):
+
+    journal = Journal(str(tmp_path / "journal"), max_size=100)
+    for index in range(10):
+        journal.append(Frame(MSG_CREATED, 0, f"./file{index}".encode(), b""))
+
+    # the pending operations are dropped once the journal is full, a reconciliation is needed
+    assert journal.overflowed
+    assert len(journal.pending(0, 100)) < 10
+    journal.close()
+
+
+def test_fold():
+
+    records = list(enumerate([
+        Frame(MSG_CREATED, 0, b"./a", b""),
+        Frame(MSG_MODIFIED, 0, b"./a", b"/abs/a"),
+        Frame(MSG_MODIFIED, 0, b"./b", b"/abs/b"),
+        Frame(MSG_MOVED, 0, b"./b", b"./c"),
+        Frame(MSG_MODIFIED, 0, b"./b", b"/abs/b"),
+        Frame(MSG_MODIFIED, 0, b"./a", b"/abs/a"),
+        Frame(MSG_MODIFIED, 0, b"./d", b"/abs/d"),
+        Frame(MSG_CREATED, FLAG_DIRECTORY, b"./e", b""),
+        Frame(MSG_DELETED, 0, b"./d", b""),
+    ], 1))
+
+    # the uploads of ./a are superseded by the last one, the move of ./b and the directory act as barriers
+    assert [seq for seq, _ in fold(records)] == [3, 4, 5, 6, 7, 8, 9]
+
+
+@patch("client_pkg.protocol.reactor")
+def test_protocol_replay(reactor_mock, tmp_path):
+
+    reactor_mock.callFromThread.side_effect = lambda f, *args: f(*args)
+    (tmp_path / "test.log").write_bytes(b"log")
+
+    # operations are recorded while the client is offline
+    journal = Journal(str(tmp_path / "journal"))
+    protocol = SyncClientProtocol(client_id="test", compression=[], journal=journal)
+    protocol.ACK_BATCH = 2
+    assert protocol.accepting_events
+    protocol.send_event("created", True, "./dir")
+    protocol.send_file("./test.log", str(tmp_path / "test.log"))
+    protocol.send_move_event(False, "./test.log", "./dir/test.log")
+
+    transport = StringTransport()
+    protocol.makeConnection(transport)
+    transport.clear()
+    protocol.dataReceived(encode_hello_frame(features=["ack"]))
+
+    # and replayed in order after connecting, with acknowledgement requests
+    assert FrameDecoder().feed(transport.value()) == [
+        Frame(MSG_CREATED, FLAG_DIRECTORY, b"./dir", b""),
+        Frame(MSG_CHUNK, FLAG_FIRST | FLAG_LAST, b"./test.log", b"log"),
+        Frame(MSG_ACK_REQUEST, 0, b"", SEQUENCE.pack(2)),
+        Frame(MSG_MOVED, 0, b"./test.log", b"./dir/test.log"),
+        Frame(MSG_ACK_REQUEST, 0, b"", SEQUENCE.pack(3))
+    ]
+    transport.clear()
+
+    protocol.dataReceived(encode_frame(MSG_ACK, 0, b"", SEQUENCE.pack(2)))
+    assert [seq for seq, _ in journal.pending(0, 10)] == [3]
+
+    # operations which are not acknowledged are replayed after connecting again
+    protocol.sent_seq = None
+    protocol.mode = None
+    protocol.negotiation_finished("binary")
+    assert FrameDecoder().feed(transport.value()) == [
+        Frame(MSG_MOVED, 0, b"./test.log", b"./dir/test.log"),
+        Frame(MSG_ACK_REQUEST, 0, b"", SEQUENCE.pack(3))
+    ]
+
+    protocol.dataReceived(encode_frame(MSG_ACK, 0, b"", SEQUENCE.pack(3)))
+    assert journal.pending(0, 10) == []
+    journal.close()
+
+
+@patch.object(journal_module, "COMPACT_MIN_SIZE", 0)
+def test_journal_maintenance(tmp_path):
+
+    journal = Journal(str(tmp_path / "journal"))
+    journal.append(Frame(MSG_CREATED, 0, b"./a", b""))
+    journal.acknowledge(1)
+
+    assert journal.worth_compacting()
+    journal.sync_and_compact()
+    assert journal.stats()["compactions"] == 1 and not journal.dirty
+    journal.close()
+
+
+def test_journal_sync(tmp_path):
+
+    journal = Journal(str(tmp_path / "journal"))
+
+    def fsync(fd):
+        assert journal.lock.acquire(blocking=False), "The lock must not be held while syncing"
+        journal.lock.release()
+        synced.append(fd)
+
+    # appending and acknowledging never wait for the disk, the records are synced in groups by the maintenance
+    synced = []
+    with patch("client_pkg.journal.os.fsync", side_effect=fsync):
+        for name in (b"./a", b"./b", b"./c"):
+            journal.append(Frame(MSG_CREATED, 0, name, b""))
+            journal.acknowledge(1)
+        assert not synced and journal.dirty
+
+        journal.sync_and_compact()
+        assert len(synced) == 1 and not journal.dirty
+        journal.close()
+
+
+@patch("client_pkg.protocol.reactor")
+def test_protocol_resume(reactor_mock, tmp_path):
+
+    reactor_mock.callFromThread.side_effect = lambda f, *args: f(*args)
+
+    journal = Journal(str(tmp_path / "journal"))
+    protocol = SyncClientProtocol(client_id="test", compression=[], journal=journal)
+    for name in ("./a", "./b", "./c"):
+        protocol.send_event("deleted", False, name)
+
+    transport = StringTransport()
+    protocol.makeConnection(transport)
+    assert b'"resume": true' in transport.value()
+    transport.clear()
+
+    # the server has applied the first two operations, the last one is sent with its sequence number
+    protocol.dataReceived(encode_hello_frame(features=["ack", "resume"], resume=2))
+    assert journal.acked == 2
+    assert FrameDecoder().feed(transport.value()) == [
+        Frame(MSG_OPERATION, 0, b"", SEQUENCE.pack(3)),
+        Frame(MSG_DELETED, 0, b"./c", b""),
+        Frame(MSG_ACK_REQUEST, 0, b"", SEQUENCE.pack(3))
+    ]
+
+    # the same protocol object is used for the next connection
+    protocol.connectionLost("test")
+    assert protocol.accepting_events, "Events must be recorded while the client connects again"
+    transport = StringTransport()
+    protocol.makeConnection(transport)
+    transport.clear()
+    protocol.dataReceived(encode_hello_frame(features=["ack", "resume"], resume=3))
+    assert transport.value() == b"" and journal.pending(0, 10) == []
+    journal.close()
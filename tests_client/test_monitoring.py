@@ -1,4 +1,7 @@
-from unittest.mock import patch, Mock, MagicMock
+import os
+from unittest.mock import patch, Mock, call
+from client_pkg.ignore import IgnoreRules
+from client_pkg.index import FileIndex
 from client_pkg.monitoring import create_observer, SyncEventHandler
 
 
@@ -17,10 +20,24 @@ def test_observer_creation(observer_mock, handler_mock):
     assert create_observer(protocol, "/var/log") == observer, "Incorrect observer reference returned."
     observer_mock.assert_called_once(), "Observer must have been created through its constructor."
 
-    handler_mock.assert_called_once_with(protocol, "/var/log")
+    handler_mock.assert_called_once_with(protocol, "/var/log", None, None)
     observer.schedule.assert_called_once_with(handler, "/var/log", recursive=True)
 
 
+@patch("client_pkg.monitoring.EventCoalescer")
+@patch("client_pkg.monitoring.SyncEventHandler")
+@patch("client_pkg.monitoring.Observer")
+def test_observer_creation_with_coalescing(observer_mock, handler_mock, coalescer_mock):
+
+    protocol = object()  # used as a mock protocol object
+
+    create_observer(protocol, "/var/log", quiet_window=0.5, max_latency=2)
+
+    coalescer_mock.assert_called_once_with(protocol, "/var/log", 0.5, 2, index=None)
+    coalescer_mock.return_value.start.assert_called_once()
+    handler_mock.assert_called_once_with(coalescer_mock.return_value, "/var/log", None, None)
+
+
 @patch("client_pkg.monitoring.open")
 @patch("client_pkg.monitoring.os.path.exists")
 def test_event_handler(path_exists_mock, open_mock):
@@ -64,15 +81,11 @@ def test_event_handler(path_exists_mock, open_mock):
 
     path_exists_mock.return_value = True
 
-    file_mock = MagicMock()
-    open_mock.return_value = file_mock
-    file_mock.__enter__.return_value.read.return_value = b"This is a test"
-
     handler.on_modified(event)
 
     path_exists_mock.assert_called_once_with("/var/log/testing/test1.log")
-    open_mock.assert_called_once_with("/var/log/testing/test1.log", "rb")
-    protocol.send_modify_event.assert_called_with("./testing/test1.log", b"This is a test")
+    open_mock.assert_not_called()  # the content is streamed by the protocol, never read by the handler
+    protocol.send_file.assert_called_with("./testing/test1.log", "/var/log/testing/test1.log")
 
     # test moved event
     event = Mock()
@@ -82,3 +95,84 @@ def test_event_handler(path_exists_mock, open_mock):
 
     handler.on_moved(event)
     protocol.send_move_event.assert_called_with(True, "./test/test/test1", "./test/test/test2")
+
+
+@patch("client_pkg.monitoring.Observer")
+def test_ignored_paths(observer_mock, tmp_path):
+
+    for path in ("src/app", "src/node_modules/lib", "docs", "node_modules/lib", "moved/sub"):
+        os.makedirs(tmp_path / path)
+    (tmp_path / "moved" / "sub" / "data.txt").write_bytes(b"data")
+    (tmp_path / "moved" / "data.swp").write_bytes(b"swap")
+    root = str(tmp_path)
+
+    # ignored folders are never watched, folders without ignored folders below them get a single recursive watch
+    observer = observer_mock.return_value
+    protocol = Mock()
+    create_observer(protocol, root, ignore=IgnoreRules(["node_modules/\n", "*.swp\n"]))
+    assert sorted((args[1], kwargs["recursive"]) for args, kwargs in observer.schedule.call_args_list) == [
+        (root, False), (f"{root}/docs", True), (f"{root}/moved", True), (f"{root}/src", False),
+        (f"{root}/src/app", True)
+    ]
+
+    # events of ignored paths are dropped before the file is touched
+    handler = observer.schedule.call_args[0][0]
+    handler.on_modified(Mock(src_path=f"{root}/src/node_modules/lib/index.js", is_directory=False))
+    handler.on_created(Mock(src_path=f"{root}/.doc.swp", is_directory=False, event_type="created"))
+    handler.on_deleted(Mock(src_path=f"{root}/node_modules", is_directory=True, event_type="deleted"))
+    protocol.send_file.assert_not_called()
+    protocol.send_event.assert_not_called()
+
+    # an editor save - the swap file moved over the original is a new file for the server
+    handler.on_moved(Mock(src_path=f"{root}/.doc.swp", dest_path=f"{root}/doc.txt", is_directory=False))
+    assert protocol.mock_calls == [
+        call.send_event("created", False, "./doc.txt"),
+        call.send_file("./doc.txt", f"{root}/doc.txt")
+    ]
+
+    # a folder moved from an ignored path is sent with its content, except for the ignored files
+    protocol.reset_mock()
+    handler.on_moved(Mock(src_path=f"{root}/node_modules/moved", dest_path=f"{root}/moved", is_directory=True))
+    assert protocol.mock_calls == [
+        call.send_event("created", True, "./moved"),
+        call.send_event("created", True, "./moved/sub"),
+        call.send_event("created", False, "./moved/sub/data.txt"),
+        call.send_file("./moved/sub/data.txt", f"{root}/moved/sub/data.txt")
+    ]
+
+    # a folder moved to an ignored path is deleted on the server and its watch is removed
+    protocol.reset_mock()
+    handler.on_moved(Mock(src_path=f"{root}/docs", dest_path=f"{root}/node_modules/docs", is_directory=True))
+    protocol.send_event.assert_called_once_with("deleted", True, "./docs")
+    assert f"{root}/docs" not in handler.watches.watches
+
+    # a folder created in a folder watched without its subfolders gets its own watch
+    os.makedirs(tmp_path / "src" / "new")
+    handler.on_created(Mock(src_path=f"{root}/src/new", is_directory=True, event_type="created"))
+    observer.schedule.assert_called_with(handler, f"{root}/src/new", recursive=True)
+
+
+def test_created_file(tmp_path):
+
+    (tmp_path / "new.txt").write_bytes(b"content")
+    created = Mock(src_path=str(tmp_path / "new.txt"), is_directory=False, event_type="created")
+    modified = Mock(src_path=str(tmp_path / "new.txt"), is_directory=False)
+
+    # without the index, the content of a new file is only sent by its modified event
+    protocol = Mock()
+    handler = SyncEventHandler(protocol, str(tmp_path))
+    handler.on_created(created)
+    handler.on_modified(modified)
+    assert protocol.mock_calls == [call.send_event("created", False, "./new.txt"),
+                                   call.send_file("./new.txt", str(tmp_path / "new.txt"))]
+
+    # with the index, it's sent by the created event too (a file moved in from an unwatched folder has no modified
+    # event), but only once
+    protocol.reset_mock()
+    index = FileIndex(":memory:", str(tmp_path))
+    handler = SyncEventHandler(protocol, str(tmp_path), index)
+    handler.on_created(created)
+    handler.on_modified(modified)
+    assert protocol.mock_calls == [call.send_event("created", False, "./new.txt"),
+                                   call.send_file("./new.txt", str(tmp_path / "new.txt"))]
+    index.close()
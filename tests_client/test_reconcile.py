@@ -0,0 +1,82 @@
+from unittest.mock import Mock, patch
+from twisted.internet import defer
+from client_pkg.ignore import IgnoreRules
+from client_pkg.reconcile import Reconciler
+from common_pkg.framing import Frame, MSG_CREATED, MSG_DELETED, MSG_TREE_REQUEST, FLAG_DIRECTORY
+from common_pkg.manifest import build_manifest, encode_listing
+
+
+def test_reconciliation(tmp_path):
+
+    client, server = tmp_path / "client", tmp_path / "server"
+    for root in (client, server):
+        (root / "same" / "deep").mkdir(parents=True)
+        (root / "same" / "deep" / "a.log").write_bytes(b"a")
+        (root / "changed").mkdir()
+        (root / "changed" / "b.log").write_bytes(b"b")
+    (client / "changed" / "b.log").write_bytes(b"modified offline")
+    (client / "changed" / "new.log").write_bytes(b"new")
+    (client / "new_dir").mkdir()
+    (client / "new_dir" / "c.log").write_bytes(b"c")
+    (server / "changed" / "deleted.log").write_bytes(b"deleted offline")
+    (server / "kind").mkdir()
+    (client / "kind").write_bytes(b"now a file")
+
+    protocol = Mock()
+    reconciler = Reconciler(protocol, str(client))
+    with patch("client_pkg.reconcile.threads.deferToThread", side_effect=lambda f, *args: defer.succeed(f(*args))):
+        reconciler.start()
+    server_manifest = build_manifest(str(server))
+
+    def reply(path):
+        directory = server_manifest.find(path)
+        reconciler.listing_received(path.encode("utf-8"), directory.digest + encode_listing(directory.entries()))
+
+    # only the root and the differing directory are compared
+    assert reconciler.pending == {"."}
+    reply(".")
+    assert reconciler.pending == {"./changed"}
+    reply("./changed")
+    assert not reconciler.pending
+
+    frames = [args[0] for args, kwargs in protocol.queue.put_frame.call_args_list]
+    files = sorted(args[0] for args, kwargs in protocol.queue.put_file.call_args_list)
+    assert frames[0].msg_type == MSG_TREE_REQUEST and frames[1].msg_type == MSG_TREE_REQUEST
+    assert sorted(frames[2:]) == sorted([
+        Frame(MSG_DELETED, FLAG_DIRECTORY, b"./kind", b""),
+        Frame(MSG_CREATED, FLAG_DIRECTORY, b"./new_dir", b""),
+        Frame(MSG_DELETED, 0, b"./changed/deleted.log", b"")
+    ])
+    assert files == ["./changed/b.log", "./changed/new.log", "./kind", "./new_dir/c.log"]
+
+    # a directory with the same hash is not compared again
+    protocol.reset_mock()
+    reconciler.manifest = server_manifest
+    reconciler.request(".", server_manifest)
+    reconciler.listing_received(b".", server_manifest.digest)
+    protocol.queue.put_file.assert_not_called()
+    assert len(protocol.queue.put_frame.call_args_list) == 1
+
+
+def test_ignored_paths(tmp_path):
+
+    client, server = tmp_path / "client", tmp_path / "server"
+    for root in (client, server):
+        (root / "node_modules").mkdir(parents=True)
+        (root / "main.py").write_bytes(b"main")
+    (client / "node_modules" / "lib.js").write_bytes(b"client")
+    (client / "main.py.swp").write_bytes(b"swap")
+    (server / "node_modules" / "lib.js").write_bytes(b"server")
+    (server / "build.swp").write_bytes(b"server swap")
+
+    protocol = Mock()
+    reconciler = Reconciler(protocol, str(client), ignore=IgnoreRules(["node_modules/\n", "*.swp\n"]))
+    with patch("client_pkg.reconcile.threads.deferToThread", side_effect=lambda f, *args: defer.succeed(f(*args))):
+        reconciler.start()
+    assert list(reconciler.manifest.files) == ["main.py"] and not reconciler.manifest.dirs
+
+    # ignored paths are neither sent nor deleted
+    server_manifest = build_manifest(str(server))
+    reconciler.listing_received(b".", server_manifest.digest + encode_listing(server_manifest.entries()))
+    assert len(protocol.queue.put_frame.call_args_list) == 1
+    protocol.queue.put_file.assert_not_called()
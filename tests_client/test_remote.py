@@ -0,0 +1,96 @@
+import os
+from client_pkg.index import FileIndex
+from client_pkg.remote import RemoteChanges, PARTIAL_SUFFIX
+from common_pkg.manifest import file_digest
+from common_pkg.echo import EchoFilter
+from common_pkg.framing import Frame, MSG_CHUNK, MSG_DELETED, MSG_MOVED, MSG_VERSION, FLAG_DIRECTORY, FLAG_FIRST, \
+    FLAG_LAST
+from common_pkg.versions import decode_vector, encode_vector
+
+
+def push_file(remote, relative_path, vector, chunks):
+
+    path = relative_path.encode("utf-8")
+    remote.frame_received(Frame(MSG_VERSION, 0, path, encode_vector(vector)))
+    for number, chunk in enumerate(chunks):
+        flags = (FLAG_FIRST if number == 0 else 0) | (FLAG_LAST if number == len(chunks) - 1 else 0)
+        remote.frame_received(Frame(MSG_CHUNK, flags, path, chunk))
+
+
+def test_remote_changes(tmp_path):
+
+    index = FileIndex(":memory:", str(tmp_path))
+    echo = EchoFilter()
+    remote = RemoteChanges(str(tmp_path), index, echo, "alice")
+
+    # a pushed file is renamed into place once complete, its events are echoes
+    push_file(remote, "./dir/a.txt", {"server": 1}, [b"first ", b"second"])
+    assert (tmp_path / "dir" / "a.txt").read_bytes() == b"first second"
+    assert not (tmp_path / "dir" / f"a.txt{PARTIAL_SUFFIX}").exists()
+    assert index.get("./dir/a.txt")[3] == file_digest(str(tmp_path / "dir" / "a.txt"))
+    assert index.version("./dir/a.txt") == {"server": 1}
+    assert echo.match(str(tmp_path / "dir" / "a.txt")) is not None
+
+    # a push concurrent with a local change is dropped, the server resolves the conflict
+    (tmp_path / "dir" / "a.txt").write_bytes(b"local")
+    remote.local_change("./dir/a.txt")
+    index.put("./dir/a.txt", os.stat(tmp_path / "dir" / "a.txt"), None)
+    push_file(remote, "./dir/a.txt", {"server": 2}, [b"server"])
+    assert (tmp_path / "dir" / "a.txt").read_bytes() == b"local"
+    assert decode_vector(remote.version_frame("./dir/a.txt").payload) == {"server": 1, "alice": 1}
+
+    # so is a push of a file changed since it was indexed, even if the change hasn't been handled yet
+    (tmp_path / "dir" / "b.txt").write_bytes(b"unhandled")
+    push_file(remote, "./dir/b.txt", {"server": 1}, [b"server"])
+    assert (tmp_path / "dir" / "b.txt").read_bytes() == b"unhandled"
+
+    # moves and deletions which have seen the local changes are applied
+    remote.frame_received(Frame(MSG_MOVED, 0, b"./dir/a.txt", b"./c.txt"))
+    assert (tmp_path / "c.txt").read_bytes() == b"local"
+    assert index.version("./c.txt") == {"server": 1, "alice": 1}
+    remote.frame_received(Frame(MSG_VERSION, 0, b"./c.txt", encode_vector({"server": 2, "alice": 1})))
+    remote.frame_received(Frame(MSG_DELETED, 0, b"./c.txt", b""))
+    assert not os.path.exists(tmp_path / "c.txt")
+    assert index.get("./c.txt") is None
+    assert index.version("./c.txt") == {"server": 2, "alice": 1}, "The versions of deleted files must be kept"
+
+    assert remote.stats()["applied"] == 2 and remote.stats()["rejected"] == 2
+    index.close()
+
+
+def test_remote_lost_writes(tmp_path):
+
+    index = FileIndex(":memory:", str(tmp_path))
+    remote = RemoteChanges(str(tmp_path), index, EchoFilter(), "alice")
+    push_file(remote, "./dir/synced.txt", {"server": 1}, [b"synced"])
+    push_file(remote, "./dir/sub/edited.txt", {"server": 1}, [b"synced"])
+    push_file(remote, "./b.txt", {"server": 1}, [b"b"])
+    push_file(remote, "./c.txt", {"server": 1}, [b"c"])
+
+    # a local change which hasn't been sent yet, and a new file
+    (tmp_path / "dir" / "sub" / "edited.txt").write_bytes(b"local")
+    (tmp_path / "dir" / "new.txt").write_bytes(b"new")
+
+    # a pushed folder deletion only deletes the files whose changes the server has seen
+    for path in (b"./dir/synced.txt", b"./dir/sub/edited.txt", b"./dir/gone.txt"):
+        remote.frame_received(Frame(MSG_VERSION, 0, path, encode_vector({"server": 1})))
+    remote.frame_received(Frame(MSG_DELETED, FLAG_DIRECTORY, b"./dir", b""))
+    assert sorted(str(path.relative_to(tmp_path / "dir")) for path in (tmp_path / "dir").rglob("*")) == \
+        ["new.txt", "sub", "sub/edited.txt"]
+    assert (tmp_path / "dir" / "sub" / "edited.txt").read_bytes() == b"local"
+    assert index.get("./dir/synced.txt") is None and index.get("./dir/sub/edited.txt") is not None
+    assert not remote.versions
+
+    # a pushed move over a file with local changes keeps a copy of it
+    (tmp_path / "c.txt").write_bytes(b"local c")
+    remote.frame_received(Frame(MSG_VERSION, 0, b"./c.txt", encode_vector({"server": 1})))
+    remote.frame_received(Frame(MSG_MOVED, 0, b"./b.txt", b"./c.txt"))
+    assert (tmp_path / "c.txt").read_bytes() == b"b"
+    assert (tmp_path / "c (conflict alice).txt").read_bytes() == b"local c"
+
+    # ... but not of an unchanged one
+    push_file(remote, "./d.txt", {"server": 1}, [b"d"])
+    remote.frame_received(Frame(MSG_VERSION, 0, b"./d.txt", encode_vector({"server": 1})))
+    remote.frame_received(Frame(MSG_MOVED, 0, b"./c.txt", b"./d.txt"))
+    assert (tmp_path / "d.txt").read_bytes() == b"b" and not (tmp_path / "d (conflict alice).txt").exists()
+    index.close()
@@ -0,0 +1,364 @@
+import io
+import os
+import socket
+import pytest
+from unittest.mock import patch, Mock
+from zope.interface import implementer
+from twisted.internet.interfaces import ITCPTransport
+from twisted.internet.task import Clock
+from client_pkg.zerocopy import write_file_part
+from client_pkg.transfer import TransferQueue, CHUNKS_PER_ITERATION, BATCH_ENTRIES, BATCH_LATENCY, SMALL_FILE_SIZE, \
+    overlaps
+from common_pkg.content import content_hasher, encode_offer, encode_resume, CONTENT_MATERIALISED, CONTENT_NEEDED
+from common_pkg.delta import compute_signature, apply_delta
+from common_pkg.framing import Frame, FrameDecoder, decode_batch, MSG_BATCH, MSG_MODIFIED, MSG_DELETED, MSG_CHUNK, MSG_CREATED, MSG_DELTA, MSG_SIGNATURE_REQUEST, MSG_CONTENT_OFFER, \
+    FLAG_FIRST, FLAG_LAST, FLAG_ABORT, encode_frame
+
+
+def test_transfer_queue(tmp_path):
+
+    clock = Clock()
+    protocol = Mock()
+    protocol.mode = "binary"
+    protocol.features = set()
+    protocol.compressor = None
+    queue = TransferQueue(protocol, chunk_size=2)
+
+    file_path = tmp_path / "test.log"
+    file_path.write_bytes(b"x" * (2 * CHUNKS_PER_ITERATION + 3))
+
+    with patch("client_pkg.transfer.reactor", clock):
+
+        # nothing is written while paused
+        queue.put_frame(Frame(MSG_CREATED, 0, b"./test.log", b""))
+        queue.put_file("./test.log", str(file_path))
+        queue.put_frame(Frame(MSG_CREATED, 0, b"./test2.log", b""))
+        protocol.write_frame.assert_not_called()
+
+        # a single iteration writes a bounded number of chunks, after the first one sent when the transfer starts
+        queue.resumeProducing()
+        frames = [args[0] for args, kwargs in protocol.write_frame.call_args_list]
+        assert frames[0] == Frame(MSG_CREATED, 0, b"./test.log", b"")
+        assert frames[1] == Frame(MSG_CHUNK, FLAG_FIRST, b"./test.log", b"xx")
+        assert len(frames) == 2 + CHUNKS_PER_ITERATION
+        assert len(clock.getDelayedCalls()) == 1
+
+        # the transport is full - nothing is written until it is resumed
+        queue.pauseProducing()
+        clock.advance(0)
+        assert protocol.write_frame.call_count == 2 + CHUNKS_PER_ITERATION
+
+        queue.resumeProducing()
+        frames = [args[0] for args, kwargs in protocol.write_frame.call_args_list]
+        assert frames[-2] == Frame(MSG_CHUNK, FLAG_LAST, b"./test.log", b"x")
+        assert frames[-1] == Frame(MSG_CREATED, 0, b"./test2.log", b"")
+        assert b"".join(frame.payload for frame in frames) == file_path.read_bytes()
+
+        # dropping everything when the connection is lost
+        queue.put_file("./test.log", str(file_path))
+        queue.pauseProducing()
+        queue.put_frame(Frame(MSG_CREATED, 0, b"./test3.log", b""))
+        queue.stopProducing()
+        assert not queue.streams and not queue.items
+        assert queue.flow.queued == 0, "The room of the dropped messages must be released"
+
+
+def test_delta_transfer(tmp_path):
+
+    protocol = Mock()
+    protocol.mode = "binary"
+    protocol.features = {"delta"}
+    protocol.compressor = None
+    queue = TransferQueue(protocol, chunk_size=1024, delta_min_size=4096)
+    queue.paused = False
+
+    old_content = bytes(range(256)) * 64
+    new_content = old_content[:5000] + b"changed" + old_content[5000:]
+    file_path = tmp_path / "test.bin"
+    file_path.write_bytes(new_content)
+
+    with patch("client_pkg.transfer.reactor", Clock()):
+
+        # the signature of the server's copy is requested first and the queue waits for it
+        queue.put_file("./test.bin", str(file_path))
+        queue.put_frame(Frame(MSG_CREATED, 0, b"./test2.log", b""))
+        protocol.write_frame.assert_called_once_with(Frame(MSG_SIGNATURE_REQUEST, 0, b"./test.bin", b""))
+
+        # unexpected signatures are ignored
+        queue.signature_received(b"./other.bin", b"")
+        assert queue.streams[b"./test.bin"].waiting
+
+        queue.signature_received(b"./test.bin", compute_signature(io.BytesIO(old_content), len(old_content), 1024))
+
+    frames = [args[0] for args, kwargs in protocol.write_frame.call_args_list[1:]]
+    assert frames[-1] == Frame(MSG_CREATED, 0, b"./test2.log", b"")
+
+    delta_frames = frames[:-1]
+    assert all(frame.msg_type == MSG_DELTA for frame in delta_frames)
+    assert delta_frames[0].flags & FLAG_FIRST and delta_frames[-1].flags & FLAG_LAST
+
+    # only the changed block is sent as literal data
+    assert sum(len(frame.payload) for frame in delta_frames) < 2 * 1024
+
+    rebuilt = io.BytesIO()
+    for frame in delta_frames:
+        apply_delta(frame.payload, io.BytesIO(old_content), rebuilt)
+    assert rebuilt.getvalue() == new_content
+
+
+def test_dedup_transfer(tmp_path):
+
+    protocol = Mock()
+    protocol.mode = "binary"
+    protocol.features = {"dedup"}
+    protocol.compressor = None
+    queue = TransferQueue(protocol, chunk_size=4, dedup_min_size=8)
+    queue.paused = False
+
+    content = b"0123456789"
+    hasher = content_hasher()
+    hasher.update(content)
+    offer = Frame(MSG_CONTENT_OFFER, 0, b"./test.log", encode_offer(hasher.digest(), len(content)))
+    (tmp_path / "test.log").write_bytes(content)
+
+    with patch("client_pkg.transfer.reactor", Clock()):
+
+        # the file is hashed and offered, nothing else is sent until the server replies
+        queue.put_file("./test.log", str(tmp_path / "test.log"))
+        queue.put_frame(Frame(MSG_CREATED, 0, b"./test2.log", b""))
+        protocol.write_frame.assert_called_once_with(offer)
+
+        # the server has the content
+        queue.content_reply_received(b"./test.log", CONTENT_MATERIALISED)
+        assert protocol.write_frame.call_args_list[-1][0][0] == Frame(MSG_CREATED, 0, b"./test2.log", b"")
+        assert protocol.write_frame.call_count == 2
+
+        # the server needs the content
+        queue.put_file("./test.log", str(tmp_path / "test.log"))
+        queue.content_reply_received(b"./test.log", CONTENT_NEEDED)
+
+    frames = [args[0] for args, kwargs in protocol.write_frame.call_args_list[2:]]
+    assert frames[0] == offer
+    assert frames[1:] == [
+        Frame(MSG_CHUNK, FLAG_FIRST, b"./test.log", b"0123"),
+        Frame(MSG_CHUNK, 0, b"./test.log", b"4567"),
+        Frame(MSG_CHUNK, FLAG_LAST, b"./test.log", b"89")
+    ]
+
+
+def test_resumed_transfer(tmp_path):
+
+    protocol = Mock()
+    protocol.mode = "binary"
+    protocol.features = {"dedup"}
+    protocol.compressor = None
+    queue = TransferQueue(protocol, chunk_size=4, dedup_min_size=8)
+    queue.paused = False
+    (tmp_path / "test.log").write_bytes(b"0123456789")
+
+    with patch("client_pkg.transfer.reactor", Clock()):
+
+        # the server has staged the first 6 bytes of the file, the rest is sent as part of the same transfer
+        queue.put_file("./test.log", str(tmp_path / "test.log"))
+        queue.content_reply_received(b"./test.log", encode_resume(6))
+
+    frames = [args[0] for args, kwargs in protocol.write_frame.call_args_list[1:]]
+    assert frames == [
+        Frame(MSG_CHUNK, 0, b"./test.log", b"6789"),
+        Frame(MSG_CHUNK, FLAG_LAST, b"./test.log", b"")
+    ]
+    assert not queue.streams and queue.flow.queued == 0
+
+
+def test_batch_transfer(tmp_path):
+
+    clock = Clock()
+    protocol = Mock()
+    protocol.mode = "binary"
+    protocol.features = {"batch"}
+    protocol.compressor = None
+    queue = TransferQueue(protocol)
+    queue.paused = False
+
+    (tmp_path / "small.log").write_bytes(b"small")
+    (tmp_path / "big.bin").write_bytes(b"x" * SMALL_FILE_SIZE)
+
+    with patch("client_pkg.transfer.reactor", clock):
+
+        # operations and small files are held back for the latency budget of the batch
+        queue.put_frame(Frame(MSG_CREATED, 0, b"./a.log", b""))
+        queue.put_file("./small.log", str(tmp_path / "small.log"))
+        protocol.write_frame.assert_not_called()
+
+        clock.advance(BATCH_LATENCY)
+        [batch] = [args[0] for args, kwargs in protocol.write_frame.call_args_list]
+        assert batch.msg_type == MSG_BATCH
+        assert decode_batch(batch.payload) == [Frame(MSG_CREATED, 0, b"./a.log", b""),
+                                               Frame(MSG_MODIFIED, 0, b"./small.log", b"small")]
+        protocol.write_frame.reset_mock()
+
+        # a message which can't be batched is sent after the batch, a single message is sent as it is
+        queue.put_frame(Frame(MSG_DELETED, 0, b"./a.log", b""))
+        queue.put_file("./big.bin", str(tmp_path / "big.bin"))
+        frames = [args[0] for args, kwargs in protocol.write_frame.call_args_list]
+        assert frames[0] == Frame(MSG_DELETED, 0, b"./a.log", b"")
+        assert frames[1].msg_type == MSG_CHUNK
+        protocol.write_frame.reset_mock()
+
+        # full batches are sent straight away
+        for index in range(BATCH_ENTRIES + 1):
+            queue.put_frame(Frame(MSG_CREATED, 0, f"./{index}.log".encode("utf-8"), b""))
+        [batch] = [args[0] for args, kwargs in protocol.write_frame.call_args_list]
+        assert len(decode_batch(batch.payload)) == BATCH_ENTRIES
+
+        clock.advance(BATCH_LATENCY)
+        assert protocol.write_frame.call_count == 2
+        assert queue.batches == 2
+        assert queue.flow.queued == 0
+
+
+def test_multiplexed_transfer(tmp_path):
+
+    protocol = Mock()
+    protocol.mode = "binary"
+    protocol.features = {"streams"}
+    protocol.compressor = None
+    queue = TransferQueue(protocol, chunk_size=2, max_streams=2)
+
+    for name in ("a", "b", "c"):
+        (tmp_path / f"{name}.bin").write_bytes(name.encode("utf-8") * 5)
+
+    with patch("client_pkg.transfer.reactor", Clock()):
+
+        # messages overtake the files being streamed, unless they depend on them, and the files take turns
+        queue.put_file("./a.bin", str(tmp_path / "a.bin"))
+        queue.put_file("./b.bin", str(tmp_path / "b.bin"))
+        queue.put_frame(Frame(MSG_CREATED, 0, b"./x.log", b""))
+        queue.put_frame(Frame(MSG_DELETED, 0, b"./a.bin", b""))
+        queue.put_frame(Frame(MSG_CREATED, 0, b"./y.log", b""))
+        queue.resumeProducing()
+
+        frames = [args[0] for args, kwargs in protocol.write_frame.call_args_list]
+        assert frames == [
+            Frame(MSG_CHUNK, FLAG_FIRST, b"./a.bin", b"aa"),
+            Frame(MSG_CHUNK, FLAG_FIRST, b"./b.bin", b"bb"),
+            Frame(MSG_CREATED, 0, b"./x.log", b""),
+            Frame(MSG_CHUNK, 0, b"./a.bin", b"aa"),
+            Frame(MSG_CHUNK, 0, b"./b.bin", b"bb"),
+            Frame(MSG_CHUNK, FLAG_LAST, b"./a.bin", b"a"),
+            Frame(MSG_DELETED, 0, b"./a.bin", b""),
+            Frame(MSG_CREATED, 0, b"./y.log", b""),
+            Frame(MSG_CHUNK, FLAG_LAST, b"./b.bin", b"b")
+        ]
+        protocol.write_frame.reset_mock()
+
+        # a file waits for a stream to finish, the messages behind it keep their order
+        queue.pauseProducing()
+        for name in ("a", "b", "c"):
+            queue.put_file(f"./{name}.bin", str(tmp_path / f"{name}.bin"))
+        queue.put_frame(Frame(MSG_CREATED, 0, b"./z.log", b""))
+        queue.resumeProducing()
+
+        frames = [args[0] for args, kwargs in protocol.write_frame.call_args_list]
+        assert frames.index(Frame(MSG_CHUNK, FLAG_FIRST, b"./c.bin", b"cc")) == \
+            frames.index(Frame(MSG_CHUNK, FLAG_LAST, b"./a.bin", b"a")) + 1
+        assert frames.index(Frame(MSG_CREATED, 0, b"./z.log", b"")) == \
+            frames.index(Frame(MSG_CHUNK, FLAG_FIRST, b"./c.bin", b"cc")) + 1
+        assert len(frames) == 10 and not queue.streams
+        assert queue.flow.queued == 0
+
+    assert overlaps(b"./dir", b"./dir/a.log") and overlaps(b"./dir/a.log", b"./dir")
+    assert not overlaps(b"./dir", b"./dir2") and not overlaps(b"./a.log", b"./b.log")
+
+
+@implementer(ITCPTransport)
+class SocketTransport:
+    """
+    The part of a TCP transport used by the queue - what the socket doesn't take is buffered until it's drained, and
+    the producer is paused while more than the buffer size is buffered.
+    """
+
+    def __init__(self, sock, buffer_size=64 * 1024):
+        self.sock = sock
+        self.buffer_size = buffer_size
+        self.buffered = []
+        self.producer = None
+        self.producer_paused = False
+
+    def getHandle(self):
+        return self.sock
+
+    def writeSequence(self, data):
+        self.buffered.extend(data)
+        if not self.producer_paused and sum(len(part) for part in self.buffered) > self.buffer_size:
+            self.producer_paused = True
+            self.producer.pauseProducing()
+
+    def drain(self, stream):
+        stream += b"".join(self.buffered)
+        self.buffered.clear()
+        if self.producer_paused:
+            self.producer_paused = False
+            self.producer.resumeProducing()
+
+
+@pytest.mark.skipif(not hasattr(os, "sendfile"), reason="os.sendfile is not available")
+def test_zero_copy_transfer(tmp_path):
+
+    clock = Clock()
+    sender, receiver = socket.socketpair()
+    sender.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 16 * 1024)
+    sender.setblocking(False)
+    receiver.setblocking(False)
+
+    transport = SocketTransport(sender)
+    protocol = Mock(mode="binary", features=set(), compressor=None, transport=transport)
+    protocol.write_frame.side_effect = lambda frame: transport.writeSequence([encode_frame(*frame)])
+    queue = transport.producer = TransferQueue(protocol, chunk_size=64 * 1024)
+
+    content = os.urandom(1024 * 1024 + 5)
+    (tmp_path / "test.bin").write_bytes(content)
+    (tmp_path / "truncated.bin").write_bytes(content)
+
+    def truncate(transport, prefix, fh, offset, count):
+        if fh.name.endswith("truncated.bin") and offset >= 512 * 1024:
+            os.truncate(fh.name, offset + 10)
+        return write_file_part(transport, prefix, fh, offset, count)
+
+    stream = bytearray()
+
+    def receive():
+        try:
+            while True:
+                stream.extend(receiver.recv(1024 * 1024))
+        except BlockingIOError:
+            pass
+
+    with patch("client_pkg.transfer.reactor", clock), patch("client_pkg.transfer.write_file_part", truncate):
+        queue.put_file("./test.bin", str(tmp_path / "test.bin"))
+        queue.put_file("./truncated.bin", str(tmp_path / "truncated.bin"))
+        queue.start()
+
+        # the chunks are sent from the page cache once the transport has drained its buffer, the socket is drained
+        # before the transport so that the order of the bytes is kept
+        while queue.streams or queue.items or transport.buffered:
+            clock.advance(0)
+            receive()
+            transport.drain(stream)
+        receive()
+
+    sender.close()
+    receiver.close()
+
+    frames = FrameDecoder().feed(bytes(stream))
+    assert all(frame.msg_type == MSG_CHUNK for frame in frames)
+    sent = [frame for frame in frames if frame.path == b"./test.bin"]
+    assert sent[0].flags & FLAG_FIRST and sent[-1].flags & FLAG_LAST
+    assert b"".join(frame.payload for frame in sent) == content
+    assert 0 < queue.zero_copy_bytes < 2 * len(content), "Part of the content should have been sent from the page cache"
+
+    # the transfer of a file truncated while a chunk is sent from the page cache is aborted, not completed with zeroes
+    truncated = [frame for frame in frames if frame.path == b"./truncated.bin"]
+    assert truncated[-1] == Frame(MSG_CHUNK, FLAG_ABORT, b"./truncated.bin", b"")
+    assert not any(frame.flags & FLAG_LAST for frame in truncated)
+    assert not queue.streams and queue.flow.queued == 0
@@ -0,0 +1,58 @@
+import os
+from unittest.mock import patch
+from pytest import raises, mark
+from common_pkg.compression import CODECS, CompressionError, PayloadCompressor, PayloadDecompressor, ZlibCodec, \
+    choose_codec, READ_SIZE
+
+
+@mark.parametrize("name", list(CODECS))
+def test_codecs(name):
+
+    codec = CODECS[name]
+    data = b"compressible line of text\n" * 50000
+
+    payload = codec.compress(data)
+    pieces = list(codec.decompress(payload))
+    assert b"".join(pieces) == data
+    assert all(len(piece) <= READ_SIZE for piece in pieces), "Payloads must be decompressed in bounded pieces"
+
+    with raises(CompressionError):
+        list(codec.decompress(payload[:len(payload) // 2]))
+
+
+def test_choose_codec():
+
+    assert choose_codec(["lzma", "zlib"]).name == "zlib", "The preference of the server must be used"
+    assert choose_codec(["lzma"]).name == "lzma"
+    assert choose_codec(["unknown"]) is None
+    assert choose_codec([]) is None
+
+
+def test_payload_compression():
+
+    compressor = PayloadCompressor(ZlibCodec())
+    text = b"compressible line of text\n" * 10000
+    noise = os.urandom(len(text))
+
+    assert compressor.worth_compressing(text)
+    assert not compressor.worth_compressing(noise), "Incompressible data must be detected from a sample"
+    assert not compressor.worth_compressing(b"short")
+
+    compressed, payload = compressor.compress(text)
+    assert compressed and len(payload) < len(text) // 10
+
+    compressed, payload = compressor.compress(noise)
+    assert not compressed and payload == noise, "Payloads which don't shrink must be sent as they are"
+
+    stats = compressor.stats.as_dict()
+    assert stats["compressed"] == 1 and stats["skipped"] == 1
+    assert stats["bytes_saved"] > 0 and stats["raw_bytes"] == 2 * len(text)
+
+    decompressor = PayloadDecompressor(ZlibCodec())
+    assert decompressor.decompress(ZlibCodec().compress(text)) == text
+    assert decompressor.stats.as_dict()["raw_bytes"] == len(text)
+
+    # payloads decompressing to too much data are refused
+    with patch("common_pkg.compression.MAX_DECOMPRESSED_SIZE", len(text) - 1):
+        with raises(CompressionError):
+            decompressor.decompress(ZlibCodec().compress(text))
@@ -0,0 +1,103 @@
+import io
+import os
+import random
+import zlib
+from pytest import raises
+from common_pkg.delta import DeltaEncoder, DeltaError, apply_delta, compute_signature, empty_signature, \
+    decode_signature, block_size_for, strong_hash, ADLER_MODULUS, MIN_BLOCK_SIZE, MAX_BLOCK_SIZE, COPY_OP, DATA_OP, \
+    COPY, DATA
+
+
+def encode(old, new, block_size, max_payload_length):
+
+    signature = compute_signature(io.BytesIO(old), len(old), block_size)
+    encoder = DeltaEncoder(signature, io.BytesIO(new), max_payload_length)
+
+    rebuilt = io.BytesIO()
+    for payload in encoder:
+        assert len(payload) <= max_payload_length
+        apply_delta(payload, io.BytesIO(old), rebuilt)
+
+    assert rebuilt.getvalue() == new
+    return encoder
+
+
+def test_rolling_checksum():
+
+    data = os.urandom(3000)
+    block_size = 1024
+
+    weak = zlib.adler32(data[:block_size])
+    a, b = weak & 0xffff, weak >> 16
+    for i in range(len(data) - block_size):
+        a = (a - data[i] + data[i + block_size]) % ADLER_MODULUS
+        b = (b - block_size * data[i] + a - 1) % ADLER_MODULUS
+        assert (b << 16) | a == zlib.adler32(data[i + 1:i + 1 + block_size])
+
+
+def test_signature():
+
+    assert block_size_for(0) == MIN_BLOCK_SIZE
+    assert block_size_for(100 * 1024 * 1024) == 10 * 1024
+    assert block_size_for(2 ** 50) == MAX_BLOCK_SIZE
+
+    data = b"a" * 2048 + b"b" * 100
+    block_size, table = decode_signature(compute_signature(io.BytesIO(data), len(data), 1024))
+    assert block_size == 1024
+    assert table[zlib.adler32(b"a" * 1024)] == {strong_hash(b"a" * 1024): 0}, "First identical block must be kept"
+    assert table[zlib.adler32(b"b" * 100)] == {strong_hash(b"b" * 100): 2048}
+
+    assert decode_signature(empty_signature()) == (MIN_BLOCK_SIZE, {})
+    with raises(DeltaError):
+        decode_signature(b"short")
+
+
+def test_delta():
+
+    old = os.urandom(64 * 1024)
+
+    # unchanged file - a single copy operation
+    encoder = encode(old, old, 1024, 4096)
+    assert encoder.copied == len(old) and encoder.literal == 0
+
+    # insertion shifting the rest of the file
+    new = old[:10000] + b"inserted" + old[10000:]
+    encoder = encode(old, new, 1024, 4096)
+    assert encoder.literal < 2 * 1024
+
+    # rewritten file - everything sent as literal data
+    new = os.urandom(64 * 1024)
+    encoder = encode(old, new, 1024, 4096)
+    assert encoder.copied == 0 and encoder.literal == len(new)
+
+    # no existing copy
+    encoder = DeltaEncoder(empty_signature(), io.BytesIO(new), 4096)
+    rebuilt = io.BytesIO()
+    for payload in encoder:
+        apply_delta(payload, None, rebuilt)
+    assert rebuilt.getvalue() == new
+
+    # random edits
+    rng = random.Random(7)
+    for _ in range(50):
+        new = bytearray(old[:rng.randint(0, len(old))])
+        for _ in range(rng.randint(0, 4)):
+            position = rng.randint(0, len(new))
+            if rng.random() < 0.5:
+                new[position:position] = os.urandom(rng.randint(1, 3000))
+            else:
+                del new[position:position + rng.randint(1, 3000)]
+        encode(old, bytes(new), rng.choice([7, 512, 1024]), rng.choice([64, 4096]))
+
+
+def test_apply_delta_errors():
+
+    for payload in (b"X", COPY_OP.pack(COPY, 0, 10)[:-1], DATA_OP.pack(DATA, 10) + b"short"):
+        with raises(DeltaError):
+            apply_delta(payload, io.BytesIO(b"0123456789"), io.BytesIO())
+
+    with raises(DeltaError):
+        apply_delta(COPY_OP.pack(COPY, 0, 10), None, io.BytesIO())
+
+    with raises(DeltaError):
+        apply_delta(COPY_OP.pack(COPY, 5, 10), io.BytesIO(b"0123456789"), io.BytesIO())
@@ -0,0 +1,16 @@
+from pytest import raises
+from twisted.internet import reactor
+from common_pkg.engine import engine_argument, engine_of, install_engine, ASYNCIO, TWISTED
+
+
+def test_engine():
+
+    assert engine_argument(["/data", "127.0.0.1", "--engine", "asyncio", "--bidirectional"]) == ASYNCIO
+    assert engine_argument(["/data", "--port", "9999"]) == TWISTED
+
+    # the reactor can't be replaced once it has been installed
+    assert install_engine(engine_of(reactor)) is reactor
+    with raises(RuntimeError):
+        install_engine(ASYNCIO if engine_of(reactor) == TWISTED else TWISTED)
+    with raises(ValueError):
+        install_engine("gevent")
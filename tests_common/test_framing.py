@@ -0,0 +1,73 @@
+from pytest import raises
+from common_pkg.framing import FrameDecoder, Frame, ProtocolError, encode_frame, encode_legacy_frame, \
+    decode_legacy_line, decode_hello, encode_hello_line, encode_batch, decode_batch, HEADER, MSG_CREATED, MSG_MODIFIED, MSG_MOVED, MSG_HELLO, \
+    FLAG_DIRECTORY, LEGACY_DELIMITER
+
+
+def test_frame_decoder():
+
+    decoder = FrameDecoder(max_payload_length=1024)
+
+    first = encode_frame(MSG_CREATED, FLAG_DIRECTORY, b"./test")
+    second = encode_frame(MSG_MODIFIED, 0, b"./test.log", b"::content" + LEGACY_DELIMITER)
+
+    # partial header and partial frame
+    assert decoder.feed(first[:3]) == []
+    assert decoder.feed(first[3:] + second[:-1]) == [Frame(MSG_CREATED, FLAG_DIRECTORY, b"./test", b"")]
+    assert decoder.buffered == len(second) - 1
+
+    frames = decoder.feed(second[-1:])
+    assert frames == [Frame(MSG_MODIFIED, 0, b"./test.log", b"::content" + LEGACY_DELIMITER)]
+    assert not frames[0].is_directory
+    assert decoder.buffered == 0
+
+    # empty path and payload
+    assert decoder.feed(encode_frame(MSG_HELLO, 0)) == [Frame(MSG_HELLO, 0, b"", b"")]
+
+    with raises(ProtocolError):
+        decoder.feed(HEADER.pack(1, MSG_MODIFIED, 0, 0, 1025))
+
+    with raises(ProtocolError):
+        FrameDecoder().feed(HEADER.pack(2, MSG_MODIFIED, 0, 0, 0))
+
+
+def test_legacy_format():
+
+    frame = Frame(MSG_MOVED, FLAG_DIRECTORY, b"./test1", b"./test2")
+    assert encode_legacy_frame(frame) == b"moved::1::./test1::./test2\r\r\r\n\n\n"
+    assert decode_legacy_line(b"moved::1::./test1::./test2") == frame
+
+    frame = Frame(MSG_MODIFIED, 0, b"./test.log", b"content::with separator")
+    assert encode_legacy_frame(frame) == b"modified::0::./test.log::content::with separator\r\r\r\n\n\n"
+    assert decode_legacy_line(b"modified::0::./test.log::content::with separator") == frame
+
+    assert decode_legacy_line(b"created::0::./test.log") == Frame(MSG_CREATED, 0, b"./test.log", b"")
+
+    for line in (b"created::0", b"unknown::0::./test", b"created::x::./test", b"moved::0::./test"):
+        with raises(ProtocolError):
+            decode_legacy_line(line)
+
+    with raises(ProtocolError):
+        encode_legacy_frame(Frame(MSG_HELLO, 0, b"", b""))
+
+
+def test_hello():
+
+    line = encode_hello_line(client="test")
+    assert line.startswith(b"hello::0::") and line.endswith(LEGACY_DELIMITER)
+    assert decode_hello(line[len(b"hello::0::"):-len(LEGACY_DELIMITER)]) == {"client": "test", "version": 1}
+
+    for body in (b"not json", b"[]", b'{"version": "1"}'):
+        with raises(ProtocolError):
+            decode_hello(body)
+
+
+def test_batch():
+
+    frames = [Frame(MSG_CREATED, FLAG_DIRECTORY, b"./dir", b""), Frame(MSG_MODIFIED, 0, b"./dir/a.log", b"a"),
+              Frame(MSG_MOVED, 0, b"./dir/a.log", b"./b.log")]
+    payload = encode_batch(frames)
+    assert decode_batch(payload) == frames
+
+    with raises(ProtocolError):
+        decode_batch(payload[:-1])
@@ -0,0 +1,48 @@
+import os
+from unittest.mock import patch
+from pytest import raises
+from common_pkg.content import DIGEST_SIZE
+from common_pkg.manifest import HashCache, ManifestError, build_manifest, encode_listing, decode_listing, file_digest, \
+    FILE, DIRECTORY
+
+
+def test_manifest(tmp_path):
+
+    (tmp_path / "a" / "b").mkdir(parents=True)
+    (tmp_path / "a" / "b" / "c.log").write_bytes(b"c")
+    (tmp_path / "a" / "d.log").write_bytes(b"d")
+    (tmp_path / "e.log").write_bytes(b"e")
+    (tmp_path / "empty").mkdir()
+    (tmp_path / "ignored.tmp").write_bytes(b"ignored")
+    os.symlink(str(tmp_path / "e.log"), str(tmp_path / "link.log"))
+
+    cache = HashCache()
+    manifest = build_manifest(str(tmp_path), cache, lambda path, is_directory: path.endswith(".tmp"))
+    assert sorted(manifest.files) == ["e.log"], "Symbolic links and ignored files must be skipped"
+    assert sorted(manifest.dirs) == ["a", "empty"]
+    assert manifest.find("./a/b").files["c.log"] == file_digest(str(tmp_path / "a" / "b" / "c.log"))
+    assert manifest.find("./missing") is None
+    assert [path for path, _ in manifest.walk()] == [".", "./a", "./a/b", "./empty"]
+
+    # unchanged files are not read again
+    with patch("common_pkg.manifest.file_digest") as digest_mock:
+        assert build_manifest(str(tmp_path), cache, lambda path, is_directory: path.endswith(".tmp")).digest == manifest.digest
+        digest_mock.assert_not_called()
+
+    # a change deep in the tree changes the hashes of all its ancestors only
+    (tmp_path / "a" / "b" / "c.log").write_bytes(b"changed")
+    changed = build_manifest(str(tmp_path), cache, lambda path, is_directory: path.endswith(".tmp"))
+    assert changed.digest != manifest.digest
+    assert changed.find("./a").digest != manifest.find("./a").digest
+    assert changed.find("./empty").digest == manifest.find("./empty").digest
+
+
+def test_listing_encoding():
+
+    entries = [("a.log", FILE, b"1" * DIGEST_SIZE), ("dir", DIRECTORY, b"2" * DIGEST_SIZE), ("ü", FILE, b"3" * DIGEST_SIZE)]
+    payload = encode_listing(entries)
+    assert decode_listing(payload, DIGEST_SIZE) == {name: (kind, digest) for name, kind, digest in entries}
+    assert decode_listing(b"", DIGEST_SIZE) == {}
+
+    with raises(ManifestError):
+        decode_listing(payload[:-1], DIGEST_SIZE)
@@ -0,0 +1,69 @@
+import logging
+from twisted.web.test.requesthelper import DummyRequest
+from common_pkg.logs import configure_logging, event_log, SampleFilter
+from common_pkg.metrics import MetricsPage, Registry
+
+
+def test_metrics():
+
+    registry = Registry()
+    messages = registry.counter("messages_total", "Messages", ("type",))
+    latency = registry.histogram("apply_seconds", "Latency", buckets=(0.1, 1.0))
+    queue = []
+    registry.gauge("queued", "Queue depth", lambda: len(queue))
+
+    messages.inc("created")
+    messages.inc("created", amount=2)
+    messages.inc("say \"hi\"")
+    latency.observe(0.05)
+    latency.observe(0.5)
+    latency.observe(5)
+    queue.append(1)
+
+    # a counter registered again is shared
+    assert registry.counter("messages_total", "Messages", ("type",)) is messages
+
+    request = DummyRequest([b"metrics"])
+    body = MetricsPage(registry).render_GET(request).decode("utf-8")
+    assert request.responseHeaders.getRawHeaders(b"content-type") == [b"text/plain; version=0.0.4; charset=utf-8"]
+    assert body == "\n".join([
+        "# HELP messages_total Messages",
+        "# TYPE messages_total counter",
+        "messages_total{type=\"created\"} 3",
+        "messages_total{type=\"say \\\"hi\\\"\"} 1",
+        "# HELP apply_seconds Latency",
+        "# TYPE apply_seconds histogram",
+        "apply_seconds_bucket{le=\"0.1\"} 1",
+        "apply_seconds_bucket{le=\"1.0\"} 2",
+        "apply_seconds_bucket{le=\"+Inf\"} 3",
+        "apply_seconds_sum 5.55",
+        "apply_seconds_count 3",
+        "# HELP queued Queue depth",
+        "# TYPE queued gauge",
+        "queued 1",
+    ]) + "\n"
+
+    assert registry.snapshot() == {"messages_total": {"created": 3, "say \"hi\"": 1},
+                                   "apply_seconds": {"count": 3, "mean": 1.85}, "queued": 1}
+
+
+def test_sampled_logging():
+
+    sample = SampleFilter(3)
+    records = [logging.LogRecord("syncapp.events", logging.INFO, __file__, 1, "event", None, None) for _ in range(7)]
+
+    # the first record is kept, then one in every three
+    assert [sample.filter(record) for record in records] == [True, False, False, True, False, False, True]
+
+
+def test_configure_logging():
+
+    # the listener is stopped when the process exits
+    configure_logging(logging.DEBUG, 10)
+    try:
+        # watchdog's per-event records are dropped, the per-event records of the client and the server are sampled
+        assert logging.getLogger("watchdog").getEffectiveLevel() == logging.INFO
+        assert any(isinstance(log_filter, SampleFilter) for log_filter in event_log.filters)
+    finally:
+        logging.getLogger("watchdog").setLevel(logging.NOTSET)
+        event_log.filters.clear()
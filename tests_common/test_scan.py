@@ -0,0 +1,67 @@
+import os
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+from unittest.mock import Mock, patch
+from common_pkg.manifest import HashCache, build_manifest, file_digest
+from common_pkg.scan import ScanPool, hash_file, MMAP_THRESHOLD
+
+
+def make_tree(root):
+
+    for number in range(200):
+        folder = root / f"dir{number % 5}" / f"sub{number % 3}"
+        folder.mkdir(parents=True, exist_ok=True)
+        (folder / f"file{number}.log").write_bytes(str(number).encode("utf-8") * number)
+    (root / "big.bin").write_bytes(os.urandom(MMAP_THRESHOLD + 1))
+    (root / "ignored").mkdir()
+    (root / "ignored" / "a.log").write_bytes(b"a")
+    os.symlink(str(root / "big.bin"), str(root / "link.bin"))
+
+
+def test_scan_pool(tmp_path):
+
+    make_tree(tmp_path)
+    ignore = lambda path, is_directory: path == "./ignored"
+    expected = build_manifest(str(tmp_path), None, ignore)
+
+    # the parallel scan builds the same manifest, the hashes are handed over as they are computed
+    pool = ScanPool(workers=3)
+    cache = HashCache()
+    found = {}
+    manifest = pool.build_manifest(str(tmp_path), cache, ignore, lambda path, digest: found.__setitem__(path, digest))
+    assert manifest.digest == expected.digest
+    assert len(found) == 201 and found["./big.bin"] == expected.files["big.bin"]
+    assert "./ignored/a.log" not in found and "./link.bin" not in found
+
+    # the cached hashes are reused
+    (tmp_path / "dir0" / "sub0" / "file0.log").write_bytes(b"changed")
+    manifest = pool.build_manifest(str(tmp_path), cache, ignore)
+    assert manifest.dirs["dir0"].dirs["sub0"].files["file0.log"] == file_digest(str(tmp_path / "dir0" / "sub0" /
+                                                                                  "file0.log"))
+    assert pool.stats()["files"] == 402 and pool.stats()["hashed_files"] == 202
+
+    # files which disappear during the scan are left out
+    with patch("common_pkg.scan.os.lstat", side_effect=FileNotFoundError):
+        assert not pool.build_manifest(str(tmp_path), None, ignore).files
+    pool.close()
+
+
+def test_broken_hashing_process(tmp_path):
+
+    make_tree(tmp_path)
+    assert hash_file(str(tmp_path / "big.bin"), True) == file_digest(str(tmp_path / "big.bin"))
+
+    # the batch of a hashing process which died is hashed again with plain reads
+    def broken(*args):
+        future = Future()
+        future.set_exception(BrokenProcessPool())
+        return future
+
+    pool = ScanPool(workers=2)
+    pool.hashers = Mock(submit=Mock(side_effect=broken))
+    with patch.object(pool, "start_processes", return_value=pool.threads):
+        manifest = pool.build_manifest(str(tmp_path))
+
+    assert manifest.digest == build_manifest(str(tmp_path)).digest
+    assert pool.hashers is pool.threads
+    pool.close()
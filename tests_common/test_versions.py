@@ -0,0 +1,60 @@
+import os
+from pytest import raises
+from common_pkg.echo import EchoFilter
+from common_pkg.framing import ProtocolError
+from common_pkg.versions import compare, conflict_path, decode_vector, encode_vector, increment, merge, AFTER, BEFORE, \
+    CONCURRENT, EQUAL
+
+
+def test_version_vectors():
+
+    base = increment({}, "server")
+    alice = increment(base, "alice")
+    bob = increment(base, "bob")
+
+    assert compare(alice, base) == AFTER and compare(base, alice) == BEFORE
+    assert compare(alice, dict(alice)) == EQUAL and compare({}, {}) == EQUAL
+    assert compare(alice, bob) == CONCURRENT
+    assert merge(alice, bob) == {"server": 1, "alice": 1, "bob": 1}
+    assert compare(merge(alice, bob), bob) == AFTER
+
+    assert decode_vector(encode_vector(merge(alice, bob))) == merge(alice, bob)
+    for payload in (b"\xff", b"[1]", b'{"a": -1}', b'{"a": "1"}'):
+        with raises(ProtocolError):
+            decode_vector(payload)
+
+    existing = {"/data/notes (conflict bob).txt", "/data/notes (conflict bob 2).txt"}
+    assert conflict_path("/data/notes.txt", "alice", existing.__contains__) == "/data/notes (conflict alice).txt"
+    assert conflict_path("/data/notes.txt", "bob", existing.__contains__) == "/data/notes (conflict bob 3).txt"
+
+
+def test_echo_filter(tmp_path):
+
+    now = [0.0]
+    echo = EchoFilter(window=2.0, clock=lambda: now[0])
+    path = str(tmp_path / "a.txt")
+
+    # the events of a write are echoes while it's in progress and right after it
+    echo.expect(path, "alice")
+    assert echo.match(path).origin == "alice"
+    (tmp_path / "a.txt").write_bytes(b"pushed")
+    echo.settle(path)
+    assert echo.match(path) is not None
+
+    # a local change made right after the write isn't
+    (tmp_path / "a.txt").write_bytes(b"local change")
+    assert echo.match(path) is None
+
+    # nor is an event arriving after the window
+    echo.expect(path)
+    echo.settle(path)
+    now[0] = 3.0
+    assert echo.match(path) is None
+
+    # the content of a deleted folder is deleted with it
+    (tmp_path / "dir").mkdir()
+    echo.expect(str(tmp_path / "dir"))
+    os.rmdir(tmp_path / "dir")
+    echo.settle(str(tmp_path / "dir"))
+    assert echo.match(str(tmp_path / "dir" / "b.txt")) is not None
+    assert echo.echoes == 3
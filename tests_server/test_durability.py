@@ -0,0 +1,75 @@
+import os
+from unittest.mock import patch
+from twisted.internet import defer
+from twisted.internet.task import Clock
+from server_pkg.durability import GroupCommit
+from server_pkg.executor import PathExecutor
+
+
+def test_group_commit(tmp_path):
+
+    clock = Clock()
+    commits = GroupCommit(PathExecutor(0), str(tmp_path), interval=0.01, max_bytes=100, clock=clock)
+    (tmp_path / "dir").mkdir()
+    (tmp_path / "dir" / "a.log").write_bytes(b"a")
+    (tmp_path / "b.log").write_bytes(b"b")
+
+    with patch("server_pkg.durability.os.fsync") as fsync_mock:
+
+        # nothing to wait for
+        assert commits.wait().called
+
+        # the changes wait for others until the interval is over, then are synced together
+        commits.written(str(tmp_path / "dir" / "a.log"), 1, parents=True)
+        commits.written(str(tmp_path / "b.log"), 1)
+        d = commits.wait()
+        assert not d.called and fsync_mock.call_count == 0
+
+        clock.advance(0.01)
+        assert d.called and commits.commits == 1
+        assert fsync_mock.call_count == 4, "The files, their folder and the sync folder must be synced"
+
+        # a file moved before the commit is synced at its new path, the deleted ones are skipped
+        commits.written(str(tmp_path / "b.log"), 1)
+        commits.written(str(tmp_path / "c.log"), 1)
+        commits.moved(str(tmp_path / "b.log"), str(tmp_path / "dir" / "b.log"))
+        (tmp_path / "b.log").rename(tmp_path / "dir" / "b.log")
+        assert commits.files == {str(tmp_path / "dir" / "b.log"), str(tmp_path / "c.log")}
+        clock.advance(0.01)
+        assert fsync_mock.call_count == 7
+
+        # writing enough bytes starts a commit right away
+        commits.written(str(tmp_path / "dir" / "a.log"), 100)
+        d = commits.wait()
+        clock.advance(0)
+        assert d.called and commits.commits == 3
+
+
+def test_commit_ordering(tmp_path):
+
+    clock = Clock()
+    executor = PathExecutor(0)
+    commits = GroupCommit(executor, str(tmp_path), interval=0.01, clock=clock)
+    (tmp_path / "a.log").write_bytes(b"a")
+    commits.written(str(tmp_path / "a.log"), 1)
+
+    # a rename of the written file, submitted for another client before the commit and still being applied
+    renamed = defer.Deferred()
+
+    def rename():
+        (tmp_path / "a.log").rename(tmp_path / "b.log")
+        commits.moved(str(tmp_path / "a.log"), str(tmp_path / "b.log"))
+
+    renamed.addCallback(lambda _: rename())
+    executor.submit([str(tmp_path / "a.log"), str(tmp_path / "b.log")], lambda: renamed, owner="other")
+
+    with patch("server_pkg.durability.os.fsync") as fsync_mock, \
+            patch("server_pkg.durability.os.open", wraps=os.open) as open_mock:
+        d = commits.wait()
+        clock.advance(0.01)
+        assert not d.called and fsync_mock.call_count == 0, "The commit must wait for the rename"
+
+        # the file is synced at its new path once renamed
+        renamed.callback(None)
+        assert d.called and commits.commits == 1
+        assert [call[0][0] for call in open_mock.call_args_list] == [str(tmp_path / "b.log"), str(tmp_path)]
@@ -0,0 +1,97 @@
+from unittest.mock import Mock
+from server_pkg.executor import PathExecutor, ancestors
+
+
+def test_ancestors():
+
+    assert ancestors("./a/b/c.log") == ["./a/b/c.log", "./a/b", "./a", "."]
+    assert ancestors(".") == ["."]
+
+
+def test_synchronous_executor():
+
+    executor = PathExecutor(workers=0)
+
+    results = []
+    executor.submit(["./a"], results.append, 1).addCallback(results.append)
+    assert results == [1, None]
+
+    failures = []
+    executor.submit(["./a"], Mock(side_effect=OSError("test"))).addErrback(failures.append)
+    assert len(failures) == 1
+
+    metrics = executor.metrics()
+    assert metrics["applied"] == 2 and metrics["failed"] == 1 and metrics["queued"] == metrics["running"] == 0
+    assert not executor.latest and not executor.active_below
+
+
+def test_path_ordering():
+
+    executor = PathExecutor(workers=0)
+
+    # record the started operations instead of applying them, so that their completion can be controlled
+    started = []
+    executor.run = lambda operation: (started.append(operation), setattr(executor, "running", executor.running + 1))
+
+    def submit(*paths):
+        executor.submit(list(paths), Mock())
+        return executor.latest[paths[0]]
+
+    def finish(operation):
+        executor.finished(None, operation)
+
+    write_a = submit("./dir/a.log")
+    write_b = submit("./dir/b.log")
+    write_other = submit("./other/c.log")
+    assert started == [write_a, write_b, write_other], "Unrelated paths must be applied in parallel"
+
+    # same path, descendants and ancestors wait for earlier operations
+    write_a_again = submit("./dir/a.log")
+    delete_dir = submit("./dir")
+    create_in_dir = submit("./dir/new/d.log")
+    move = submit("./other/c.log", "./dir/e.log")
+    unrelated = submit("./third/f.log")
+    assert started == [write_a, write_b, write_other, unrelated]
+    assert executor.metrics()["queued"] == 4 and executor.depth == 8
+
+    finish(write_a)
+    assert started[-1] is write_a_again
+
+    finish(write_b)
+    finish(write_a_again)
+    assert started[-1] is delete_dir, "Directory operation must wait for all operations inside it"
+
+    finish(write_other)
+    finish(delete_dir)
+    assert started[-2:] == [create_in_dir, move]
+
+    for operation in (unrelated, create_in_dir, move):
+        finish(operation)
+    assert executor.depth == 0
+    assert not executor.latest and not executor.active_below
+
+
+def test_fair_scheduling():
+
+    executor = PathExecutor(workers=0)
+    executor.pool = Mock()  # pretend there is a single worker thread
+    executor.workers = 1
+
+    started = []
+    executor.run = lambda operation: (started.append(operation), setattr(executor, "running", executor.running + 1))
+
+    # a client with a big backlog submits first
+    for i in range(3):
+        executor.submit([f"/a/{i}"], Mock(), owner="a")
+    executor.submit(["/b/0"], Mock(), owner="b")
+    executor.submit(["/c/0"], Mock(), owner="c")
+    assert executor.pending("a") == 3 and executor.pending("b") == 1
+    assert executor.metrics()["waiting"] == 4 and executor.depth == 5
+
+    # the first operation started straight away, the others take turns
+    while len(started) < 5:
+        executor.finished(None, started[-1])
+    assert [operation.owner for operation in started] == ["a", "a", "b", "c", "a"], "Clients must take turns"
+
+    executor.finished(None, started[-1])
+    assert executor.depth == 0 and executor.pending("a") == 0
@@ -1,7 +1,23 @@
-from unittest.mock import patch, MagicMock
+import io
+import os
+import time
+from unittest.mock import patch
 from pytest import fixture
+from twisted.internet.task import Clock
 from twisted.test.proto_helpers import StringTransport
-from server_pkg.protocol import create_server, SyncFactory
+from server_pkg.protocol import create_server, SyncFactory, MAX_CONNECTIONS, FEATURES, KEEP_BOTH, SCAN_WORKERS
+from server_pkg.executor import WORKERS
+from server_pkg.transfer import STAGING_TTL
+from common_pkg.framing import encode_frame, encode_hello_line, encode_hello_frame, MSG_CREATED, MSG_MODIFIED, \
+    MSG_MOVED, MSG_CHUNK, MSG_SIGNATURE_REQUEST, MSG_SIGNATURE, MSG_DELTA, MSG_CONTENT_OFFER, MSG_CONTENT_REPLY, \
+    MSG_TREE_REQUEST, MSG_TREE, MSG_ACK_REQUEST, MSG_ACK, MSG_OPERATION, MSG_BATCH, MSG_DELETED, SEQUENCE, decode_hello, \
+    MSG_VERSION, encode_batch, FLAG_DIRECTORY, FLAG_FIRST, FLAG_LAST, FLAG_COMPRESSED, FLAG_ABORT, HEADER, FrameDecoder, \
+    Frame
+from common_pkg.compression import ZlibCodec
+from common_pkg.manifest import build_manifest, decode_listing, DIRECTORY
+from common_pkg.content import content_hasher, encode_offer, encode_resume, CONTENT_MATERIALISED, CONTENT_NEEDED
+from common_pkg.delta import DeltaEncoder, decode_signature, empty_signature
+from common_pkg.versions import decode_vector, encode_vector
 
 
 @patch("server_pkg.protocol.reactor")
@@ -12,7 +28,8 @@ def test_connect(endpoint_mock, factory_mock, reactor_mock):
     reactor = create_server("/var/log", 9999)
 
     endpoint_mock.assert_called_once_with(reactor_mock, 9999)
-    factory_mock.assert_called_once_with("/var/log")
+    factory_mock.assert_called_once_with("/var/log", WORKERS, "multi", MAX_CONNECTIONS, False, False, KEEP_BOTH,
+                                         SCAN_WORKERS, None)
     endpoint_mock.return_value.listen.assert_called_once_with(factory_mock.return_value)
 
     assert reactor == reactor_mock, "Incorrect reactor reference returned"
@@ -91,16 +108,500 @@ def test_moved_event(os_mock, shutil_mock, setup_connection):
     shutil_mock.move.assert_called_with("/var/log/tests.log", "/var/log/testing.log")
 
 
-@patch("server_pkg.protocol.open")
-def test_modify_event(open_mock, setup_connection):
+@patch("server_pkg.protocol.IncomingTransfer")
+def test_modify_event(transfer_mock, setup_connection):
 
     factory, protocol, transport1 = setup_connection
 
-    fh = MagicMock()
-    open_mock.return_value = fh
+    # the content is written to a temporary file renamed into place
     protocol.lineReceived(b"modified::0::./tests.log::Test content.")
-    open_mock.assert_called_with("/var/log/tests.log", "wb")
-    fh.__enter__.return_value.write.assert_called_with(b"Test content.")
+    transfer_mock.assert_called_with("/var/log/tests.log", store=factory.store, commits=None)
+    transfer_mock.return_value.write.assert_called_with(b"Test content.", None)
+    transfer_mock.return_value.commit.assert_called_once()
+
+
+@patch("server_pkg.protocol.shutil")
+@patch("server_pkg.protocol.IncomingTransfer")
+@patch("server_pkg.protocol.os")
+def test_binary_protocol(os_mock, transfer_mock, shutil_mock):
+
+    factory = SyncFactory("/var/log")
+    protocol = factory.buildProtocol("127.0.0.1")
+    transport = StringTransport()
+    protocol.makeConnection(transport)
+
+    # the hello line and the first frames may arrive in the same packet
+    protocol.dataReceived(encode_hello_line() + encode_frame(MSG_CREATED, FLAG_DIRECTORY, b"./tests"))
+    assert transport.value() == encode_hello_frame(features=FEATURES), "Server must accept the binary wire format"
+    os_mock.makedirs.assert_called_with("/var/log/tests", exist_ok=True)
+
+    # content containing the old delimiter and separator, delivered byte by byte
+    frame = encode_frame(MSG_MODIFIED, 0, b"./tests.log", b"Test::content\r\r\r\n\n\n.")
+    for i in range(len(frame)):
+        protocol.dataReceived(frame[i:i + 1])
+    transfer_mock.assert_called_once_with("/var/log/tests.log", store=factory.store, commits=None)
+    transfer_mock.return_value.write.assert_called_with(b"Test::content\r\r\r\n\n\n.", None)
+
+    os_mock.path.exists.return_value = True
+    protocol.dataReceived(encode_frame(MSG_MOVED, 0, b"./tests.log", b"./testing.log"))
+    shutil_mock.move.assert_called_with("/var/log/tests.log", "/var/log/testing.log")
+
+    # a frame with an unknown version breaks the protocol
+    protocol.dataReceived(HEADER.pack(99, MSG_CREATED, 0, 0, 0))
+    assert transport.disconnecting, "Connection must be closed on protocol violations"
+
+
+def test_multiple_clients(tmp_path):
+
+    factory = SyncFactory(str(tmp_path), mode="multi", max_connections=3, client_roots=True)
+
+    def connect(hello=None):
+        protocol = factory.buildProtocol("127.0.0.1")
+        transport = StringTransport()
+        protocol.makeConnection(transport)
+        if hello is not None:
+            protocol.dataReceived(hello)
+        return protocol, transport
+
+    # each client is mapped to its own root, unless it asks for a shared one
+    alice, alice_transport = connect(encode_hello_line(client_id="alice"))
+    bob, _ = connect(encode_hello_line(client_id="bob", root="team"))
+    legacy, _ = connect(b"created::1::./tests\r\r\r\n\n\n")
+    alice.dataReceived(encode_frame(MSG_MODIFIED, 0, b"./test.log", b"alice"))
+    bob.dataReceived(encode_frame(MSG_MODIFIED, 0, b"./test.log", b"bob"))
+    assert (tmp_path / "alice" / "test.log").read_bytes() == b"alice"
+    assert (tmp_path / "team" / "test.log").read_bytes() == b"bob"
+    assert (tmp_path / "default" / "tests").is_dir(), "Legacy clients must use the default root"
+    assert alice.session.messages_received == 1 and factory.connections == 3
+
+    # the connection cap is enforced
+    _, transport = connect()
+    assert transport.disconnected and factory.connections == 3
+
+    # a root escaping the sync folder is refused
+    legacy.connectionLost("test reason")
+    protocol, transport = connect(encode_hello_line(client_id="mallory", root=".."))
+    assert transport.disconnecting and protocol.session is None
+
+    # a client connecting again replaces its previous connection
+    protocol.connectionLost("test reason")
+    alice2, _ = connect(encode_hello_line(client_id="alice"))
+    assert alice_transport.disconnected and factory.clients["alice"] is alice2
+    alice.connectionLost("test reason")
+    assert factory.clients["alice"] is alice2 and factory.connections == 2
+
+
+def test_path_escaping_root(tmp_path):
+
+    factory = SyncFactory(str(tmp_path), client_roots=True)
+    protocol = factory.buildProtocol("127.0.0.1")
+    transport = StringTransport()
+    protocol.makeConnection(transport)
+    protocol.dataReceived(encode_hello_line(client_id="alice"))
+    (tmp_path / "bob").mkdir()
+
+    # events whose path resolves outside of the root of the client, or isn't valid UTF-8, are dropped before anything
+    # is submitted
+    with patch.object(factory.executor, "submit", wraps=factory.executor.submit) as submit:
+        protocol.dataReceived(encode_frame(MSG_MODIFIED, 0, b"./../bob/evil.txt", b"evil"))
+        protocol.dataReceived(encode_frame(MSG_MODIFIED, 0, b"./../../escaped.txt", b"evil"))
+        protocol.dataReceived(encode_frame(MSG_MOVED, 0, b"./a.txt", b"./../bob/moved.txt"))
+        protocol.dataReceived(encode_frame(MSG_MODIFIED, 0, b"./invalid\xff.txt", b"evil"))
+        protocol.dataReceived(encode_frame(MSG_MOVED, 0, b"./a.txt", b"./\xc3.txt"))
+        protocol.dataReceived(encode_frame(MSG_BATCH, 0, b"", encode_batch([
+            Frame(MSG_CREATED, 0, b"./sub/../../bob/batch.txt", b""),
+            Frame(MSG_MODIFIED, 0, b"./sub/../ok.txt", b"ok")
+        ])))
+    assert not (tmp_path / "bob" / "evil.txt").exists() and not (tmp_path.parent / "escaped.txt").exists()
+    assert not (tmp_path / "bob" / "moved.txt").exists() and not (tmp_path / "bob" / "batch.txt").exists()
+    assert not transport.disconnecting
+
+    # paths staying inside of the root are applied
+    assert submit.call_count == 1 and (tmp_path / "alice" / "ok.txt").read_bytes() == b"ok"
+
+
+def test_chunked_transfer(tmp_path):
+
+    factory = SyncFactory(str(tmp_path))
+    protocol = factory.buildProtocol("127.0.0.1")
+    protocol.makeConnection(StringTransport())
+    protocol.dataReceived(encode_hello_line())
+
+    target = tmp_path / "dir" / "test.log"
+    target.parent.mkdir()
+    target.write_bytes(b"old content")
+    os.chmod(str(target), 0o640)
+
+    protocol.dataReceived(encode_frame(MSG_CHUNK, FLAG_FIRST, b"./dir/test.log", b"new "))
+    protocol.dataReceived(encode_frame(MSG_CHUNK, 0, b"./dir/test.log", b"content "))
+
+    # the destination is untouched until the last chunk arrives
+    assert target.read_bytes() == b"old content"
+    assert len(list(target.parent.iterdir())) == 2
+
+    protocol.dataReceived(encode_frame(MSG_CHUNK, FLAG_LAST, b"./dir/test.log", b"streamed"))
+    assert target.read_bytes() == b"new content streamed"
+    assert os.stat(str(target)).st_mode & 0o777 == 0o640, "Permissions of the replaced file must be kept"
+    assert [p.name for p in target.parent.iterdir()] == ["test.log"], "Temporary file must be renamed into place"
+
+    # a single chunk transfer of a file in a missing folder
+    protocol.dataReceived(encode_frame(MSG_CHUNK, FLAG_FIRST | FLAG_LAST, b"./new/empty.log", b""))
+    assert (tmp_path / "new" / "empty.log").read_bytes() == b""
+
+    # chunks without a transfer in progress are ignored
+    protocol.dataReceived(encode_frame(MSG_CHUNK, FLAG_LAST, b"./other.log", b"data"))
+    assert not (tmp_path / "other.log").exists()
+
+    # an aborted transfer is discarded, the destination is untouched
+    protocol.dataReceived(encode_frame(MSG_CHUNK, FLAG_FIRST, b"./dir/test.log", b"trunc\0\0\0"))
+    protocol.dataReceived(encode_frame(MSG_CHUNK, FLAG_ABORT, b"./dir/test.log", b""))
+    assert target.read_bytes() == b"new content streamed"
+    assert [p.name for p in target.parent.iterdir()] == ["test.log"] and not protocol.transfers
+
+    # incomplete transfers are removed when the connection is lost
+    protocol.dataReceived(encode_frame(MSG_CHUNK, FLAG_FIRST, b"./dir/test.log", b"partial"))
+    protocol.connectionLost("test reason")
+    assert target.read_bytes() == b"new content streamed"
+    assert [p.name for p in target.parent.iterdir()] == ["test.log"]
+
+
+def test_delta_transfer(tmp_path):
+
+    factory = SyncFactory(str(tmp_path))
+    protocol = factory.buildProtocol("127.0.0.1")
+    transport = StringTransport()
+    protocol.makeConnection(transport)
+    protocol.dataReceived(encode_hello_line())
+    transport.clear()
+
+    old_content = os.urandom(8192)
+    new_content = old_content[:3000] + b"changed" + old_content[3000:]
+    (tmp_path / "test.bin").write_bytes(old_content)
+
+    # signature of the existing copy
+    protocol.dataReceived(encode_frame(MSG_SIGNATURE_REQUEST, 0, b"./test.bin"))
+    [frame] = FrameDecoder().feed(transport.value())
+    assert frame.msg_type == MSG_SIGNATURE and frame.path == b"./test.bin"
+    assert len(decode_signature(frame.payload)[1]) == 4
+    transport.clear()
+
+    payloads = [payload for payload in DeltaEncoder(frame.payload, io.BytesIO(new_content), 1024) if payload]
+    for i, payload in enumerate(payloads):
+        flags = (FLAG_FIRST if i == 0 else 0) | (FLAG_LAST if i == len(payloads) - 1 else 0)
+        protocol.dataReceived(encode_frame(MSG_DELTA, flags, b"./test.bin", payload))
+    assert (tmp_path / "test.bin").read_bytes() == new_content
+    assert [p.name for p in tmp_path.iterdir()] == ["test.bin"]
+
+    # signature of a missing file
+    protocol.dataReceived(encode_frame(MSG_SIGNATURE_REQUEST, 0, b"./missing.bin"))
+    assert FrameDecoder().feed(transport.value())[0].payload == empty_signature()
+
+    # invalid delta - the existing copy is kept
+    protocol.dataReceived(encode_frame(MSG_DELTA, FLAG_FIRST | FLAG_LAST, b"./test.bin", b"invalid"))
+    assert (tmp_path / "test.bin").read_bytes() == new_content
+    assert [p.name for p in tmp_path.iterdir()] == ["test.bin"]
+
+
+def test_content_offer(tmp_path):
+
+    factory = SyncFactory(str(tmp_path))
+    factory.store.min_size = 0
+    protocol = factory.buildProtocol("127.0.0.1")
+    transport = StringTransport()
+    protocol.makeConnection(transport)
+    protocol.dataReceived(encode_hello_line())
+    transport.clear()
+
+    content = os.urandom(4096)
+    hasher = content_hasher()
+    hasher.update(content)
+    offer = encode_offer(hasher.digest(), len(content))
+
+    # unknown content must be sent
+    protocol.dataReceived(encode_frame(MSG_CONTENT_OFFER, 0, b"./a.bin", offer))
+    assert FrameDecoder().feed(transport.value()) == [Frame(MSG_CONTENT_REPLY, 0, b"./a.bin", CONTENT_NEEDED)]
+    transport.clear()
+
+    # received files are added to the store
+    protocol.dataReceived(encode_frame(MSG_CHUNK, FLAG_FIRST | FLAG_LAST, b"./a.bin", content))
+
+    # the same content at another path is put in place without a transfer
+    protocol.dataReceived(encode_frame(MSG_CONTENT_OFFER, 0, b"./dir/b.bin", offer))
+    assert FrameDecoder().feed(transport.value()) == [Frame(MSG_CONTENT_REPLY, 0, b"./dir/b.bin", CONTENT_MATERIALISED)]
+    assert (tmp_path / "dir" / "b.bin").read_bytes() == content
+    transport.clear()
+
+    # a file linked to the store is never modified in place
+    protocol.dataReceived(encode_frame(MSG_MODIFIED, 0, b"./a.bin", b"new content"))
+    assert (tmp_path / "a.bin").read_bytes() == b"new content"
+    assert (tmp_path / "dir" / "b.bin").read_bytes() == content
+
+    protocol.dataReceived(encode_frame(MSG_CONTENT_OFFER, 0, b"./c.bin", b"invalid"))
+    assert FrameDecoder().feed(transport.value()) == [Frame(MSG_CONTENT_REPLY, 0, b"./c.bin", CONTENT_NEEDED)]
+
+
+def test_compressed_payloads(tmp_path):
+
+    factory = SyncFactory(str(tmp_path), mode="multi")
+    protocol = factory.buildProtocol("127.0.0.1")
+    transport = StringTransport()
+    protocol.makeConnection(transport)
+    protocol.dataReceived(encode_hello_line(compression=["unknown", "zlib"]))
+    assert transport.value() == encode_hello_frame(features=FEATURES, compression="zlib")
+
+    text = b"compressible line of text\n" * 1000
+    compressed = ZlibCodec().compress(text)
+
+    protocol.dataReceived(encode_frame(MSG_MODIFIED, FLAG_COMPRESSED, b"./a.log", compressed))
+    assert (tmp_path / "a.log").read_bytes() == text
+
+    protocol.dataReceived(encode_frame(MSG_CHUNK, FLAG_FIRST | FLAG_COMPRESSED, b"./b.log", compressed))
+    protocol.dataReceived(encode_frame(MSG_CHUNK, FLAG_LAST, b"./b.log", b"raw"))
+    assert (tmp_path / "b.log").read_bytes() == text + b"raw"
+
+    # a corrupted payload leaves the file untouched
+    protocol.dataReceived(encode_frame(MSG_MODIFIED, FLAG_COMPRESSED, b"./a.log", compressed[:100]))
+    assert (tmp_path / "a.log").read_bytes() == text
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["a.log", "b.log"]
+
+    assert protocol.session.stats()["compression"]["raw_bytes"] == 2 * len(text)
+
+    # compressed payloads without a negotiated codec break the protocol
+    protocol = factory.buildProtocol("127.0.0.1")
+    transport = StringTransport()
+    protocol.makeConnection(transport)
+    protocol.dataReceived(encode_hello_line() + encode_frame(MSG_MODIFIED, FLAG_COMPRESSED, b"./a.log", compressed))
+    assert transport.disconnecting and (tmp_path / "a.log").read_bytes() == text
+
+
+def test_tree_request(tmp_path):
+
+    factory = SyncFactory(str(tmp_path))
+    protocol = factory.buildProtocol("127.0.0.1")
+    transport = StringTransport()
+    protocol.makeConnection(transport)
+    protocol.dataReceived(encode_hello_line())
+    transport.clear()
+
+    (tmp_path / "dir").mkdir()
+    (tmp_path / "dir" / "a.log").write_bytes(b"a")
+    (tmp_path / ".syncstore").mkdir()
+    (tmp_path / ".b.log.1234.synctmp").write_bytes(b"partial")
+    manifest = build_manifest(str(tmp_path / "dir"))
+
+    # the listing of a differing directory, without the files used by the server itself
+    protocol.dataReceived(encode_frame(MSG_TREE_REQUEST, 0, b".", b"client hash"))
+    [frame] = FrameDecoder().feed(transport.value())
+    assert frame.msg_type == MSG_TREE and frame.path == b"."
+    assert decode_listing(frame.payload[32:], 32) == {"dir": (DIRECTORY, manifest.digest)}
+    transport.clear()
+
+    # only the hash of a matching directory
+    protocol.dataReceived(encode_frame(MSG_TREE_REQUEST, 0, b"./dir", manifest.digest))
+    assert FrameDecoder().feed(transport.value()) == [Frame(MSG_TREE, 0, b"./dir", manifest.digest)]
+    transport.clear()
+
+    protocol.dataReceived(encode_frame(MSG_TREE_REQUEST, 0, b"./missing", b"client hash"))
+    assert len(FrameDecoder().feed(transport.value())[0].payload) == 32
+
+
+def test_ack_request(tmp_path):
+
+    factory = SyncFactory(str(tmp_path))
+    protocol = factory.buildProtocol("127.0.0.1")
+    transport = StringTransport()
+    protocol.makeConnection(transport)
+    protocol.dataReceived(encode_hello_line())
+    transport.clear()
+
+    # the acknowledgement is sent once the earlier operations have been applied
+    protocol.dataReceived(encode_frame(MSG_CREATED, FLAG_DIRECTORY, b"./dir") +
+                          encode_frame(MSG_ACK_REQUEST, 0, b"", SEQUENCE.pack(7)))
+    assert FrameDecoder().feed(transport.value()) == [Frame(MSG_ACK, 0, b"", SEQUENCE.pack(7))]
+    assert (tmp_path / "dir").is_dir()
+
+
+def test_durable_ack(tmp_path):
+
+    clock = Clock()
+    factory = SyncFactory(str(tmp_path), mode="multi", commit_interval=0.01)
+    factory.commits.clock = clock
+    protocol = factory.buildProtocol("127.0.0.1")
+    transport = StringTransport()
+    protocol.makeConnection(transport)
+    protocol.dataReceived(encode_hello_line(client_id="alice", resume=True))
+    transport.clear()
+
+    with patch("server_pkg.durability.os.fsync") as fsync_mock:
+
+        # the operation is applied, but neither acknowledged nor a resume point until its changes are durable
+        protocol.dataReceived(encode_frame(MSG_OPERATION, 0, b"", SEQUENCE.pack(1)) +
+                              encode_frame(MSG_MODIFIED, 0, b"./a.log", b"content") +
+                              encode_frame(MSG_ACK_REQUEST, 0, b"", SEQUENCE.pack(1)))
+        assert (tmp_path / "a.log").read_bytes() == b"content"
+        assert transport.value() == b"" and "alice" not in factory.resume_points
+
+        clock.advance(0.01)
+        assert FrameDecoder().feed(transport.value()) == [Frame(MSG_ACK, 0, b"", SEQUENCE.pack(1))]
+        assert factory.resume_points["alice"] == 1
+        assert fsync_mock.call_count == 2, "The file and the sync folder must be synced"
+
+
+def test_resume(tmp_path):
+
+    factory = SyncFactory(str(tmp_path), mode="multi")
+    factory.startFactory()
+
+    def connect():
+        protocol = factory.buildProtocol("127.0.0.1")
+        transport = StringTransport()
+        protocol.makeConnection(transport)
+        protocol.dataReceived(encode_hello_line(client_id="alice", resume=True))
+        [hello] = FrameDecoder().feed(transport.value())
+        transport.clear()
+        return protocol, transport, decode_hello(hello.payload)
+
+    protocol, transport, hello = connect()
+    assert hello["resume"] == 0 and "resume" in hello["features"]
+
+    # an operation is applied once the messages of the next one start
+    protocol.dataReceived(encode_frame(MSG_OPERATION, 0, b"", SEQUENCE.pack(4)) +
+                          encode_frame(MSG_CREATED, FLAG_DIRECTORY, b"./dir") +
+                          encode_frame(MSG_OPERATION, 0, b"", SEQUENCE.pack(5)) +
+                          encode_frame(MSG_CREATED, 0, b"./dir/a.log"))
+    assert protocol.session.applied == 4
+    protocol.connectionLost("test")
+
+    # the client resumes after the last operation the server has applied, even after a restart
+    protocol, transport, hello = connect()
+    assert hello["resume"] == 4
+    factory.stopFactory()
+
+    factory = SyncFactory(str(tmp_path), mode="multi")
+    factory.startFactory()
+    protocol, transport, hello = connect()
+    assert hello["resume"] == 4
+    factory.stopFactory()
+
+
+def test_batch(tmp_path):
+
+    factory = SyncFactory(str(tmp_path))
+    protocol = factory.buildProtocol("127.0.0.1")
+    transport = StringTransport()
+    protocol.makeConnection(transport)
+    protocol.dataReceived(encode_hello_line(client_id="alice", resume=True))
+    transport.clear()
+    (tmp_path / "old.log").write_bytes(b"old")
+
+    protocol.dataReceived(encode_frame(MSG_BATCH, 0, b"", encode_batch([
+        Frame(MSG_OPERATION, 0, b"", SEQUENCE.pack(1)),
+        Frame(MSG_MODIFIED, 0, b"./dir/sub/a.log", b"a"),
+        Frame(MSG_OPERATION, 0, b"", SEQUENCE.pack(2)),
+        Frame(MSG_CREATED, FLAG_DIRECTORY, b"./dir", b""),
+        Frame(MSG_OPERATION, 0, b"", SEQUENCE.pack(3)),
+        Frame(MSG_MOVED, 0, b"./dir/sub/a.log", b"./dir/b.log"),
+        Frame(MSG_OPERATION, 0, b"", SEQUENCE.pack(4)),
+        Frame(MSG_CREATED, 0, b"./dir/sub/a.log", b""),
+        Frame(MSG_MODIFIED, 0, b"./dir/sub/a.log", b"new a"),
+        Frame(MSG_DELETED, 0, b"./old.log", b""),
+        Frame(MSG_ACK_REQUEST, 0, b"", SEQUENCE.pack(4))
+    ])))
+
+    # the operations are applied in order, the acknowledgement is sent once they have all been applied
+    assert (tmp_path / "dir" / "b.log").read_bytes() == b"a"
+    assert (tmp_path / "dir" / "sub" / "a.log").read_bytes() == b"new a"
+    assert not (tmp_path / "old.log").exists()
+    assert FrameDecoder().feed(transport.value()) == [Frame(MSG_ACK, 0, b"", SEQUENCE.pack(4))]
+    assert protocol.session.applied == 4
+
+    # batches may only carry operations
+    protocol.dataReceived(encode_frame(MSG_BATCH, 0, b"", encode_batch([
+        Frame(MSG_CREATED, 0, b"./c.log", b""),
+        Frame(MSG_BATCH, 0, b"", b"")
+    ])))
+    assert transport.disconnecting
+    assert not (tmp_path / "c.log").exists()
+
+
+def test_streams(tmp_path):
+
+    factory = SyncFactory(str(tmp_path))
+    protocol = factory.buildProtocol("127.0.0.1")
+    transport = StringTransport()
+    protocol.makeConnection(transport)
+    protocol.dataReceived(encode_hello_line(client_id="alice", resume=True))
+    assert "streams" in decode_hello(FrameDecoder().feed(transport.value())[0].payload)["features"]
+    transport.clear()
+
+    # a streamed file belongs to the operation it started in, the messages of later operations are interleaved with it
+    protocol.dataReceived(encode_frame(MSG_OPERATION, 0, b"", SEQUENCE.pack(1)) +
+                          encode_frame(MSG_CHUNK, FLAG_FIRST, b"./big.bin", b"ab") +
+                          encode_frame(MSG_OPERATION, 0, b"", SEQUENCE.pack(2)) +
+                          encode_frame(MSG_CREATED, 0, b"./a.log") +
+                          encode_frame(MSG_ACK_REQUEST, 0, b"", SEQUENCE.pack(2)))
+    assert (tmp_path / "a.log").exists()
+
+    # the acknowledgement waits for the file
+    assert protocol.session.applied == 0
+    assert transport.value() == b""
+
+    protocol.dataReceived(encode_frame(MSG_CHUNK, FLAG_LAST, b"./big.bin", b"c"))
+    assert (tmp_path / "big.bin").read_bytes() == b"abc"
+    assert protocol.session.applied == 2
+    assert FrameDecoder().feed(transport.value()) == [Frame(MSG_ACK, 0, b"", SEQUENCE.pack(2))]
+
+
+@patch("server_pkg.transfer.CHECKPOINT_SIZE", 4)
+@patch("server_pkg.protocol.RESUMABLE_MIN_SIZE", 4)
+def test_resumable_transfer(tmp_path):
+
+    factory = SyncFactory(str(tmp_path))
+    content = b"0123456789"
+    hasher = content_hasher()
+    hasher.update(content)
+    offer = encode_frame(MSG_CONTENT_OFFER, 0, b"./big.bin", encode_offer(hasher.digest(), len(content)))
+
+    def connect():
+        protocol = factory.buildProtocol("127.0.0.1")
+        transport = StringTransport()
+        protocol.makeConnection(transport)
+        protocol.dataReceived(encode_hello_line(client_id="alice", resumable=True))
+        transport.clear()
+        return protocol, transport
+
+    # a big file is staged, what has been received is kept when the connection is lost
+    protocol, transport = connect()
+    protocol.dataReceived(offer)
+    assert FrameDecoder().feed(transport.value()) == [Frame(MSG_CONTENT_REPLY, 0, b"./big.bin", encode_resume(0))]
+    protocol.dataReceived(encode_frame(MSG_CHUNK, 0, b"./big.bin", b"012345") +
+                          encode_frame(MSG_CHUNK, 0, b"./big.bin", b"67"))
+    protocol.connectionLost("test")
+    assert not (tmp_path / "big.bin").exists()
+
+    # the client is asked for the rest when it offers the same content again
+    protocol, transport = connect()
+    protocol.dataReceived(offer)
+    assert FrameDecoder().feed(transport.value()) == [Frame(MSG_CONTENT_REPLY, 0, b"./big.bin", encode_resume(8))]
+    protocol.dataReceived(encode_frame(MSG_CHUNK, FLAG_LAST, b"./big.bin", b"89"))
+    assert (tmp_path / "big.bin").read_bytes() == content
+    assert os.listdir(factory.staging.root) == []
+
+    # a resumed transfer which doesn't match the offered content is discarded
+    (tmp_path / "big.bin").unlink()
+    protocol.dataReceived(offer + encode_frame(MSG_CHUNK, 0, b"./big.bin", b"01234"))
+    protocol.connectionLost("test")
+    protocol, transport = connect()
+    protocol.dataReceived(offer + encode_frame(MSG_CHUNK, FLAG_LAST, b"./big.bin", b"xxxxx"))
+    assert not (tmp_path / "big.bin").exists()
+    assert os.listdir(factory.staging.root) == []
+
+    # staged files are removed once their TTL has expired
+    protocol.dataReceived(offer + encode_frame(MSG_CHUNK, 0, b"./big.bin", b"01234"))
+    protocol.connectionLost("test")
+    assert factory.staging.collect() == 0
+    assert factory.staging.collect(time.time() + STAGING_TTL) == 1
+    assert os.listdir(factory.staging.root) == []
 
 
 @fixture(scope='module')
@@ -118,3 +619,57 @@ def setup_connection():
     protocol.makeConnection(transport)
 
     return factory, protocol, transport
+
+
+def test_bidirectional_sync(tmp_path):
+
+    factory = SyncFactory(str(tmp_path), watch=True)
+    protocol = factory.buildProtocol("127.0.0.1")
+    transport = StringTransport()
+    protocol.makeConnection(transport)
+    protocol.dataReceived(encode_hello_line(client_id="alice", resume=True, push=True))
+    assert {"versions", "push"} <= set(decode_hello(FrameDecoder().feed(transport.value())[0].payload)["features"])
+    protocol.push.clock = Clock()
+    transport.clear()
+
+    # a change made on top of the server's copy replaces it
+    (tmp_path / "a.txt").write_bytes(b"server")
+    factory.versions.put(str(tmp_path / "a.txt"), {"server": 1})
+    protocol.dataReceived(encode_frame(MSG_VERSION, 0, b"./a.txt", encode_vector({"server": 1, "alice": 1})) +
+                          encode_frame(MSG_MODIFIED, 0, b"./a.txt", b"alice"))
+    assert (tmp_path / "a.txt").read_bytes() == b"alice"
+    assert factory.versions.get(str(tmp_path / "a.txt")) == {"server": 1, "alice": 1}
+
+    # a concurrent change keeps the server's copy aside, both copies are pushed back
+    (tmp_path / "a.txt").write_bytes(b"server again")
+    factory.local_change("modified", False, str(tmp_path / "a.txt"))
+    protocol.dataReceived(encode_frame(MSG_VERSION, 0, b"./a.txt", encode_vector({"server": 1, "alice": 2})) +
+                          encode_frame(MSG_MODIFIED, 0, b"./a.txt", b"alice again"))
+    assert (tmp_path / "a.txt").read_bytes() == b"alice again"
+    assert (tmp_path / "a (conflict server).txt").read_bytes() == b"server again"
+    assert factory.conflicts == 1
+
+    # a deletion of an older version is dropped, the server's copy is pushed instead
+    protocol.dataReceived(encode_frame(MSG_VERSION, 0, b"./a.txt", encode_vector({"server": 1, "alice": 1})) +
+                          encode_frame(MSG_DELETED, 0, b"./a.txt"))
+    assert (tmp_path / "a.txt").exists()
+
+    transport.clear()
+    protocol.push.pump()
+    frames = FrameDecoder().feed(transport.value())
+    assert [(frame.msg_type, frame.path) for frame in frames] == [(MSG_VERSION, b"./a.txt"), (MSG_CHUNK, b"./a.txt")]
+    assert decode_vector(frames[0].payload) == factory.versions.get(str(tmp_path / "a.txt"))
+    assert frames[1] == Frame(MSG_CHUNK, FLAG_FIRST | FLAG_LAST, b"./a.txt", b"alice again")
+
+    # the versions of the files below a deleted folder and of a file replaced by a move are pushed ahead of them
+    factory.versions.put(str(tmp_path / "dir" / "b.txt"), {"server": 1})
+    factory.local_change("deleted", True, str(tmp_path / "dir"))
+    factory.local_change("moved", False, str(tmp_path / "a.txt"), str(tmp_path / "c.txt"))
+    transport.clear()
+    protocol.push.pump()
+    frames = FrameDecoder().feed(transport.value())
+    assert [(frame.msg_type, frame.path) for frame in frames] == [
+        (MSG_VERSION, b"./dir/b.txt"), (MSG_DELETED, b"./dir"), (MSG_VERSION, b"./c.txt"), (MSG_MOVED, b"./a.txt")]
+    assert decode_vector(frames[0].payload) == {"server": 1}
+    assert decode_vector(frames[2].payload) == factory.versions.get(str(tmp_path / "c.txt"))
+    factory.versions.close()
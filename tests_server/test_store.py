@@ -0,0 +1,56 @@
+import os
+from server_pkg.store import ContentStore
+from common_pkg.content import content_hasher
+
+
+def digest_of(content):
+
+    hasher = content_hasher()
+    hasher.update(content)
+    return hasher.digest()
+
+
+def test_content_store(tmp_path):
+
+    store = ContentStore(str(tmp_path), min_size=4)
+    content = b"some content"
+    digest = digest_of(content)
+
+    (tmp_path / "a.log").write_bytes(content)
+    (tmp_path / "small.log").write_bytes(b"abc")
+    store.add(str(tmp_path / "a.log"), digest, len(content))
+    store.add(str(tmp_path / "small.log"), digest_of(b"abc"), 3)
+    assert os.path.samefile(store.blob_path(digest), str(tmp_path / "a.log"))
+    assert not os.path.exists(store.blob_path(digest_of(b"abc"))), "Small files mustn't be added"
+
+    # the same content is put in place at another path
+    assert store.materialise(digest, len(content), str(tmp_path / "dir" / "b.log"))
+    assert (tmp_path / "dir" / "b.log").read_bytes() == content
+    assert store.materialise(digest, len(content), str(tmp_path / "a.log")), "Linked file is already in place"
+    assert not store.materialise(digest_of(b"other"), 5, str(tmp_path / "c.log"))
+    assert sorted(p.name for p in tmp_path.iterdir()) == [".syncstore", "a.log", "dir", "small.log"]
+
+    # the files sharing the content don't share an inode, a file written in place leaves the others and the blob alone
+    with open(str(tmp_path / "dir" / "b.log"), "r+b") as fh:
+        fh.write(b"SOME")
+    with open(store.blob_path(digest), "rb") as fh:
+        assert fh.read() == content and (tmp_path / "a.log").read_bytes() == content
+    assert store.materialise(digest, len(content), str(tmp_path / "dir" / "b.log"))
+    assert (tmp_path / "dir" / "b.log").read_bytes() == content
+
+    # a file about to be written in place no longer shares its content with the blob
+    store.detach(str(tmp_path / "a.log"))
+    assert (tmp_path / "a.log").read_bytes() == b"" and (tmp_path / "dir" / "b.log").read_bytes() == content
+
+    # a blob modified in place is detected and removed
+    (tmp_path / "d.log").write_bytes(b"other content")
+    store.add(str(tmp_path / "d.log"), digest_of(b"other content"), 13)
+    with open(str(tmp_path / "d.log"), "r+b") as fh:
+        fh.write(b"OTHER")
+    assert not store.materialise(digest_of(b"other content"), 13, str(tmp_path / "e.log"))
+    assert not os.path.exists(store.blob_path(digest_of(b"other content")))
+
+    # blobs no longer linked to any file are collected
+    (tmp_path / "dir" / "b.log").unlink()
+    assert store.collect() == 1
+    assert not os.path.exists(store.blob_path(digest))